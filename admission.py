@@ -0,0 +1,386 @@
+"""Priority-aware admission control: under overload, shed the least important requests first.
+
+AdmissionControl wraps the WSGI app. Every route belongs to a tier:
+
+* critical    - booking and auth; never shed for the sake of another tier;
+* normal      - pages and dashboards (anything not listed elsewhere);
+* best_effort - AI chat, exports, reports, live streams.
+
+A request is answered with an immediate 503 (and Retry-After) instead of
+being run when
+
+* concurrency: its tier and every less important one together already
+  hold SHARES[tier] of this process's request slots (CAPACITY: gunicorn
+  threads or greenlets). Best-effort work can never take more than half
+  the slots, so booking and login always find one free. Critical requests
+  have no share: the server never hands a worker more than it has slots;
+* latency: its own tier, or a more important one, is over its latency
+  target. Like CoDel, a tier is over target when even the fastest of its
+  requests in the last INTERVAL took longer than TARGETS[tier] (queue
+  delay plus time to the response), i.e. there is a standing queue rather
+  than one slow request. Critical requests are not shed this way;
+* queue_delay: the request already waited longer than MAX_QUEUE_DELAY
+  before reaching the app, whatever its tier; its client has most likely
+  given up.
+
+Queue delay is time spent before a worker picked the request up. It is
+only visible when the proxy in front stamps requests, as nginx does with
+`proxy_set_header X-Request-Start "t=${msec}";`; without the header it
+counts as zero and the latency signal is the app's own time to respond.
+
+Decisions are per process. Counters, in-flight gauges and histograms of
+queue delay and latency per tier are flushed every FLUSH_INTERVAL seconds,
+by a background thread so no request waits on it, to a small SQLite file
+shared by the workers (like ratelimit.db). metrics() renders their sum over
+all workers in the Prometheus text format.
+
+A worker's rows are keyed by its pid and start time, so a new worker that
+gets a dead one's pid never overwrites its numbers. When a worker exits,
+retire() folds its counters into one row for retired workers and drops
+the rest, so the totals never go backwards and the table stays as small
+as the set of live workers. clear() empties the file when a new server
+starts.
+"""
+import bisect
+import os
+import sqlite3
+import threading
+import time
+
+from werkzeug.exceptions import HTTPException
+
+
+METRICS_DB = os.getenv("ADMISSION_METRICS_DB", "metrics.db")
+ENABLED = os.getenv("ADMISSION_ENABLED", "1") == "1"
+
+# Most important first.
+TIERS = ("critical", "normal", "best_effort")
+TARGETS = {
+    "critical": float(os.getenv("ADMISSION_TARGET_CRITICAL_MS", "500")) / 1000,
+    "normal": float(os.getenv("ADMISSION_TARGET_NORMAL_MS", "2000")) / 1000,
+    "best_effort": float(os.getenv("ADMISSION_TARGET_BEST_EFFORT_MS", "15000")) / 1000,
+}
+# Share of the request slots a tier may hold together with every less important tier.
+SHARES = {"normal": 0.75, "best_effort": 0.5}
+CAPACITY = int(os.getenv("ADMISSION_CAPACITY", "8"))
+INTERVAL = 1.0
+MAX_QUEUE_DELAY = float(os.getenv("ADMISSION_MAX_QUEUE_DELAY", "10"))
+RETRY_AFTER = 2
+FLUSH_INTERVAL = 1.0
+# A worker that has not flushed for this long is gone; its gauges no longer count.
+STALE_AFTER = 10.0
+GAUGES = ("admission_inflight", "admission_over_target", "admission_standing_latency_seconds")
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+REASONS = ("concurrency", "latency", "queue_delay")
+SHED_BODY = b'{"success": false, "error": "Server busy, please retry shortly"}'
+
+
+def queue_delay(environ, now):
+    """Seconds since the proxy's X-Request-Start stamp ("t=<seconds, ms or us since the epoch>"), or 0."""
+    stamp = environ.get("HTTP_X_REQUEST_START", "")
+    try:
+        started = float(stamp[2:] if stamp.startswith("t=") else stamp)
+    except ValueError:
+        return 0.0
+    while started > now * 10:
+        started /= 1000
+    return max(0.0, now - started)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+
+class TierState:
+    def __init__(self):
+        self.inflight = 0
+        self.admitted = 0
+        self.shed = dict.fromkeys(REASONS, 0)
+        self.queue_delay = Histogram()
+        self.latency = Histogram()
+        # CoDel-style: the lowest latency seen in the current interval, and whether the last full one was over target.
+        self.interval_min = None
+        self.over_target = False
+        self.standing = 0.0
+
+
+class AdmissionControl:
+    def __init__(self, wsgi_app, url_map, tiers, capacity=CAPACITY, metrics_path=METRICS_DB, enabled=ENABLED):
+        """`tiers` maps endpoint names to a tier or None (never shed, not counted); others are normal."""
+        self.wsgi_app = wsgi_app
+        self.url_map = url_map
+        self.tiers = tiers
+        self.capacity = capacity
+        self.metrics_path = metrics_path
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        stop = getattr(self, "_stop", None)
+        if stop is not None:
+            stop.set()
+        self._pid = os.getpid()
+        self._started = time.time()
+        self._state = {tier: TierState() for tier in TIERS}
+        self._interval_end = time.monotonic() + INTERVAL
+        self._conn = None
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _ensure_flusher(self):
+        # Threads do not survive fork; _admit resets the state of a new process first.
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._flush_loop, args=(self._stop,),
+                                            name="admission-metrics", daemon=True)
+            self._thread.start()
+
+    def _flush_loop(self, stop):
+        while not stop.wait(FLUSH_INTERVAL):
+            self.flush()
+
+    def close(self):
+        """Stop the flush thread and write the final numbers (gunicorn's worker_exit)."""
+        if self._pid != os.getpid():
+            return
+        self._stop.set()
+        self.flush()
+
+    def classify(self, environ):
+        try:
+            endpoint, _ = self.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            # 404/405: cheap to answer, nothing to protect.
+            return None
+        return self.tiers.get(endpoint, "normal")
+
+    def __call__(self, environ, start_response):
+        tier = self.classify(environ) if self.enabled else None
+        if tier is None:
+            return self.wsgi_app(environ, start_response)
+
+        delay = queue_delay(environ, time.time())
+        reason = self._admit(tier, delay)
+        if reason:
+            start_response("503 Service Unavailable", [
+                ("Content-Type", "application/json"), ("Content-Length", str(len(SHED_BODY))),
+                ("Retry-After", str(RETRY_AFTER)),
+            ])
+            return [SHED_BODY]
+
+        t0 = time.perf_counter()
+        try:
+            return self.wsgi_app(environ, start_response)
+        finally:
+            # In flight until the response is built, not until its body is sent: an open slot event
+            # stream or a long export would otherwise hold a slot for as long as the client stays.
+            self._observe(tier, delay + time.perf_counter() - t0)
+            self._release(tier)
+
+    def _admit(self, tier, delay):
+        """The reason to shed this request, or None after counting it in flight."""
+        with self._lock:
+            if self._pid != os.getpid():
+                self.reset()
+            self._ensure_flusher()
+            self._roll_interval()
+            state = self._state[tier]
+            rank = TIERS.index(tier)
+
+            reason = None
+            if delay > MAX_QUEUE_DELAY:
+                reason = "queue_delay"
+            elif tier != "critical" and \
+                    sum(self._state[t].inflight for t in TIERS[rank:]) >= max(1, int(SHARES[tier] * self.capacity)):
+                reason = "concurrency"
+            elif tier != "critical" and any(self._state[t].over_target for t in TIERS[:rank + 1]):
+                reason = "latency"
+
+            if reason:
+                state.shed[reason] += 1
+                return reason
+            state.inflight += 1
+            state.admitted += 1
+            state.queue_delay.observe(delay)
+            return None
+
+    def _observe(self, tier, latency):
+        with self._lock:
+            state = self._state[tier]
+            state.latency.observe(latency)
+            if state.interval_min is None or latency < state.interval_min:
+                state.interval_min = latency
+
+    def _release(self, tier):
+        with self._lock:
+            if self._pid == os.getpid():
+                self._state[tier].inflight -= 1
+
+    def _roll_interval(self):
+        now = time.monotonic()
+        if now < self._interval_end:
+            return
+        # An interval without a completed request says nothing new, and clears the flag so the tier gets probed again.
+        for tier, state in self._state.items():
+            state.standing = state.interval_min or 0.0
+            state.over_target = state.interval_min is not None and state.interval_min > TARGETS[tier]
+            state.interval_min = None
+        self._interval_end = now + INTERVAL
+
+    def stats(self):
+        """This process's view, for debugging: in flight, admitted, shed and state per tier."""
+        with self._lock:
+            return {"capacity": self.capacity, "tiers": {
+                tier: {"inflight": s.inflight, "admitted": s.admitted, "shed": dict(s.shed),
+                       "over_target": s.over_target, "standing_latency_s": s.standing,
+                       "target_s": TARGETS[tier]}
+                for tier, s in self._state.items()}}
+
+    # ---- metrics shared across workers ----
+
+    def _metrics_conn(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.metrics_path, timeout=0.2, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Metrics are disposable; losing the last flush on a crash is harmless.
+            conn.execute("PRAGMA synchronous=OFF")
+            columns = {r[1] for r in conn.execute("PRAGMA table_info(admission_metrics)")}
+            if columns and "started" not in columns:
+                # Keyed by pid alone before; disposable, so start over.
+                conn.execute("DROP TABLE admission_metrics")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS admission_metrics (
+                    pid INTEGER NOT NULL,
+                    started REAL NOT NULL,
+                    name TEXT NOT NULL,
+                    labels TEXT NOT NULL,
+                    value REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (pid, started, name, labels)
+                ) WITHOUT ROWID
+            """)
+            self._conn = conn
+        return self._conn
+
+    def _series(self):
+        """(name, labels, value) of every series, as of now, for this process."""
+        rows = []
+        with self._lock:
+            for tier, s in self._state.items():
+                label = f'tier="{tier}"'
+                rows += [("admission_requests_total", label, s.admitted),
+                         ("admission_inflight", label, s.inflight),
+                         ("admission_over_target", label, int(s.over_target)),
+                         ("admission_standing_latency_seconds", label, s.standing)]
+                rows += [("admission_shed_total", f'{label},reason="{r}"', n) for r, n in s.shed.items()]
+                for name, hist in (("admission_queue_delay_seconds", s.queue_delay),
+                                   ("admission_latency_seconds", s.latency)):
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS + ("+Inf",), hist.counts):
+                        cumulative += count
+                        rows.append((f"{name}_bucket", f'{label},le="{bound}"', cumulative))
+                    rows += [(f"{name}_count", label, cumulative), (f"{name}_sum", label, hist.sum)]
+        return rows
+
+    def flush(self):
+        """Write this process's series; runs on the flush thread, at exit and before metrics()."""
+        with self._flush_lock:
+            try:
+                now = time.time()
+                conn = self._metrics_conn()
+                with conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    conn.executemany("""
+                        INSERT INTO admission_metrics (pid, started, name, labels, value, updated_at)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                        ON CONFLICT (pid, started, name, labels)
+                        DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+                    """, [(self._pid, self._started, name, labels, value, now)
+                          for name, labels, value in self._series()])
+            except sqlite3.Error as e:
+                # Metrics must never fail a request.
+                print("Admission metrics flush failed:", e)
+
+    def retire(self, pids):
+        """Fold the counters of exited workers `pids` into the retired row (pid 0) and drop their rows."""
+        pids = [int(p) for p in pids]
+        if not pids:
+            return
+        marks = ",".join("?" for _ in pids)
+        gauges = ",".join("?" for _ in GAUGES)
+        try:
+            conn = self._metrics_conn()
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute(f"""
+                    INSERT INTO admission_metrics (pid, started, name, labels, value, updated_at)
+                    SELECT 0, 0, name, labels, TOTAL(value), MAX(updated_at) FROM admission_metrics
+                    WHERE pid IN ({marks}) AND name NOT IN ({gauges})
+                    GROUP BY name, labels
+                    ON CONFLICT (pid, started, name, labels)
+                    DO UPDATE SET value = value + excluded.value, updated_at = excluded.updated_at
+                """, (*pids, *GAUGES))
+                conn.execute(f"DELETE FROM admission_metrics WHERE pid IN ({marks})", pids)
+        except sqlite3.Error as e:
+            print("Admission metrics retire failed:", e)
+
+    def clear(self):
+        """Forget every worker's series; a new server starts counting from zero (gunicorn's on_starting)."""
+        try:
+            self._metrics_conn().execute("DELETE FROM admission_metrics")
+        except sqlite3.Error as e:
+            print("Admission metrics clear failed:", e)
+
+    def metrics(self):
+        """All workers' series in the Prometheus text format. Counters are summed over every worker
+        that has flushed; gauges only over those that flushed recently (the live ones)."""
+        self.flush()
+        fresh = time.time() - STALE_AFTER
+        rows = self._metrics_conn().execute(f"""
+            SELECT name, labels,
+                   CASE WHEN name IN ({",".join("?" for _ in GAUGES)})
+                        THEN TOTAL(value) FILTER (WHERE updated_at >= ?) ELSE TOTAL(value) END
+            FROM admission_metrics GROUP BY name, labels
+        """, (*GAUGES, fresh)).fetchall()
+
+        lines, typed = [], set()
+        for name, labels, value in sorted(rows, key=_series_order):
+            family = _family(name)
+            if family not in typed:
+                lines.append(f"# TYPE {family} {KINDS[family]}")
+                typed.add(family)
+            lines.append(f"{name}{{{labels}}} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+KINDS = {
+    "admission_requests_total": "counter",
+    "admission_shed_total": "counter",
+    "admission_inflight": "gauge",
+    "admission_over_target": "gauge",
+    "admission_standing_latency_seconds": "gauge",
+    "admission_queue_delay_seconds": "histogram",
+    "admission_latency_seconds": "histogram",
+}
+
+
+def _family(name):
+    for suffix in ("_bucket", "_count", "_sum"):
+        if name.endswith(suffix) and KINDS.get(name[:-len(suffix)]) == "histogram":
+            return name[:-len(suffix)]
+    return name
+
+
+def _series_order(row):
+    # Histogram buckets in ascending order of their bound, +Inf last.
+    name, labels, _ = row
+    bound = labels.rsplit('le="', 1)[1].rstrip('"') if 'le="' in labels else "0"
+    return _family(name), name, labels.split(",le=")[0], float(bound)
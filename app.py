@@ -1,46 +1,279 @@
-from flask import Flask, request, redirect, url_for, session, render_template, flash, jsonify
+from flask import Flask, request, redirect, url_for, session, render_template, flash, jsonify, Response
 from datetime import date, timedelta, datetime
+import csv
+import io
 import json
 import sqlite3
 import hashlib
 import os
-from openai import OpenAI
+import threading
+import time
 from dotenv import load_dotenv
-load_dotenv()
+import ratelimit
+from ratelimit import TokenBucketLimiter
+import jobs
+import admission
+import archive
+import audit
+import clinical
+import conversations
+import doctorload
+import exports
+import faq
+import fuzzy
+import livefeed
+import pagecache
+import refcache
+import rollups
+import schedule
+import slotmaps
+from dbwriter import SerializedWriter, WriteTimeout
+from repositories import Repositories, IntegrityError, DatabaseError, create_backend
 
 
 app = Flask(__name__)
 app.secret_key = 'a_very_secret_and_complex_key_for_hospital_app'
-DATABASE_NAME = 'hospital.db'
+DATABASE_NAME = os.getenv("DATABASE_NAME", 'hospital.db')
 
 # ===================== AI CONFIG (GEMMA 3N) =====================
-print("API KEY FOUND:", os.getenv("OPENROUTER_API_KEY") is not None)
-
-client = OpenAI(
-    api_key=os.getenv("OPENROUTER_API_KEY"),
-    base_url="https://openrouter.ai/api/v1",
-    default_headers={
-        "HTTP-Referer": "http://localhost:5000",
-        "X-Title": "Hospital Management AI"
-    }
-)
+# The openai SDK (and its httpx client) is imported on the first AI request,
+# not at app import, so workers that never serve AI traffic skip it entirely.
+_ai_client = None
+_ai_client_lock = threading.Lock()
+
+
+def get_ai_client():
+    global _ai_client
+    if _ai_client is None:
+        with _ai_client_lock:
+            if _ai_client is None:
+                from openai import OpenAI
+
+                _ai_client = OpenAI(
+                    api_key=app.config.get("OPENROUTER_API_KEY") or os.getenv("OPENROUTER_API_KEY"),
+                    base_url=app.config.get("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1"),
+                    default_headers={
+                        "HTTP-Referer": "http://localhost:5000",
+                        "X-Title": "Hospital Management AI"
+                    }
+                )
+    return _ai_client
+
+# Common questions answered from faq.json without an upstream call (see faq.py).
+faq_index = faq.FaqIndex()
 
 # ===============================================================
 
+# ===================== RATE LIMITS =====================
+# (rate in tokens per second, burst)
+LOGIN_LIMIT_PER_IP = (5 / 60, 10)
+LOGIN_LIMIT_PER_USER = (5 / 60, 5)
+LOGIN_LIMIT_GLOBAL = (50, 100)
+AI_LIMIT_PER_USER = (6 / 60, 3)
+AI_LIMIT_PER_IP = (20 / 60, 10)
+AI_LIMIT_GLOBAL = (5, 10)
+
+# Multiplies every rate and burst above; load tests raise it so the limits don't shape the result.
+RATE_LIMIT_SCALE = float(os.getenv("RATE_LIMIT_SCALE", "1"))
+
+limiter = TokenBucketLimiter()
+
+
+def check_rate_limits(scope, **keys):
+    limits = {
+        "login": {"ip": LOGIN_LIMIT_PER_IP, "user": LOGIN_LIMIT_PER_USER, "global": LOGIN_LIMIT_GLOBAL},
+        "ai": {"ip": AI_LIMIT_PER_IP, "user": AI_LIMIT_PER_USER, "global": AI_LIMIT_GLOBAL},
+    }[scope]
+
+    rules = [(f"{scope}:global", *limits["global"])]
+    for kind, value in keys.items():
+        # Usernames come straight from the form; bound what they can add to the bucket table.
+        value = value and ratelimit.key_part(value)
+        if value:
+            rules.append((f"{scope}:{kind}:{value}", *limits[kind]))
+    if RATE_LIMIT_SCALE != 1:
+        rules = [(key, rate * RATE_LIMIT_SCALE, burst * RATE_LIMIT_SCALE) for key, rate, burst in rules]
+
+    allowed, retry_after = limiter.hit(rules)
+    return None if allowed else max(1, int(retry_after + 0.999))
+
+
+def schedule_limiter_purge(delay=ratelimit.PURGE_INTERVAL_SECONDS):
+    # One attempt: a failed run is retried by the next one, which its finally has already queued.
+    return job_queue.enqueue("purge_rate_limits", priority=-10, delay=delay, max_attempts=1, unique=True)
+
+
+@jobs.task("purge_rate_limits")
+def purge_rate_limits_job(payload):
+    try:
+        return {"purged": limiter.purge()}
+    finally:
+        schedule_limiter_purge()
+
+
+def audit_event(action, entity_type, entity_id=None, **details):
+    """Record who did what to which entity; buffered, so it never lengthens the write it follows."""
+    audit_log.record(action, entity_type, entity_id, actor_id=session.get('user_id'),
+                     actor_role=session.get('user_role'), details=details, ip=request.remote_addr)
+
+# =======================================================
+
+# ===================== ADMISSION CONTROL =====================
+# Under overload the least important requests get a fast 503 first (see admission.py).
+# Endpoints not listed are normal: pages and dashboards.
+ADMISSION_TIERS = {
+    # Booking and auth.
+    "login": "critical",
+    "logout": "critical",
+    "register": "critical",
+    "patient_book_slot": "critical",
+    "appointments_batch": "critical",
+    "doctor_day_slots": "critical",
+    "patientdoctoravailability": "critical",
+    "record_visit": "critical",
+    "record_visits_batch": "critical",
+    # Slow or optional: AI, exports, reports, live updates.
+    "ai_chat": "best_effort",
+    "ai_conversations": "best_effort",
+    "ai_conversation": "best_effort",
+    "job_status": "best_effort",
+    "admin_export": "best_effort",
+    "admin_utilisation_report": "best_effort",
+    "doctor_slot_events": "best_effort",
+    # Never shed.
+    "static": None,
+    "metrics": None,
+}
+admission_control = admission.AdmissionControl(app.wsgi_app, app.url_map, ADMISSION_TIERS)
+app.wsgi_app = admission_control
+
+# =======================================================
+
 def get_db_connection():
     conn = sqlite3.connect(DATABASE_NAME)
     conn.row_factory = sqlite3.Row
     return conn
 
 
+def configure_storage(database_name):
+    global DATABASE_NAME, db_writer, job_queue, repo, reference, slot_feed, page_cache, audit_log, name_index
+    DATABASE_NAME = database_name
+    # All request-path writes go through this one thread per process (see dbwriter.py).
+    db_writer = SerializedWriter(DATABASE_NAME)
+    job_queue = jobs.JobQueue(DATABASE_NAME, db_writer)
+    # Route data access; DB_BACKEND=postgres switches engines (see repositories.py).
+    repo = Repositories(create_backend(db_writer, DATABASE_NAME))
+    # Departments, doctor roster and patient list, reloaded only when their table changes.
+    reference = refcache.ReferenceCache(repo.backend, {
+        "departments": ("departments", repo.departments.list_summary),
+        "department_names": ("departments", repo.departments.list_names),
+        "doctors": ("doctors", repo.doctors.list_summary),
+        "patients": ("patients", repo.patients.list_summary),
+    })
+    # Slot changes pushed to open availability pages (see livefeed.py).
+    slot_feed = livefeed.ChangeBroker(DATABASE_NAME)
+    # Rendered availability pages; slot changes from any worker invalidate them (see pagecache.py).
+    page_cache = pagecache.PageCache()
+    slot_feed.add_listener(page_cache.on_change)
+    # Compliance trail, buffered and written to its own file next to the database (see audit.py).
+    audit_log = audit.AuditLog(os.path.join(os.path.dirname(database_name), audit.AUDIT_DATABASE_NAME))
+    # Typo-tolerant typeahead over doctor, patient and department names (see fuzzy.py).
+    name_index = fuzzy.NameDirectory(repo.backend, fetch_names)
+
+
+def fetch_names(kind, ids=None):
+    return {"doctor": repo.doctors, "patient": repo.patients, "department": repo.departments}[kind].names(ids)
+
+
+# Nothing here opens a connection or starts a thread; that happens on first use.
+configure_storage(DATABASE_NAME)
+
+
+@app.errorhandler(WriteTimeout)
+def write_timeout(e):
+    # The write is still queued and may yet commit; the client should retry shortly.
+    headers = {"Retry-After": "2"}
+    if request.is_json or request.accept_mimetypes.best == "application/json":
+        return jsonify({"success": False, "error": "Server busy, please retry shortly"}), 503, headers
+    return "Server busy, please retry shortly", 503, headers
+
+
+def reset_after_fork():
+    """Drop per-process resources inherited from the gunicorn master."""
+    global _ai_client
+    db_writer.reset()
+    job_queue.reset()
+    limiter.reset()
+    repo.reset()
+    reference.reset()
+    slot_feed.reset()
+    page_cache.reset()
+    audit_log.reset()
+    faq_index.reset()
+    name_index.reset()
+    admission_control.reset()
+    _ai_client = None
+
+
+def create_app(config=None):
+    load_dotenv()
+    app.config.from_mapping(
+        DATABASE_NAME=os.getenv("DATABASE_NAME", DATABASE_NAME),
+        OPENROUTER_API_KEY=os.getenv("OPENROUTER_API_KEY"),
+        OPENROUTER_BASE_URL=os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1"),
+    )
+    if os.getenv("SECRET_KEY"):
+        app.secret_key = os.getenv("SECRET_KEY")
+    if config:
+        app.config.update(config)
+
+    if app.config["DATABASE_NAME"] != DATABASE_NAME:
+        configure_storage(app.config["DATABASE_NAME"])
+    if not app.config["OPENROUTER_API_KEY"]:
+        app.logger.warning("OPENROUTER_API_KEY is not set; /ai/chat will fail")
+    return app
+
+
+@app.cli.command("init-db")
+def init_db_command():
+    init_db()
+
+
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
 
 # ===================== DATABASE INIT =====================
+# Bump when init_db gains tables, columns or indexes.
+SCHEMA_VERSION = 13
+
+
 def init_db():
+    """Create or upgrade the schema. Cheap no-op once the database is current."""
+    if repo.backend.name == "postgres":
+        repo.backend.init_schema()
+        if repo.users.count() == 0:
+            repo.write(lambda tx: repo.users.create(tx, 'admin@123', hash_password('admin@123'), 'admin'))
+
+        def slots(tx):
+            schedule.seed_defaults(tx)
+            schedule.compile_slots(tx, bitmaps=False)
+
+        repo.write(slots)
+        return
+
     conn = get_db_connection()
+    conn.isolation_level = None
     cursor = conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+
+    # Every process that starts may call this; the first to take the write lock
+    # migrates and the others see the new user_version and return.
+    cursor.execute("BEGIN IMMEDIATE")
+    if cursor.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+        cursor.execute("ROLLBACK")
+        conn.close()
+        return
 
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS users (
@@ -85,7 +318,7 @@ def init_db():
 
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS appointments (
-            id INTEGER PRIMARY KEY,
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
             patient_name TEXT,
             patient_id INTEGER,
             doctor_name TEXT,
@@ -108,7 +341,11 @@ def init_db():
             tests_done TEXT,
             diagnosis TEXT,
             prescription TEXT,
-            medicines TEXT
+            medicines TEXT,
+            appointment_id INTEGER,
+            doctor_id INTEGER,
+            visit_date TEXT,
+            created_at TEXT
         );
     """)
 
@@ -123,104 +360,221 @@ def init_db():
         );
     """)
 
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            owner TEXT NOT NULL,
+            key TEXT NOT NULL,
+            request_hash TEXT NOT NULL,
+            status_code INTEGER NOT NULL,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (owner, key)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_created ON idempotency_keys(created_at)")
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_appt_doctor_date ON appointments(doctor_id, date, slot)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_visits_patient ON visits(patient_name, visit_no)")
+
+    # Older databases predate the blacklisted column on patients.
+    patient_cols = {r["name"] for r in cursor.execute("PRAGMA table_info(patients)")}
+    if "blacklisted" not in patient_cols:
+        cursor.execute("ALTER TABLE patients ADD COLUMN blacklisted INTEGER DEFAULT 0")
+
+    # Archived appointments keep their ids; older databases could hand them out again.
+    archive.ensure_autoincrement(conn, "appointments")
+
+    # Visits recorded through the app link back to their appointment.
+    visit_cols = {r["name"] for r in cursor.execute("PRAGMA table_info(visits)")}
+    for column, kind in (("appointment_id", "INTEGER"), ("doctor_id", "INTEGER"), ("visit_date", "TEXT"),
+                         ("created_at", "TEXT")):
+        if column not in visit_cols:
+            cursor.execute(f"ALTER TABLE visits ADD COLUMN {column} {kind}")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_visits_appointment ON visits(appointment_id)")
+
+    # Next visit_no per patient; topped up from visits loaded out of band.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS visit_counters (
+            patient_name TEXT PRIMARY KEY,
+            last_visit_no INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        INSERT INTO visit_counters (patient_name, last_visit_no)
+        SELECT patient_name, MAX(visit_no) FROM visits
+        WHERE patient_name IS NOT NULL AND visit_no IS NOT NULL GROUP BY patient_name
+        ON CONFLICT (patient_name) DO UPDATE
+            SET last_visit_no = max(visit_counters.last_visit_no, excluded.last_visit_no)
+    """)
+
+    jobs.init_schema(conn)
+    archive.init_schema(conn)
+    refcache.init_schema(conn)
+    schedule.init_schema(conn)
+    slotmaps.init_schema(conn)
+    rollups.init_schema(conn)
+    doctorload.init_schema(conn)
+    livefeed.init_schema(conn)
+    clinical.init_schema(conn)
+    conversations.init_schema(conn)
+    fuzzy.init_schema(conn)
+    schedule.compile_slots(conn)
+    doctorload.refresh(conn)
+
     if cursor.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0:
         cursor.execute(
             "INSERT INTO users (username, password_hash, role) VALUES (?, ?, ?)",
             ('admin@123', hash_password('admin@123'), 'admin')
         )
 
-    conn.commit()
+    cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    cursor.execute("COMMIT")
     conn.close()
 
 
 def authenticate_user(username, password):
-    conn = get_db_connection()
-    user = conn.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
-    conn.close()
+    user = repo.users.by_username(username)
 
     if user and user['password_hash'] == hash_password(password):
-        return dict(user)
+        return user
     return None
 
 
 def fetch_admin_dashboard_data():
-    conn = get_db_connection()
-    users = conn.execute("SELECT id, username, role FROM users").fetchall()
-    doctors = conn.execute("SELECT id, name, user_id, department, experience, blacklisted FROM doctors").fetchall()
-    patients = conn.execute("SELECT id, name, user_id, blacklisted FROM patients").fetchall()
-    appointments = conn.execute("SELECT sr_no, patient_name, doctor_name, status, department FROM appointments").fetchall()
-    departments = conn.execute("SELECT department_id, name, doctors_registered FROM departments").fetchall()
-    conn.close()
-
     return {
-        'users': [dict(u) for u in users],
-        'doctors': [dict(d) for d in doctors],
-        'patients': [dict(p) for p in patients],
-        'appointments': [dict(a) for a in appointments],
-        'departments': [dict(de) for de in departments]
+        'users': repo.users.list_summary(),
+        'doctors': reference.get("doctors"),
+        'patients': reference.get("patients"),
+        'appointments': repo.appointments.list_summary(),
+        'departments': reference.get("departments")
     }
 
 
-def fetch_doctor_dashboard_data(doctor_name):
-    conn = get_db_connection()
-    appointments = conn.execute(
-        "SELECT sr_no, patient_name, doctor_name, department FROM appointments WHERE doctor_name = ?",
-        (doctor_name,)
-    ).fetchall()
-    patients = conn.execute("SELECT name FROM patients").fetchall()
-    conn.close()
+WORKLIST_PAGE_SIZE = 50
+
+
+def parse_worklist_cursor(value):
+    """"date,slot,id" -> (date, slot, id), or None when absent or malformed."""
+    try:
+        slot_date, slot, row_id = (value or "").split(",")
+        return date.fromisoformat(slot_date).isoformat(), slot, int(row_id)
+    except ValueError:
+        return None
+
+
+def worklist_cursor(row):
+    return f"{row['date']},{row['slot']},{row['id']}"
+
+
+def fetch_doctor_dashboard_data(doctor_id, doctor_name, after=None, before=None):
+    """One page of the doctor's worklist: today and upcoming by default, or
+    older appointments (newest first) when paging back with `before`."""
+    today = date.today().isoformat()
+
+    if before:
+        rows = repo.appointments.past_for_doctor(doctor_id, before, WORKLIST_PAGE_SIZE + 1)
+    else:
+        rows = repo.appointments.upcoming_for_doctor(doctor_id, today, WORKLIST_PAGE_SIZE + 1, after)
+    more = len(rows) > WORKLIST_PAGE_SIZE
+    rows = rows[:WORKLIST_PAGE_SIZE]
 
     return {
         'name': doctor_name,
-        'appointments': [dict(a) for a in appointments],
-        'patients': [dict(p) for p in patients]
+        'view': 'past' if before else 'upcoming',
+        'appointments': rows,
+        'patients': repo.patients.summaries(sorted({r['patient_name'] for r in rows if r['patient_name']})),
+        'total_upcoming': repo.appointments.count_upcoming_for_doctor(doctor_id, today),
+        'next_cursor': worklist_cursor(rows[-1]) if more else None,
+        # Paging back starts just before today's first slot.
+        'earlier_cursor': f"{today},,0",
     }
 
 
-def fetch_patient_dashboard_data(patient_name):
-    conn = get_db_connection()
-    appointments = conn.execute(
-        "SELECT sr_no, patient_name, doctor_name, department FROM appointments WHERE patient_name = ?",
-        (patient_name,)
-    ).fetchall()
-    departments = conn.execute("SELECT department_id, name, doctors_registered FROM departments").fetchall()
-    users = conn.execute("SELECT name FROM patients WHERE username = ?", (patient_name,)).fetchone()
-    last_visit = conn.execute("""
-        SELECT visit_type, diagnosis, prescription
-        FROM visits
-        WHERE patient_name = ?
-        ORDER BY visit_no DESC LIMIT 1
-    """, (patient_name,)).fetchone()
+def session_doctor_id():
+    """The logged-in doctor's id; sessions from before it was stored look it up once."""
+    if 'doctor_id' not in session:
+        doctor = repo.doctors.by_name(session.get('doctor_name'))
+        if not doctor:
+            return None
+        session['doctor_id'] = doctor['id']
+    return session['doctor_id']
 
-    conn.close()
+
+def render_worklist(template):
+    doctor_name = session.get('doctor_name')
+    doctor_id = session_doctor_id()
+    if doctor_id is None:
+        return redirect(url_for('login'))
+
+    data = fetch_doctor_dashboard_data(
+        doctor_id,
+        doctor_name,
+        after=parse_worklist_cursor(request.args.get('after')),
+        before=parse_worklist_cursor(request.args.get('before'))
+    )
+    return render_template(template, doctor={'name': doctor_name}, data=data)
+
+
+def fetch_patient_dashboard_data(patient_name):
+    patient = repo.patients.by_username(patient_name)
 
     return {
-        'name': users['name'],
+        'name': patient['name'],
         'username': patient_name,
-        'appointments': [dict(a) for a in appointments],
-        'last_visit': dict(last_visit) if last_visit else None,
-        'departments': [dict(de) for de in departments]
+        'appointments': repo.appointments.history_for_patient(patient_name),
+        'last_visit': repo.visits.last_for_patient(patient_name),
+        'departments': reference.get("departments")
     }
 
 
 def fetch_patient_history(patient_name):
-    conn = get_db_connection()
     patient_info = {
         'name': patient_name,
         'doctor_name': 'Dr. Alice Smith',
         'department': 'Cardiology'
     }
-    visits = conn.execute("""
-        SELECT visit_no, visit_type, tests_done, diagnosis, prescription, medicines
-        FROM visits WHERE patient_name = ?
-        ORDER BY visit_no DESC
-    """, (patient_name,)).fetchall()
-    conn.close()
-
-    patient_info['visits'] = [dict(v) for v in visits]
+    patient_info['visits'] = repo.visits.for_patient(patient_name)
     return patient_info
 
 
+AI_MODEL = "google/gemma-2-9b-it:free"
+AI_SYSTEM_PROMPT = (
+    "You are a medical assistant inside a hospital system. "
+    "Give general health advice only. "
+    "Do not diagnose or prescribe medicines."
+)
+
+
+def complete(messages, max_tokens=300, temperature=0.6):
+    response = get_ai_client().chat.completions.create(
+        model=AI_MODEL,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens
+    )
+
+    # 🔒 SAFETY CHECK
+    if not response or not response.choices:
+        raise Exception("Empty or invalid response from OpenRouter")
+
+    return response.choices[0].message.content.strip()
+
+
+def complete_chat(messages):
+    """complete() for a chat reply, timed for faq_index's upstream statistics."""
+    t0 = time.perf_counter()
+    reply = complete(messages)
+    faq_index.record_upstream(time.perf_counter() - t0)
+    return reply
+
+
+def ask_ai(message):
+    return complete_chat([
+        {"role": "system", "content": AI_SYSTEM_PROMPT},
+        {"role": "user", "content": message}
+    ])
+
+
 @app.route("/", methods=["GET"])
 def home():
     return render_template("home.html")
@@ -229,37 +583,45 @@ def ai_chat():
     if "user_id" not in session:
         return jsonify({"success": False, "error": "Login required"}), 401
 
+    retry_after = check_rate_limits("ai", ip=request.remote_addr, user=session["user_id"])
+    if retry_after:
+        return jsonify({
+            "success": False,
+            "error": "Too many requests, please slow down"
+        }), 429, {"Retry-After": str(retry_after)}
+
     data = request.get_json(silent=True) or {}
     message = data.get("message", "").strip()
 
     if not message:
         return jsonify({"success": False, "error": "Message is required"}), 400
 
-    try:
-        response = client.chat.completions.create(
-            model="google/gemma-2-9b-it:free",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "You are a medical assistant inside a hospital system. "
-                        "Give general health advice only. "
-                        "Do not diagnose or prescribe medicines."
-                    )
-                },
-                {"role": "user", "content": message}
-            ],
-            temperature=0.6,
-            max_tokens=300
-        )
+    conversation = None
+    if data.get("conversation_id") is not None:
+        conversation = repo.conversations.get(data["conversation_id"])
+        if conversation is None or conversation["user_id"] != session["user_id"]:
+            return jsonify({"success": False, "error": "Conversation not found"}), 404
+        if conversations.estimate_tokens(message) > conversations.MESSAGE_MAX_TOKENS:
+            return jsonify({"success": False, "error": "Message is too long"}), 400
+
+    # Follow-ups may lean on earlier turns, so only standalone questions are tried against the FAQ.
+    if opening_message(conversation):
+        reply = faq_index.answer(message)
+        if reply is not None:
+            if conversation:
+                store_turns(conversation["id"], message, reply)
+            return jsonify({"success": True, "reply": reply, "source": "faq"})
+
+    if data.get("async"):
+        payload = {"message": message}
+        if conversation:
+            payload["conversation_id"] = conversation["id"]
+        job_id = job_queue.enqueue("ai_chat", payload, priority=5, max_attempts=3, owner=session["user_id"])
+        return jsonify({"success": True, "job_id": job_id, "status_url": url_for("job_status", job_id=job_id)}), 202
 
-        # 🔒 SAFETY CHECK
-        if not response or not response.choices:
-            raise Exception("Empty or invalid response from OpenRouter")
-
-        reply = response.choices[0].message.content.strip()
-
-        return jsonify({"success": True, "reply": reply})
+    try:
+        reply = converse(conversation, message) if conversation else ask_ai(message)
+        return jsonify({"success": True, "reply": reply, "source": "llm"})
 
     except Exception as e:
         print("OPENROUTER ERROR:", repr(e))
@@ -269,6 +631,140 @@ def ai_chat():
         }), 502
 
 
+@jobs.task("ai_chat")
+def ai_chat_job(payload):
+    if payload.get("conversation_id"):
+        conversation = repo.conversations.get(payload["conversation_id"])
+        if conversation is None:
+            return {"error": "Conversation not found"}
+        return {"reply": converse(conversation, payload["message"])}
+    return {"reply": ask_ai(payload["message"])}
+
+
+# ===================== AI CONVERSATIONS =====================
+# Turns are stored per conversation and each prompt is assembled within
+# conversations.PROMPT_BUDGET tokens (see conversations.py).
+def converse(conversation, message):
+    """Answer `message` within `conversation` and store both turns."""
+    recent = repo.conversations.recent(conversation["id"], conversation["summarized_through"])
+    prompt, _ = conversations.build_prompt(AI_SYSTEM_PROMPT, conversation["summary"], recent, message)
+    reply = complete_chat(prompt)
+    store_turns(conversation["id"], message, reply)
+    return reply
+
+
+def opening_message(conversation):
+    """Whether a message would start its conversation (or has none)."""
+    if conversation is None:
+        return True
+    return not conversation["summary"] and not repo.conversations.recent(conversation["id"], 0, limit=1)
+
+
+def store_turns(conversation_id, message, reply):
+    """Append a question and its reply, requesting a summary once the window overflows."""
+    def store(tx):
+        now = datetime.utcnow().isoformat()
+        repo.conversations.add_messages(tx, conversation_id, [("user", message), ("assistant", reply)], now)
+        current = repo.conversations.get(conversation_id, tx)
+        if time.time() - current["summary_requested_at"] < conversations.SUMMARY_RETRY_SECONDS:
+            return False
+        if not conversations.needs_summary(repo.conversations.recent(
+                conversation_id, current["summarized_through"], tx=tx)):
+            return False
+        repo.conversations.request_summary(tx, conversation_id, time.time())
+        return True
+
+    if repo.write(store):
+        enqueue_summary(conversation_id)
+
+
+def enqueue_summary(conversation_id):
+    return job_queue.enqueue("summarize_conversation", {"conversation_id": conversation_id}, priority=-1,
+                             max_attempts=3)
+
+
+@jobs.task("summarize_conversation")
+def summarize_conversation_job(payload):
+    """Fold the oldest turns that fell out of the window into the summary, one chunk per run."""
+    conversation_id = payload["conversation_id"]
+    conversation = repo.conversations.get(conversation_id)
+    if conversation is None:
+        return {"summarized": 0}
+
+    through = conversation["summarized_through"]
+    recent = repo.conversations.recent(conversation_id, through)
+    older = repo.conversations.between(conversation_id, through, conversations.keep_boundary(recent))
+    chunk = conversations.take_chunk(older)
+    if not chunk:
+        repo.write(lambda tx: repo.conversations.request_summary(tx, conversation_id, 0))
+        return {"summarized": 0}
+
+    summary = conversations.clip_summary(complete(
+        conversations.summary_request(conversation["summary"], chunk),
+        max_tokens=conversations.SUMMARY_MAX_TOKENS, temperature=0.2))
+    # More than one chunk behind: keep the request open and queue the next run.
+    more = len(chunk) < len(older) or len(older) == conversations.WINDOW_LIMIT
+    stored = repo.write(lambda tx: repo.conversations.save_summary(
+        tx, conversation_id, summary, chunk[-1]["id"], through, time.time() if more else 0))
+    if stored and more:
+        enqueue_summary(conversation_id)
+    return {"summarized": len(chunk) if stored else 0}
+
+
+@app.route("/admin/ai/stats")
+def admin_ai_stats():
+    """This worker's FAQ hit rate and lookup latency, and the upstream time the hits saved."""
+    if session.get('user_role') != 'admin':
+        return jsonify({"success": False, "error": "Admin only"}), 403
+    return jsonify({"success": True, "pid": os.getpid(), "faq": faq_index.stats()})
+
+
+@app.route("/ai/conversations", methods=["GET", "POST"])
+def ai_conversations():
+    if "user_id" not in session:
+        return jsonify({"success": False, "error": "Login required"}), 401
+
+    if request.method == "GET":
+        return jsonify({"success": True, "conversations": repo.conversations.for_user(session["user_id"])})
+
+    data = request.get_json(silent=True) or {}
+    title = (data.get("title") or "").strip()[:100] or None
+    user_id = session["user_id"]
+    conversation_id = repo.write(lambda tx: repo.conversations.create(tx, user_id, title, datetime.utcnow().isoformat()))
+    return jsonify({"success": True, "conversation": {"id": conversation_id, "title": title}}), 201
+
+
+@app.route("/ai/conversations/<int:conversation_id>")
+def ai_conversation(conversation_id):
+    """A page of a conversation's messages, oldest first; ?before=<message id> for earlier pages."""
+    if "user_id" not in session:
+        return jsonify({"success": False, "error": "Login required"}), 401
+
+    conversation = repo.conversations.get(conversation_id)
+    if conversation is None or conversation["user_id"] != session["user_id"]:
+        return jsonify({"success": False, "error": "Conversation not found"}), 404
+
+    limit = min(max(request.args.get("limit", 50, type=int), 1), 200)
+    messages = repo.conversations.messages(conversation_id, request.args.get("before", type=int), limit)
+    return jsonify({
+        "success": True,
+        "conversation": {k: conversation[k] for k in ("id", "title", "created_at", "updated_at")},
+        "messages": messages[::-1],
+    })
+
+
+@app.route("/jobs/<int:job_id>")
+def job_status(job_id):
+    if "user_id" not in session:
+        return jsonify({"success": False, "error": "Login required"}), 401
+
+    job = job_queue.get(job_id)
+    if not job or (session.get("user_role") != "admin" and job["owner"] != str(session["user_id"])):
+        return jsonify({"success": False, "error": "Job not found"}), 404
+
+    return jsonify({"success": True, "job": job})
+
+
 @app.route("/ai_assistant")
 def ai_assistant():
     # 🔐 Only logged-in patients can access
@@ -287,6 +783,14 @@ def login():
     if request.method == "POST":
         username = request.form.get("username")
         password = request.form.get("password")
+
+        retry_after = check_rate_limits("login", ip=request.remote_addr, user=username)
+        if retry_after:
+            return render_template(
+                "login.html",
+                error="Too many login attempts. Please try again later."
+            ), 429, {"Retry-After": str(retry_after)}
+
         user = authenticate_user(username, password)
 
         if user:
@@ -298,11 +802,10 @@ def login():
                 return redirect(url_for('admin_home'))
 
             elif user['role'] == 'doctor':
-                conn = get_db_connection()
-                doctor = conn.execute("SELECT name FROM doctors WHERE user_id = ?", (user['id'],)).fetchone()
-                conn.close()
+                doctor = repo.doctors.by_user_id(user['id'])
                 if doctor:
                     session['doctor_name'] = doctor['name']
+                    session['doctor_id'] = doctor['id']
                 return redirect(url_for('doctor_home'))
 
             elif user['role'] == 'patient':
@@ -321,60 +824,89 @@ def register():
         new_password = request.form.get("password")
         new_name = request.form.get("name")
 
-        conn = get_db_connection()
+        password_hash = hash_password(new_password)
+
+        def create_patient(tx):
+            new_user_id = repo.users.create(tx, new_username, password_hash, 'patient')
+            return repo.patients.create(tx, new_username, new_name, new_user_id)
+
         try:
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO users (username, password_hash, role) VALUES (?, ?, ?)",
-                (new_username, hash_password(new_password), 'patient')
-            )
-            new_user_id = cursor.lastrowid
-            cursor.execute("INSERT INTO patients (username, name, user_id) VALUES (?, ?, ?)",
-                           (new_username, new_name, new_user_id))
-            conn.commit()
+            name_index.refresh("patient", [repo.write(create_patient)])
             return redirect(url_for('login'))
 
-        except sqlite3.IntegrityError:
-            conn.close()
+        except IntegrityError:
             return render_template("register.html", error="Username already exists.")
 
-        finally:
-            conn.close()
-
     return render_template("register.html")
 
 
 @app.route("/search")
 def search():
     q = request.args.get("q", "")
-    conn = get_db_connection()
-
-    doctors = conn.execute(
-        "SELECT name, department, experience FROM doctors WHERE name LIKE ? OR department LIKE ?",
-        (f"%{q}%", f"%{q}%")
-    ).fetchall()
-
-    patients = conn.execute(
-        "SELECT name FROM patients WHERE name LIKE ?",
-        (f"%{q}%",)
-    ).fetchall()
-
-    departments = conn.execute(
-        "SELECT name, description FROM departments WHERE name LIKE ?",
-        (f"%{q}%",)
-    ).fetchall()
-
-    conn.close()
 
     return render_template(
         "search_results.html",
         q=q,
-        doctors=doctors,
-        patients=patients,
-        departments=departments
+        doctors=repo.doctors.search(q),
+        patients=repo.patients.search(q),
+        departments=repo.departments.search(q)
     )
 
 
+@app.route("/search/suggest")
+def search_suggest():
+    """Typeahead: ranked, typo-tolerant name matches, e.g. ?q=cardiolgy&kind=doctor,department."""
+    if "user_id" not in session:
+        return jsonify({"success": False, "error": "Login required"}), 401
+
+    q = request.args.get("q", "").strip()
+    kinds = [k for k in request.args.get("kind", "doctor,department").split(",") if k]
+    if any(kind not in fuzzy.KINDS for kind in kinds):
+        return jsonify({"success": False, "error": f"kind must be among {', '.join(fuzzy.KINDS)}"}), 400
+    if "patient" in kinds and session.get('user_role') not in ('admin', 'doctor'):
+        return jsonify({"success": False, "error": "Not allowed"}), 403
+    try:
+        limit = min(max(int(request.args.get("limit", 10)), 1), 50)
+    except ValueError:
+        return jsonify({"success": False, "error": "limit must be a number"}), 400
+
+    suggestions = [
+        {"kind": kind, "id": key, "name": name, "detail": detail, "score": score}
+        for kind in kinds
+        for score, key, name, detail in name_index.search(kind, q, limit)
+    ] if len(q) >= 2 else []
+    suggestions.sort(key=lambda s: -s["score"])
+    return jsonify({"success": True, "suggestions": suggestions[:limit]})
+
+
+@app.route("/metrics")
+def metrics():
+    """Admission control metrics of all workers, in the Prometheus text format.
+
+    Open unless METRICS_TOKEN is set, in which case scrapers send it as a bearer token.
+    """
+    token = os.getenv("METRICS_TOKEN")
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        return Response("Unauthorized\n", status=401, mimetype="text/plain")
+    return Response(admission_control.metrics(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/admin/admission/stats")
+def admin_admission_stats():
+    """This worker's in-flight requests, shed counts and latency state per tier."""
+    if session.get('user_role') != 'admin':
+        return jsonify({"success": False, "error": "Admin only"}), 403
+    return jsonify({"success": True, "pid": os.getpid(), "admission": admission_control.stats()})
+
+
+@app.route("/admin/search/stats")
+def admin_search_stats():
+    """This worker's name index sizes, memory and lookup latency."""
+    if session.get('user_role') != 'admin':
+        return jsonify({"success": False, "error": "Admin only"}), 403
+    return jsonify({"success": True, "pid": os.getpid(), "names": name_index.stats()})
+
+
 @app.route("/adddoctor.html", methods=["GET", "POST"])
 def add_doctor():
     if session.get('user_role') != 'admin':
@@ -385,56 +917,38 @@ def add_doctor():
         username = request.form.get("username")
         specialization = request.form.get("specialization")
         experience = request.form.get("experience")
+        password_hash = hash_password("doctor@123")
+
+        def create_doctor(tx):
+            new_user_id = repo.users.create(tx, username, password_hash, "doctor")
+
+            department_id = repo.departments.id_by_name(specialization, tx)
+            if department_id is None:
+                raise LookupError("Department not found.")
+
+            doctor_id = repo.doctors.create(tx, username, fullname, new_user_id, specialization, experience,
+                                            department_id)
+            repo.departments.add_doctor(tx, department_id)
+            compile_doctor_slots(tx, [doctor_id])
+            return doctor_id
 
-        conn = get_db_connection()
         try:
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO users (username, password_hash, role) VALUES (?, ?, ?)",
-                (username, hash_password("doctor@123"), "doctor")
-            )
-            new_user_id = cursor.lastrowid
-
-            dept_row = cursor.execute(
-                "SELECT department_id FROM departments WHERE name = ?",
-                (specialization,)
-            ).fetchone()
-
-            if not dept_row:
-                conn.rollback()
-                return render_template("adddoctor.html", error="Department not found.", action="Add")
-
-            department_id = dept_row["department_id"]
-
-            cursor.execute("""
-                INSERT INTO doctors (username, name, user_id, department, experience, department_id)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (username, fullname, new_user_id, specialization, experience, department_id))
-
-            cursor.execute(
-                "UPDATE departments SET doctors_registered = doctors_registered + 1 WHERE department_id = ?",
-                (department_id,)
-            )
-
-            conn.commit()
+            doctor_id = repo.write(create_doctor)
+            name_index.refresh("doctor", [doctor_id])
+            audit_event("doctor.create", "doctor", doctor_id, username=username, name=fullname,
+                        department=specialization, experience=experience)
             return redirect(url_for('admin_doctor'))
 
-        except sqlite3.IntegrityError:
-            conn.rollback()
+        except LookupError:
+            return render_template("adddoctor.html", error="Department not found.", action="Add")
+
+        except IntegrityError:
             return render_template("adddoctor.html", error="Username already exists.", action='Add')
 
         except Exception as e:
-            conn.rollback()
             return render_template("adddoctor.html", error=f"Error creating doctor: {e}", action='Add')
 
-        finally:
-            conn.close()
-
-    conn = get_db_connection()
-    depts = conn.execute("SELECT department_id, name FROM departments").fetchall()
-    conn.close()
-
-    return render_template("adddoctor.html", action='Add', departments=[dict(d) for d in depts])
+    return render_template("adddoctor.html", action='Add', departments=reference.get("department_names"))
 
 
 @app.route("/doctor/edit/<int:doctor_id>", methods=["GET", "POST"])
@@ -442,9 +956,6 @@ def edit_doctor(doctor_id):
     if session.get('user_role') != 'admin':
         return redirect(url_for('login'))
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-
     if request.method == "POST":
         fullname = request.form.get("fullname", "").strip()
         username = request.form.get("username", "").strip()
@@ -453,51 +964,40 @@ def edit_doctor(doctor_id):
 
         redirect_target = None
 
-        try:
-            doc_row = cur.execute("SELECT user_id FROM doctors WHERE id = ?", (doctor_id,)).fetchone()
-
+        def update_doctor(tx):
+            doc_row = repo.doctors.get(doctor_id, tx)
             if not doc_row:
-                redirect_target = url_for('admin_doctor')
-            else:
-                user_id = doc_row["user_id"]
-
-                cur.execute("""
-                    UPDATE doctors
-                    SET name = ?, department = ?, experience = ?
-                    WHERE id = ?
-                """, (fullname, specialization, experience, doctor_id))
+                return False
 
-                if username:
-                    cur.execute("UPDATE users SET username = ? WHERE id = ?", (username, user_id))
+            repo.doctors.update(tx, doctor_id, fullname, specialization, experience)
+            if username:
+                repo.users.set_username(tx, doc_row["user_id"], username)
+            return True
 
-                conn.commit()
+        try:
+            if repo.write(update_doctor):
+                name_index.refresh("doctor", [doctor_id])
+                audit_event("doctor.update", "doctor", doctor_id, username=username, name=fullname,
+                            department=specialization, experience=experience)
                 flash("Doctor updated successfully.", "success")
-                redirect_target = url_for('admin_doctor')
+            redirect_target = url_for('admin_doctor')
 
-        except sqlite3.IntegrityError:
-            conn.rollback()
+        except IntegrityError:
             flash("Username already exists.", "error")
 
         except Exception as e:
-            conn.rollback()
             flash(f"Error updating doctor: {e}", "error")
 
-        finally:
-            conn.close()
-
         if redirect_target:
             return redirect(redirect_target)
 
-    conn = get_db_connection()
-    doctor = conn.execute("SELECT * FROM doctors WHERE id = ?", (doctor_id,)).fetchone()
-    depts = conn.execute("SELECT department_id, name FROM departments").fetchall()
-    conn.close()
+    doctor = repo.doctors.get(doctor_id)
 
     if not doctor:
         flash("Doctor not found.", "error")
         return redirect(url_for('admin_doctor'))
 
-    return render_template("editdoctor.html", doctor=dict(doctor), departments=[dict(d) for d in depts])
+    return render_template("editdoctor.html", doctor=doctor, departments=reference.get("department_names"))
 
 
 @app.route("/doctor/delete/<int:doctor_id>", methods=["POST"])
@@ -505,20 +1005,21 @@ def delete_doctor(doctor_id):
     if session.get('user_role') != 'admin':
         return redirect(url_for('login'))
 
-    conn = get_db_connection()
+    selection = repo.doctors.select(ids=[doctor_id])
+    today = date.today().isoformat()
+
     try:
-        conn.execute("DELETE FROM users WHERE id = ?", (doctor_id,))
-        conn.execute("DELETE FROM doctors WHERE user_id = ?", (doctor_id,))
-        conn.commit()
+        deleted, counts = repo.write(lambda tx: repo.doctors.delete_many(tx, selection, today))
+        if not deleted:
+            flash("Doctor not found.", "error")
+            return redirect(url_for('admin_doctor'))
+        name_index.refresh("doctor", deleted)
+        audit_event("doctor.delete", "doctor", doctor_id, **counts)
         flash("Doctor deleted successfully.", "success")
 
     except Exception as e:
-        conn.rollback()
         flash(f"Error deleting doctor: {e}", "error")
 
-    finally:
-        conn.close()
-
     return redirect(url_for('admin_doctor'))
 
 
@@ -527,20 +1028,21 @@ def toggle_blacklist_doctor(doctor_id):
     if session.get('user_role') != 'admin':
         return redirect(url_for('login'))
 
-    conn = get_db_connection()
-    cur = conn.cursor()
+    def toggle(tx):
+        row = repo.doctors.get(doctor_id, tx)
+        if not row:
+            return False
 
-    row = cur.execute("SELECT blacklisted FROM doctors WHERE id = ?", (doctor_id,)).fetchone()
+        new_status = 0 if row["blacklisted"] == 1 else 1
+        repo.doctors.set_blacklisted(tx, doctor_id, new_status)
+        return True, new_status
 
-    if not row:
+    found, new_status = repo.write(toggle) or (False, None)
+    if not found:
         flash("Doctor not found.", "error")
         return redirect(url_for('admin_doctor'))
 
-    new_status = 0 if row["blacklisted"] == 1 else 1
-
-    cur.execute("UPDATE doctors SET blacklisted = ? WHERE id = ?", (new_status, doctor_id))
-    conn.commit()
-    conn.close()
+    audit_event("doctor.blacklist", "doctor", doctor_id, blacklisted=new_status)
 
     flash("Status updated successfully.", "success")
     return redirect(url_for('admin_doctor'))
@@ -555,24 +1057,21 @@ def add_department():
         name = request.form.get("fullname")
         description = request.form.get("description")
 
-        conn = get_db_connection()
+        def create_department(tx):
+            return repo.departments.create(tx, name, description)
+
         try:
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO departments(name, description) VALUES (?, ?)", (name, description))
-            conn.commit()
+            department_id = repo.write(create_department)
+            name_index.refresh("department", [department_id])
+            audit_event("department.create", "department", department_id, name=name)
             return redirect(url_for('admin_department'))
 
-        except sqlite3.IntegrityError:
-            conn.rollback()
+        except IntegrityError:
             return render_template("adddepartment.html", error="Invalid or duplicate department.", action='Add')
 
         except Exception as e:
-            conn.rollback()
             return render_template("adddepartment.html", error=f"Error creating department: {e}", action='Add')
 
-        finally:
-            conn.close()
-
     return render_template("adddepartment.html", action='Add')
 
 
@@ -618,61 +1117,50 @@ def edit_patients(patients_id):
     if session.get('user_role') != 'admin':
         return redirect(url_for('login'))
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-
     if request.method == "POST":
         name = request.form.get("name", "").strip()
         username = request.form.get("username", "").strip()
 
         if not name or not username:
             flash("Name and username are required.", "error")
-            patient = cur.execute("SELECT * FROM patients WHERE id = ?", (patients_id,)).fetchone()
-            conn.close()
-            return render_template("editpatient.html", patient=dict(patient))
+            return render_template("editpatient.html", patient=repo.patients.get(patients_id))
 
-        try:
-            row = cur.execute("SELECT user_id FROM patients WHERE id = ?", (patients_id,)).fetchone()
+        def update_patient(tx):
+            row = repo.patients.get(patients_id, tx)
             if not row:
-                conn.close()
-                flash("Patient not found.", "error")
-                return redirect(url_for('admin_patient'))
+                return False
 
-            user_id = row["user_id"]
+            repo.patients.update(tx, patients_id, name, username)
+            repo.users.set_username(tx, row["user_id"], username)
+            return True
 
-            cur.execute("UPDATE patients SET name = ?, username = ? WHERE id = ?",
-                        (name, username, patients_id))
-            cur.execute("UPDATE users SET username = ? WHERE id = ?", (username, user_id))
-
-            conn.commit()
-            conn.close()
-            flash("Patient updated successfully.", "success")
-            return redirect(url_for('admin_patient'))
+        try:
+            found = repo.write(update_patient)
 
-        except sqlite3.IntegrityError:
-            conn.rollback()
-            conn.close()
+        except IntegrityError:
             flash("Username already exists.", "error")
-
-            conn = get_db_connection()
-            patient = conn.execute("SELECT * FROM patients WHERE id = ?", (patients_id,)).fetchone()
-            conn.close()
-            return render_template("editpatient.html", patient=dict(patient))
+            return render_template("editpatient.html", patient=repo.patients.get(patients_id))
 
         except Exception as e:
-            conn.rollback()
-            conn.close()
             flash(f"Error updating patient: {e}", "error")
             return redirect(url_for('admin_patient'))
 
-    patient = cur.execute("SELECT * FROM patients WHERE id = ?", (patients_id,)).fetchone()
-    conn.close()
+        if not found:
+            flash("Patient not found.", "error")
+            return redirect(url_for('admin_patient'))
+
+        name_index.refresh("patient", [patients_id])
+        audit_event("patient.update", "patient", patients_id, name=name, username=username)
+        flash("Patient updated successfully.", "success")
+        return redirect(url_for('admin_patient'))
+
+    patient = repo.patients.get(patients_id)
 
     if not patient:
         flash("Patient not found.", "error")
         return redirect(url_for('admin_patient'))
 
-    return render_template("editpatient.html", patient=dict(patient))
+    return render_template("editpatient.html", patient=patient)
 
 
 @app.route("/patient/delete/<int:patients_id>", methods=["POST"])
@@ -680,20 +1168,21 @@ def delete_patients(patients_id):
     if session.get('user_role') != 'admin':
         return redirect(url_for('login'))
 
-    conn = get_db_connection()
+    selection = repo.patients.select(ids=[patients_id])
+    today = date.today().isoformat()
+
     try:
-        conn.execute("DELETE FROM users WHERE id = ?", (patients_id,))
-        conn.execute("DELETE FROM patients WHERE user_id = ?", (patients_id,))
-        conn.commit()
+        deleted, counts = repo.write(lambda tx: repo.patients.delete_many(tx, selection, today))
+        if not deleted:
+            flash("Patient not found.", "error")
+            return redirect(url_for('admin_patient'))
+        name_index.refresh("patient", deleted)
+        audit_event("patient.delete", "patient", patients_id, **counts)
         flash("Patient deleted successfully.", "success")
 
     except Exception as e:
-        conn.rollback()
         flash(f"Error deleting patient: {e}", "error")
 
-    finally:
-        conn.close()
-
     return redirect(url_for('admin_patient'))
 
 
@@ -702,19 +1191,21 @@ def toggle_blacklist_patient(patients_id):
     if session.get('user_role') != 'admin':
         return redirect(url_for('login'))
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-    row = cur.execute("SELECT blacklisted FROM patients WHERE id = ?", (patients_id,)).fetchone()
+    def toggle(tx):
+        row = repo.patients.get(patients_id, tx)
+        if not row:
+            return False
+
+        new_status = 0 if row["blacklisted"] == 1 else 1
+        repo.patients.set_blacklisted(tx, patients_id, new_status)
+        return True, new_status
 
-    if not row:
+    found, new_status = repo.write(toggle) or (False, None)
+    if not found:
         flash("Patient not found.", "error")
         return redirect(url_for('admin_patient'))
 
-    new_status = 0 if row["blacklisted"] == 1 else 1
-
-    cur.execute("UPDATE patients SET blacklisted = ? WHERE id = ?", (new_status, patients_id))
-    conn.commit()
-    conn.close()
+    audit_event("patient.blacklist", "patient", patients_id, blacklisted=new_status)
 
     flash("Patient status updated successfully.", "success")
     return redirect(url_for('admin_patient'))
@@ -725,25 +1216,17 @@ def blacklist_patients(patients_id):
     if session.get('user_role') != 'admin':
         return redirect(url_for('login'))
 
-    conn = get_db_connection()
-    try:
-        conn.execute("ALTER TABLE patients ADD COLUMN blacklisted INTEGER DEFAULT 0")
-
-    except Exception:
-        pass
+    def blacklist(tx):
+        repo.patients.set_blacklisted(tx, patients_id, 1)
 
     try:
-        conn.execute("UPDATE patients SET blacklisted = 1 WHERE id = ?", (patients_id,))
-        conn.commit()
+        repo.write(blacklist)
+        audit_event("patient.blacklist", "patient", patients_id, blacklisted=1)
         flash("Patient blacklisted successfully.", "success")
 
     except Exception as e:
-        conn.rollback()
         flash(f"Error blacklisting patient: {e}", "error")
 
-    finally:
-        conn.close()
-
     return redirect(url_for('admin_patient'))
 
 
@@ -770,24 +1253,7 @@ def admindepartmentview(department_id):
     if session.get('user_role') != 'admin':
         return redirect(url_for('login'))
 
-    conn = get_db_connection()
-    try:
-        department = conn.execute(
-            "SELECT department_id, name, description, doctors_registered FROM departments WHERE department_id = ?",
-            (department_id,)
-        ).fetchone()
-
-        doctors = []
-        if department:
-            doctors = conn.execute(
-                "SELECT id, name, experience, blacklisted, department_id FROM doctors WHERE department_id = ?",
-                (department_id,)
-            ).fetchall()
-
-        admin_data = fetch_admin_dashboard_data()
-
-    finally:
-        conn.close()
+    department = repo.departments.get(department_id)
 
     if not department:
         flash("Department not found.", "error")
@@ -795,9 +1261,9 @@ def admindepartmentview(department_id):
 
     return render_template(
         "admindepartmentview.html",
-        data=admin_data,
-        department=dict(department),
-        doctors=[dict(d) for d in doctors]
+        data=fetch_admin_dashboard_data(),
+        department=department,
+        doctors=repo.doctors.in_department(department_id)
     )
 
 
@@ -811,8 +1277,7 @@ def doctor_home():
     if 'user_id' not in session:
         return redirect(url_for('login'))
 
-    data = fetch_doctor_dashboard_data(doctor_name)
-    return render_template("doctorhome.html", doctor={'name': doctor_name}, data=data)
+    return render_worklist("doctorhome.html")
 
 
 @app.route("/doctor/availability", methods=["GET", "POST"])
@@ -821,11 +1286,9 @@ def doctor_availability():
         return redirect(url_for("login"))
 
     doctor_name = session.get("doctor_name")
-    conn = get_db_connection()
-    doc_row = conn.execute("SELECT id, name FROM doctors WHERE name = ?", (doctor_name,)).fetchone()
+    doc_row = repo.doctors.by_name(doctor_name)
 
     if not doc_row:
-        conn.close()
         flash("Doctor record not found.", "error")
         return redirect(url_for("doctor_home"))
 
@@ -841,24 +1304,15 @@ def doctor_availability():
             avail_map = None
 
         if payload and avail_map is not None:
-            cur = conn.cursor()
+            if payload.get("async"):
+                job_id = job_queue.enqueue("save_availability",
+                                           {"doctor_id": doctor_id, "availability": avail_map},
+                                           priority=10, owner=session.get("user_id"))
+                return {"status": "queued", "job_id": job_id,
+                        "status_url": url_for("job_status", job_id=job_id)}, 202
 
-            for dstr, slots in avail_map.items():
-                for slot_key, val in slots.items():
-                    try:
-                        val_int = 1 if int(val) else 0
-                    except Exception:
-                        val_int = 1 if bool(val) else 0
-
-                    cur.execute("""
-                        INSERT INTO doctor_availability (doctor_id, date, slot, status)
-                        VALUES (?, ?, ?, ?)
-                        ON CONFLICT(doctor_id, date, slot)
-                        DO UPDATE SET status = excluded.status
-                    """, (doctor_id, dstr, slot_key, val_int))
-
-            conn.commit()
-            conn.close()
+            repo.write(save_availability, doctor_id, avail_map)
+            page_cache.invalidate(doctor_id)
 
             if request.is_json:
                 return {"status": "ok", "message": "Availability updated."}, 200
@@ -876,25 +1330,17 @@ def doctor_availability():
                     except ValueError:
                         pass
 
-            cur = conn.cursor()
             today = date.today()
             num_days = 7
+            week = {}
 
             for n in range(num_days):
-                d = today + timedelta(days=n)
-                dstr = d.isoformat()
-
-                for slot_key, _ in SLOTS:
-                    val = form_avail.get(dstr, {}).get(slot_key, 0)
-                    cur.execute("""
-                        INSERT INTO doctor_availability (doctor_id, date, slot, status)
-                        VALUES (?, ?, ?, ?)
-                        ON CONFLICT(doctor_id, date, slot)
-                        DO UPDATE SET status = excluded.status
-                    """, (doctor_id, dstr, slot_key, val))
-
-            conn.commit()
-            conn.close()
+                dstr = (today + timedelta(days=n)).isoformat()
+                week[dstr] = {slot_key: form_avail.get(dstr, {}).get(slot_key, 0)
+                              for slot_key, _ in doctor_sessions(doctor_id)}
+
+            repo.write(save_availability, doctor_id, week)
+            page_cache.invalidate(doctor_id)
             flash("Availability updated.", "success")
             return redirect(url_for("doctor_availability"))
 
@@ -904,20 +1350,20 @@ def doctor_availability():
     dates = [(today + timedelta(days=i)) for i in range(num_days)]
     date_strs = [d.isoformat() for d in dates]
 
-    q = "SELECT date, slot, status FROM doctor_availability WHERE doctor_id = ? AND date BETWEEN ? AND ?"
-    rows = conn.execute(q, (doctor_id, date_strs[0], date_strs[-1])).fetchall()
-    conn.close()
+    rows = repo.availability.for_range(doctor_id, date_strs[0], date_strs[-1])
 
     avail = {}
     for r in rows:
         avail.setdefault(r["date"], {})[r["slot"]] = r["status"]
 
+    sessions = doctor_sessions(doctor_id)
+
     for d in dates:
         dstr = d.isoformat()
         weekday = d.strftime("%a")
         slots = []
 
-        for slot_key, slot_label in SLOTS:
+        for slot_key, slot_label in sessions:
             status = avail.get(dstr, {}).get(slot_key, 0)
             slots.append({"key": slot_key, "label": slot_label, "status": status})
 
@@ -927,7 +1373,7 @@ def doctor_availability():
             "slots": slots
         })
 
-    return render_template("doctoravailability.html", doctor=dict(doc_row), days=days)
+    return render_template("doctoravailability.html", doctor=doc_row, days=days)
 
 
 @app.route("/doctorassigned.html")
@@ -937,11 +1383,88 @@ def doctor_assigned():
     if session.get('user_role') != 'doctor' or not doctor_name:
         return redirect(url_for('login'))
 
-    data = fetch_doctor_dashboard_data(doctor_name)
-    return render_template("doctorassigned.html", doctor={'name': doctor_name}, data=data)
+    return render_worklist("doctorassigned.html")
 
 
-SLOTS = [("morning", "08:00 - 12:00"), ("afternoon", "12:00 - 16:00")]
+def doctor_sessions(doctor_id):
+    """[(session key, "HH:MM - HH:MM")] the doctor marks availability for."""
+    return schedule.sessions(repo.schedule.doctor_slots(doctor_id))
+
+
+def compile_doctor_slots(tx, doctor_ids=None):
+    # Only today onwards: past bitmaps and rollups keep the slots they were booked under.
+    today = date.today().isoformat()
+    schedule.compile_slots(tx, doctor_ids, bitmaps=repo.backend.name == "sqlite", since=today)
+    if repo.backend.name == "sqlite":
+        rollups.mark_offered_from(tx, today, doctor_ids)
+    refresh_doctor_load(tx, doctor_ids)
+
+
+def refresh_doctor_load(tx, doctor_ids=None):
+    if repo.backend.name == "sqlite":
+        doctorload.refresh(tx, doctor_ids)
+
+
+def save_availability(tx, doctor_id, avail_map):
+    rows = []
+    for dstr, slots in avail_map.items():
+        for slot_key, val in slots.items():
+            try:
+                val_int = 1 if int(val) else 0
+            except Exception:
+                val_int = 1 if bool(val) else 0
+            rows.append((doctor_id, dstr, slot_key, val_int))
+
+    repo.availability.upsert_many(tx, rows)
+
+
+def schedule_archival(delay=archive.ARCHIVE_INTERVAL_SECONDS):
+    # One attempt: a failed run is retried by the next one, which its finally has already queued.
+    return job_queue.enqueue("archive_old_rows", priority=-10, delay=delay, max_attempts=1, unique=True)
+
+
+@jobs.task("archive_old_rows")
+def archive_old_rows_job(payload):
+    conn = get_db_connection()
+    conn.isolation_level = None
+    try:
+        return archive.run_archival(conn)
+    finally:
+        conn.close()
+        # Whether this run worked or not, so one bad run never ends the chain.
+        schedule_archival()
+
+
+def schedule_rollups(delay=rollups.ROLLUP_INTERVAL_SECONDS):
+    # One attempt: a failed run is retried by the next one, which its finally has already queued.
+    return job_queue.enqueue("refresh_rollups", priority=-5, delay=delay, max_attempts=1, unique=True)
+
+
+@jobs.task("refresh_rollups")
+def refresh_rollups_job(payload):
+    conn = get_db_connection()
+    conn.isolation_level = None
+    try:
+        return rollups.refresh(conn)
+    finally:
+        conn.close()
+        schedule_rollups()
+
+
+def schedule_recurring_jobs():
+    """Start every recurring job's chain; a kind that already has a copy waiting is left alone."""
+    schedule_limiter_purge(delay=0)
+    # Archival and rollups work on the SQLite database only.
+    if repo.backend.name == "sqlite":
+        schedule_archival()
+        schedule_rollups(delay=0)
+
+
+@jobs.task("save_availability")
+def save_availability_job(payload):
+    repo.write(save_availability, payload["doctor_id"], payload["availability"])
+    page_cache.invalidate(payload["doctor_id"])
+    return {"saved": sum(len(slots) for slots in payload["availability"].values())}
 
 
 def ensure_doctor_row_by_name(conn, doctor_name):
@@ -949,21 +1472,43 @@ def ensure_doctor_row_by_name(conn, doctor_name):
     return row["id"] if row else None
 
 
+def cached_page(name, doctor_id, render, days=7):
+    """A doctor page from page_cache, with its ETag; 304 when the client already has it.
+
+    `render()` returns the HTML, or None when the doctor does not exist
+    (then this returns None too).
+    """
+    if repo.backend.name == "sqlite":
+        # The change log poller that invalidates entries for writes made by other workers.
+        slot_feed.start()
+
+    body, etag = page_cache.get((name, doctor_id, date.today().isoformat(), days), render)
+    if body is None:
+        return None
+
+    response = Response(body, mimetype="text/html")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = f"private, max-age={int(page_cache.ttl)}"
+    return response.make_conditional(request)
+
+
 @app.route("/doctorview/<int:doctor_id>")
 def patient_doctor_view(doctor_id):
     if session.get('user_role') != 'patient':
         return redirect(url_for('login'))
 
-    conn = get_db_connection()
-    doctor = conn.execute(
-        "SELECT id, name, department, experience, blacklisted FROM doctors WHERE id = ?",
-        (doctor_id,)
-    ).fetchone()
-
-    if not doctor:
-        conn.close()
+    response = cached_page("doctorview", doctor_id, lambda: render_doctor_view(doctor_id))
+    if response is None:
         flash("Doctor not found.", "error")
         return redirect(url_for('patient_department'))
+    return response
+
+
+def render_doctor_view(doctor_id):
+    doctor = repo.doctors.get(doctor_id)
+
+    if not doctor:
+        return None
 
     days = []
     today = date.today()
@@ -971,19 +1516,13 @@ def patient_doctor_view(doctor_id):
     dates = [(today + timedelta(days=i)) for i in range(num_days)]
     date_strs = [d.isoformat() for d in dates]
 
-    q = "SELECT date, slot, status FROM doctor_availability WHERE doctor_id = ? AND date BETWEEN ? AND ?"
-    rows = conn.execute(q, (doctor_id, date_strs[0], date_strs[-1])).fetchall()
+    rows = repo.availability.for_range(doctor_id, date_strs[0], date_strs[-1])
 
     avail = {}
     for r in rows:
         avail.setdefault(r["date"], {})[r["slot"]] = r["status"]
 
-    try:
-        SLOTS
-    except Exception:
-        local_slots = [("morning", "08:00 - 12:00"), ("evening", "16:00 - 20:00")]
-    else:
-        local_slots = SLOTS
+    local_slots = doctor_sessions(doctor_id)
 
     for d in dates:
         dstr = d.isoformat()
@@ -1006,11 +1545,9 @@ def patient_doctor_view(doctor_id):
         for s in day['slots']
     )
 
-    conn.close()
-
     return render_template(
         "patientdoctorview.html",
-        doctor=dict(doctor),
+        doctor=doctor,
         days=days,
         has_availability=has_availability
     )
@@ -1021,43 +1558,25 @@ def doctoravailability(doctor_id):
     if session.get('user_role') != 'patient':
         return redirect(url_for('login'))
 
-    conn = get_db_connection()
-    doctor = conn.execute("""
-        SELECT id, name, department, experience, blacklisted, department_id
-        FROM doctors
-        WHERE id = ?
-    """, (doctor_id,)).fetchone()
+    doctor = repo.doctors.get(doctor_id)
 
     if not doctor:
-        conn.close()
         flash("Doctor not found.", "error")
         return redirect(url_for("patient_department"))
 
-    count = conn.execute("""
-        SELECT COUNT(*) AS total
-        FROM appointments
-        WHERE doctor_name = ?
-    """, (doctor["name"],)).fetchone()
-
-    conn.close()
-
-    booked_count = count["total"]
+    booked_count = repo.appointments.count_for_doctor_name(doctor["name"])
     max_slots = 10
     available_slots = max(max_slots - booked_count, 0)
 
     return render_template(
         "patientdoctoravailability.html",
-        doctor=dict(doctor),
+        doctor=doctor,
         booked_count=booked_count,
         available_slots=available_slots,
         max_slots=max_slots
     )
 
 
-SLOT_DEFS = [
-    {"key": "morning", "label": "08:00 - 12:00"},
-    {"key": "evening", "label": "16:00 - 20:00"},
-]
 
 
 def next_7_days():
@@ -1070,15 +1589,17 @@ def next_7_days():
 
 @app.route('/patient/doctor/<int:doctor_id>/availability')
 def patientdoctoravailability(doctor_id):
-    conn = get_db_connection()
-    cur = conn.cursor()
+    response = cached_page("availability", doctor_id, lambda: render_doctor_availability(doctor_id))
+    if response is None:
+        return "Doctor not found", 404
+    return response
+
 
-    cur.execute("SELECT id, name, department, experience, blacklisted FROM doctors WHERE id = ?", (doctor_id,))
-    doctor = cur.fetchone()
+def render_doctor_availability(doctor_id):
+    doctor = repo.doctors.get(doctor_id)
 
     if doctor is None:
-        conn.close()
-        return "Doctor not found", 404
+        return None
 
     today = date.today()
     days_raw = [{
@@ -1087,60 +1608,31 @@ def patientdoctoravailability(doctor_id):
     } for i in range(7)]
 
     date_list = [d["date"] for d in days_raw]
-    placeholders = ",".join("?" for _ in date_list)
-
-    cur.execute(f"""
-        SELECT date, slot, status
-        FROM doctor_availability
-        WHERE doctor_id = ?
-          AND date IN ({placeholders})
-    """, (doctor_id, *date_list))
 
-    avail_rows = cur.fetchall()
+    avail_rows = repo.availability.for_range(doctor_id, date_list[0], date_list[-1])
     avail_map = {}
 
     for r in avail_rows:
         avail_map.setdefault(r["date"], {})[r["slot"]] = r["status"]
 
-    cur.execute(f"""
-        SELECT date, slot, COUNT(*) AS cnt
-        FROM appointments
-        WHERE doctor_id = ?
-          AND date IN ({placeholders})
-          AND status = 'confirmed'
-        GROUP BY date, slot
-    """, (doctor_id, *date_list))
-
-    booked_rows = cur.fetchall()
+    booked_rows = repo.appointments.booked_counts(doctor_id, date_list)
     booked_map = {}
 
     for r in booked_rows:
         booked_map.setdefault(r["date"], {})[r["slot"]] = r["cnt"]
 
+    doctor_slots = repo.schedule.doctor_slots(doctor_id)
+    closed = holiday_dates([doctor], date_list[0], date_list[-1])[doctor_id]
     days = []
 
     for d in days_raw:
-        slots = []
-
-        for s in SLOT_DEFS:
-            status = avail_map.get(d["date"], {}).get(s["key"], 0)
-            already_booked = booked_map.get(d["date"], {}).get(s["key"], 0) > 0
-
-            slots.append({
-                "key": s["key"],
-                "label": s["label"],
-                "status": 1 if int(status) == 1 else 0,
-                "booked": already_booked
-            })
-
         days.append({
             "date": d["date"],
             "display": d["display"],
-            "slots": slots
+            "slots": schedule.day_grid(doctor_slots, avail_map.get(d["date"], {}),
+                                       booked_map.get(d["date"], {}), d["date"] in closed)
         })
 
-    conn.close()
-
     return render_template(
         "patientdoctoravailability.html",
         doctor=doctor,
@@ -1149,6 +1641,435 @@ def patientdoctoravailability(doctor_id):
     )
 
 
+def holiday_dates(doctors, start, end):
+    """doctor id -> set of holiday dates between start and end (inclusive)."""
+    closed = {d["id"]: set() for d in doctors}
+    for h in repo.schedule.holidays_between(start, end):
+        for d in doctors:
+            if schedule.applies_to(h, d) is not None:
+                closed[d["id"]].add(h["date"])
+    return closed
+
+
+@app.route("/doctor/<int:doctor_id>/slots")
+def doctor_day_slots(doctor_id):
+    """One day's slots with remaining capacity and the merged free intervals."""
+    if "user_id" not in session:
+        return jsonify({"success": False, "error": "Login required"}), 401
+
+    doctor = repo.doctors.get(doctor_id)
+    if doctor is None:
+        return jsonify({"success": False, "error": "Doctor not found"}), 404
+
+    try:
+        slot_date = date.fromisoformat(request.args.get("date") or date.today().isoformat()).isoformat()
+    except ValueError:
+        return jsonify({"success": False, "error": "Invalid date"}), 400
+
+    session_status = {r["slot"]: r["status"] for r in repo.availability.for_range(doctor_id, slot_date, slot_date)}
+    booked = {r["slot"]: r["cnt"] for r in repo.appointments.booked_counts(doctor_id, [slot_date])}
+    holiday = slot_date in holiday_dates([doctor], slot_date, slot_date)[doctor_id]
+    grid = schedule.day_grid(repo.schedule.doctor_slots(doctor_id), session_status, booked, holiday)
+
+    return jsonify({
+        "success": True,
+        "doctor_id": doctor_id,
+        "date": slot_date,
+        "holiday": holiday,
+        "slots": grid,
+        "free_intervals": schedule.free_intervals(grid)
+    })
+
+
+@app.route("/doctor/<int:doctor_id>/events")
+def doctor_slot_events(doctor_id):
+    """Server-Sent Events: one `slot` event per booking or availability change
+    of this doctor. Reconnects resume from the Last-Event-ID header."""
+    if "user_id" not in session:
+        return jsonify({"success": False, "error": "Login required"}), 401
+    if repo.backend.name != "sqlite":
+        return jsonify({"success": False, "error": "Live updates need the SQLite change log"}), 501
+    if repo.doctors.get(doctor_id) is None:
+        return jsonify({"success": False, "error": "Doctor not found"}), 404
+
+    last_event_id = request.headers.get("Last-Event-ID", type=int)
+    sub, missed = slot_feed.subscribe(doctor_id, last_event_id)
+    return Response(livefeed.stream(slot_feed, sub, missed), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+
+# ===================== SLOT RULES =====================
+@app.route("/admin/schedule")
+def admin_schedule():
+    if session.get('user_role') != 'admin':
+        return jsonify({"success": False, "error": "Admin only"}), 403
+
+    return jsonify({
+        "success": True,
+        "rules": repo.schedule.rules(),
+        "breaks": repo.schedule.breaks(),
+        "holidays": repo.schedule.holidays()
+    })
+
+
+def parse_schedule_entry(kind, data):
+    """Validate a rule/break/holiday body; returns the write function."""
+    department_id = data.get("department_id")
+    doctor_id = data.get("doctor_id")
+    department_id = int(department_id) if department_id not in (None, "") else None
+    doctor_id = int(doctor_id) if doctor_id not in (None, "") else None
+
+    if kind == "holidays":
+        holiday_date = date.fromisoformat(data["date"]).isoformat()
+        return lambda tx: repo.schedule.add_holiday(tx, department_id, doctor_id, holiday_date, data.get("label"))
+
+    start_time, end_time = data["start"], data["end"]
+    start, end = schedule.to_minutes(start_time), schedule.to_minutes(end_time)
+    if end <= start:
+        raise ValueError("end must be after start")
+
+    if kind == "breaks":
+        return lambda tx: repo.schedule.add_break(tx, department_id, doctor_id, start_time, end_time,
+                                                  data.get("label"))
+
+    session_key = (data.get("session") or "").strip()
+    slot_minutes = int(data.get("slot_minutes") or end - start)
+    capacity = int(data.get("capacity", 1))
+    if not session_key or slot_minutes <= 0 or capacity < 0:
+        raise ValueError("session, a positive slot_minutes and capacity >= 0 are required")
+    return lambda tx: repo.schedule.save_rule(tx, department_id, doctor_id, session_key, start_time, end_time,
+                                              slot_minutes, capacity)
+
+
+@app.route("/admin/schedule/<kind>", methods=["POST"])
+def admin_schedule_add(kind):
+    """Add a holiday, a break or a (replacing) session rule; JSON body.
+
+    rules:    {"session", "start": "HH:MM", "end": "HH:MM", "slot_minutes", "capacity"}
+    breaks:   {"start", "end", "label"}
+    holidays: {"date": "YYYY-MM-DD", "label"}
+    Each takes optional "department_id" or "doctor_id"; neither means hospital-wide.
+    """
+    if session.get('user_role') != 'admin':
+        return jsonify({"success": False, "error": "Admin only"}), 403
+    if kind not in ("rules", "breaks", "holidays"):
+        return jsonify({"success": False, "error": "Unknown schedule entry"}), 404
+
+    data = request.get_json(silent=True) or {}
+    try:
+        save = parse_schedule_entry(kind, data)
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({"success": False, "error": f"Invalid {kind[:-1]}: {e}"}), 400
+
+    def apply(tx):
+        row_id = save(tx)
+        # Holidays are applied when reading; rules and breaks change the slot grid.
+        if kind != "holidays":
+            compile_doctor_slots(tx, [int(data["doctor_id"])] if data.get("doctor_id") else None)
+        else:
+            refresh_doctor_load(tx)
+        return row_id
+
+    try:
+        row_id = repo.write(apply)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    audit_event(f"schedule.{kind}.create", f"schedule.{kind}", row_id, **data)
+    return jsonify({"success": True, "id": row_id}), 201
+
+
+@app.route("/admin/schedule/<kind>/<int:row_id>", methods=["DELETE"])
+def admin_schedule_delete(kind, row_id):
+    if session.get('user_role') != 'admin':
+        return jsonify({"success": False, "error": "Admin only"}), 403
+    if kind not in ("rules", "breaks", "holidays"):
+        return jsonify({"success": False, "error": "Unknown schedule entry"}), 404
+
+    def remove(tx):
+        row = repo.schedule.delete(tx, kind, row_id)
+        if row and kind != "holidays":
+            compile_doctor_slots(tx, [row["doctor_id"]] if row["doctor_id"] else None)
+        elif row:
+            refresh_doctor_load(tx)
+        return row
+
+    try:
+        row = repo.write(remove)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    if row is None:
+        return jsonify({"success": False, "error": "Not found"}), 404
+    audit_event(f"schedule.{kind}.delete", f"schedule.{kind}", row_id)
+    return jsonify({"success": True})
+
+
+# ===================== REPORTS =====================
+MAX_REPORT_DAYS = 731
+REPORT_COLUMNS = ["offered", "booked", "confirmed", "cancelled", "no_show", "utilisation", "cancel_rate",
+                  "no_show_rate", "avg_lead_days"]
+
+
+def ratio(numerator, denominator):
+    return round(numerator / denominator, 4) if denominator else None
+
+
+def report_row(row):
+    """Add the rates to a rollup row; sums stay additive, so rates are derived last."""
+    row = dict(row)
+    row["utilisation"] = ratio(row["confirmed"], row["offered"])
+    row["cancel_rate"] = ratio(row["cancelled"], row["booked"])
+    row["no_show_rate"] = ratio(row["no_show"], row["booked"])
+    row["avg_lead_days"] = ratio(row.pop("lead_days_sum"), row.pop("lead_count"))
+    return row
+
+
+@app.route("/admin/reports/utilisation")
+def admin_utilisation_report():
+    """Daily utilisation from the rollup tables (see rollups.py).
+
+    ?group=department (default) or doctor; ?start/?end (default the last 30
+    days); optional ?department_id and, for doctors, ?doctor_id;
+    ?format=csv downloads the rows.
+    """
+    if session.get('user_role') != 'admin':
+        return jsonify({"success": False, "error": "Admin only"}), 403
+    if repo.backend.name != "sqlite":
+        return jsonify({"success": False, "error": "Reports need the SQLite rollup tables"}), 501
+
+    group = request.args.get("group", "department")
+    if group not in ("department", "doctor"):
+        return jsonify({"success": False, "error": "group must be department or doctor"}), 400
+
+    try:
+        end = date.fromisoformat(request.args.get("end") or date.today().isoformat())
+        start = date.fromisoformat(request.args.get("start") or (end - timedelta(days=29)).isoformat())
+        department_id = request.args.get("department_id", type=int)
+        doctor_id = request.args.get("doctor_id", type=int)
+    except ValueError:
+        return jsonify({"success": False, "error": "Invalid start or end"}), 400
+
+    if not 0 <= (end - start).days < MAX_REPORT_DAYS:
+        return jsonify({"success": False, "error": f"Range must be 1-{MAX_REPORT_DAYS} days"}), 400
+
+    if group == "department":
+        rows = repo.reports.department_days(start.isoformat(), end.isoformat(), department_id)
+        keys = ["date", "department_id", "department"]
+    else:
+        rows = repo.reports.doctor_days(start.isoformat(), end.isoformat(), department_id, doctor_id)
+        keys = ["date", "doctor_id", "doctor", "department_id"]
+
+    totals = {c: sum(r[c] for r in rows) for c in rollups.STAT_COLUMNS}
+    rows = [report_row(r) for r in rows]
+
+    if request.args.get("format") == "csv":
+        out = io.StringIO()
+        writer = csv.DictWriter(out, fieldnames=keys + REPORT_COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
+        filename = f"utilisation-{group}-{start.isoformat()}-{end.isoformat()}.csv"
+        return Response(out.getvalue(), mimetype="text/csv",
+                        headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+    return jsonify({
+        "success": True,
+        "group": group,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        # Days changed since the last refresh_rollups run; not yet reflected above.
+        "pending_days": repo.reports.pending_days(),
+        "totals": report_row(totals),
+        "rows": rows
+    })
+
+# =======================================================
+
+# ===================== EXPORTS =====================
+@app.route("/admin/export/<name>")
+def admin_export(name):
+    """A whole table as JSON lines or CSV, streamed batch by batch from the cursor (see exports.py).
+
+    ?format=jsonl|csv; ?history=1 adds archived appointments and availability.
+    """
+    if session.get('user_role') != 'admin':
+        return jsonify({"success": False, "error": "Admin only"}), 403
+    if name not in repo.exports.TABLES:
+        return jsonify({"success": False, "error": f"Unknown export; one of {', '.join(repo.exports.TABLES)}"}), 404
+
+    fmt = request.args.get("format", "jsonl")
+    if fmt not in exports.FORMATS:
+        return jsonify({"success": False, "error": "format must be jsonl or csv"}), 400
+    history = request.args.get("history") == "1"
+
+    columns, batches = repo.exports.stream(name, history)
+    audit_event("data.export", name, format=fmt, history=history)
+    mimetype, extension = exports.FORMATS[fmt]
+    return Response(exports.encode(fmt, columns, batches), mimetype=mimetype, headers={
+        "Content-Disposition": f"attachment; filename={name}-{date.today().isoformat()}.{extension}",
+        # Let a proxy pass chunks through rather than buffer the whole export.
+        "X-Accel-Buffering": "no",
+    })
+
+# =======================================================
+
+# ===================== BULK ADMIN ACTIONS =====================
+BULK_MAX_IDS = 50000
+# blacklisted is 1 for an active account and 0 for a blocked one (see the admin templates).
+BULK_ACTIONS = {"blacklist": 0, "unblacklist": 1, "delete": None}
+BULK_FILTERS = {
+    "doctor": {"name": str, "department_id": int, "blacklisted": int},
+    "patient": {"name": str, "blacklisted": int},
+}
+
+
+def bulk_selection(kind, data):
+    """The repository selection for a bulk request's "ids" and "filter"; raises ValueError."""
+    ids = data.get("ids")
+    if ids is not None:
+        if not isinstance(ids, list) or len(ids) > BULK_MAX_IDS:
+            raise ValueError(f"ids must be a list of at most {BULK_MAX_IDS}")
+        ids = [int(i) for i in ids]
+
+    filters = data.get("filter") or {}
+    if not isinstance(filters, dict) or set(filters) - set(BULK_FILTERS[kind]):
+        raise ValueError(f"filter may use {', '.join(BULK_FILTERS[kind])}")
+    filters = {key: BULK_FILTERS[kind][key](value) for key, value in filters.items()}
+    if filters.get("blacklisted", 0) not in (0, 1):
+        raise ValueError("blacklisted must be 0 or 1")
+
+    repository = repo.doctors if kind == "doctor" else repo.patients
+    return repository.select(ids=ids, **filters)
+
+
+def bulk_admin_action(kind):
+    if session.get('user_role') != 'admin':
+        return jsonify({"success": False, "error": "Admin only"}), 403
+
+    data = request.get_json(silent=True) or {}
+    action = data.get("action")
+    if action not in BULK_ACTIONS:
+        return jsonify({"success": False, "error": f"action must be one of {', '.join(BULK_ACTIONS)}"}), 400
+    try:
+        selection = bulk_selection(kind, data)
+    except (TypeError, ValueError) as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    repository = repo.doctors if kind == "doctor" else repo.patients
+    today = date.today().isoformat()
+
+    def run(tx):
+        if action == "delete":
+            return repository.delete_many(tx, selection, today)
+        changed = repository.set_blacklisted_many(tx, selection, BULK_ACTIONS[action])
+        return changed, {f"{kind}s": len(changed)}
+
+    try:
+        ids, counts = repo.write(run)
+    except DatabaseError as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+    if action == "delete":
+        name_index.refresh(kind, ids)
+    audit_event(f"{kind}.bulk_{action}", kind, ids=ids, filter=data.get("filter"), **counts)
+    return jsonify({"success": True, "action": action, "ids": ids, "counts": counts})
+
+
+@app.route("/admin/doctors/bulk", methods=["POST"])
+def bulk_doctors():
+    """Blacklist, unblacklist or delete many doctors in one transaction.
+
+    {"action": "blacklist" | "unblacklist" | "delete",
+     "ids": [doctor ids], "filter": {"name", "department_id", "blacklisted"}}
+
+    ids and filter narrow each other; at least one is required. Each table
+    is changed by one set-based statement. Deleting also removes the
+    doctors' logins and future availability and cancels their future
+    confirmed appointments.
+    """
+    return bulk_admin_action("doctor")
+
+
+@app.route("/admin/patients/bulk", methods=["POST"])
+def bulk_patients():
+    """As /admin/doctors/bulk for patients; filter on "name" or "blacklisted".
+
+    Deleting removes the patients' logins and cancels their future confirmed appointments.
+    """
+    return bulk_admin_action("patient")
+
+# =======================================================
+
+
+MAX_RANGE_DAYS = 366
+
+
+@app.route("/availability/range")
+def availability_range():
+    """Availability of many doctors over an arbitrary date range as packed bitmaps.
+
+    ?department_id=3 or ?doctor_id=1,2,3 (repeatable); ?start=YYYY-MM-DD
+    (default today) and ?end=YYYY-MM-DD or ?days=N (default 90); ?detail=1
+    adds the offered/full bitmaps and per-day free slot counts.
+    """
+    if "user_id" not in session:
+        return jsonify({"success": False, "error": "Login required"}), 401
+
+    try:
+        start = date.fromisoformat(request.args.get("start") or date.today().isoformat())
+        if request.args.get("end"):
+            days = (date.fromisoformat(request.args["end"]) - start).days + 1
+        else:
+            days = int(request.args.get("days", 90))
+    except ValueError:
+        return jsonify({"success": False, "error": "Invalid start, end or days"}), 400
+
+    if not 1 <= days <= MAX_RANGE_DAYS:
+        return jsonify({"success": False, "error": f"Range must be 1-{MAX_RANGE_DAYS} days"}), 400
+
+    if request.args.get("department_id"):
+        doctors = repo.doctors.in_department(request.args.get("department_id", type=int))
+    else:
+        try:
+            ids = [int(i) for arg in request.args.getlist("doctor_id") for i in arg.split(",") if i]
+        except ValueError:
+            return jsonify({"success": False, "error": "Invalid doctor_id"}), 400
+        doctors = [d for d in (repo.doctors.get(i) for i in dict.fromkeys(ids)) if d]
+
+    if not doctors:
+        return jsonify({"success": False, "error": "No doctors found"}), 404
+
+    doctor_ids = [d["id"] for d in doctors]
+    start_str = start.isoformat()
+    end_str = (start + timedelta(days=days - 1)).isoformat()
+    slots, doctor_bits = repo.schedule.slot_bits_for(doctor_ids)
+    closed = [(i, (date.fromisoformat(day) - start).days)
+              for i, days_off in enumerate(holiday_dates(doctors, start_str, end_str).values())
+              for day in days_off]
+
+    results = slotmaps.summarize(
+        doctor_ids, start_str, days, slots, doctor_bits,
+        repo.availability.day_bitmaps(doctor_ids, start_str, end_str),
+        closed=closed,
+        detail=request.args.get("detail") == "1"
+    )
+    for doctor, result in zip(doctors, results):
+        result["name"] = doctor["name"]
+        result["blacklisted"] = doctor["blacklisted"]
+
+    return jsonify({
+        "success": True,
+        "start": start_str,
+        "end": end_str,
+        "days": days,
+        "slots": slots,
+        "hex_digits_per_day": slotmaps.hex_width(len(slots)),
+        "doctors": results
+    })
+
+
 @app.route('/patient/book', methods=['POST'])
 def patient_book_slot():
     if "user_id" not in session:
@@ -1164,53 +2085,24 @@ def patient_book_slot():
     if not (doctor_id and slot_date and slot):
         return jsonify({"ok": False, "message": "Missing parameters"}), 400
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-
-    cur.execute("SELECT id, name, department, blacklisted FROM doctors WHERE id = ?", (doctor_id,))
-    doc = cur.fetchone()
+    doc = repo.doctors.get(doctor_id)
 
     if doc is None:
-        conn.close()
         return jsonify({"ok": False, "message": "Doctor not found"}), 404
 
     if doc["blacklisted"] == 0:
-        conn.close()
         return jsonify({"ok": False, "message": "Doctor is blocked"}), 403
 
-    cur.execute("""
-        SELECT status FROM doctor_availability
-        WHERE doctor_id = ? AND date = ? AND slot = ?
-    """, (doctor_id, slot_date, slot))
-
-    avail = cur.fetchone()
+    slot_row = repo.schedule.slot(doctor_id, slot)
+    avail = repo.availability.status(doctor_id, slot_date, slot_row["session"]) if slot_row else None
 
-    if not avail or int(avail["status"]) != 1:
-        conn.close()
+    if avail is None or int(avail) != 1 or repo.schedule.is_holiday(doc, slot_date):
         return jsonify({"ok": False, "message": "Slot unavailable"}), 409
 
-    try:
-        conn.execute("BEGIN")
-
-        cur.execute("""
-            SELECT COUNT(*) AS cnt FROM appointments
-            WHERE doctor_id = ? AND date = ? AND slot = ? AND status = 'confirmed'
-        """, (doctor_id, slot_date, slot))
-
-        cnt = cur.fetchone()["cnt"]
-
-        if cnt > 0:
-            conn.execute("ROLLBACK")
-            conn.close()
-            return jsonify({"ok": False, "message": "Slot already booked"}), 409
-
-        now = datetime.utcnow().isoformat()
-
-        cur.execute("""
-            INSERT INTO appointments
-                (patient_name, patient_id, doctor_name, doctor_id, date, slot, department, sr_no, created_at, status)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
+    def book(tx):
+        # Checks capacity, availability and holidays again inside the write.
+        return repo.appointments.book(
+            tx,
             patient_name,
             patient_id,
             doc["name"],
@@ -1218,28 +2110,450 @@ def patient_book_slot():
             slot_date,
             slot,
             doc["department"],
-            None,
-            now,
-            'confirmed'
-        ))
-
-        conn.commit()
-        appointment_id = cur.lastrowid
+            datetime.utcnow().isoformat()
+        )
 
-    except sqlite3.Error:
-        try:
-            conn.execute("ROLLBACK")
-        except Exception:
-            pass
+    try:
+        appointment_id = repo.write(book)
 
-        conn.close()
+    except DatabaseError:
         return jsonify({"ok": False, "message": "Booking failed"}), 500
 
-    conn.close()
+    if appointment_id is None:
+        return jsonify({"ok": False, "message": "Slot already booked"}), 409
 
+    page_cache.invalidate(doc["id"])
+    audit_event("appointment.book", "appointment", appointment_id, doctor_id=doc["id"], date=slot_date, slot=slot)
     return jsonify({"ok": True, "message": "Appointment confirmed", "appointment_id": appointment_id})
 
 
+def recommended_doctors(department_id, limit=None):
+    """A department's open doctors ranked by the doctor_load index (doctorload.py)."""
+    if repo.backend.name != "sqlite":
+        return []
+
+    # The index counts from the day it was last rolled over; roll it the first time it is read each day.
+    as_of = repo.doctors.load_as_of(department_id)
+    if as_of is not None and as_of < doctorload.today_day():
+        repo.write(doctorload.refresh, [d["id"] for d in repo.doctors.in_department(department_id)])
+
+    results = []
+    for d in repo.doctors.recommended(department_id, limit):
+        results.append({
+            "doctor_id": d["id"],
+            "name": d["name"],
+            "experience": d["experience"],
+            "next_free_date": doctorload.day_to_date(d["next_free_day"]),
+            "booked_next_days": d["booked_ahead"],
+            "score": round(d["score"], 2) if d["score"] is not None else None
+        })
+    return results
+
+
+@app.route("/department/<int:department_id>/recommended")
+def department_recommended(department_id):
+    """Doctors of a department best first: soonest free slot, lightest upcoming
+    load, then experience. ?limit=N (default 5)."""
+    if "user_id" not in session:
+        return jsonify({"success": False, "error": "Login required"}), 401
+    if repo.backend.name != "sqlite":
+        return jsonify({"success": False, "error": "Recommendations need the SQLite load index"}), 501
+
+    limit = request.args.get("limit", 5, type=int)
+    if not 1 <= limit <= 500:
+        return jsonify({"success": False, "error": "limit must be 1-500"}), 400
+
+    return jsonify({
+        "success": True,
+        "department_id": department_id,
+        "window_days": doctorload.LOAD_WINDOW_DAYS,
+        "doctors": recommended_doctors(department_id, limit)
+    })
+
+
+# ===================== AUDIT =====================
+AUDIT_PAGE_MAX = 1000
+
+
+def audit_time(value, end=False):
+    """Epoch seconds from an ISO date or datetime; a bare end date includes that whole day."""
+    if value is None:
+        return None
+    if len(value) == 10:
+        day = date.fromisoformat(value) + timedelta(days=1 if end else 0)
+        return datetime.combine(day, datetime.min.time()).timestamp()
+    return datetime.fromisoformat(value).timestamp()
+
+
+@app.route("/admin/audit")
+def admin_audit():
+    """Audit events newest first. Filters: ?actor_id, ?entity_type, ?entity_id,
+    ?action, ?start/?end (ISO date or datetime); ?limit (100) and ?before=<cursor>
+    from next_cursor for the following page."""
+    if session.get('user_role') != 'admin':
+        return jsonify({"success": False, "error": "Admin only"}), 403
+
+    try:
+        start = audit_time(request.args.get("start"))
+        end = audit_time(request.args.get("end"), end=True)
+        before = None
+        if request.args.get("before"):
+            at, event_id = request.args["before"].split(",")
+            before = (float(at), int(event_id))
+    except ValueError:
+        return jsonify({"success": False, "error": "Invalid start, end or cursor"}), 400
+
+    limit = request.args.get("limit", 100, type=int)
+    if not 1 <= limit <= AUDIT_PAGE_MAX:
+        return jsonify({"success": False, "error": f"limit must be 1-{AUDIT_PAGE_MAX}"}), 400
+
+    events = audit_log.query(
+        actor_id=request.args.get("actor_id", type=int),
+        entity_type=request.args.get("entity_type"),
+        entity_id=request.args.get("entity_id"),
+        action=request.args.get("action"),
+        start=start,
+        end=end,
+        before=before,
+        limit=limit
+    )
+    for event in events:
+        event["time"] = datetime.fromtimestamp(event["at"]).isoformat(timespec="seconds")
+
+    return jsonify({
+        "success": True,
+        "events": events,
+        "next_cursor": f"{events[-1]['at']!r},{events[-1]['id']}" if len(events) == limit else None
+    })
+
+
+# ===================== BATCH BOOKING =====================
+BATCH_MAX_ITEMS = 5000
+IDEMPOTENCY_TTL_SECONDS = 24 * 3600
+
+
+class BatchRejected(Exception):
+    """Raised inside the write to roll back an atomic batch that had failures."""
+
+    def __init__(self, response):
+        super().__init__("atomic batch rejected")
+        self.response = response
+
+
+def apply_batch_item(tx, item, doctors, patients, created_at):
+    """Book, move or cancel one appointment; returns its result entry."""
+    op = item.get("op")
+
+    if op == "cancel":
+        appointment_id = repo.appointments.cancel(tx, item.get("appointment_id"))
+        if appointment_id is None:
+            return {"op": op, "ok": False, "error": "not_found_or_not_confirmed"}
+        return {"op": op, "ok": True, "appointment_id": appointment_id}
+
+    if op not in ("book", "move"):
+        return {"op": op, "ok": False, "error": "unknown_op"}
+
+    doc = doctors.get(item.get("doctor_id"))
+    if doc is None:
+        return {"op": op, "ok": False, "error": "doctor_not_found"}
+
+    if op == "move":
+        appointment_id = repo.appointments.move(tx, item.get("appointment_id"), doc["id"], item["date"],
+                                                item["slot"])
+    else:
+        patient = patients.get(item.get("patient"))
+        if patient is None:
+            return {"op": op, "ok": False, "error": "patient_not_found"}
+        appointment_id = repo.appointments.book(tx, patient["username"], patient["user_id"], doc["name"],
+                                                doc["id"], item["date"], item["slot"], doc["department"],
+                                                created_at)
+
+    if appointment_id is None:
+        return {"op": op, "ok": False, "error": "slot_unavailable"}
+    return {"op": op, "ok": True, "appointment_id": appointment_id}
+
+
+def validate_batch_items(items):
+    if not isinstance(items, list) or not items:
+        raise ValueError("items must be a non-empty list")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise ValueError(f"At most {BATCH_MAX_ITEMS} items per batch")
+
+    for n, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise ValueError(f"item {n} must be an object")
+        if item.get("op") not in ("book", "move", "cancel"):
+            raise ValueError(f"item {n} needs an op of book, move or cancel")
+        for field in ("doctor_id", "appointment_id"):
+            if item.get(field) is not None:
+                item[field] = int(item[field])
+        if item["op"] in ("move", "cancel") and item.get("appointment_id") is None:
+            raise ValueError(f"item {n} needs an appointment_id")
+        if item["op"] == "book" and not (isinstance(item.get("patient"), str) and item["patient"]):
+            raise ValueError(f"item {n} needs a patient username")
+        if item["op"] in ("book", "move"):
+            item["date"] = date.fromisoformat(str(item.get("date"))).isoformat()
+            if not (isinstance(item.get("slot"), str) and item["slot"]):
+                raise ValueError(f"item {n} needs a slot")
+
+
+@app.route("/appointments/batch", methods=["POST"])
+def appointments_batch():
+    """Book, move or cancel many appointments in one transaction (staff only).
+
+    {"items": [{"op": "book", "patient": <username>, "doctor_id", "date", "slot"},
+               {"op": "move", "appointment_id", "doctor_id", "date", "slot"},
+               {"op": "cancel", "appointment_id"}],
+     "atomic": false}
+
+    Every item gets a result in request order. With "atomic": true any
+    failed item rolls the whole batch back (409). An Idempotency-Key header
+    makes retries safe: a repeated key with the same body returns the stored
+    response instead of applying the batch again.
+    """
+    if session.get('user_role') != 'admin':
+        return jsonify({"success": False, "error": "Staff only"}), 403
+
+    data = request.get_json(silent=True) or {}
+    items = data.get("items")
+    try:
+        validate_batch_items(items)
+    except (TypeError, ValueError) as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    key = request.headers.get("Idempotency-Key") or data.get("idempotency_key")
+    owner = str(session["user_id"])
+    request_hash = hashlib.sha256(json.dumps(
+        {"items": items, "atomic": bool(data.get("atomic"))}, sort_keys=True, default=str
+    ).encode()).hexdigest()
+
+    def run(tx):
+        now = time.time()
+        if key:
+            previous = repo.idempotency.get(tx, owner, key)
+            if previous:
+                return previous, True
+            repo.idempotency.purge(tx, now - IDEMPOTENCY_TTL_SECONDS)
+
+        doctors = repo.doctors.many(sorted({i.get("doctor_id") for i in items if i.get("doctor_id")}), tx)
+        patients = repo.patients.by_usernames(sorted({i["patient"] for i in items if i.get("patient")}), tx)
+        created_at = datetime.utcnow().isoformat()
+
+        results = []
+        for n, item in enumerate(items):
+            result = apply_batch_item(tx, item, doctors, patients, created_at)
+            result["index"] = n
+            results.append(result)
+
+        failed = sum(1 for r in results if not r["ok"])
+        response = {
+            "success": failed == 0,
+            "atomic": bool(data.get("atomic")),
+            "applied": len(results) - failed,
+            "failed": failed,
+            "results": results
+        }
+        if failed and data.get("atomic"):
+            raise BatchRejected(response)
+
+        body = json.dumps(response)
+        if key:
+            repo.idempotency.save(tx, owner, key, request_hash, 200, body, now)
+        return {"request_hash": request_hash, "status_code": 200, "response": body}, False
+
+    try:
+        stored, replayed = repo.write(run)
+    except BatchRejected as e:
+        e.response["applied"] = 0
+        return jsonify(e.response), 409
+    except IntegrityError:
+        # A concurrent request with the same key committed first.
+        return jsonify({"success": False, "error": "Request with this Idempotency-Key already in progress"}), 409
+    except DatabaseError:
+        return jsonify({"success": False, "error": "Batch failed"}), 500
+
+    if replayed and stored["request_hash"] != request_hash:
+        return jsonify({"success": False, "error": "Idempotency-Key reused with a different request"}), 422
+
+    if not replayed:
+        for item, result in zip(items, json.loads(stored["response"])["results"]):
+            if result["ok"]:
+                audit_event(f"appointment.{item['op']}", "appointment", result["appointment_id"], batch=True,
+                            **{f: item[f] for f in ("doctor_id", "patient", "date", "slot") if f in item})
+
+    headers = {"Idempotent-Replayed": "true"} if replayed else {}
+    return app.response_class(stored["response"], status=stored["status_code"], mimetype="application/json",
+                              headers=headers)
+
+
+# ===================== VISITS =====================
+VISIT_FIELDS = ("visit_type", "tests_done", "diagnosis", "prescription", "medicines")
+VISIT_BATCH_MAX = 5000
+
+
+class VisitRejected(Exception):
+    """Raised inside the write so a batch with one bad visit records none."""
+
+    def __init__(self, index, error, status=409):
+        super().__init__(error)
+        self.index = index
+        self.error = error
+        self.status = status
+
+
+def validate_visits(items):
+    if not isinstance(items, list) or not items:
+        raise ValueError("visits must be a non-empty list")
+    if len(items) > VISIT_BATCH_MAX:
+        raise ValueError(f"At most {VISIT_BATCH_MAX} visits per batch")
+
+    seen = set()
+    for n, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise ValueError(f"visit {n} must be an object")
+        if item.get("appointment_id") is None:
+            raise ValueError(f"visit {n} needs an appointment_id")
+        item["appointment_id"] = int(item["appointment_id"])
+        if item["appointment_id"] in seen:
+            raise ValueError(f"visit {n} repeats appointment {item['appointment_id']}")
+        seen.add(item["appointment_id"])
+        for field in ("visit_type", "diagnosis"):
+            if item.get(field) is not None and not isinstance(item[field], str):
+                raise ValueError(f"visit {n}: {field} must be a string")
+        try:
+            clinical.normalise(item)
+        except ValueError as e:
+            raise ValueError(f"visit {n}: {e}") from None
+
+
+def record_visits(tx, items, doctor_id=None):
+    """Insert one visit per item, linked to its appointment; `doctor_id` limits them to that doctor's."""
+    appointments = repo.appointments.many([i["appointment_id"] for i in items], tx)
+    created_at = datetime.utcnow().isoformat()
+
+    visits = []
+    for n, item in enumerate(items):
+        appt = appointments.get(item["appointment_id"])
+        if appt is None:
+            raise VisitRejected(n, "appointment_not_found", 404)
+        if doctor_id is not None and appt["doctor_id"] != doctor_id:
+            raise VisitRejected(n, "not_your_appointment", 403)
+        if appt["status"] == "cancelled":
+            raise VisitRejected(n, "appointment_cancelled")
+
+        visit = {field: item.get(field) for field in VISIT_FIELDS}
+        visit.update(patient_name=appt["patient_name"], appointment_id=appt["id"], doctor_id=appt["doctor_id"],
+                     visit_date=appt["date"], created_at=created_at)
+        visits.append(visit)
+
+    numbers = repo.visits.create_many(tx, visits)
+    return [{"index": n, "appointment_id": v["appointment_id"], "patient": v["patient_name"], "visit_no": no}
+            for n, (v, no) in enumerate(zip(visits, numbers))]
+
+
+def save_visits(items):
+    """(json, status) for recording `items` in one transaction as the logged-in doctor or admin."""
+    doctor_id = None
+    if session.get('user_role') == 'doctor':
+        doctor_id = session_doctor_id()
+        if doctor_id is None:
+            return {"success": False, "error": "Doctor record not found"}, 403
+    elif session.get('user_role') != 'admin':
+        return {"success": False, "error": "Doctors only"}, 403
+
+    try:
+        validate_visits(items)
+    except (TypeError, ValueError) as e:
+        return {"success": False, "error": str(e)}, 400
+
+    try:
+        results = repo.write(record_visits, items, doctor_id)
+    except VisitRejected as e:
+        return {"success": False, "error": e.error, "index": e.index}, e.status
+    except IntegrityError:
+        return {"success": False, "error": "A visit is already recorded for one of these appointments"}, 409
+    except DatabaseError:
+        return {"success": False, "error": "Saving visits failed"}, 500
+
+    for r in results:
+        audit_event("visit.create", "visit", f"{r['patient']}/{r['visit_no']}", appointment_id=r["appointment_id"])
+    return {"success": True, "recorded": len(results), "visits": results}, 201
+
+
+@app.route("/doctor/visits", methods=["POST"])
+def record_visit():
+    """Record the visit of one appointment:
+    {"appointment_id", "visit_type", "diagnosis",
+     "medicines": [{"name", "dose", "frequency", "days"}], "tests_done": [{"name", "result", "unit"}],
+     "prescription": {"advice", "follow_up"}}.
+    Medicines, tests and prescription may also be sent as free text (see clinical.py).
+    The patient's next visit_no is allocated with the insert."""
+    body, status = save_visits([request.get_json(silent=True) or {}])
+    if status == 201:
+        body = {"success": True, **body["visits"][0]}
+        del body["index"]
+    return jsonify(body), status
+
+
+@app.route("/doctor/visits/batch", methods=["POST"])
+def record_visits_batch():
+    """{"visits": [...]} recorded in one transaction; one bad visit rejects the batch.
+    Doctors record their own appointments' visits, admins any (end-of-day entry)."""
+    data = request.get_json(silent=True) or {}
+    body, status = save_visits(data.get("visits"))
+    return jsonify(body), status
+
+
+VISIT_SEARCH_MAX = 1000
+
+
+@app.route("/visits/search")
+def visit_search():
+    """Visits that prescribed a medicine (?medicine=) or ran a test (?test=), newest first.
+
+    ?start/?end bound the visit date (default: this month), ?match=prefix
+    matches names starting with the term, ?limit caps the visits (200).
+    Doctors see their own visits, admins everyone's; the response also
+    lists the distinct patients.
+    """
+    role = session.get('user_role')
+    if role not in ('doctor', 'admin'):
+        return jsonify({"success": False, "error": "Doctors only"}), 403
+    if repo.backend.name != "sqlite":
+        return jsonify({"success": False, "error": "Visit search needs the SQLite visit_items index"}), 501
+
+    kind = "medicine" if request.args.get("medicine") else "test"
+    name = (request.args.get(kind) or "").strip()
+    if not name:
+        return jsonify({"success": False, "error": "Pass ?medicine= or ?test="}), 400
+
+    try:
+        today = date.today()
+        start = date.fromisoformat(request.args.get("start") or today.replace(day=1).isoformat()).isoformat()
+        end = date.fromisoformat(request.args.get("end") or today.isoformat()).isoformat()
+    except ValueError:
+        return jsonify({"success": False, "error": "Invalid date"}), 400
+
+    limit = request.args.get("limit", 200, type=int)
+    if not 1 <= limit <= VISIT_SEARCH_MAX:
+        return jsonify({"success": False, "error": f"limit must be 1-{VISIT_SEARCH_MAX}"}), 400
+
+    doctor_id = session_doctor_id() if role == 'doctor' else request.args.get("doctor_id", type=int)
+    if role == 'doctor' and doctor_id is None:
+        return jsonify({"success": False, "error": "Doctor record not found"}), 403
+    visits = repo.visits.search(kind, name, start, end, prefix=request.args.get("match") == "prefix",
+                                doctor_id=doctor_id, limit=limit)
+
+    return jsonify({
+        "success": True,
+        kind: name,
+        "start": start,
+        "end": end,
+        "visits": visits,
+        "patients": sorted({v["patient_name"] for v in visits if v["patient_name"]})
+    })
+
+
 @app.route("/patienthome.html")
 def patienthome():
     patient_name = session.get('patient_name')
@@ -1258,26 +2572,22 @@ def patientdepartmentview(department_id):
     if session.get('user_role') != 'patient' or not patient_name:
         return redirect(url_for('login'))
 
-    conn = get_db_connection()
-
-    department = conn.execute(
-        "SELECT department_id, name, description, doctors_registered FROM departments WHERE department_id = ?",
-        (department_id,)
-    ).fetchone()
-
-    doctors = conn.execute(
-        "SELECT id, name, experience, blacklisted FROM doctors WHERE department = ?",
-        (department['name'],)
-    ).fetchall() if department else []
+    department = repo.departments.get(department_id)
+    doctors = repo.doctors.in_department_named(department['name']) if department else []
 
-    patient_data = fetch_patient_dashboard_data(patient_name)
-    conn.close()
+    # Least-loaded doctors with the soonest free slot first, so bookings spread out.
+    ranked = {d["doctor_id"]: d for d in recommended_doctors(department_id)}
+    order = {doctor_id: n for n, doctor_id in enumerate(ranked)}
+    doctors = sorted(doctors, key=lambda d: order.get(d["id"], len(order)))
+    for d in doctors:
+        d["next_free_date"] = ranked[d["id"]]["next_free_date"] if d["id"] in ranked else None
+        d["recommended"] = order.get(d["id"]) == 0
 
     return render_template(
         "patientdepartmentview.html",
-        data=patient_data,
-        department=dict(department) if department else None,
-        doctors=[dict(d) for d in doctors]
+        data=fetch_patient_dashboard_data(patient_name),
+        department=department,
+        doctors=doctors
     )
 
 
@@ -1323,5 +2633,7 @@ def _list_endpoints():
 
 # ===================== RUN =====================
 if __name__ == "__main__":
+    create_app()
     init_db()
+    schedule_recurring_jobs()
     app.run(debug=True)
@@ -0,0 +1,260 @@
+"""Move old appointment and availability rows into a cold archive database.
+
+The hot tables in hospital.db only keep rows newer than a horizon; older
+rows are copied into hospital_archive.db beside it (ATTACHed as `archive`) and
+deleted from the hot table in small batches, so no single transaction
+holds the write lock for long. Rows keep their ids, so the hot tables use
+AUTOINCREMENT ids that are never handed out again, and a clash with an
+archived id fails the batch rather than overwriting history.
+
+Delete triggers that keep derived state current should skip rows being
+archived: each batch sets a flag row in `archival_running` inside its own
+transaction, so no other connection ever sees it, and such triggers add
+`skip_archival(event)` to their WHEN clause. The batch records its days in
+`rollup_dirty` itself.
+
+`attach_archive` also creates TEMP views (`appointments_all`,
+`doctor_availability_all`) that union both sides for history pages and
+reports.
+
+    python archive.py                    # one pass with the default horizons
+    python archive.py --enable-incremental-vacuum
+    python archive.py --schedule         # enqueue the recurring job
+"""
+import argparse
+import os
+import sqlite3
+import time
+from datetime import date, timedelta
+from urllib.parse import quote
+
+
+ARCHIVE_DATABASE_NAME = os.getenv("ARCHIVE_DATABASE_NAME", "hospital_archive.db")
+APPOINTMENT_HORIZON_DAYS = int(os.getenv("ARCHIVE_APPOINTMENT_HORIZON_DAYS", "180"))
+AVAILABILITY_HORIZON_DAYS = int(os.getenv("ARCHIVE_AVAILABILITY_HORIZON_DAYS", "7"))
+ARCHIVE_BATCH_SIZE = 1000
+ARCHIVE_INTERVAL_SECONDS = 24 * 3600
+VACUUM_PAGES_PER_RUN = 2000
+
+ARCHIVED_TABLES = {
+    "appointments": ["CREATE INDEX IF NOT EXISTS archive.idx_arch_appt_patient ON appointments(patient_name, date)",
+                     "CREATE INDEX IF NOT EXISTS archive.idx_arch_appt_doctor ON appointments(doctor_id, date)"],
+    "doctor_availability": ["CREATE INDEX IF NOT EXISTS archive.idx_arch_avail_doctor ON doctor_availability(doctor_id, date)"],
+}
+
+
+# For the WHEN clause of delete triggers on the archived tables.
+NOT_ARCHIVING = "NOT EXISTS (SELECT 1 FROM archival_running)"
+
+
+def skip_archival(event):
+    """Extra WHEN condition for a trigger on `event` ("AFTER DELETE ON appointments", ...)."""
+    if event.startswith("AFTER DELETE ON ") and event.split()[-1] in ARCHIVED_TABLES:
+        return f" AND {NOT_ARCHIVING}"
+    return ""
+
+
+def init_schema(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS archival_running (flag INTEGER PRIMARY KEY)")
+
+
+def archive_file(conn):
+    """The archive file beside `conn`'s main database (an absolute ARCHIVE_DATABASE_NAME is used as is)."""
+    main = next(r[2] for r in conn.execute("PRAGMA database_list") if r[1] == "main")
+    return os.path.join(os.path.dirname(main), ARCHIVE_DATABASE_NAME)
+
+
+def ensure_autoincrement(conn, table, archive_path=None):
+    """Rebuild `table` with an AUTOINCREMENT id if it has a plain INTEGER PRIMARY KEY.
+
+    Its sequence starts past every id already in the hot table or the
+    archive, so archived ids are not handed out again. Runs inside the
+    caller's transaction; indexes are recreated, triggers are the caller's.
+    """
+    ddl = conn.execute("SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()[0]
+    if "AUTOINCREMENT" in ddl.upper():
+        return False
+
+    indexes = [r[0] for r in conn.execute(
+        "SELECT sql FROM main.sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (table,))]
+    # Rename the old table away rather than the new one in, so the stored DDL keeps its plain name.
+    conn.execute(f"ALTER TABLE main.{table} RENAME TO {table}_old")
+    conn.execute(ddl.replace("id INTEGER PRIMARY KEY", "id INTEGER PRIMARY KEY AUTOINCREMENT", 1))
+    conn.execute(f"INSERT INTO main.{table} SELECT * FROM main.{table}_old")
+    conn.execute(f"DROP TABLE main.{table}_old")
+    for sql in indexes:
+        conn.execute(sql)
+
+    top = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM main.{table}").fetchone()[0]
+    archive_path = archive_path or archive_file(conn)
+    if os.path.exists(archive_path):
+        # ATTACH is not allowed inside the migration's transaction; read the archive separately.
+        cold = sqlite3.connect(f"file:{quote(os.path.abspath(archive_path))}?mode=ro", uri=True)
+        try:
+            if _columns(cold, "main", table):
+                top = max(top, cold.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0])
+        finally:
+            cold.close()
+    conn.execute("DELETE FROM sqlite_sequence WHERE name = ?", (table,))
+    conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table, top))
+    return True
+
+
+def _columns(conn, schema, table):
+    return [r[1] for r in conn.execute(f"PRAGMA {schema}.table_info({table})")]
+
+
+def _sync_archive_table(conn, table):
+    if not _columns(conn, "archive", table):
+        ddl = conn.execute(
+            "SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table,)
+        ).fetchone()[0]
+        conn.execute(ddl.replace(f"CREATE TABLE {table}", f"CREATE TABLE IF NOT EXISTS archive.{table}", 1))
+
+    # Hot tables gain columns over time; keep the archive a superset.
+    archived = set(_columns(conn, "archive", table))
+    for col in conn.execute(f"PRAGMA main.table_info({table})").fetchall():
+        if col[1] not in archived:
+            conn.execute(f"ALTER TABLE archive.{table} ADD COLUMN {col[1]} {col[2]}")
+
+    for ddl in ARCHIVED_TABLES[table]:
+        conn.execute(ddl)
+
+
+def attach_archive(conn, path=None, create=False, readonly=False):
+    """ATTACH the archive (by default `archive_file(conn)`) to `conn` and create the *_all union views.
+
+    Without an archive file (and `create` False) the views cover the hot
+    tables only, so callers can always query `appointments_all`. Pass
+    `readonly` for connections opened with uri=True in mode=ro.
+    """
+    path = path or archive_file(conn)
+    attached = False
+    if create or os.path.exists(path):
+        is_new = not os.path.exists(path)
+        target = f"file:{quote(os.path.abspath(path))}?mode=ro" if readonly and not create else path
+        if not any(r[1] == "archive" for r in conn.execute("PRAGMA database_list")):
+            conn.execute("ATTACH DATABASE ? AS archive", (target,))
+        if is_new:
+            conn.execute("PRAGMA archive.auto_vacuum = INCREMENTAL")
+        for table in ARCHIVED_TABLES:
+            if create:
+                _sync_archive_table(conn, table)
+        attached = all(_columns(conn, "archive", t) for t in ARCHIVED_TABLES)
+
+    for table in ARCHIVED_TABLES:
+        cols = ", ".join(_columns(conn, "main", table))
+        if attached:
+            body = f"SELECT {cols} FROM main.{table} UNION ALL SELECT {cols} FROM archive.{table}"
+        else:
+            body = f"SELECT {cols} FROM main.{table}"
+        conn.execute(f"DROP VIEW IF EXISTS temp.{table}_all")
+        conn.execute(f"CREATE TEMP VIEW {table}_all AS {body}")
+
+    return attached
+
+
+def archive_table(conn, table, cutoff, batch_size=ARCHIVE_BATCH_SIZE):
+    cols = ", ".join(_columns(conn, "main", table))
+    batch = f"SELECT id FROM main.{table} WHERE date < ? ORDER BY id LIMIT ?"
+    moved = 0
+
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("INSERT INTO archival_running (flag) VALUES (1)")
+            # Plain INSERT: an id already in the archive is an error, never a silent overwrite.
+            cur = conn.execute(f"""
+                INSERT INTO archive.{table} ({cols})
+                SELECT {cols} FROM main.{table} WHERE id IN ({batch})
+            """, (cutoff, batch_size))
+            n = cur.rowcount
+            # The rollup triggers are skipped below; the reports still recompute these days.
+            conn.execute(f"""
+                INSERT INTO rollup_dirty (doctor_id, date)
+                SELECT DISTINCT doctor_id, date FROM main.{table}
+                WHERE id IN ({batch}) AND doctor_id IS NOT NULL AND date IS NOT NULL
+                ON CONFLICT DO NOTHING
+            """, (cutoff, batch_size))
+            conn.execute(f"DELETE FROM main.{table} WHERE id IN ({batch})", (cutoff, batch_size))
+            conn.execute("DELETE FROM archival_running")
+            conn.execute("COMMIT")
+
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        moved += n
+        if n < batch_size:
+            return moved
+        # Let waiting writers in between batches.
+        time.sleep(0.01)
+
+
+def incremental_vacuum(conn, schema="main", pages=VACUUM_PAGES_PER_RUN):
+    mode = conn.execute(f"PRAGMA {schema}.auto_vacuum").fetchone()[0]
+    if mode != 2:
+        return False
+    conn.execute(f"PRAGMA {schema}.incremental_vacuum({int(pages)})").fetchall()
+    return True
+
+
+def enable_incremental_vacuum(conn):
+    # Switching auto_vacuum mode on an existing file needs one full VACUUM.
+    conn.execute("PRAGMA main.auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+
+
+def run_archival(conn, appointment_horizon_days=APPOINTMENT_HORIZON_DAYS,
+                 availability_horizon_days=AVAILABILITY_HORIZON_DAYS,
+                 archive_path=None, batch_size=ARCHIVE_BATCH_SIZE):
+    """`conn` must be in autocommit mode (isolation_level=None)."""
+    attach_archive(conn, archive_path, create=True)
+    today = date.today()
+
+    stats = {
+        "appointments": archive_table(
+            conn, "appointments", (today - timedelta(days=appointment_horizon_days)).isoformat(), batch_size),
+        "doctor_availability": archive_table(
+            conn, "doctor_availability", (today - timedelta(days=availability_horizon_days)).isoformat(), batch_size),
+    }
+    # Packed availability (slotmaps.py) is only read for current and future days.
+    stats["day_bitmaps"] = conn.execute(
+        "DELETE FROM day_bitmaps WHERE day < unixepoch(?) / 86400",
+        ((today - timedelta(days=availability_horizon_days)).isoformat(),)
+    ).rowcount
+    stats["vacuumed_main"] = incremental_vacuum(conn, "main")
+    stats["vacuumed_archive"] = incremental_vacuum(conn, "archive")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive old appointments and availability rows")
+    parser.add_argument("--appointment-horizon-days", type=int, default=APPOINTMENT_HORIZON_DAYS)
+    parser.add_argument("--availability-horizon-days", type=int, default=AVAILABILITY_HORIZON_DAYS)
+    parser.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE)
+    parser.add_argument("--enable-incremental-vacuum", action="store_true",
+                        help="switch hospital.db to incremental auto_vacuum (runs a full VACUUM once)")
+    parser.add_argument("--schedule", action="store_true", help="enqueue the recurring archival job and exit")
+    args = parser.parse_args()
+
+    import app
+
+    app.create_app()
+    if args.schedule:
+        print("Scheduled archival job:", app.schedule_archival(delay=0))
+        return
+
+    conn = app.get_db_connection()
+    conn.isolation_level = None
+    try:
+        if args.enable_incremental_vacuum:
+            enable_incremental_vacuum(conn)
+        print(run_archival(conn, args.appointment_horizon_days, args.availability_horizon_days,
+                           batch_size=args.batch_size))
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
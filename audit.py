@@ -0,0 +1,240 @@
+"""Append-only audit trail of admin changes and bookings, in its own database file.
+
+record() only appends the event to an in-process buffer, so it adds nothing
+to the write transaction of the change it describes. A per-process thread
+flushes the buffer to audit.db in one transaction per batch: every
+FLUSH_INTERVAL seconds, or sooner once FLUSH_BATCH events are waiting.
+Keeping the trail in a separate file means these inserts never contend
+with hospital.db's writer.
+
+Nothing is dropped when the buffer outgrows MAX_BUFFERED (audit.db
+unreachable, say): the recording request tries one synchronous flush,
+which applies back-pressure. That flush is bounded so a broken audit.db
+cannot stall every request: it waits at most BACKPRESSURE_TIMEOUT for the
+file's lock, is skipped while another flush is running, and after a
+failure no request retries for RETRY_INTERVAL (the thread keeps trying).
+close() flushes what is left within a time limit; it runs at interpreter
+exit and from gunicorn's worker_exit hook.
+
+Events are indexed by actor, by entity and by time; query() pages through
+them newest first with an (at, id) cursor.
+"""
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import quote
+
+
+AUDIT_DATABASE_NAME = os.getenv("AUDIT_DATABASE_NAME", "audit.db")
+FLUSH_INTERVAL = 1.0
+FLUSH_BATCH = 500
+MAX_BUFFERED = 20000
+LOCK_TIMEOUT = 10.0
+BACKPRESSURE_TIMEOUT = 0.5
+RETRY_INTERVAL = 5.0
+CLOSE_TIMEOUT = 5.0
+
+COLUMNS = ("at", "actor_id", "actor_role", "action", "entity_type", "entity_id", "details", "ip")
+
+
+def init_schema(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS audit_events (
+            id INTEGER PRIMARY KEY,
+            at REAL NOT NULL,
+            actor_id INTEGER,
+            actor_role TEXT,
+            action TEXT NOT NULL,
+            entity_type TEXT NOT NULL,
+            entity_id TEXT,
+            details TEXT,
+            ip TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_audit_actor ON audit_events(actor_id, at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_audit_entity ON audit_events(entity_type, entity_id, at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_audit_at ON audit_events(at)")
+    # Append-only: the trail cannot be edited through SQL either.
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS audit_events_no_update BEFORE UPDATE ON audit_events
+        BEGIN SELECT RAISE(ABORT, 'audit_events is append-only'); END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS audit_events_no_delete BEFORE DELETE ON audit_events
+        BEGIN SELECT RAISE(ABORT, 'audit_events is append-only'); END
+    """)
+
+
+class AuditLog:
+    def __init__(self, path=AUDIT_DATABASE_NAME, flush_interval=FLUSH_INTERVAL, flush_batch=FLUSH_BATCH,
+                 max_buffered=MAX_BUFFERED):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.max_buffered = max_buffered
+        self._lock = threading.Lock()
+        # Held while writing to audit.db, so flushes from the thread, close() and back-pressure never interleave.
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self.reset()
+        atexit.register(self.close)
+
+    def reset(self):
+        self._pid = None
+        self._thread = None
+        self._buffer = []
+        self._closed = False
+        self._conn = None
+        self._retry_at = 0.0
+        self.flushed = self.batches = self.errors = 0
+
+    def _connect(self):
+        # Opening runs the schema statements, which wait for the lock too; keep that short.
+        conn = sqlite3.connect(self.path, timeout=BACKPRESSURE_TIMEOUT, check_same_thread=False)
+        conn.isolation_level = None
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        init_schema(conn)
+        return conn
+
+    def _ensure_started(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        # Threads do not survive fork, so each worker process starts its own.
+        if self._pid != os.getpid():
+            self._buffer = []
+            self._conn = None
+        self._pid = os.getpid()
+        self._closed = False
+        self._thread = threading.Thread(target=self._loop, name="audit-writer", daemon=True)
+        self._thread.start()
+
+    def record(self, action, entity_type, entity_id=None, actor_id=None, actor_role=None, details=None, ip=None):
+        event = (time.time(), actor_id, actor_role, action, entity_type,
+                 None if entity_id is None else str(entity_id),
+                 json.dumps(details, default=str) if details else None, ip)
+        with self._lock:
+            self._ensure_started()
+            self._buffer.append(event)
+            backlog = len(self._buffer)
+            if backlog >= self.flush_batch:
+                self._wake.notify()
+        if backlog > self.max_buffered and time.monotonic() >= self._retry_at:
+            # Never queue behind a flush already in progress; that one is draining the same buffer.
+            if self._flush_lock.acquire(blocking=False):
+                try:
+                    self._flush(busy_timeout=BACKPRESSURE_TIMEOUT)
+                finally:
+                    self._flush_lock.release()
+
+    def _take(self):
+        with self._lock:
+            events, self._buffer = self._buffer, []
+            return events
+
+    def flush(self):
+        """Write everything buffered so far; returns how many events were written."""
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self, busy_timeout=None):
+        """flush() with _flush_lock held; `busy_timeout` caps the wait for audit.db's lock."""
+        events = self._take()
+        if not events:
+            return 0
+        try:
+            if self._conn is None:
+                self._conn = self._connect()
+            self._conn.execute(f"PRAGMA busy_timeout = {int((busy_timeout or LOCK_TIMEOUT) * 1000)}")
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.executemany(f"""
+                INSERT INTO audit_events ({", ".join(COLUMNS)}) VALUES ({", ".join("?" for _ in COLUMNS)})
+            """, events)
+            self._conn.execute("COMMIT")
+        except Exception as e:
+            if self._conn is not None and self._conn.in_transaction:
+                self._conn.execute("ROLLBACK")
+            # Put them back in order; the next flush retries.
+            with self._lock:
+                self._buffer[:0] = events
+            self._retry_at = time.monotonic() + RETRY_INTERVAL
+            self.errors += 1
+            print("Audit flush failed:", e)
+            return 0
+        self.flushed += len(events)
+        self.batches += 1
+        return len(events)
+
+    def _loop(self):
+        while True:
+            with self._lock:
+                if self._closed:
+                    return
+                if len(self._buffer) < self.flush_batch:
+                    self._wake.wait(self.flush_interval)
+            self.flush()
+
+    def close(self, timeout=CLOSE_TIMEOUT):
+        """Stop the thread and flush what is buffered, giving up after `timeout` seconds."""
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            self._closed = True
+            self._wake.notify()
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                if not self._buffer:
+                    return
+            if not self.flush():
+                time.sleep(0.1)
+        print(f"Audit log closed with {len(self._buffer)} events unwritten")
+
+    def query(self, actor_id=None, entity_type=None, entity_id=None, action=None, start=None, end=None,
+              before=None, limit=100):
+        """Events newest first; `before` is the (at, id) of the last event of the previous page.
+        Events still in this process's buffer are flushed first."""
+        self.flush()
+        where, params = [], []
+        for column, value in (("actor_id", actor_id), ("entity_type", entity_type),
+                              ("entity_id", None if entity_id is None else str(entity_id)), ("action", action)):
+            if value is not None:
+                where.append(f"{column} = ?")
+                params.append(value)
+        if start is not None:
+            where.append("at >= ?")
+            params.append(start)
+        if end is not None:
+            where.append("at < ?")
+            params.append(end)
+        if before is not None:
+            where.append("(at, id) < (?, ?)")
+            params += list(before)
+        if not os.path.exists(self.path):
+            return []
+
+        conn = sqlite3.connect(f"file:{quote(os.path.abspath(self.path))}?mode=ro", uri=True, timeout=10)
+        conn.row_factory = sqlite3.Row
+        try:
+            rows = conn.execute(f"""
+                SELECT * FROM audit_events
+                {"WHERE " + " AND ".join(where) if where else ""}
+                ORDER BY at DESC, id DESC
+                LIMIT ?
+            """, (*params, limit)).fetchall()
+        finally:
+            conn.close()
+
+        events = []
+        for r in rows:
+            event = dict(r)
+            event["details"] = json.loads(event["details"]) if event["details"] else None
+            events.append(event)
+        return events
+
+    def stats(self):
+        return {"buffered": len(self._buffer), "flushed": self.flushed, "batches": self.batches,
+                "errors": self.errors}
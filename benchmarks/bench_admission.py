@@ -0,0 +1,142 @@
+"""Booking latency under an AI flood, with and without admission control.
+
+    python benchmarks/bench_admission.py [--duration 20] [--book-clients 8] [--page-clients 8]
+                                         [--ai-clients 32] [--ai-delay 2.0] [--threads 8]
+
+Seeds a throwaway database, starts benchmarks/fake_llm.py in-process
+(every AI reply takes --ai-delay seconds) and runs `serve.py --preset
+gthread` against it twice, with ADMISSION_ENABLED=0 and =1. Each run
+drives, for --duration seconds:
+
+* --book-clients patients looping over a doctor's day slots and a booking
+  attempt (critical);
+* --page-clients patients loading the patient home page (normal);
+* --ai-clients patients looping on /ai/chat (best effort), more of them
+  than the worker has threads.
+
+Prints requests/s, p95 latency and 503s per tier. With admission control
+the AI clients should get fast 503s once they hold their share of the
+threads, and the critical p95 should stay near its unloaded value.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_workers import login, percentile, seed, serve, stop, wait_until_up  # noqa: E402
+
+
+def run_load(base, duration, clients, doctor_ids, dates):
+    """clients: {tier: count}. Returns {tier: (latencies of 2xx-4xx answers, 503 count, other errors)}."""
+    def critical(opener):
+        doctor, day = random.choice(doctor_ids), random.choice(dates)
+        if random.random() < .5:
+            return opener.open(f"{base}/doctor/{doctor}/slots?date={day}", timeout=60)
+        body = json.dumps({"doctor_id": doctor, "date": day, "slot": "morning"}).encode()
+        return opener.open(urllib.request.Request(f"{base}/patient/book", body,
+                                                  {"Content-Type": "application/json"}), timeout=60)
+
+    def normal(opener):
+        return opener.open(f"{base}/patienthome.html", timeout=60)
+
+    def best_effort(opener):
+        # A fresh question every time, so the local FAQ answers never stand in for the LLM call.
+        body = json.dumps({"message": f"Question {random.random()} about my medication schedule"}).encode()
+        return opener.open(urllib.request.Request(f"{base}/ai/chat", body,
+                                                  {"Content-Type": "application/json"}), timeout=60)
+
+    calls = {"critical": critical, "normal": normal, "best_effort": best_effort}
+    results = {tier: ([], [0], [0]) for tier in clients}
+    start = threading.Event()
+    deadline = [0.0]
+    user = iter(range(sum(clients.values())))
+
+    def client(tier, opener):
+        latencies, shed, errors = results[tier]
+        start.wait()
+        while time.monotonic() < deadline[0]:
+            t0 = time.perf_counter()
+            try:
+                calls[tier](opener).read()
+            except urllib.error.HTTPError as e:
+                if e.code == 503:
+                    shed[0] += 1
+                    # A real client honours Retry-After; here just don't spin.
+                    time.sleep(.1)
+                    continue
+            except (urllib.error.URLError, OSError):
+                errors[0] += 1
+                continue
+            latencies.append(time.perf_counter() - t0)
+
+    threads = [threading.Thread(target=client, args=(tier, login(base, f"pat{next(user)}")))
+               for tier, count in clients.items() for _ in range(count)]
+    for t in threads:
+        t.start()
+    deadline[0] = time.monotonic() + duration
+    start.set()
+    for t in threads:
+        t.join()
+    return {tier: (sorted(lat), shed[0], errors[0]) for tier, (lat, shed, errors) in results.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--book-clients", type=int, default=8)
+    parser.add_argument("--page-clients", type=int, default=8)
+    parser.add_argument("--ai-clients", type=int, default=32)
+    parser.add_argument("--ai-delay", type=float, default=2.0)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--doctors", type=int, default=20)
+    parser.add_argument("--port", type=int, default=8124)
+    args = parser.parse_args()
+
+    if importlib.util.find_spec("gunicorn") is None:
+        sys.exit("gunicorn is not installed (pip install -r requirements.txt)")
+
+    import fake_llm
+
+    clients = {"critical": args.book_clients, "normal": args.page_clients, "best_effort": args.ai_clients}
+    llm = fake_llm.start(delay=args.ai_delay)
+    base = f"http://127.0.0.1:{args.port}"
+    print(f"gthread, {args.workers} workers x {args.threads} threads; {clients}; "
+          f"{args.ai_delay}s per AI reply; {args.duration:.0f}s per run")
+    print(f"  {'admission':<11}{'tier':<13}{'req/s':>8}{'p50':>9}{'p95':>9}{'503s':>7}{'errors':>8}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        _, doctor_ids, dates = seed(db_path, args.doctors, sum(clients.values()))
+        for enabled in ("0", "1"):
+            env = dict(os.environ, DATABASE_NAME=db_path, RATELIMIT_DB=os.path.join(tmp, "ratelimit.db"),
+                       ADMISSION_METRICS_DB=os.path.join(tmp, f"metrics-{enabled}.db"), ADMISSION_ENABLED=enabled,
+                       OPENROUTER_BASE_URL=f"http://127.0.0.1:{llm.server_port}/v1", OPENROUTER_API_KEY="bench",
+                       RATE_LIMIT_SCALE="1000000")
+            proc = serve("gthread", args.workers, args.threads, args.port, env, tmp)
+            try:
+                if not wait_until_up(base, proc):
+                    stop(proc)
+                    sys.exit(f"server failed to start: {proc.stderr.read().decode()[-500:]}")
+                result = run_load(base, args.duration, clients, doctor_ids, dates)
+            finally:
+                stop(proc)
+            label = "on" if enabled == "1" else "off"
+            for tier, (latencies, shed, errors) in result.items():
+                print(f"  {label:<11}{tier:<13}{len(latencies) / args.duration:>8.1f}"
+                      f"{percentile(latencies, .5) * 1000:>7.0f}ms{percentile(latencies, .95) * 1000:>7.0f}ms"
+                      f"{shed:>7}{errors:>8}")
+    llm.shutdown()
+
+
+if __name__ == "__main__":
+    main()
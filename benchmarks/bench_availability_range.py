@@ -0,0 +1,77 @@
+"""Time the packed-bitmap range availability API for a whole department.
+
+    python benchmarks/bench_availability_range.py [--doctors 50] [--days 90] [--bookings 5000]
+
+Seeds a throwaway database, then times /availability/range for the
+department over the range and reports the JSON payload size.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("OPENROUTER_API_KEY", "bench")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--doctors", type=int, default=50)
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--bookings", type=int, default=5000)
+    parser.add_argument("--requests", type=int, default=50)
+    args = parser.parse_args()
+
+    import app
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app.create_app({"DATABASE_NAME": os.path.join(tmp, "bench.db")})
+        app.init_db()
+        repo = app.repo
+        days = [(date.today() + timedelta(days=i)).isoformat() for i in range(args.days)]
+
+        sessions = [key for key, _, _ in app.schedule.DEFAULT_SESSIONS]
+
+        def load(tx):
+            dept_id = repo.departments.create(tx, "Bench", "bench")
+            doctor_ids = []
+            for i in range(args.doctors):
+                uid = repo.users.create(tx, f"doc{i}", "x", "doctor")
+                doctor_ids.append(repo.doctors.create(tx, f"doc{i}", f"Dr {i}", uid, "Bench", 5, dept_id))
+            app.compile_doctor_slots(tx, doctor_ids)
+            repo.availability.upsert_many(tx, [(d, day, s, int(random.random() < 0.7))
+                                               for d in doctor_ids for day in days for s in sessions])
+            for n in range(args.bookings):
+                repo.appointments.create(tx, f"p{n}", n, "Dr", random.choice(doctor_ids), random.choice(days),
+                                         random.choice(sessions), "Bench", "2024-01-01T00:00:00")
+            return dept_id
+
+        dept_id = repo.write(load)
+
+        client = app.app.test_client()
+        with client.session_transaction() as s:
+            s["user_id"] = 1
+            s["user_role"] = "patient"
+
+        url = f"/availability/range?department_id={dept_id}&days={args.days}"
+        client.get(url)
+        samples = []
+        for _ in range(args.requests):
+            t0 = time.perf_counter()
+            response = client.get(url)
+            samples.append(time.perf_counter() - t0)
+        samples.sort()
+
+        body = response.get_json()
+        bitmap_bytes = sum(len(d["free"]) for d in body["doctors"])
+        print(f"{args.doctors} doctors x {args.days} days, {len(body['slots'])} slots/day")
+        print(f"  request p50 {samples[len(samples) // 2] * 1000:7.2f} ms  "
+              f"p95 {samples[int(len(samples) * .95)] * 1000:7.2f} ms")
+        print(f"  response {len(response.data) / 1024:7.1f} KB  (free bitmaps alone {bitmap_bytes / 1024:.1f} KB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""Throughput of /appointments/batch against one-at-a-time /patient/book.
+
+    python benchmarks/bench_batch_booking.py [--doctors 100] [--days 60] [--batch 1000 5000] [--single 500]
+
+Seeds a throwaway database with every session open, then books fresh
+slots: --single appointments through /patient/book one request each, and
+one /appointments/batch call per --batch size. Also times a replay of the
+largest batch with the same Idempotency-Key, a batch that moves those
+appointments and one that cancels them.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("OPENROUTER_API_KEY", "bench")
+
+
+def report(label, n, elapsed):
+    print(f"  {label:<34} {n:6d} appts  {elapsed * 1000:9.1f} ms  {n / elapsed:9.0f} appts/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--doctors", type=int, default=100)
+    parser.add_argument("--days", type=int, default=60)
+    parser.add_argument("--patients", type=int, default=2000)
+    parser.add_argument("--batch", type=int, nargs="+", default=[1000, 5000])
+    parser.add_argument("--single", type=int, default=500)
+    args = parser.parse_args()
+
+    import app
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app.create_app({"DATABASE_NAME": os.path.join(tmp, "bench.db")})
+        app.init_db()
+        repo = app.repo
+        days = [(date.today() + timedelta(days=i)).isoformat() for i in range(args.days)]
+        sessions = [key for key, _, _ in app.schedule.DEFAULT_SESSIONS]
+
+        def load(tx):
+            dept_id = repo.departments.create(tx, "Bench", "bench")
+            doctor_ids = []
+            for i in range(args.doctors):
+                uid = repo.users.create(tx, f"doc{i}", "x", "doctor")
+                doctor_ids.append(repo.doctors.create(tx, f"doc{i}", f"Dr {i}", uid, "Bench", 5, dept_id))
+            app.compile_doctor_slots(tx, doctor_ids)
+            repo.availability.upsert_many(tx, [(d, day, s, 1) for d in doctor_ids for day in days for s in sessions])
+            patients = []
+            for i in range(args.patients):
+                uid = repo.users.create(tx, f"pat{i}", "x", "patient")
+                repo.patients.create(tx, f"pat{i}", f"Patient {i}", uid)
+                patients.append((uid, f"pat{i}"))
+            return doctor_ids, patients
+
+        doctor_ids, patients = repo.write(load)
+        # Every (doctor, day, session) is one free slot; hand them out in order.
+        free = iter([(d, day, s) for day in days for d in doctor_ids for s in sessions])
+        needed = args.single + sum(args.batch) + args.batch[-1]
+        if needed > args.doctors * args.days * len(sessions):
+            sys.exit(f"Need {needed} free slots; raise --doctors or --days")
+
+        client = app.app.test_client()
+        print(f"{args.doctors} doctors x {args.days} days, {len(sessions)} slots/day")
+
+        t0 = time.perf_counter()
+        for n in range(args.single):
+            doctor_id, day, slot = next(free)
+            uid, username = patients[n % len(patients)]
+            with client.session_transaction() as s:
+                s.update(user_id=uid, user_role="patient", username=username)
+            response = client.post("/patient/book", json={"doctor_id": doctor_id, "date": day, "slot": slot})
+            assert response.status_code == 200, response.get_json()
+        report("/patient/book, one per request", args.single, time.perf_counter() - t0)
+
+        with client.session_transaction() as s:
+            s.clear()
+            s.update(user_id=1, user_role="admin")
+
+        for size in args.batch:
+            items = []
+            for n in range(size):
+                doctor_id, day, slot = next(free)
+                items.append({"op": "book", "patient": patients[n % len(patients)][1],
+                              "doctor_id": doctor_id, "date": day, "slot": slot})
+            t0 = time.perf_counter()
+            response = client.post("/appointments/batch", json={"items": items},
+                                   headers={"Idempotency-Key": f"bench-{size}"})
+            elapsed = time.perf_counter() - t0
+            body = response.get_json()
+            assert response.status_code == 200 and body["failed"] == 0, body.get("error")
+            report(f"/appointments/batch x{size}", size, elapsed)
+
+        t0 = time.perf_counter()
+        response = client.post("/appointments/batch", json={"items": items},
+                               headers={"Idempotency-Key": f"bench-{size}"})
+        assert response.headers.get("Idempotent-Replayed") == "true"
+        report(f"replay x{size} (Idempotency-Key)", size, time.perf_counter() - t0)
+
+        moves = []
+        for result in body["results"]:
+            doctor_id, day, slot = next(free)
+            moves.append({"op": "move", "appointment_id": result["appointment_id"], "doctor_id": doctor_id,
+                          "date": day, "slot": slot})
+        t0 = time.perf_counter()
+        response = client.post("/appointments/batch", json={"items": moves, "atomic": True})
+        assert response.status_code == 200, response.get_json()
+        report(f"move x{size}, atomic", size, time.perf_counter() - t0)
+
+        cancels = [{"op": "cancel", "appointment_id": m["appointment_id"]} for m in moves]
+        t0 = time.perf_counter()
+        response = client.post("/appointments/batch", json={"items": cancels})
+        assert response.get_json()["failed"] == 0
+        report(f"cancel x{size}", size, time.perf_counter() - t0)
+
+
+if __name__ == "__main__":
+    main()
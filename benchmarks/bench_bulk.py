@@ -0,0 +1,106 @@
+"""Bulk admin actions against one transaction per row, on 10k doctors and patients.
+
+    python benchmarks/bench_bulk.py [--rows 10000] [--per-row-sample 500]
+
+Seeds --rows doctors (each with a week of availability and two future
+appointments) and --rows patients into a throwaway database, then times
+POST /admin/doctors/bulk and /admin/patients/bulk blacklisting,
+unblacklisting and deleting all of them through the Flask test client.
+
+For comparison, the one-at-a-time way (a write transaction per row, as the
+single toggle routes do) is timed on --per-row-sample rows and scaled up
+to --rows.
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("OPENROUTER_API_KEY", "bench")
+
+
+def seed(path, rows):
+    import app
+
+    app.create_app({"DATABASE_NAME": path})
+    app.init_db()
+    days = [(date.today() + timedelta(days=i)).isoformat() for i in range(7)]
+    conn = sqlite3.connect(path)
+    with conn:
+        # init_db may have added users (the admin); number ours after them.
+        base = conn.execute("SELECT COALESCE(MAX(id), 0) FROM users").fetchone()[0]
+        conn.execute("INSERT INTO departments (name, description, doctors_registered) VALUES ('Bench', 'bench', ?)",
+                     (rows,))
+        conn.executemany("INSERT INTO users (id, username, password_hash, role) VALUES (?, ?, 'x', ?)",
+                         [(base + i + 1, f"user{i}", "doctor" if i < rows else "patient") for i in range(2 * rows)])
+        conn.executemany("""
+            INSERT INTO doctors (id, username, name, user_id, department, department_id, experience)
+            VALUES (?, ?, ?, ?, 'Bench', 1, 5)
+        """, [(i + 1, f"doc{i}", f"Dr {i}", base + i + 1) for i in range(rows)])
+        conn.executemany("INSERT INTO patients (id, username, name, user_id) VALUES (?, ?, ?, ?)",
+                         [(i + 1, f"pat{i}", f"Patient {i}", base + rows + i + 1) for i in range(rows)])
+        conn.executemany("INSERT INTO doctor_availability (doctor_id, date, slot, status) VALUES (?, ?, ?, 1)",
+                         [(d + 1, day, s) for d in range(rows) for day in days for s in ("morning", "afternoon")])
+        conn.executemany("""
+            INSERT INTO appointments (patient_name, patient_id, doctor_name, doctor_id, date, slot, status)
+            VALUES (?, ?, ?, ?, ?, '09:00', 'confirmed')
+        """, [(f"pat{d}", base + rows + d + 1, f"Dr {d}", d + 1, days[n + 1]) for d in range(rows) for n in range(2)])
+    conn.close()
+    return app
+
+
+def admin_client(app):
+    client = app.app.test_client()
+    with client.session_transaction() as s:
+        s["user_role"] = "admin"
+        s["user_id"] = 1
+    return client
+
+
+def bulk(client, kind, action, ids):
+    t0 = time.perf_counter()
+    body = client.post(f"/admin/{kind}s/bulk", json={"action": action, "ids": ids}).get_json()
+    elapsed = time.perf_counter() - t0
+    assert body["success"], body
+    return elapsed, body["counts"]
+
+
+def per_row(app, kind, ids, value):
+    repository = app.repo.doctors if kind == "doctor" else app.repo.patients
+    t0 = time.perf_counter()
+    for row_id in ids:
+        app.repo.write(lambda tx: repository.set_blacklisted(tx, row_id, value))
+    return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--per-row-sample", type=int, default=500)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        t0 = time.perf_counter()
+        app = seed(os.path.join(tmp, "bench.db"), args.rows)
+        print(f"{args.rows} doctors and {args.rows} patients seeded in {time.perf_counter() - t0:.1f}s")
+        client = admin_client(app)
+        ids = list(range(1, args.rows + 1))
+        sample = ids[:args.per_row_sample]
+
+        # Patients first, so deleting them still has future appointments to cancel.
+        for kind in ("patient", "doctor"):
+            elapsed = per_row(app, kind, sample, 0) * args.rows / len(sample)
+            per_row(app, kind, sample, 1)
+            print(f"  {kind + 's':<10}{'per row (est.)':<16}{'blacklist':<13}{elapsed * 1000:>7.0f} ms")
+            for action in ("blacklist", "unblacklist", "delete"):
+                elapsed, counts = bulk(client, kind, action, ids)
+                print(f"  {kind + 's':<10}{'bulk':<16}{action:<13}{elapsed * 1000:>7.0f} ms  {counts}")
+        app.audit_log.close()
+
+
+if __name__ == "__main__":
+    main()
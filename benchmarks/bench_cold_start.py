@@ -0,0 +1,108 @@
+"""Measure worker cold start: import time, create_app() and the first request.
+
+    python benchmarks/bench_cold_start.py [--runs 5] [--record benchmarks/cold_start.jsonl]
+                                          [--max-import-ms 300]
+
+Each run is a fresh interpreter, so nothing is cached in-process. With
+--record the medians are appended as one JSON line (with the git revision)
+so regressions show up over time; --max-import-ms makes the script exit
+non-zero when `import app` gets slower than the budget.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+PROBE = r"""
+import json, os, sys, time
+t0 = time.perf_counter()
+import app
+t1 = time.perf_counter()
+app.create_app({"DATABASE_NAME": os.environ["BENCH_DB"]})
+app.init_db()
+t2 = time.perf_counter()
+app.app.test_client().get("/")
+t3 = time.perf_counter()
+openai_loaded = "openai" in sys.modules
+modules = len(sys.modules)
+app.get_ai_client()
+t4 = time.perf_counter()
+print(json.dumps({
+    "import_ms": (t1 - t0) * 1000,
+    "create_app_ms": (t2 - t1) * 1000,
+    "first_request_ms": (t3 - t2) * 1000,
+    "ai_client_ms": (t4 - t3) * 1000,
+    "openai_loaded_at_start": openai_loaded,
+    "modules": modules,
+}))
+"""
+
+
+def run_once(db_path):
+    env = dict(os.environ, BENCH_DB=db_path, OPENROUTER_API_KEY="bench")
+    t0 = time.perf_counter()
+    out = subprocess.run([sys.executable, "-c", PROBE], cwd=ROOT, env=env,
+                         capture_output=True, text=True, check=True).stdout
+    result = json.loads(out.strip().splitlines()[-1])
+    result["process_ms"] = (time.perf_counter() - t0) * 1000
+    return result
+
+
+def slowest_imports(limit=10):
+    err = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], cwd=ROOT,
+                         env=dict(os.environ, OPENROUTER_API_KEY="bench"),
+                         capture_output=True, text=True, check=True).stderr
+    rows = []
+    for line in err.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented one extra space per level.
+        if not name[1:].startswith(" "):
+            rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--record", help="append the medians as a JSON line to this file")
+    parser.add_argument("--max-import-ms", type=float, help="fail if the median import time exceeds this")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # The first run creates the schema; later runs see it current, as new workers would.
+        results = [run_once(os.path.join(tmp, "cold.db")) for _ in range(args.runs)]
+
+    keys = ["import_ms", "create_app_ms", "first_request_ms", "ai_client_ms", "process_ms"]
+    summary = {k: round(statistics.median(r[k] for r in results), 1) for k in keys}
+    summary["modules"] = results[-1]["modules"]
+    summary["openai_loaded_at_start"] = any(r["openai_loaded_at_start"] for r in results)
+
+    for k in keys:
+        print(f"  {k:<18} {summary[k]:8.1f} ms")
+    print(f"  modules at start   {summary['modules']:8d}")
+    print(f"  openai at start    {summary['openai_loaded_at_start']!s:>8}")
+    print("slowest top-level imports (cumulative us):")
+    for cumulative, name in slowest_imports():
+        print(f"  {cumulative:>9}  {name}")
+
+    if args.record:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                             capture_output=True, text=True).stdout.strip()
+        with open(args.record, "a") as f:
+            f.write(json.dumps({"time": int(time.time()), "rev": rev, **summary}) + "\n")
+
+    if args.max_import_ms is not None and summary["import_ms"] > args.max_import_ms:
+        print(f"import time {summary['import_ms']} ms exceeds budget {args.max_import_ms} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
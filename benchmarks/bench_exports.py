@@ -0,0 +1,111 @@
+"""Peak memory and time to first byte of the streamed admin exports.
+
+    python benchmarks/bench_exports.py [--rows 1000000] [--format jsonl]
+
+Seeds --rows appointments into a throwaway database, then exports them
+twice:
+
+* listed - what the listing routes do today: `backend.all()` builds a
+  dict per row, then the whole list is serialised at once;
+* streamed - GET /admin/export/appointments through the Flask test client,
+  reading the body chunk by chunk as a client would.
+
+Each runs once timed and once under tracemalloc; prints its peak traced
+memory, time to the first byte and total time. The streamed peak should not grow with
+--rows (try 100000 against 1000000).
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("OPENROUTER_API_KEY", "bench")
+
+
+def seed(path, rows):
+    import app
+
+    app.create_app({"DATABASE_NAME": path})
+    app.init_db()
+    days = [(date.today() - timedelta(days=i)).isoformat() for i in range(365)]
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany("""
+            INSERT INTO appointments (patient_name, patient_id, doctor_name, doctor_id, date, slot, status,
+                                      department, sr_no, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, 'confirmed', 'Cardiology', ?, ?)
+        """, ((f"pat{i % 50000}", i % 50000, f"Dr {i % 200}", i % 200, random.choice(days),
+               f"{9 + i % 8:02d}:00", i, days[0]) for i in range(rows)))
+    conn.close()
+    return app
+
+
+def listed(app, fmt):
+    t0 = time.perf_counter()
+    rows = app.repo.backend.all("SELECT * FROM appointments ORDER BY id")
+    if fmt == "jsonl":
+        body = "".join(json.dumps(r) + "\n" for r in rows)
+    else:
+        out = io.StringIO()
+        writer = csv.DictWriter(out, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+        body = out.getvalue()
+    # The first byte can only go out once the whole body exists.
+    first = time.perf_counter() - t0
+    return first, time.perf_counter() - t0, len(body)
+
+
+def streamed(app, fmt):
+    client = app.app.test_client()
+    with client.session_transaction() as s:
+        s["user_role"] = "admin"
+        s["user_id"] = 1
+    t0 = time.perf_counter()
+    response = client.get(f"/admin/export/appointments?format={fmt}", buffered=False)
+    first, size = None, 0
+    for chunk in response.response:
+        if first is None:
+            first = time.perf_counter() - t0
+        size += len(chunk)
+    response.close()
+    return first, time.perf_counter() - t0, size
+
+
+def measure(label, fn, *args):
+    first, total, size = fn(*args)
+    # Again under tracemalloc for the peak; tracing slows it down too much to time the same run.
+    tracemalloc.start()
+    fn(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"  {label:<10}{peak / 1e6:>10.1f} MB{first * 1000:>10.0f} ms{total:>9.1f} s{size / 1e6:>10.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--format", choices=("jsonl", "csv"), default="jsonl")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        t0 = time.perf_counter()
+        app = seed(os.path.join(tmp, "bench.db"), args.rows)
+        print(f"{args.rows} appointments seeded in {time.perf_counter() - t0:.1f}s; format {args.format}")
+        print(f"  {'':<10}{'peak':>13}{'first byte':>13}{'total':>11}{'body':>13}")
+        measure("streamed", streamed, app, args.format)
+        measure("listed", listed, app, args.format)
+        app.audit_log.close()
+
+
+if __name__ == "__main__":
+    main()
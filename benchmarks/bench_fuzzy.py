@@ -0,0 +1,93 @@
+"""Fuzzy name lookup latency and memory on a large synthetic directory.
+
+    python benchmarks/bench_fuzzy.py [--names 500000] [--queries 300]
+
+Builds a fuzzy.NameIndex over --names "First Last" names drawn from a
+skewed (Zipf-like) distribution of made-up first names and surnames, so
+common surnames repeat the way real ones do, then times --queries lookups
+of each shape a typeahead sees: the exact name, the name with one letter
+dropped, the surname alone, the first four letters, and the first name
+plus the start of the surname. Prints load time, memory by part, and p50 /
+p95 / max latency per shape with how often the intended name was among
+the results. The target is a p95 under 5 ms.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import fuzzy
+
+SYLLABLES = ("ka ri mo sha ven dra lo ti na per son ker ram esh wal sing ber ton gup ta an el is ou ich mann ez ov "
+             "ski sen berg li wei jo hn ma ry pr iya ar jun de pa sam uel gr ace fa ti ma mu ham med ol ga ken ji "
+             "yu ki car los").split()
+
+
+def directory(n):
+    def word(shortest, longest):
+        return "".join(random.choice(SYLLABLES) for _ in range(random.randint(shortest, longest))).title()
+
+    firsts = sorted({word(2, 3) for _ in range(3000)})
+    lasts = sorted({word(2, 4) for _ in range(40000)})
+    # Popularity must not follow spelling, or the common names would all be near-identical.
+    random.shuffle(firsts)
+    random.shuffle(lasts)
+    first = random.choices(firsts, [1 / (i + 1) for i in range(len(firsts))], k=n)
+    last = random.choices(lasts, [1 / (i + 1) ** 0.8 for i in range(len(lasts))], k=n)
+    return [(i, f"{f} {l}", None) for i, (f, l) in enumerate(zip(first, last))]
+
+
+def drop_letter(name):
+    i = random.randrange(1, len(name) - 1)
+    return name[:i] + name[i + 1:]
+
+
+def percentile(samples, p):
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--names", type=int, default=500000)
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    names = directory(args.names)
+    index = fuzzy.NameIndex()
+    t0 = time.perf_counter()
+    index.load(names)
+    print(f"{len(index)} names loaded in {time.perf_counter() - t0:.2f}s")
+    print("memory: " + ", ".join(f"{part} {size / 1e6:.1f} MB" for part, size in index.memory_bytes().items()))
+
+    targets = [random.choice(names)[1] for _ in range(args.queries)]
+    shapes = {
+        "exact": targets,
+        "typo": [drop_letter(t) for t in targets],
+        "surname": [t.split()[1] for t in targets],
+        "prefix": [t[:4] for t in targets],
+        "first+3": [f"{t.split()[0]} {t.split()[1][:3]}" for t in targets],
+    }
+    index.search("warm up")
+
+    print(f"  {'query':<10}{'p50':>9}{'p95':>9}{'max':>9}{'found':>9}")
+    for shape, queries in shapes.items():
+        latencies, found = [], 0
+        for q, target in zip(queries, targets):
+            t0 = time.perf_counter()
+            results = index.search(q)
+            latencies.append(time.perf_counter() - t0)
+            # A short query is answered when the results complete it, even if not to this exact name.
+            found += any(name == target or name.lower().startswith(q.lower()) or q.lower() in name.lower()
+                         for _, _, name, _ in results)
+        latencies.sort()
+        print(f"  {shape:<10}{percentile(latencies, .5) * 1000:>7.2f}ms{percentile(latencies, .95) * 1000:>7.2f}ms"
+              f"{latencies[-1] * 1000:>7.2f}ms{found:>5}/{len(queries)}")
+
+
+if __name__ == "__main__":
+    main()
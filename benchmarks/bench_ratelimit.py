@@ -0,0 +1,67 @@
+"""Measure the per-call overhead of the shared token-bucket limiter.
+
+    python benchmarks/bench_ratelimit.py [--calls N] [--procs P]
+
+Runs N limiter checks (ip + user + global buckets, as /login.html does)
+in each of P processes against a throwaway store and reports latency.
+"""
+import argparse
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ratelimit import TokenBucketLimiter
+
+
+def run(path, calls, worker_no, out):
+    limiter = TokenBucketLimiter(path)
+    samples = []
+    for i in range(calls):
+        rules = [
+            ("login:global", 1e9, 1e9),
+            (f"login:ip:10.0.{worker_no}.{i % 250}", 1e9, 1e9),
+            (f"login:user:user{i % 1000}", 1e9, 1e9),
+        ]
+        t0 = time.perf_counter()
+        limiter.hit(rules)
+        samples.append(time.perf_counter() - t0)
+    out.put(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=5000)
+    parser.add_argument("--procs", type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "ratelimit.db")
+        out = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=run, args=(path, args.calls, n, out)) for n in range(args.procs)]
+
+        t0 = time.perf_counter()
+        for p in procs:
+            p.start()
+        samples = []
+        for _ in procs:
+            samples.extend(out.get())
+        for p in procs:
+            p.join()
+        elapsed = time.perf_counter() - t0
+
+    samples.sort()
+    print(f"processes:   {args.procs}")
+    print(f"checks:      {len(samples)}")
+    print(f"throughput:  {len(samples) / elapsed:,.0f} checks/s")
+    print(f"mean:        {statistics.mean(samples) * 1e6:.1f} us")
+    print(f"p50:         {samples[len(samples) // 2] * 1e6:.1f} us")
+    print(f"p99:         {samples[int(len(samples) * 0.99)] * 1e6:.1f} us")
+
+
+if __name__ == "__main__":
+    main()
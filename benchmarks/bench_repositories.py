@@ -0,0 +1,108 @@
+"""Run the same repository workload against SQLite or PostgreSQL.
+
+    python benchmarks/bench_repositories.py --backend sqlite
+    python benchmarks/bench_repositories.py --backend postgres --dsn postgresql://localhost/hospital_bench
+
+For Postgres, start a local server and create an empty database first, e.g.
+`initdb -D /tmp/pg && pg_ctl -D /tmp/pg start && createdb hospital_bench`.
+The tables are created if missing; rows are added on every run.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("OPENROUTER_API_KEY", "bench")
+
+from dbwriter import SerializedWriter
+from repositories import PostgresBackend, Repositories, SqliteBackend
+
+
+def make_repo(args, tmp):
+    if args.backend == "postgres":
+        backend = PostgresBackend(args.dsn)
+        backend.init_schema()
+        return Repositories(backend)
+
+    import app
+
+    path = os.path.join(tmp, "bench.db")
+    app.create_app({"DATABASE_NAME": path})
+    app.init_db()
+    return Repositories(SqliteBackend(path, SerializedWriter(path)))
+
+
+def seed(repo, doctors, patients, tag):
+    days = [(date.today() + timedelta(days=i)).isoformat() for i in range(7)]
+
+    def load(tx):
+        dept_id = repo.departments.create(tx, f"Dept {tag}", "bench")
+        for i in range(doctors):
+            uid = repo.users.create(tx, f"doc{tag}_{i}", "x", "doctor")
+            doc_id = repo.doctors.create(tx, f"doc{tag}_{i}", f"Dr {tag} {i}", uid, f"Dept {tag}", 5, dept_id)
+            repo.availability.upsert_many(tx, [(doc_id, d, s, 1) for d in days for s in ("morning", "afternoon")])
+        for i in range(patients):
+            uid = repo.users.create(tx, f"pat{tag}_{i}", "x", "patient")
+            repo.patients.create(tx, f"pat{tag}_{i}", f"Patient {tag} {i}", uid)
+        return dept_id
+
+    return repo.write(load), days
+
+
+def timed(label, n, fn):
+    t0 = time.perf_counter()
+    for i in range(n):
+        fn(i)
+    elapsed = time.perf_counter() - t0
+    print(f"  {label:<28} {n / elapsed:10,.0f} ops/s  {elapsed / n * 1e6:9.1f} us/op")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=["sqlite", "postgres"], default="sqlite")
+    parser.add_argument("--dsn", default=os.getenv("DATABASE_URL"))
+    parser.add_argument("--doctors", type=int, default=200)
+    parser.add_argument("--patients", type=int, default=2000)
+    parser.add_argument("--ops", type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        repo = make_repo(args, tmp)
+        tag = str(int(time.time()))
+
+        t0 = time.perf_counter()
+        dept_id, days = seed(repo, args.doctors, args.patients, tag)
+        print(f"{args.backend}: seeded {args.doctors} doctors / {args.patients} patients "
+              f"in {time.perf_counter() - t0:.2f}s")
+
+        doctor_ids = [d["id"] for d in repo.doctors.in_department(dept_id)]
+
+        timed("users.by_username", args.ops,
+              lambda i: repo.users.by_username(f"pat{tag}_{i % args.patients}"))
+        timed("doctors.get", args.ops, lambda i: repo.doctors.get(random.choice(doctor_ids)))
+        timed("availability.for_range", args.ops,
+              lambda i: repo.availability.for_range(random.choice(doctor_ids), days[0], days[-1]))
+        timed("appointments.booked_counts", args.ops,
+              lambda i: repo.appointments.booked_counts(random.choice(doctor_ids), days))
+        timed("departments.list_summary", args.ops, lambda i: repo.departments.list_summary())
+
+        def book(i):
+            doc_id = random.choice(doctor_ids)
+
+            def tx_fn(tx):
+                if repo.appointments.count_confirmed(tx, doc_id, days[i % 7], "morning") > 100:
+                    return None
+                return repo.appointments.create(tx, f"pat{tag}_{i}", i, "Dr", doc_id, days[i % 7], "morning",
+                                                "Dept", "2024-01-01T00:00:00")
+
+            repo.write(tx_fn)
+
+        timed("book (write transaction)", args.ops, book)
+
+
+if __name__ == "__main__":
+    main()
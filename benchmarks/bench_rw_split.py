@@ -0,0 +1,151 @@
+"""Compare read latency under write bursts: legacy connections vs WAL + serialized writer.
+
+    python benchmarks/bench_rw_split.py [--readers 8] [--writers 8] [--seconds 5]
+
+"legacy" mirrors the original app: rollback journal, a fresh read-write
+connection per request and one commit per write. "split" uses WAL,
+mode=ro reader connections and dbwriter.SerializedWriter with group
+commit. Each mode runs against its own throwaway copy of the schema.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+from urllib.parse import quote
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from dbwriter import SerializedWriter
+
+
+DOCTORS = 200
+DAYS = [(date.today() + timedelta(days=i)).isoformat() for i in range(7)]
+
+
+def build_db(path, wal):
+    conn = sqlite3.connect(path)
+    conn.execute(f"PRAGMA journal_mode={'WAL' if wal else 'DELETE'}")
+    conn.execute("""
+        CREATE TABLE appointments (
+            id INTEGER PRIMARY KEY, patient_name TEXT, patient_id INTEGER, doctor_name TEXT,
+            doctor_id INTEGER, date TEXT, slot TEXT, status TEXT DEFAULT 'confirmed',
+            department TEXT, sr_no INTEGER, created_at TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE doctor_availability (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, doctor_id INTEGER, date TEXT, slot TEXT,
+            status INTEGER DEFAULT 1, UNIQUE(doctor_id, date, slot)
+        )
+    """)
+    conn.executemany(
+        "INSERT INTO doctor_availability (doctor_id, date, slot, status) VALUES (?, ?, ?, 1)",
+        [(d, day, s) for d in range(DOCTORS) for day in DAYS for s in ("morning", "afternoon")]
+    )
+    conn.commit()
+    conn.close()
+
+
+def read_page(conn, doctor_id):
+    conn.execute(
+        "SELECT date, slot, status FROM doctor_availability WHERE doctor_id = ? AND date BETWEEN ? AND ?",
+        (doctor_id, DAYS[0], DAYS[-1])
+    ).fetchall()
+    conn.execute(
+        "SELECT date, slot, COUNT(*) FROM appointments WHERE doctor_id = ? AND status = 'confirmed' "
+        "GROUP BY date, slot", (doctor_id,)
+    ).fetchall()
+
+
+def insert_booking(conn, n):
+    conn.execute(
+        "INSERT INTO appointments (patient_name, doctor_id, date, slot, created_at) VALUES (?, ?, ?, ?, ?)",
+        (f"p{n}", n % DOCTORS, random.choice(DAYS), "morning", time.time())
+    )
+
+
+def run(mode, path, readers, writers, seconds):
+    stop = threading.Event()
+    read_lat, write_lat = [], []
+    errors = {"locked": 0}
+    lock = threading.Lock()
+    writer = SerializedWriter(path) if mode == "split" else None
+
+    def reader():
+        samples = []
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            try:
+                if mode == "split":
+                    conn = sqlite3.connect(f"file:{quote(path)}?mode=ro", uri=True)
+                else:
+                    conn = sqlite3.connect(path)
+                read_page(conn, random.randrange(DOCTORS))
+                conn.close()
+                samples.append(time.perf_counter() - t0)
+            except sqlite3.OperationalError:
+                with lock:
+                    errors["locked"] += 1
+        with lock:
+            read_lat.extend(samples)
+
+    def writer_loop(w):
+        samples = []
+        n = w
+        while not stop.is_set():
+            n += writers
+            t0 = time.perf_counter()
+            try:
+                if mode == "split":
+                    writer.run(insert_booking, n)
+                else:
+                    conn = sqlite3.connect(path)
+                    insert_booking(conn, n)
+                    conn.commit()
+                    conn.close()
+                samples.append(time.perf_counter() - t0)
+            except sqlite3.OperationalError:
+                with lock:
+                    errors["locked"] += 1
+        with lock:
+            write_lat.extend(samples)
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    threads += [threading.Thread(target=writer_loop, args=(w,)) for w in range(writers)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+
+    def pct(samples, p):
+        samples = sorted(samples)
+        return samples[min(int(len(samples) * p), len(samples) - 1)] * 1000 if samples else float("nan")
+
+    print(f"{mode:>6}: reads {len(read_lat) / seconds:8.0f}/s  p50 {pct(read_lat, .5):6.2f} ms  "
+          f"p99 {pct(read_lat, .99):7.2f} ms | writes {len(write_lat) / seconds:7.0f}/s  "
+          f"p99 {pct(write_lat, .99):7.2f} ms | lock errors {errors['locked']}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ("legacy", "split"):
+            path = os.path.join(tmp, f"{mode}.db")
+            build_db(path, wal=(mode == "split"))
+            run(mode, path, args.readers, args.writers, args.seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""Throughput of end-of-day visit entry for a whole department.
+
+    python benchmarks/bench_visits.py [--doctors 40] [--per-doctor 30] [--single 300]
+
+Seeds a throwaway database with one department's day of appointments
+(--doctors x --per-doctor, patients reused so each gets several visits),
+then records their visits: --single one request each through
+/doctor/visits, each doctor's day as one /doctor/visits/batch call, and
+the rest of the department as a single admin batch.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import date, datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("OPENROUTER_API_KEY", "bench")
+
+
+def report(label, n, elapsed):
+    print(f"  {label:<38} {n:6d} visits  {elapsed * 1000:9.1f} ms  {n / elapsed:9.0f} visits/s")
+
+
+def visit(appointment_id):
+    return {"appointment_id": appointment_id, "visit_type": "OPD", "tests_done": "CBC",
+            "diagnosis": "Seasonal flu", "prescription": "Rest, fluids", "medicines": "Paracetamol 500mg"}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--doctors", type=int, default=40)
+    parser.add_argument("--per-doctor", type=int, default=30)
+    parser.add_argument("--patients", type=int, default=300)
+    parser.add_argument("--single", type=int, default=300)
+    args = parser.parse_args()
+
+    import app
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app.create_app({"DATABASE_NAME": os.path.join(tmp, "bench.db")})
+        app.init_db()
+        repo = app.repo
+        today = date.today().isoformat()
+
+        def load(tx):
+            dept_id = repo.departments.create(tx, "Bench", "bench")
+            patients = []
+            for i in range(args.patients):
+                uid = repo.users.create(tx, f"pat{i}", "x", "patient")
+                repo.patients.create(tx, f"pat{i}", f"Patient {i}", uid)
+                patients.append((f"pat{i}", uid))
+
+            by_doctor = {}
+            n = 0
+            for d in range(args.doctors):
+                uid = repo.users.create(tx, f"doc{d}", "x", "doctor")
+                doctor_id = repo.doctors.create(tx, f"doc{d}", f"Dr {d}", uid, "Bench", 5, dept_id)
+                by_doctor[doctor_id] = []
+                for k in range(args.per_doctor):
+                    username, patient_id = patients[n % len(patients)]
+                    n += 1
+                    by_doctor[doctor_id].append(repo.appointments.create(
+                        tx, username, patient_id, f"Dr {d}", doctor_id, today, f"{k:04d}", "Bench",
+                        datetime.utcnow().isoformat()))
+            return by_doctor
+
+        by_doctor = repo.write(load)
+        total = args.doctors * args.per_doctor
+        print(f"{args.doctors} doctors x {args.per_doctor} appointments, {args.patients} patients")
+
+        client = app.app.test_client()
+        doctor_ids = list(by_doctor)
+        pending = {d: list(ids) for d, ids in by_doctor.items()}
+
+        t0 = time.perf_counter()
+        for n in range(min(args.single, total)):
+            doctor_id = doctor_ids[n % len(doctor_ids)]
+            with client.session_transaction() as s:
+                s.clear()
+                s.update(user_id=doctor_id, user_role="doctor", doctor_id=doctor_id)
+            response = client.post("/doctor/visits", json=visit(pending[doctor_id].pop()))
+            assert response.status_code == 201, response.get_json()
+        report("/doctor/visits, one per request", min(args.single, total), time.perf_counter() - t0)
+
+        half = doctor_ids[:len(doctor_ids) // 2]
+        recorded = 0
+        t0 = time.perf_counter()
+        for doctor_id in half:
+            with client.session_transaction() as s:
+                s.clear()
+                s.update(user_id=doctor_id, user_role="doctor", doctor_id=doctor_id)
+            items = [visit(a) for a in pending.pop(doctor_id)]
+            response = client.post("/doctor/visits/batch", json={"visits": items})
+            assert response.status_code == 201, response.get_json()
+            recorded += len(items)
+        report("/doctor/visits/batch, per doctor", recorded, time.perf_counter() - t0)
+
+        items = [visit(a) for ids in pending.values() for a in ids]
+        with client.session_transaction() as s:
+            s.clear()
+            s.update(user_id=1, user_role="admin")
+        t0 = time.perf_counter()
+        response = client.post("/doctor/visits/batch", json={"visits": items})
+        assert response.status_code == 201, response.get_json()
+        report("/doctor/visits/batch, department", len(items), time.perf_counter() - t0)
+
+        conn = app.get_db_connection()
+        gaps = conn.execute("""
+            SELECT COUNT(*) FROM (
+                SELECT patient_name FROM visits GROUP BY patient_name
+                HAVING COUNT(DISTINCT visit_no) != COUNT(*) OR MAX(visit_no) != COUNT(*)
+            )
+        """).fetchone()[0]
+        conn.close()
+        print(f"  visit numbers: {gaps} patients with gaps or duplicates")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""Compare gunicorn worker models on the same mixed database + AI load.
+
+    python benchmarks/bench_workers.py [--duration 15] [--db-clients 32] [--ai-clients 16]
+                                       [--ai-delay 2.0] [--threads 4,8,16]
+
+Seeds a throwaway database, starts benchmarks/fake_llm.py in-process
+(every AI reply takes --ai-delay seconds), then for each configuration
+runs `serve.py` against it and drives it for --duration seconds:
+
+* --db-clients logged-in patients loop over short SQLite reads (day
+  slots, a department's availability range, the patient home page);
+* --ai-clients patients loop on /ai/chat, which holds a worker, thread or
+  greenlet for the whole fake LLM call.
+
+Configurations: the sync preset, gthread at each --threads, and the async
+(gevent) preset when gevent is installed. Rate limits are scaled out of
+the way (RATE_LIMIT_SCALE) so they don't shape the result. Prints DB
+throughput and latency and AI throughput per model, then recommends the
+configuration with the best DB p95 among those that kept up with the AI
+load, as workers and threads per core.
+"""
+import argparse
+import http.cookiejar
+import importlib.util
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import date, timedelta
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("OPENROUTER_API_KEY", "bench")
+
+PASSWORD = "bench-pw"
+
+
+def seed(path, doctors, patients, days=30):
+    import app
+
+    app.create_app({"DATABASE_NAME": path})
+    app.init_db()
+    repo = app.repo
+    dates = [(date.today() + timedelta(days=i)).isoformat() for i in range(days)]
+    sessions = [key for key, _, _ in app.schedule.DEFAULT_SESSIONS]
+
+    def load(tx):
+        dept_id = repo.departments.create(tx, "Bench", "bench")
+        doctor_ids = []
+        for i in range(doctors):
+            uid = repo.users.create(tx, f"doc{i}", app.hash_password(PASSWORD), "doctor")
+            doctor_ids.append(repo.doctors.create(tx, f"doc{i}", f"Dr {i}", uid, "Bench", 5, dept_id))
+        app.compile_doctor_slots(tx, doctor_ids)
+        repo.availability.upsert_many(tx, [(d, day, s, 1) for d in doctor_ids for day in dates for s in sessions])
+        for i in range(patients):
+            uid = repo.users.create(tx, f"pat{i}", app.hash_password(PASSWORD), "patient")
+            repo.patients.create(tx, f"pat{i}", f"Patient {i}", uid)
+        return dept_id, doctor_ids
+
+    dept_id, doctor_ids = repo.write(load)
+    return dept_id, doctor_ids, dates
+
+
+def login(base, username):
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    data = urllib.parse.urlencode({"username": username, "password": PASSWORD}).encode()
+    opener.open(f"{base}/login.html", data, timeout=30).read()
+    return opener
+
+
+def run_load(base, duration, db_clients, ai_clients, dept_id, doctor_ids, dates):
+    """Drive the server at `base`; returns DB latencies, DB errors, AI replies and AI failures."""
+    db_urls = [
+        lambda: f"/doctor/{random.choice(doctor_ids)}/slots?date={random.choice(dates)}",
+        lambda: f"/availability/range?department_id={dept_id}&days={len(dates)}",
+        lambda: "/patienthome.html",
+    ]
+    results = {"db": [], "db_errors": 0, "ai_ok": 0, "ai_failed": 0}
+    lock = threading.Lock()
+    openers = [login(base, f"pat{n}") for n in range(db_clients + ai_clients)]
+    start = threading.Event()
+    deadline = [0.0]
+
+    def db_client(opener):
+        start.wait()
+        latencies, errors = [], 0
+        while time.monotonic() < deadline[0]:
+            t0 = time.perf_counter()
+            try:
+                opener.open(base + random.choice(db_urls)(), timeout=30).read()
+                latencies.append(time.perf_counter() - t0)
+            except (urllib.error.URLError, OSError):
+                errors += 1
+        with lock:
+            results["db"] += latencies
+            results["db_errors"] += errors
+
+    def ai_client(opener):
+        start.wait()
+        ok = failed = 0
+        while time.monotonic() < deadline[0]:
+            request = urllib.request.Request(f"{base}/ai/chat", json.dumps({"message": "I have a cold"}).encode(),
+                                             {"Content-Type": "application/json"})
+            try:
+                body = json.loads(opener.open(request, timeout=60).read())
+                ok += bool(body.get("success"))
+                failed += not body.get("success")
+            except (urllib.error.URLError, OSError, ValueError):
+                failed += 1
+        with lock:
+            results["ai_ok"] += ok
+            results["ai_failed"] += failed
+
+    threads = [threading.Thread(target=db_client, args=(o,)) for o in openers[:db_clients]]
+    threads += [threading.Thread(target=ai_client, args=(o,)) for o in openers[db_clients:]]
+    for t in threads:
+        t.start()
+    deadline[0] = time.monotonic() + duration
+    start.set()
+    for t in threads:
+        t.join()
+    return results
+
+
+def wait_until_up(base, proc, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            return False
+        try:
+            urllib.request.urlopen(base + "/", timeout=2).read()
+            return True
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.3)
+    return False
+
+
+def serve(preset, workers, threads, port, env, tmp):
+    return subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "serve.py"), "--preset", preset, "--workers", str(workers),
+         "--threads", str(threads), "--bind", f"127.0.0.1:{port}", "--pidfile", os.path.join(tmp, "gunicorn.pid")],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+    )
+
+
+def stop(proc):
+    if proc.poll() is None:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(timeout=40)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+
+def percentile(samples, p):
+    return samples[min(len(samples) - 1, int(len(samples) * p))] if samples else float("nan")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", type=float, default=15)
+    parser.add_argument("--db-clients", type=int, default=32)
+    parser.add_argument("--ai-clients", type=int, default=16)
+    parser.add_argument("--ai-delay", type=float, default=2.0)
+    parser.add_argument("--threads", default="4,8,16")
+    parser.add_argument("--doctors", type=int, default=20)
+    parser.add_argument("--port", type=int, default=8123)
+    args = parser.parse_args()
+
+    if importlib.util.find_spec("gunicorn") is None:
+        sys.exit("gunicorn is not installed (pip install -r requirements.txt)")
+
+    import fake_llm
+
+    cores = os.cpu_count() or 1
+    configs = [("sync", 2 * cores + 1, 1)]
+    configs += [("gthread", cores, int(t)) for t in args.threads.split(",")]
+    if importlib.util.find_spec("gevent") is not None:
+        configs.append(("async", cores, 1))
+    else:
+        print("gevent is not installed; skipping the async preset")
+
+    llm = fake_llm.start(delay=args.ai_delay)
+    base = f"http://127.0.0.1:{args.port}"
+    # Every AI client can complete at most one call per --ai-delay seconds.
+    ai_ceiling = args.ai_clients / args.ai_delay
+    print(f"{cores} cores; {args.db_clients} DB clients, {args.ai_clients} AI clients "
+          f"({args.ai_delay}s per reply, at most {ai_ceiling:.1f} replies/s); {args.duration:.0f}s per run")
+    print(f"  {'model':<10}{'workers':>8}{'threads':>8}{'db req/s':>10}{'db p50':>9}{'db p95':>9}"
+          f"{'db err':>8}{'ai/s':>7}{'ai fail':>8}")
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        dept_id, doctor_ids, dates = seed(db_path, args.doctors, args.db_clients + args.ai_clients)
+        env = dict(os.environ, DATABASE_NAME=db_path, RATELIMIT_DB=os.path.join(tmp, "ratelimit.db"),
+                   OPENROUTER_BASE_URL=f"http://127.0.0.1:{llm.server_port}/v1", OPENROUTER_API_KEY="bench",
+                   RATE_LIMIT_SCALE="1000000")
+
+        for preset, workers, threads in configs:
+            proc = serve(preset, workers, threads, args.port, env, tmp)
+            try:
+                if not wait_until_up(base, proc):
+                    stop(proc)
+                    print(f"  {preset:<10} failed to start: {proc.stderr.read().decode()[-500:]}")
+                    continue
+                result = run_load(base, args.duration, args.db_clients, args.ai_clients, dept_id, doctor_ids, dates)
+            finally:
+                stop(proc)
+
+            db = sorted(result["db"])
+            row = {"preset": preset, "workers": workers, "threads": threads,
+                   "db_rps": len(db) / args.duration, "p50": percentile(db, .5), "p95": percentile(db, .95),
+                   "db_errors": result["db_errors"], "ai_rps": result["ai_ok"] / args.duration,
+                   "ai_failed": result["ai_failed"]}
+            rows.append(row)
+            print(f"  {preset:<10}{workers:>8}{threads:>8}{row['db_rps']:>10.0f}{row['p50'] * 1000:>7.1f}ms"
+                  f"{row['p95'] * 1000:>7.1f}ms{row['db_errors']:>8}{row['ai_rps']:>7.1f}{row['ai_failed']:>8}")
+
+    llm.shutdown()
+    if not rows:
+        sys.exit("No configuration ran")
+
+    # Keeping up with the AI load matters first; among those, the lowest DB tail latency wins.
+    kept_up = [r for r in rows if r["ai_rps"] >= 0.9 * ai_ceiling and not r["db_errors"]] or rows
+    best = min(kept_up, key=lambda r: r["p95"])
+    print(f"\nRecommended: --preset {best['preset']} --workers {best['workers']} --threads {best['threads']}")
+    if best["preset"] == "async":
+        print(f"  = {best['workers'] / cores:g} gevent workers per core")
+    else:
+        print(f"  = {best['workers'] / cores:g} workers per core, {best['threads']} threads each "
+              f"({best['workers'] * best['threads'] / cores:g} concurrent requests per core)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""A local stand-in for the OpenRouter chat completions API, for load tests.
+
+    python benchmarks/fake_llm.py [--port 8900] [--delay 2.0]
+
+Answers POST /v1/chat/completions with a fixed OpenAI-shaped reply after
+--delay seconds, so the app's AI calls cost wall-clock time without
+leaving the machine. Point the app at it with
+OPENROUTER_BASE_URL=http://127.0.0.1:8900/v1.
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def make_handler(delay):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if self.path.rstrip("/") not in ("/v1/chat/completions", "/chat/completions"):
+                self.send_error(404)
+                return
+            try:
+                model = json.loads(body).get("model", "fake")
+            except ValueError:
+                model = "fake"
+            time.sleep(delay)
+            reply = json.dumps({
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": "Drink water and rest."}}],
+                "usage": {"prompt_tokens": 20, "completion_tokens": 6, "total_tokens": 26},
+            }).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(reply)))
+            self.end_headers()
+            self.wfile.write(reply)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def start(port=0, delay=2.0):
+    """Serve from a daemon thread; returns the server (server.server_port is the bound port)."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(delay))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-llm", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--delay", type=float, default=2.0)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(args.delay))
+    print(f"Fake LLM on http://127.0.0.1:{args.port}/v1 ({args.delay}s per reply)")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
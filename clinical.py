@@ -0,0 +1,228 @@
+"""Structured medicines, tests and prescriptions on visits, indexed for lookup.
+
+The three visit columns hold JSON (SQLite's JSON1 reads them in place):
+
+* medicines    - [{"name", "dose", "frequency", "days"}], name required
+* tests_done   - [{"name", "result", "unit"}], name required
+* prescription - {"advice", "follow_up"}, follow_up an ISO date
+
+normalise() validates what the visit API receives; free text is still
+accepted and parsed ("Paracetamol 500mg, Cetirizine 10mg"; "CBC: normal,
+Lipid panel"). init_schema() converts rows that still hold free text the
+same way.
+
+Triggers on visits explode medicines and tests into `visit_items`, one row
+per item keyed by kind and lower-cased name, with the visit date, patient
+and doctor copied alongside. "Who was prescribed X this month" is then one
+range scan of idx_visit_items_name (VisitRepository.search) instead of
+parsing every visit. SQLite only, like the other trigger-maintained tables.
+"""
+import json
+import re
+from datetime import date
+
+
+ITEM_KINDS = {
+    # kind: (visits column, item fields, the field copied to visit_items.detail)
+    "medicine": ("medicines", ("name", "dose", "frequency", "days"), "dose"),
+    "test": ("tests_done", ("name", "result", "unit"), "result"),
+}
+
+_DOSE = re.compile(r"^(?P<name>.+?)\s+(?P<dose>\d[\d.,/]*\s*(?:mg|g|mcg|ml|iu|units?|%|tabs?|caps?)\b.*)$", re.I)
+_SPLIT = re.compile(r"[,;\n]+")
+
+
+def _parts(text):
+    return [p.strip() for p in _SPLIT.split(text) if p.strip()]
+
+
+def parse_medicines(text):
+    items = []
+    for part in _parts(text):
+        m = _DOSE.match(part)
+        items.append({"name": m["name"], "dose": m["dose"]} if m else {"name": part})
+    return items
+
+
+_RESULT = re.compile(r"^(?P<name>[^:=]+?)\s*[:=]\s*(?P<result>.+)$")
+
+
+def parse_tests(text):
+    items = []
+    for part in _parts(text):
+        m = _RESULT.match(part)
+        items.append({"name": m["name"], "result": m["result"]} if m else {"name": part})
+    return items
+
+
+def _items(value, kind):
+    _, fields, _ = ITEM_KINDS[kind]
+    if isinstance(value, str):
+        return parse_medicines(value) if kind == "medicine" else parse_tests(value)
+    if not isinstance(value, list):
+        raise ValueError("must be a list or text")
+
+    items = []
+    for n, item in enumerate(value):
+        if isinstance(item, str):
+            item = {"name": item}
+        if not isinstance(item, dict) or not isinstance(item.get("name"), str) or not item["name"].strip():
+            raise ValueError(f"item {n} needs a name")
+        unknown = set(item) - set(fields)
+        if unknown:
+            raise ValueError(f"item {n}: unknown field {sorted(unknown)[0]}")
+        for field in fields:
+            if field == "days":
+                if item.get(field) is not None and (not isinstance(item[field], int) or item[field] < 0):
+                    raise ValueError(f"item {n}: days must be a whole number")
+            elif item.get(field) is not None and not isinstance(item[field], str):
+                raise ValueError(f"item {n}: {field} must be text")
+        items.append({f: item[f].strip() if isinstance(item[f], str) else item[f]
+                      for f in fields if item.get(f) not in (None, "")})
+    return items
+
+
+def _prescription(value):
+    if isinstance(value, str):
+        return {"advice": value.strip()}
+    if not isinstance(value, dict):
+        raise ValueError("must be an object or text")
+    unknown = set(value) - {"advice", "follow_up"}
+    if unknown:
+        raise ValueError(f"unknown field {sorted(unknown)[0]}")
+    if value.get("advice") is not None and not isinstance(value["advice"], str):
+        raise ValueError("advice must be text")
+    result = {"advice": (value.get("advice") or "").strip()}
+    if value.get("follow_up"):
+        result["follow_up"] = date.fromisoformat(str(value["follow_up"])).isoformat()
+    return result
+
+
+def normalise(item):
+    """Validate and encode the medicines, tests_done and prescription of one visit in place."""
+    for kind, (column, _, _) in ITEM_KINDS.items():
+        if item.get(column) is not None:
+            try:
+                item[column] = json.dumps(_items(item[column], kind))
+            except ValueError as e:
+                raise ValueError(f"{column}: {e}") from None
+    if item.get("prescription") is not None:
+        try:
+            item["prescription"] = json.dumps(_prescription(item["prescription"]))
+        except ValueError as e:
+            raise ValueError(f"prescription: {e}") from None
+    return item
+
+
+def decode(row):
+    """A visit row with its JSON columns as lists and dicts."""
+    for column in ("medicines", "tests_done", "prescription"):
+        if isinstance(row.get(column), str):
+            try:
+                row[column] = json.loads(row[column])
+            except ValueError:
+                pass
+    return row
+
+
+def _items_sql(ref, kind, table=""):
+    """SELECT of the visit_items rows of visit `ref`: NEW in triggers, or every visit with table="visits v, "."""
+    column, _, detail = ITEM_KINDS[kind]
+    source = f"{ref}.{column}"
+    return f"""
+        SELECT '{kind}', lower(trim(json_extract(j.value, '$.name'))), {ref}.visit_date, {ref}.id, j.key,
+               json_extract(j.value, '$.name'), json_extract(j.value, '$.{detail}'),
+               {ref}.patient_name, {ref}.doctor_id
+        FROM {table}json_each(CASE WHEN json_valid({source}) THEN
+                           CASE WHEN json_type({source}) = 'array' THEN {source} END END) j
+        WHERE json_type(j.value) = 'object' AND json_extract(j.value, '$.name') IS NOT NULL
+    """
+
+
+_INSERT_ITEMS = """
+    INSERT INTO visit_items (kind, name_key, visit_date, visit_id, item_no, name, detail, patient_name, doctor_id)
+"""
+
+
+def _add_sql(ref):
+    return "".join(f"{_INSERT_ITEMS} {_items_sql(ref, kind)};" for kind in ITEM_KINDS)
+
+
+TRIGGERS = {
+    "visits_items_insert": ("AFTER INSERT ON visits", _add_sql("NEW")),
+    "visits_items_update": ("AFTER UPDATE OF medicines, tests_done, visit_date, patient_name, doctor_id ON visits",
+                            "DELETE FROM visit_items WHERE visit_id = OLD.id;" + _add_sql("NEW")),
+    "visits_items_delete": ("AFTER DELETE ON visits", "DELETE FROM visit_items WHERE visit_id = OLD.id;"),
+}
+
+
+def init_schema(conn):
+    """visit_items, its triggers, and the one-off conversion of free-text visits."""
+    created = not conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'visit_items'"
+    ).fetchone()
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS visit_items (
+            id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            name_key TEXT NOT NULL,
+            visit_date TEXT,
+            visit_id INTEGER NOT NULL,
+            item_no INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            detail TEXT,
+            patient_name TEXT,
+            doctor_id INTEGER
+        )
+    """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_visit_items_name ON visit_items(kind, name_key, visit_date, visit_id)
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_visit_items_visit ON visit_items(visit_id)")
+
+    # Recreated every migration so trigger bodies follow the code.
+    for name, (event, body) in TRIGGERS.items():
+        conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+        conn.execute(f"CREATE TRIGGER {name} {event} BEGIN {body} END")
+
+    convert_free_text(conn)
+    if created:
+        conn.execute("DELETE FROM visit_items")
+        for kind in ITEM_KINDS:
+            conn.execute(f"{_INSERT_ITEMS} {_items_sql('v', kind, table='visits v, ')}")
+
+
+def convert_free_text(conn):
+    """Rewrite visits whose medicines, tests or prescription are not yet structured JSON."""
+    rows = conn.execute("""
+        SELECT id, medicines, tests_done, prescription FROM visits
+        WHERE (medicines IS NOT NULL AND NOT (json_valid(medicines) AND json_type(medicines) = 'array'))
+           OR (tests_done IS NOT NULL AND NOT (json_valid(tests_done) AND json_type(tests_done) = 'array'))
+           OR (prescription IS NOT NULL AND NOT (json_valid(prescription) AND json_type(prescription) = 'object'))
+    """).fetchall()
+
+    updates = []
+    for row in rows:
+        fields = {}
+        for column, parse in (("medicines", parse_medicines), ("tests_done", parse_tests)):
+            value = row[column]
+            if value is not None and not _is_json(value, list):
+                fields[column] = json.dumps(parse(str(value)))
+        if row["prescription"] is not None and not _is_json(row["prescription"], dict):
+            fields["prescription"] = json.dumps({"advice": str(row["prescription"]).strip()})
+        updates.append((fields.get("medicines"), fields.get("tests_done"), fields.get("prescription"), row["id"]))
+
+    conn.executemany("""
+        UPDATE visits SET medicines = COALESCE(?, medicines), tests_done = COALESCE(?, tests_done),
+                          prescription = COALESCE(?, prescription)
+        WHERE id = ?
+    """, updates)
+    return len(updates)
+
+
+def _is_json(value, kind):
+    try:
+        return isinstance(json.loads(value), kind)
+    except (TypeError, ValueError):
+        return False
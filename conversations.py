@@ -0,0 +1,169 @@
+"""Multi-turn AI conversations, kept server-side and sent within a token budget.
+
+Each conversation belongs to one user and stores every turn in
+`ai_messages`. The prompt for a new message is
+
+    system prompt + rolling summary of older turns + most recent turns + message
+
+and never exceeds PROMPT_BUDGET tokens however long the conversation gets:
+the summary is capped at SUMMARY_MAX_TOKENS and the recency window takes
+whatever is left, newest turn first.
+
+Turns that no longer fit the window are folded into the summary by a
+background job (summarize_conversation in app.py), one chunk of at most
+SUMMARY_CHUNK_TOKENS per LLM call. `summarized_through` records the last
+message id the summary covers, so only newer messages are ever read back.
+Until the job catches up, turns that fell out of the window are simply
+left out of the prompt.
+
+Token counts are an estimate (about four characters per token plus a few
+per message for the chat framing); nothing here depends on a tokenizer.
+"""
+import os
+
+
+PROMPT_BUDGET = int(os.getenv("AI_PROMPT_BUDGET", "1500"))
+SUMMARY_MAX_TOKENS = 200
+SUMMARY_CHUNK_TOKENS = 2000
+# The newest turns are left out of the summary so the window keeps them verbatim.
+KEEP_RECENT_TOKENS = PROMPT_BUDGET // 2
+MESSAGE_MAX_TOKENS = PROMPT_BUDGET // 3
+# Messages read back for the window; the budget runs out long before this.
+WINDOW_LIMIT = 100
+MESSAGE_OVERHEAD = 4
+# A summary request older than this is assumed lost (its job gave up) and is made again.
+SUMMARY_RETRY_SECONDS = 600
+
+SUMMARY_PROMPT = (
+    "Summarise this conversation between a patient and a hospital's medical assistant for the "
+    "assistant's own later reference. Keep symptoms, durations, medicines, allergies, questions "
+    "still open and advice already given. Be brief and factual; write at most 120 words."
+)
+
+
+def estimate_tokens(text):
+    return (len(text or "") + 3) // 4 + MESSAGE_OVERHEAD
+
+
+def build_prompt(system, summary, recent, message, budget=PROMPT_BUDGET):
+    """Chat messages for the LLM, and the recent turns that made it into the window.
+
+    `recent` is the conversation's unsummarised messages newest first, as
+    dicts with role, content and tokens.
+    """
+    prompt = [{"role": "system", "content": system}]
+    used = estimate_tokens(system) + estimate_tokens(message)
+    if summary:
+        note = "Summary of the earlier conversation:\n" + summary
+        used += estimate_tokens(note)
+        prompt.append({"role": "system", "content": note})
+
+    window = []
+    for m in recent:
+        if used + m["tokens"] > budget:
+            break
+        used += m["tokens"]
+        window.append(m)
+
+    prompt += [{"role": m["role"], "content": m["content"]} for m in reversed(window)]
+    prompt.append({"role": "user", "content": message})
+    return prompt, window
+
+
+def needs_summary(recent, keep=KEEP_RECENT_TOKENS):
+    """Whether the unsummarised messages (newest first) go beyond what the window keeps verbatim."""
+    return len(recent) >= WINDOW_LIMIT or sum(m["tokens"] for m in recent) > keep
+
+
+def keep_boundary(recent, keep=KEEP_RECENT_TOKENS):
+    """The id of the oldest message kept verbatim; everything older is due for the summary.
+
+    `recent` is newest first. If even the newest message is over `keep`, it is summarised too.
+    """
+    kept = 0
+    boundary = recent[0]["id"] + 1 if recent else 0
+    for m in recent:
+        if kept + m["tokens"] > keep:
+            break
+        kept += m["tokens"]
+        boundary = m["id"]
+    return boundary
+
+
+def take_chunk(older, limit=SUMMARY_CHUNK_TOKENS):
+    """The leading run of `older` (oldest first) to fold into the summary in one LLM call."""
+    chunk, size = [], 0
+    for m in older:
+        if chunk and size + m["tokens"] > limit:
+            break
+        chunk.append(m)
+        size += m["tokens"]
+    return chunk
+
+
+def summary_request(summary, chunk):
+    """Messages asking the LLM to extend `summary` with `chunk`."""
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in chunk)
+    content = (f"Summary so far:\n{summary}\n\nLater messages:\n{transcript}" if summary
+               else f"Conversation:\n{transcript}")
+    return [{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": content}]
+
+
+def clip_summary(text, max_tokens=SUMMARY_MAX_TOKENS):
+    """Cut a summary that came back longer than asked, at a word boundary."""
+    text = text.strip()
+    limit = (max_tokens - MESSAGE_OVERHEAD) * 4
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit(" ", 1)[0] + " ..."
+
+
+def init_schema(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS ai_conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            title TEXT,
+            summary TEXT,
+            summarized_through INTEGER NOT NULL DEFAULT 0,
+            summary_requested_at REAL NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ai_conversations_user ON ai_conversations(user_id, updated_at)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS ai_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            tokens INTEGER NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ai_messages_conversation ON ai_messages(conversation_id, id)")
+
+
+POSTGRES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ai_conversations (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    title TEXT,
+    summary TEXT,
+    summarized_through INTEGER NOT NULL DEFAULT 0,
+    summary_requested_at DOUBLE PRECISION NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_ai_conversations_user ON ai_conversations(user_id, updated_at);
+CREATE TABLE IF NOT EXISTS ai_messages (
+    id SERIAL PRIMARY KEY,
+    conversation_id INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    tokens INTEGER NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_ai_messages_conversation ON ai_messages(conversation_id, id);
+"""
@@ -0,0 +1,140 @@
+"""Single serialized writer per process, with group commit.
+
+Every write in the web process is a function `fn(conn, *args)` handed to
+`SerializedWriter.run`. One background thread owns the only read-write
+connection: it takes the next queued write, drains whatever else arrived
+while the previous group was committing (optionally waiting up to
+`max_wait` seconds for a group to fill), runs each inside its own SAVEPOINT
+and then commits the whole group with one COMMIT (one WAL fsync). A failing
+write only rolls back its own savepoint; its exception is re-raised in the
+caller, and the rest of the group still commits. Callers get their result
+only after the commit is durable.
+
+If the loop itself fails (the database cannot be opened, a COMMIT or
+ROLLBACK errors), every write in that group fails with the error, the
+connection is dropped and reopened for the next group, and the thread
+carries on; a thread that died anyway is restarted by the next submit.
+A caller that waits longer than its timeout gets WriteTimeout, which the
+app answers with a 503.
+"""
+import os
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+
+class WriteTimeout(TimeoutError):
+    """The write was not committed in time. It is still queued and may yet commit."""
+
+
+class SerializedWriter:
+    def __init__(self, path, max_batch=64, max_wait=0):
+        self.path = path
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _ensure_started(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            # Threads do not survive fork, so each worker process starts its own. In the same
+            # process a dead thread is replaced and its successor takes over the queued writes.
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._loop, name="db-writer", daemon=True)
+            self._thread.start()
+
+    def reset(self):
+        with self._lock:
+            self._thread = None
+            self._pid = None
+
+    def submit(self, fn, *args):
+        self._ensure_started()
+        future = Future()
+        self._queue.put((fn, args, future))
+        return future
+
+    def run(self, fn, *args, timeout=30):
+        try:
+            return self.submit(fn, *args).result(timeout)
+        except FutureTimeout:
+            raise WriteTimeout(f"write not committed within {timeout}s") from None
+
+    def _take_batch(self, q):
+        batch = [q.get()]
+        while len(batch) < self.max_batch:
+            try:
+                if self.max_wait > 0:
+                    batch.append(q.get(timeout=self.max_wait))
+                else:
+                    batch.append(q.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        q = self._queue
+        conn = None
+
+        while True:
+            batch = self._take_batch(q)
+            outcomes = []
+
+            try:
+                if conn is None:
+                    conn = self._connect()
+                conn.execute("BEGIN IMMEDIATE")
+                for fn, args, future in batch:
+                    conn.execute("SAVEPOINT w")
+                    try:
+                        outcomes.append((future, fn(conn, *args), None))
+                        conn.execute("RELEASE w")
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO w")
+                        conn.execute("RELEASE w")
+                        outcomes.append((future, None, e))
+                conn.execute("COMMIT")
+
+            except BaseException as e:
+                conn = self._abandon(conn)
+                for _, _, future in batch:
+                    future.set_exception(e)
+                if not isinstance(e, Exception):
+                    # Let the thread die (the next submit starts another), but not holding the write lock.
+                    raise
+                continue
+
+            for future, result, error in outcomes:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+    def _abandon(self, conn):
+        """Roll back what the failed group left open; a connection that cannot even do that is dropped."""
+        if conn is None:
+            return None
+        try:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            return conn
+        except Exception as e:
+            print("DB WRITER RECONNECTING:", repr(e))
+            conn.close()
+            return None
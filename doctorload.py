@@ -0,0 +1,135 @@
+"""Per-doctor load index for recommending doctors within a department.
+
+`doctor_load` keeps one row per doctor with the two signals that would
+otherwise need per-doctor queries at ranking time:
+
+* next_free_day - the first day (days since 1970-01-01) from `as_of_day` on
+                  with a free slot that is not a holiday, read from
+                  slotmaps' day_bitmaps.
+* booked_ahead  - confirmed appointments in the LOAD_WINDOW_DAYS days from
+                  `as_of_day`.
+
+Triggers keep both current as bookings and availability change:
+appointments adjust booked_ahead by one, and a day_bitmaps change only
+rescans for the next free day when it touches that day or an earlier one.
+Ranking a department is then one indexed read of its rows
+(DoctorRepository.recommended). Rows roll over to a new `as_of_day` via
+refresh(), which the recommendation endpoint runs for a department the
+first time it is asked after midnight, and which schedule and holiday
+changes run for the doctors they affect. SQLite only, like day_bitmaps.
+"""
+from datetime import date
+
+import archive
+
+
+LOAD_WINDOW_DAYS = 14
+
+# Ranking score, lower is better: each day of waiting for a free slot weighs
+# as much as two upcoming bookings; experience (capped) breaks near-ties.
+WAIT_WEIGHT = 1.0
+LOAD_WEIGHT = 0.5
+EXPERIENCE_WEIGHT = 0.1
+EXPERIENCE_CAP = 20
+
+
+def today_day():
+    return (date.today() - date(1970, 1, 1)).days
+
+
+def day_to_date(day):
+    return date.fromordinal(date(1970, 1, 1).toordinal() + day).isoformat() if day is not None else None
+
+
+def _next_free_sql(doctor, start):
+    """First open, non-holiday day of `doctor` from day `start` on (SQL expressions)."""
+    return f"""(
+        SELECT b.day FROM day_bitmaps b
+        WHERE b.doctor_id = {doctor} AND b.day >= {start}
+          AND (b.available_mask & ~b.full_mask) != 0
+          AND NOT EXISTS (
+              SELECT 1 FROM holidays h, doctors d
+              WHERE d.id = b.doctor_id AND h.date = date(b.day * 86400, 'unixepoch')
+                AND (h.doctor_id = d.id OR h.department_id = d.department_id
+                     OR (h.doctor_id IS NULL AND h.department_id IS NULL))
+          )
+        ORDER BY b.day
+        LIMIT 1
+    )"""
+
+
+def _in_window(ref):
+    return (f"unixepoch({ref}.date) / 86400 BETWEEN as_of_day AND as_of_day + {LOAD_WINDOW_DAYS - 1}"
+            f" AND {ref}.status = 'confirmed'")
+
+
+def _bitmap_sql(ref):
+    return f"""
+        UPDATE doctor_load
+        SET next_free_day = {_next_free_sql("doctor_load.doctor_id", "doctor_load.as_of_day")}
+        WHERE doctor_id = {ref}.doctor_id AND {ref}.day >= as_of_day
+          AND (next_free_day IS NULL OR {ref}.day <= next_free_day);
+    """
+
+
+def _booked_sql(ref, delta):
+    return f"""
+        UPDATE doctor_load SET booked_ahead = booked_ahead + ({delta})
+        WHERE doctor_id = {ref}.doctor_id AND {_in_window(ref)};
+    """
+
+
+TRIGGERS = {
+    "day_bitmaps_load_insert": ("AFTER INSERT ON day_bitmaps", "NEW", _bitmap_sql("NEW")),
+    "day_bitmaps_load_update": ("AFTER UPDATE ON day_bitmaps", "NEW", _bitmap_sql("NEW")),
+    "day_bitmaps_load_delete": ("AFTER DELETE ON day_bitmaps", "OLD", _bitmap_sql("OLD")),
+    "appointments_load_insert": ("AFTER INSERT ON appointments", "NEW", _booked_sql("NEW", 1)),
+    "appointments_load_update": ("AFTER UPDATE OF doctor_id, date, status ON appointments", "NEW",
+                                 _booked_sql("OLD", -1) + _booked_sql("NEW", 1)),
+    "appointments_load_delete": ("AFTER DELETE ON appointments", "OLD", _booked_sql("OLD", -1)),
+}
+
+
+def init_schema(conn):
+    """doctor_load and its triggers; needs slotmaps' day_bitmaps and schedule's holidays."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS doctor_load (
+            doctor_id INTEGER PRIMARY KEY,
+            department_id INTEGER,
+            as_of_day INTEGER NOT NULL,
+            next_free_day INTEGER,
+            booked_ahead INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_doctor_load_department ON doctor_load(department_id)")
+
+    # Recreated every migration so trigger bodies follow the code.
+    for name, (event, ref, body) in TRIGGERS.items():
+        conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+        when = f"{ref}.doctor_id IS NOT NULL{archive.skip_archival(event)}"
+        conn.execute(f"CREATE TRIGGER {name} {event} WHEN {when} BEGIN {body} END")
+
+
+def refresh(tx, doctor_ids=None):
+    """Recompute the rows of the given doctors (all when None) as of today."""
+    if doctor_ids is not None and not doctor_ids:
+        return
+
+    as_of = today_day()
+    doctor_filter, params = "", []
+    if doctor_ids is not None:
+        doctor_filter = " WHERE id IN ({})".format(",".join("?" for _ in doctor_ids))
+        params = list(doctor_ids)
+
+    tx.execute(f"DELETE FROM doctor_load WHERE doctor_id IN (SELECT id FROM doctors{doctor_filter})", params)
+    tx.execute(f"""
+        INSERT INTO doctor_load (doctor_id, department_id, as_of_day, next_free_day, booked_ahead)
+        SELECT id, CAST(department_id AS INTEGER), ?, {_next_free_sql("doctors.id", "?")}, (
+            SELECT COUNT(*) FROM appointments a
+            WHERE a.doctor_id = doctors.id AND a.date >= date(? * 86400, 'unixepoch')
+              AND a.date < date((? + {LOAD_WINDOW_DAYS}) * 86400, 'unixepoch') AND a.status = 'confirmed'
+        )
+        FROM doctors{doctor_filter}
+    """, (as_of, as_of, as_of, as_of, *params))
+    # Doctors that no longer exist.
+    tx.execute("DELETE FROM doctor_load WHERE doctor_id NOT IN (SELECT id FROM doctors)")
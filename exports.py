@@ -0,0 +1,47 @@
+"""Chunked JSON-lines and CSV encoding for the admin exports.
+
+ExportRepository.stream (repositories.py) yields batches of plain tuples
+from the cursor; each encoder here turns one batch into one text chunk and
+lets it go before the next is fetched. A response built on them holds one
+batch at a time, whether the table has a thousand rows or ten million, and
+sends its first bytes as soon as the first batch is read.
+"""
+import csv
+import io
+import json
+
+
+# format: (mimetype, file extension)
+FORMATS = {
+    "jsonl": ("application/x-ndjson", "jsonl"),
+    "csv": ("text/csv", "csv"),
+}
+
+_encoder = json.JSONEncoder(ensure_ascii=False, check_circular=False, separators=(",", ":"))
+
+
+def jsonl_chunks(columns, batches):
+    for rows in batches:
+        yield "".join(_encoder.encode(dict(zip(columns, row))) + "\n" for row in rows)
+
+
+def csv_chunks(columns, batches):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(columns)
+    for rows in batches:
+        writer.writerows(rows)
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+    # A table with no rows still gets its header.
+    if out.tell():
+        yield out.getvalue()
+
+
+def encode(fmt, columns, batches):
+    """The response body; closing it (client gone, response done) closes the cursor's connection too."""
+    try:
+        yield from (jsonl_chunks if fmt == "jsonl" else csv_chunks)(columns, batches)
+    finally:
+        batches.close()
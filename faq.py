@@ -0,0 +1,165 @@
+"""Local answers to common health questions, tried before the LLM.
+
+faq.json is a curated list of entries, each with a few phrasings of the
+question and one answer. FaqIndex turns every phrasing into an
+L2-normalised TF-IDF vector over word unigrams and bigrams; the vectors
+are the rows of one dense float32 matrix. A lookup tokenises the
+question, picks the matrix columns of its terms and sums them weighted by
+the query's own TF-IDF, which gives the cosine similarity to every
+phrasing in one numpy operation: tens of microseconds for a corpus
+this size.
+
+/ai/chat answers locally when the best match scores at least
+FAQ_THRESHOLD and otherwise falls through to the LLM. stats() counts
+lookups and hits, lookup latency, and how long the LLM calls that did
+happen took, so the upstream time saved can be read off directly.
+
+The index is built on first use (or in the gunicorn master, see
+gunicorn.conf.py) and never changes afterwards; numpy is imported then,
+not at app import.
+"""
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import deque
+
+
+FAQ_PATH = os.getenv("FAQ_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "faq.json"))
+FAQ_THRESHOLD = float(os.getenv("FAQ_THRESHOLD", "0.7"))
+LATENCY_SAMPLES = 1000
+
+STOPWORDS = frozenset("""
+a about an and are as at be can could do does for from get have how i if in is it its me my of on or
+should so than that the there this to was what when where which who why will with would you your
+""".split())
+_WORD = re.compile(r"[a-z0-9]+")
+
+
+def _stem(word):
+    if word.endswith("ies") and len(word) > 4:
+        return word[:-3] + "y"
+    for suffix in ("ing", "es", "s"):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+
+def terms(text):
+    words = [_stem(w) for w in _WORD.findall(text.lower()) if w not in STOPWORDS]
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+class FaqIndex:
+    def __init__(self, path=FAQ_PATH, threshold=FAQ_THRESHOLD):
+        self.path = path
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._index = None
+        self.reset()
+
+    def reset(self):
+        """Zero the counters. The index itself is read-only and stays shared after fork."""
+        self.lookups = self.hits = 0
+        self.lookup_seconds = 0.0
+        self.upstream_calls = 0
+        self.upstream_seconds = 0.0
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def load(self):
+        if self._index is not None:
+            return self._index
+        with self._lock:
+            if self._index is None:
+                self._index = self._build()
+        return self._index
+
+    def _build(self):
+        import numpy as np
+
+        with open(self.path, encoding="utf-8") as f:
+            entries = json.load(f)
+
+        docs, owners = [], []
+        for n, entry in enumerate(entries):
+            for question in entry["questions"]:
+                docs.append(terms(question))
+                owners.append(n)
+
+        vocab = {}
+        for doc in docs:
+            for term in set(doc):
+                vocab.setdefault(term, len(vocab))
+        df = np.zeros(len(vocab), dtype=np.float32)
+        for doc in docs:
+            for term in set(doc):
+                df[vocab[term]] += 1
+        idf = np.log((1 + len(docs)) / (1 + df)) + 1
+
+        matrix = np.zeros((len(docs), len(vocab)), dtype=np.float32)
+        for row, doc in enumerate(docs):
+            for term in doc:
+                matrix[row, vocab[term]] += 1
+        matrix *= idf
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-9)
+
+        # Column-major, so a lookup's column gather reads contiguous memory.
+        return {"entries": entries, "owners": np.array(owners), "vocab": vocab, "idf": idf,
+                "matrix": np.asfortranarray(matrix)}
+
+    def match(self, question):
+        """(entry, score) of the closest phrasing, or (None, 0.0) when no term is known."""
+        index = self.load()
+        counts = {}
+        for term in terms(question):
+            column = index["vocab"].get(term)
+            if column is not None:
+                counts[column] = counts.get(column, 0) + 1
+        if not counts:
+            return None, 0.0
+
+        columns = list(counts)
+        weights = index["idf"][columns] * [counts[c] for c in columns]
+        # Unknown terms still count toward the query's length, so half-matching questions score lower.
+        unknown = len(terms(question)) - sum(counts.values())
+        norm = math.sqrt(float(weights @ weights) + unknown)
+        scores = index["matrix"][:, columns] @ (weights / norm)
+        best = int(scores.argmax())
+        return index["entries"][index["owners"][best]], float(scores[best])
+
+    def answer(self, question):
+        """The stored answer when the best match clears the threshold, else None."""
+        self.load()
+        t0 = time.perf_counter()
+        entry, score = self.match(question)
+        elapsed = time.perf_counter() - t0
+        hit = entry is not None and score >= self.threshold
+
+        self.lookups += 1
+        self.hits += hit
+        self.lookup_seconds += elapsed
+        self._latencies.append(elapsed)
+        return entry["answer"] if hit else None
+
+    def record_upstream(self, seconds):
+        self.upstream_calls += 1
+        self.upstream_seconds += seconds
+
+    def stats(self):
+        latencies = sorted(self._latencies)
+        upstream_avg = self.upstream_seconds / self.upstream_calls if self.upstream_calls else None
+        return {
+            "entries": len(self._index["entries"]) if self._index else None,
+            "threshold": self.threshold,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups else None,
+            "lookup_avg_us": self.lookup_seconds / self.lookups * 1e6 if self.lookups else None,
+            "lookup_p99_us": latencies[int(len(latencies) * .99)] * 1e6 if latencies else None,
+            "upstream_calls": self.upstream_calls,
+            "upstream_avg_s": upstream_avg,
+            # What the hits would have cost had they gone to the LLM at its observed average.
+            "upstream_seconds_saved": self.hits * upstream_avg if upstream_avg else None,
+        }
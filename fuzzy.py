@@ -0,0 +1,440 @@
+"""Typo-tolerant, in-memory name lookup for doctors, patients and departments.
+
+Each kind has a NameIndex. Names are split into words and the index keeps
+the distinct words in a vocabulary: every word is padded ("$$word$") and
+cut into trigrams, each trigram has a posting list of the words containing
+it, and each word has a posting list of the names it appears in. Posting
+lists are array('I'), not lists of int objects, so half a million names
+cost tens of megabytes on top of the names themselves (stats() shows it).
+
+A lookup matches each query word against the vocabulary, which is far
+smaller than the list of names: the trigram posting lists are counted with
+numpy and words scored by the Jaccard overlap of their trigram sets with
+the query word's, plus a bonus for words that start with it (typeahead).
+A misspelling only loses the trigrams around the typo, so "cardiolgy"
+still finds "Cardiology". Short words have too few trigrams for that: one
+typo in "alice" or a swap in "smith" costs most of them. So the words
+sharing the most trigrams with the query word are also scored by edit
+distance (a swap of neighbours counts as one edit), and a word keeps the
+better of its two scores. A name then scores the mean, over the query
+words, of its best matching word; that is a few numpy scatters over the
+names of the matched words, however common the rest of the name is.
+
+Updates are incremental: changing or removing a name tombstones its slot
+and a new slot is appended; the index is rebuilt once a quarter of the
+slots are dead.
+
+NameDirectory keeps one index per kind, loaded on first use, and applies
+changes two ways:
+
+* refresh(kind, ids), called by the routes that add or edit names, so this
+  process sees its own change at once;
+* on SQLite, triggers log every insert, update and delete of a name in
+  `name_changes`; before a lookup the directory checks PRAGMA data_version
+  and re-reads the entities logged since its last look, which brings in
+  changes made by other workers (and by any other write path).
+
+On Postgres there is no change log; other workers' changes are picked up
+by a full reload every REBUILD_INTERVAL seconds.
+"""
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
+from array import array
+from urllib.parse import quote
+
+
+RETAIN_CHANGES = 10000
+REBUILD_INTERVAL = 300
+# Vocabulary words kept per query word, and the least similarity that counts as a match.
+WORD_MATCHES = 30
+WORD_MIN_SCORE = 0.25
+PREFIX_BONUS = 0.3
+MIN_SCORE = 0.3
+# Most vocabulary words checked by edit distance per query word.
+EDIT_CANDIDATES = 500
+
+_SPACES = re.compile(r"[^a-z0-9]+")
+
+# kind: (table, id column, columns whose change matters)
+KINDS = {
+    "doctor": ("doctors", "id", ("name", "department")),
+    "patient": ("patients", "id", ("name", "username")),
+    "department": ("departments", "department_id", ("name", "description")),
+}
+
+
+def words(text):
+    text = unicodedata.normalize("NFKD", text or "").encode("ascii", "ignore").decode().lower()
+    return _SPACES.sub(" ", text).split()
+
+
+def trigrams(word, query=False):
+    padded = f"$${word}" if query else f"$${word}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def max_edits(word):
+    """Edits a query word may be away from a match: none up to 3 letters, one up to 5, then two."""
+    return 0 if len(word) <= 3 else 1 if len(word) <= 5 else 2
+
+
+def edit_distances(np, word, others):
+    """Optimal string alignment distance (insert, delete, substitute, swap neighbours)
+    from `word` to each of `others`, one dynamic-programming row at a time for all of them."""
+    width = max(map(len, others))
+    padded = "".join(other.ljust(width, "\0") for other in others)
+    chars = np.frombuffer(padded.encode("utf-32-le"), dtype=np.uint32).reshape(len(others), width)
+    query = np.frombuffer(word.encode("utf-32-le"), dtype=np.uint32)
+
+    before = None
+    row = np.broadcast_to(np.arange(width + 1, dtype=np.int32), (len(others), width + 1)).copy()
+    for i in range(1, len(query) + 1):
+        current = np.empty_like(row)
+        current[:, 0] = i
+        for j in range(1, width + 1):
+            cost = np.minimum(row[:, j], current[:, j - 1]) + 1
+            np.minimum(cost, row[:, j - 1] + (chars[:, j - 1] != query[i - 1]), out=cost)
+            if before is not None and j > 1:
+                swapped = (chars[:, j - 2] == query[i - 1]) & (chars[:, j - 1] == query[i - 2])
+                np.minimum(cost, np.where(swapped, before[:, j - 2] + 1, cost), out=cost)
+            current[:, j] = cost
+        before, row = row, current
+    return row[np.arange(len(others)), [len(other) for other in others]]
+
+
+class NameIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        # Vocabulary: word -> word id, the word's trigram count and length, trigram -> word ids,
+        # word id -> name slots.
+        self._vocab = {}
+        self._words = []
+        self._word_sizes = array("H")
+        self._word_lengths = array("B")
+        self._grams = {}
+        self._word_names = []
+        # Name slots.
+        self._keys = []
+        self._names = []
+        self._details = []
+        self._alive = bytearray()
+        self._slots = {}
+        self._scratch = ()
+        self.dead = 0
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _word_id(self, word):
+        wid = self._vocab.get(word)
+        if wid is None:
+            wid = self._vocab[word] = len(self._words)
+            self._words.append(word)
+            grams = trigrams(word)
+            self._word_sizes.append(min(len(grams), 0xFFFF))
+            self._word_lengths.append(min(len(word), 0xFF))
+            self._word_names.append(array("I"))
+            for gram in grams:
+                posting = self._grams.get(gram)
+                if posting is None:
+                    posting = self._grams[gram] = array("I")
+                posting.append(wid)
+        return wid
+
+    def _append(self, key, name, detail):
+        slot = len(self._keys)
+        self._keys.append(key)
+        self._names.append(name)
+        self._details.append(detail)
+        self._alive.append(1)
+        self._slots[key] = slot
+        for word in set(words(name)):
+            self._word_names[self._word_id(word)].append(slot)
+
+    def load(self, rows):
+        """Replace the contents with (key, name, detail) rows."""
+        # search() needs numpy; importing it now keeps that cost off the first lookup.
+        import numpy  # noqa: F401
+
+        with self._lock:
+            self.clear()
+            for key, name, detail in rows:
+                if name:
+                    self._append(key, name, detail)
+
+    def put(self, key, name, detail=None):
+        """Add or replace the name stored under `key`."""
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is not None:
+                if self._names[slot] == name and self._details[slot] == detail:
+                    return
+                self._kill(slot)
+            if name:
+                self._append(key, name, detail)
+            if self.dead * 4 > len(self._keys):
+                live = [(self._keys[s], self._names[s], self._details[s])
+                        for s in range(len(self._keys)) if self._alive[s]]
+                self.clear()
+                for row in live:
+                    self._append(*row)
+
+    def remove(self, key):
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is not None:
+                self._kill(slot)
+
+    def _kill(self, slot):
+        # The slot number stays (posting lists still point at it) until the next rebuild.
+        del self._slots[self._keys[slot]]
+        self._alive[slot] = 0
+        self._names[slot] = self._details[slot] = None
+        self.dead += 1
+
+    def _match_words(self, np, word):
+        """[(word id, similarity)] of the vocabulary words most like `word`, least similar first."""
+        grams = trigrams(word, query=True)
+        views = [np.frombuffer(self._grams[g], dtype=np.uint32) for g in grams if g in self._grams]
+        if not views:
+            return []
+        hits = np.bincount(np.concatenate(views), minlength=len(self._word_names))
+        del views
+        wids = np.flatnonzero(hits)
+        shared = hits[wids]
+        scores = shared / (len(grams) + np.frombuffer(self._word_sizes, dtype=np.uint16)[wids] - shared)
+
+        # Words starting with the query word share all its trigrams; give them the prefix bonus.
+        prefix = shared == len(grams)
+        if prefix.any():
+            starts = [self._words[w].startswith(word) for w in wids[prefix].tolist()]
+            scores[np.flatnonzero(prefix)[starts]] += PREFIX_BONUS
+
+        # A word in the vocabulary is taken as typed; only a misspelling needs the edit distance.
+        limit = max_edits(word) if word not in self._vocab else 0
+        if limit:
+            # Within `limit` edits the lengths differ by at most `limit`.
+            lengths = np.frombuffer(self._word_lengths, dtype=np.uint8)[wids].astype(np.int64)
+            near = np.flatnonzero(np.abs(lengths - len(word)) <= limit)
+            if len(near) > EDIT_CANDIDATES:
+                near = near[np.argpartition(-shared[near], EDIT_CANDIDATES - 1)[:EDIT_CANDIDATES]]
+            if len(near):
+                edits = edit_distances(np, word, [self._words[w] for w in wids[near].tolist()])
+                close = edits <= limit
+                near, edits = near[close], edits[close]
+                scores[near] = np.maximum(scores[near], 1 - edits / np.maximum(lengths[near], len(word)))
+
+        keep = scores >= WORD_MIN_SCORE
+        wids, scores = wids[keep], np.minimum(scores[keep], 1.0)
+        if len(wids) > WORD_MATCHES:
+            top = np.argpartition(-scores, WORD_MATCHES - 1)[:WORD_MATCHES]
+            wids, scores = wids[top], scores[top]
+        order = np.argsort(scores)
+        return list(zip(wids[order].tolist(), scores[order].tolist()))
+
+    def search(self, q, limit=10):
+        """[(score, key, name, detail)] best first; score is 0-1."""
+        import numpy as np
+
+        query = words(q)[:6]
+        if not query:
+            return []
+
+        with self._lock:
+            n = len(self._keys)
+            if len(self._scratch) < 2 * n:
+                self._scratch = np.zeros(2 * max(n, len(self._scratch)), dtype=np.float32)
+            # Reused zeroed buffers.
+            total, best = self._scratch[:n], self._scratch[len(self._scratch) // 2:][:n]
+            touched = []
+            for word in query:
+                matched = [(np.frombuffer(self._word_names[wid], dtype=np.uint32), score)
+                           for wid, score in self._match_words(np, word)]
+                if not matched:
+                    continue
+                # Least similar first, so a name with several matching words keeps its best.
+                for slots, score in matched:
+                    best[slots] = score
+                slots = np.concatenate([slots for slots, _ in matched])
+                total[slots] += best[slots]
+                best[slots] = 0
+                touched.append(slots)
+            if not touched:
+                return []
+
+            # Read the touched slots back and zero them: only those, never all n.
+            slots = np.concatenate(touched)
+            totals = total[slots]
+            total[slots] = 0
+            keep = totals >= MIN_SCORE * len(query)
+            candidates, totals = slots[keep], totals[keep]
+            # A name matched by several query words is listed once per word; keep one of each.
+            position = np.arange(len(candidates), dtype=np.float32)
+            best[candidates] = position
+            first = best[candidates] == position
+            best[candidates] = 0
+            candidates, totals = candidates[first], totals[first]
+            scores = totals / len(query) * np.frombuffer(self._alive, dtype=np.uint8)[candidates]
+            if len(candidates) > limit * 4:
+                top = np.argpartition(-scores, limit * 4 - 1)[:limit * 4]
+                candidates, scores = candidates[top], scores[top]
+            results = [(round(score, 3), self._keys[slot], self._names[slot], self._details[slot])
+                       for slot, score in zip(candidates.tolist(), scores.tolist()) if score >= MIN_SCORE]
+
+        results.sort(key=lambda r: (-r[0], len(r[2])))
+        return results[:limit]
+
+    def memory_bytes(self):
+        """Approximate footprint: posting arrays, the slot and vocabulary tables, and the stored strings."""
+        with self._lock:
+            postings = sum(sys.getsizeof(p) for p in self._word_names)
+            postings += sum(sys.getsizeof(g) + sys.getsizeof(p) for g, p in self._grams.items())
+            strings = sum(sys.getsizeof(s) for column in (self._names, self._details)
+                          for s in column if s is not None)
+            strings += sum(sys.getsizeof(w) for w in self._vocab)
+            tables = sum(sys.getsizeof(t) for t in (self._vocab, self._words, self._word_sizes, self._word_lengths,
+                                                     self._grams, self._word_names, self._keys, self._names,
+                                                     self._details, self._alive, self._slots))
+        return {"postings": postings, "strings": strings, "tables": tables, "total": postings + strings + tables}
+
+
+def init_schema(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS name_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            entity_id INTEGER NOT NULL
+        )
+    """)
+    prune = f"DELETE FROM name_changes WHERE id <= last_insert_rowid() - {RETAIN_CHANGES};"
+    for kind, (table, id_column, columns) in KINDS.items():
+        log = f"INSERT INTO name_changes (kind, entity_id) VALUES ('{kind}', {{ref}}.{id_column}); {prune}"
+        triggers = {
+            "insert": ("AFTER INSERT", log.format(ref="NEW")),
+            "update": (f"AFTER UPDATE OF {', '.join(columns)}", log.format(ref="NEW")),
+            "delete": ("AFTER DELETE", log.format(ref="OLD")),
+        }
+        for event, (when, body) in triggers.items():
+            conn.execute(f"DROP TRIGGER IF EXISTS {table}_names_{event}")
+            conn.execute(f"CREATE TRIGGER {table}_names_{event} {when} ON {table} BEGIN {body} END")
+
+
+class NameDirectory:
+    """One NameIndex per kind; `fetch(kind, ids=None)` returns (id, name, detail) rows."""
+
+    def __init__(self, backend, fetch):
+        self.backend = backend
+        self.fetch = fetch
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._pid = os.getpid()
+        self._indexes = {}
+        self._loaded_at = {}
+        self._conn = None
+        self._data_version = None
+        self._last_change = None
+        self.lookups = self.updates = self.reloads = 0
+        self.lookup_seconds = 0.0
+
+    def _change_conn(self):
+        if self._conn is None:
+            path = os.path.abspath(self.backend.path)
+            self._conn = sqlite3.connect(f"file:{quote(path)}?mode=ro", uri=True, check_same_thread=False)
+        return self._conn
+
+    def _index(self, kind):
+        index = self._indexes.get(kind)
+        stale = self.backend.name != "sqlite" and time.monotonic() - self._loaded_at.get(kind, 0) > REBUILD_INTERVAL
+        if index is None or stale:
+            if self._last_change is None and self.backend.name == "sqlite":
+                # Start the log position before loading, so nothing committed in between is missed.
+                self._last_change = self._change_conn().execute(
+                    "SELECT COALESCE(MAX(id), 0) FROM name_changes").fetchone()[0]
+            index = index or NameIndex()
+            index.load(self.fetch(kind))
+            self._indexes[kind] = index
+            self._loaded_at[kind] = time.monotonic()
+            self.reloads += 1
+        return index
+
+    def _catch_up(self):
+        if self.backend.name != "sqlite" or self._last_change is None:
+            return
+        conn = self._change_conn()
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self._data_version:
+            return
+        self._data_version = data_version
+
+        rows = conn.execute("SELECT id, kind, entity_id FROM name_changes WHERE id > ? ORDER BY id",
+                            (self._last_change,)).fetchall()
+        if not rows:
+            return
+        if rows[0][0] > self._last_change + 1 and conn.execute(
+                "SELECT MIN(id) FROM name_changes").fetchone()[0] > self._last_change + 1:
+            # Pruned past our position: reload everything rather than guess.
+            self._indexes.clear()
+            self._last_change = None
+            return
+        self._last_change = rows[-1][0]
+        changed = {}
+        for _, kind, entity_id in rows:
+            changed.setdefault(kind, set()).add(entity_id)
+        for kind, ids in changed.items():
+            if kind in self._indexes:
+                self._apply(kind, ids)
+
+    def _apply(self, kind, ids):
+        index = self._indexes[kind]
+        found = set()
+        for key, name, detail in self.fetch(kind, sorted(ids)):
+            index.put(key, name, detail)
+            found.add(key)
+        for key in set(ids) - found:
+            index.remove(key)
+        self.updates += len(ids)
+
+    def refresh(self, kind, ids):
+        """Re-read these entities now (after this process changed them)."""
+        with self._lock:
+            if self._pid != os.getpid():
+                self.reset()
+            if kind in self._indexes:
+                self._apply(kind, set(ids))
+
+    def search(self, kind, q, limit=10):
+        with self._lock:
+            if self._pid != os.getpid():
+                self.reset()
+            try:
+                self._catch_up()
+            except sqlite3.Error as e:
+                # No name_changes yet (unmigrated database): serve what is loaded.
+                print("Name index catch-up failed:", e)
+            index = self._index(kind)
+
+        t0 = time.perf_counter()
+        results = index.search(q, limit)
+        self.lookups += 1
+        self.lookup_seconds += time.perf_counter() - t0
+        return results
+
+    def stats(self):
+        return {
+            "lookups": self.lookups,
+            "lookup_avg_ms": self.lookup_seconds / self.lookups * 1000 if self.lookups else None,
+            "updates": self.updates,
+            "reloads": self.reloads,
+            "indexes": {kind: {"names": len(index), "dead_slots": index.dead, "memory_bytes": index.memory_bytes()}
+                        for kind, index in self._indexes.items()},
+        }
@@ -0,0 +1,94 @@
+"""gunicorn settings for the hospital app.
+
+    gunicorn -c gunicorn.conf.py wsgi:app     (or: python serve.py --preset gthread)
+
+GUNICORN_PRESET picks the worker model; WEB_CONCURRENCY, GUNICORN_THREADS,
+GUNICORN_WORKER_CLASS and GUNICORN_WORKER_CONNECTIONS override its numbers.
+
+* sync    - one request per process. A multi-second AI call holds a whole
+            worker, so it runs 2 x cores + 1 of them.
+* gthread - (default) a few processes with a thread pool each; threads
+            waiting on the AI API or SQLite release the GIL.
+* async   - gevent greenlets; thousands of idle SSE streams and in-flight
+            AI calls cost almost nothing. Needs gevent installed.
+
+The app is preloaded in the master (GUNICORN_PRELOAD=0 turns that off), so
+workers fork with the code already imported. The schema is created/upgraded
+once in the master before any worker is forked, and every worker drops the
+connections, threads and HTTP clients it would otherwise inherit from the
+master. Importing the app opens none of them.
+
+Live availability streams (/doctor/<id>/events) hold their connection open.
+With gthread workers each open stream takes a thread, so workers x threads
+caps the number of viewers; the async preset serves each from a greenlet.
+
+Reloading: HUP re-reads this file and replaces the workers gracefully, but
+with preload_app they fork from the master's already-imported code. To
+deploy new code send USR2 (a new master execs and loads it) and then TERM
+to the old master; `python serve.py --upgrade` does both.
+"""
+import os
+
+cores = os.cpu_count() or 1
+
+PRESETS = {
+    "sync": {"worker_class": "sync", "workers": 2 * cores + 1, "threads": 1},
+    "gthread": {"worker_class": "gthread", "workers": cores, "threads": 8},
+    "async": {"worker_class": "gevent", "workers": cores, "threads": 1},
+}
+preset = PRESETS[os.getenv("GUNICORN_PRESET", "gthread")]
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", preset["worker_class"])
+workers = int(os.getenv("WEB_CONCURRENCY", preset["workers"]))
+threads = int(os.getenv("GUNICORN_THREADS", preset["threads"]))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+pidfile = os.getenv("GUNICORN_PIDFILE") or None
+
+if worker_class == "gevent":
+    # The preloaded app is imported in the master, before gevent's worker would patch; patch first.
+    try:
+        from gevent import monkey
+    except ImportError as e:
+        raise ImportError("the gevent worker class needs gevent (pip install -r requirements.txt)") from e
+
+    monkey.patch_all()
+
+
+def on_starting(server):
+    import app
+
+    app.create_app()
+    app.init_db()
+    app.schedule_recurring_jobs()
+    # Admission metrics of a previous server's workers.
+    app.admission_control.clear()
+    # Built once here and shared by every forked worker.
+    app.faq_index.load()
+
+
+def post_fork(server, worker):
+    import app
+
+    app.reset_after_fork()
+    if "ADMISSION_CAPACITY" not in os.environ:
+        # The requests one worker serves at once: its threads, or its greenlets under gevent.
+        app.admission_control.capacity = worker_connections if worker_class == "gevent" else threads
+
+
+def worker_exit(server, worker):
+    import app
+
+    # Write out buffered audit events before the worker goes away (bounded by audit.CLOSE_TIMEOUT).
+    app.audit_log.close()
+    app.admission_control.close()
+
+
+def child_exit(server, worker):
+    import app
+
+    # In the master, after any worker exit (also a killed one): keep its counters, drop its rows.
+    app.admission_control.retire([worker.pid])
@@ -0,0 +1,330 @@
+"""Durable background jobs stored in hospital.db.
+
+Request handlers call `queue.enqueue(...)` and return straight away; a
+separate worker process (`python jobs.py worker`) claims jobs, runs the
+registered handler and records the result. Delivery is at-least-once: a
+claimed job carries a visibility deadline, and if its worker dies before
+finishing, the job becomes claimable again once the deadline passes.
+Handlers must therefore be idempotent.
+"""
+import argparse
+import json
+import os
+import random
+import signal
+import socket
+import sqlite3
+import threading
+import time
+
+
+DEFAULT_VISIBILITY_TIMEOUT = 60
+DEFAULT_MAX_ATTEMPTS = 5
+BACKOFF_BASE = 2
+BACKOFF_CAP = 15 * 60
+
+handlers = {}
+
+
+def task(kind):
+    def register(fn):
+        handlers[kind] = fn
+        return fn
+    return register
+
+
+def init_schema(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT,
+            priority INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 5,
+            run_at REAL NOT NULL,
+            locked_by TEXT,
+            locked_until REAL,
+            owner TEXT,
+            result TEXT,
+            error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs(status, priority DESC, run_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_locked ON jobs(status, locked_until)")
+
+
+def insert_job(conn, kind, payload=None, priority=0, delay=0, max_attempts=DEFAULT_MAX_ATTEMPTS, owner=None,
+               unique=False):
+    """Queue a job on `conn`; with a transaction open, it commits (or not) with the caller's writes."""
+    now = time.time()
+    if unique:
+        # Recurring jobs: at most one waiting copy of a kind at a time.
+        row = conn.execute(
+            "SELECT id FROM jobs WHERE kind = ? AND status = 'queued' LIMIT 1", (kind,)
+        ).fetchone()
+        if row:
+            return row[0]
+
+    cur = conn.execute("""
+        INSERT INTO jobs (kind, payload, priority, max_attempts, run_at, owner, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (kind, json.dumps(payload), priority, max_attempts, now + delay,
+          None if owner is None else str(owner), now, now))
+    return cur.lastrowid
+
+
+def backoff_delay(attempts):
+    delay = min(BACKOFF_BASE ** attempts, BACKOFF_CAP)
+    return delay + random.uniform(0, delay / 4)
+
+
+class JobQueue:
+    """Jobs in the app's database file.
+
+    With a `writer` (the web process's SerializedWriter), enqueue goes
+    through it like every other request-path write instead of committing
+    on a connection of its own. Claiming, completing and failing jobs is
+    the worker process's business and uses the queue's own connection.
+    """
+
+    def __init__(self, path, writer=None):
+        self.path = path
+        self.writer = writer
+        self._local = threading.local()
+        self._schema_ready = False
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        if not self._schema_ready:
+            init_schema(conn)
+            self._schema_ready = True
+
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def reset(self):
+        self._local = threading.local()
+
+    def enqueue(self, kind, payload=None, priority=0, delay=0, max_attempts=DEFAULT_MAX_ATTEMPTS, owner=None,
+                unique=False):
+        args = (kind, payload, priority, delay, max_attempts, owner, unique)
+        if self.writer is not None:
+            if not self._schema_ready:
+                # The writer's connection never runs init_schema; Postgres deployments skip init_db.
+                self._conn()
+            return self.writer.run(insert_job, *args)
+        return insert_job(self._conn(), *args)
+
+    def get(self, job_id):
+        row = self._conn().execute("""
+            SELECT id, kind, priority, status, attempts, max_attempts, run_at, owner, result, error,
+                   created_at, updated_at
+            FROM jobs WHERE id = ?
+        """, (job_id,)).fetchone()
+        if not row:
+            return None
+
+        job = dict(row)
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def claim(self, worker_id, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT):
+        conn = self._conn()
+        now = time.time()
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Jobs whose worker vanished past the visibility deadline go back on the queue,
+            # unless they have used up their attempts.
+            conn.execute("""
+                UPDATE jobs
+                SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END,
+                    error = COALESCE(error, 'visibility timeout expired'),
+                    locked_by = NULL, locked_until = NULL, updated_at = ?
+                WHERE status = 'running' AND locked_until < ?
+            """, (now, now))
+
+            row = conn.execute("""
+                UPDATE jobs
+                SET status = 'running', attempts = attempts + 1,
+                    locked_by = ?, locked_until = ?, updated_at = ?
+                WHERE id = (
+                    SELECT id FROM jobs
+                    WHERE status = 'queued' AND run_at <= ?
+                    ORDER BY priority DESC, run_at
+                    LIMIT 1
+                )
+                RETURNING id, kind, payload, attempts, max_attempts
+            """, (worker_id, now + visibility_timeout, now, now)).fetchone()
+            conn.execute("COMMIT")
+
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        if not row:
+            return None
+
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"]) if job["payload"] else None
+        return job
+
+    def extend(self, job_id, worker_id, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT):
+        self._conn().execute(
+            "UPDATE jobs SET locked_until = ? WHERE id = ? AND locked_by = ? AND status = 'running'",
+            (time.time() + visibility_timeout, job_id, worker_id)
+        )
+
+    def complete(self, job_id, worker_id, result=None):
+        self._conn().execute("""
+            UPDATE jobs
+            SET status = 'done', result = ?, error = NULL, locked_by = NULL, locked_until = NULL, updated_at = ?
+            WHERE id = ? AND locked_by = ?
+        """, (json.dumps(result), time.time(), job_id, worker_id))
+
+    def fail(self, job_id, worker_id, error):
+        now = time.time()
+        conn = self._conn()
+        row = conn.execute("SELECT attempts, max_attempts FROM jobs WHERE id = ? AND locked_by = ?",
+                           (job_id, worker_id)).fetchone()
+        if not row:
+            return
+
+        if row["attempts"] >= row["max_attempts"]:
+            status, run_at = "failed", now
+        else:
+            status, run_at = "queued", now + backoff_delay(row["attempts"])
+
+        conn.execute("""
+            UPDATE jobs
+            SET status = ?, run_at = ?, error = ?, locked_by = NULL, locked_until = NULL, updated_at = ?
+            WHERE id = ? AND locked_by = ?
+        """, (status, run_at, error, now, job_id, worker_id))
+
+    def purge(self, older_than=7 * 24 * 3600):
+        self._conn().execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+            (time.time() - older_than,)
+        )
+
+
+# ===================== WORKER =====================
+def run_job(queue, job, worker_id, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT):
+    handler = handlers.get(job["kind"])
+    if handler is None:
+        queue.fail(job["id"], worker_id, f"no handler registered for {job['kind']!r}")
+        return
+
+    # Keep pushing the visibility deadline out while the handler runs, so a long job
+    # (an LLM call, a big availability batch) is not reclaimed and run a second time.
+    # If this process dies the heartbeat stops with it and the job is reclaimed as before.
+    done = threading.Event()
+
+    def heartbeat():
+        while not done.wait(visibility_timeout / 3):
+            try:
+                queue.extend(job["id"], worker_id, visibility_timeout)
+            except sqlite3.Error as e:
+                print(f"JOB {job['id']} HEARTBEAT ERROR:", repr(e))
+
+    beat = threading.Thread(target=heartbeat, name=f"job-{job['id']}-heartbeat", daemon=True)
+    beat.start()
+    try:
+        result = handler(job["payload"])
+    except Exception as e:
+        print(f"JOB {job['id']} ({job['kind']}) attempt {job['attempts']} FAILED:", repr(e))
+        queue.fail(job["id"], worker_id, repr(e))
+    else:
+        queue.complete(job["id"], worker_id, result)
+    finally:
+        done.set()
+        beat.join()
+
+
+def worker_loop(queue, worker_id, stop, poll_interval, visibility_timeout):
+    while not stop.is_set():
+        try:
+            job = queue.claim(worker_id, visibility_timeout)
+        except sqlite3.OperationalError as e:
+            print("JOB CLAIM ERROR:", repr(e))
+            job = None
+
+        if job is None:
+            stop.wait(poll_interval)
+            continue
+
+        run_job(queue, job, worker_id, visibility_timeout)
+
+
+def run_workers(queue, concurrency=4, poll_interval=0.5, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT):
+    stop = threading.Event()
+
+    def shutdown(signum, frame):
+        print("Worker stopping, finishing in-flight jobs...")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    base_id = f"{socket.gethostname()}:{os.getpid()}"
+    threads = [
+        threading.Thread(
+            target=worker_loop,
+            args=(queue, f"{base_id}:{n}", stop, poll_interval, visibility_timeout),
+            daemon=True
+        )
+        for n in range(concurrency)
+    ]
+    for t in threads:
+        t.start()
+
+    print(f"Job worker {base_id} running {concurrency} threads; handlers: {', '.join(sorted(handlers))}")
+    while any(t.is_alive() for t in threads):
+        for t in threads:
+            t.join(timeout=0.5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hospital background job worker")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    worker = sub.add_parser("worker", help="run a worker pool")
+    worker.add_argument("--concurrency", type=int, default=4)
+    worker.add_argument("--poll-interval", type=float, default=0.5)
+    worker.add_argument("--visibility-timeout", type=float, default=DEFAULT_VISIBILITY_TIMEOUT)
+
+    status = sub.add_parser("status", help="show a job")
+    status.add_argument("job_id", type=int)
+
+    sub.add_parser("purge", help="delete finished jobs older than a week")
+
+    args = parser.parse_args()
+
+    # Importing the app registers its job handlers on the `jobs` module it imports,
+    # which is not this __main__ module, so go through that one.
+    import app
+    import jobs
+
+    app.create_app()
+    queue = app.job_queue
+    if args.command == "worker":
+        app.schedule_recurring_jobs()
+        jobs.run_workers(queue, args.concurrency, args.poll_interval, args.visibility_timeout)
+    elif args.command == "status":
+        print(json.dumps(queue.get(args.job_id), indent=2))
+    elif args.command == "purge":
+        queue.purge()
+
+
+if __name__ == "__main__":
+    main()
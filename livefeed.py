@@ -0,0 +1,224 @@
+"""Live slot-change events for open availability pages, over Server-Sent Events.
+
+Triggers on appointments and doctor_availability append one row per change
+to `slot_changes` (doctor, date, slot or session, kind), whichever process
+or job made it, and trim the table to the last RETAIN_CHANGES rows. Each web
+process runs one `ChangeBroker` thread that polls the log, using
+`PRAGMA data_version` so an idle poll reads no table pages, and hands new
+rows to the subscribers of that doctor. That works across gunicorn workers
+without any broker process.
+
+A subscriber is a bounded queue, so an open page costs a queue and a
+sleeping generator, not a polling loop. The stream sends a heartbeat
+comment every HEARTBEAT_SECONDS and event ids, so a reconnecting
+EventSource resumes from Last-Event-ID. A client that falls further behind
+than the retained log, or whose queue overflows, gets a `reset` event and
+reloads. Listeners registered with add_listener (pagecache.py) see every
+change, subscribed or not.
+
+For thousands of idle viewers, run gunicorn with an async worker class
+(GUNICORN_WORKER_CLASS=gevent), where each open stream is a greenlet
+instead of a thread.
+"""
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from urllib.parse import quote
+
+import archive
+
+
+RETAIN_CHANGES = 10000
+POLL_INTERVAL = 0.5
+HEARTBEAT_SECONDS = 15
+SUBSCRIBER_QUEUE_SIZE = 256
+
+
+def _log_sql(ref, kind, slot):
+    return f"""
+        INSERT INTO slot_changes (doctor_id, date, slot, kind) VALUES ({ref}.doctor_id, {ref}.date, {slot}, '{kind}');
+        DELETE FROM slot_changes WHERE id <= last_insert_rowid() - {RETAIN_CHANGES};
+    """
+
+
+TRIGGERS = {
+    "appointments_feed_insert": ("AFTER INSERT ON appointments", "NEW", "booking"),
+    "appointments_feed_update_old": ("AFTER UPDATE OF doctor_id, date, slot, status ON appointments", "OLD",
+                                     "booking"),
+    "appointments_feed_update_new": ("AFTER UPDATE OF doctor_id, date, slot, status ON appointments", "NEW",
+                                     "booking"),
+    "appointments_feed_delete": ("AFTER DELETE ON appointments", "OLD", "booking"),
+    "availability_feed_insert": ("AFTER INSERT ON doctor_availability", "NEW", "availability"),
+    "availability_feed_update": ("AFTER UPDATE ON doctor_availability", "NEW", "availability"),
+    "availability_feed_delete": ("AFTER DELETE ON doctor_availability", "OLD", "availability"),
+}
+
+
+def init_schema(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS slot_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            doctor_id INTEGER NOT NULL,
+            date TEXT,
+            slot TEXT,
+            kind TEXT NOT NULL
+        )
+    """)
+    # Recreated every migration so trigger bodies follow the code.
+    for name, (event, ref, kind) in TRIGGERS.items():
+        conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+        conn.execute(f"""
+            CREATE TRIGGER {name} {event}
+            WHEN {ref}.doctor_id IS NOT NULL{archive.skip_archival(event)}
+            BEGIN {_log_sql(ref, kind, f"{ref}.slot")} END
+        """)
+
+
+class Subscription:
+    def __init__(self, doctor_id):
+        self.doctor_id = doctor_id
+        self.queue = queue.Queue(SUBSCRIBER_QUEUE_SIZE)
+        self.overflowed = False
+
+    def push(self, change):
+        try:
+            self.queue.put_nowait(change)
+        except queue.Full:
+            self.overflowed = True
+
+
+class ChangeBroker:
+    def __init__(self, path, poll_interval=POLL_INTERVAL):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._listeners = []
+        self.reset()
+
+    def add_listener(self, fn):
+        """Call fn(change) from the poll thread for every change, whoever subscribes."""
+        self._listeners.append(fn)
+
+    def reset(self):
+        self._pid = None
+        self._thread = None
+        self._subscribers = {}
+        self._last_id = None
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = sqlite3.connect(f"file:{quote(os.path.abspath(self.path))}?mode=ro", uri=True,
+                               timeout=10, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def start(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            # Threads do not survive fork, so each worker process starts its own.
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._subscribers = {}
+            conn = self._connect()
+            try:
+                self._last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM slot_changes").fetchone()[0]
+            finally:
+                conn.close()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._loop, name="slot-changes", daemon=True)
+            self._thread.start()
+
+    def subscribe(self, doctor_id, last_event_id=None):
+        """Returns (subscription, missed changes); missed is None when they are no longer retained."""
+        self.start()
+        sub = Subscription(doctor_id)
+        with self._lock:
+            self._subscribers.setdefault(doctor_id, set()).add(sub)
+            missed = []
+            if last_event_id is not None and last_event_id < self._last_id:
+                missed = self.since(doctor_id, last_event_id, self._last_id)
+        return sub, missed
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            subs = self._subscribers.get(sub.doctor_id)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._subscribers[sub.doctor_id]
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(s) for s in self._subscribers.values())
+
+    def since(self, doctor_id, after_id, upto_id):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        oldest = conn.execute("SELECT MIN(id) FROM slot_changes").fetchone()[0]
+        if oldest is None or oldest > after_id + 1:
+            return None
+        return [dict(r) for r in conn.execute(
+            "SELECT * FROM slot_changes WHERE id > ? AND id <= ? AND doctor_id = ? ORDER BY id",
+            (after_id, upto_id, doctor_id)
+        )]
+
+    def _loop(self):
+        conn = self._connect()
+        data_version = None
+
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                version = conn.execute("PRAGMA data_version").fetchone()[0]
+                if version == data_version:
+                    continue
+                data_version = version
+                rows = conn.execute("SELECT * FROM slot_changes WHERE id > ? ORDER BY id",
+                                    (self._last_id,)).fetchall()
+            except sqlite3.Error as e:
+                print("Slot change poll failed:", e)
+                continue
+
+            if not rows:
+                continue
+            for listener in self._listeners:
+                for row in rows:
+                    listener(dict(row))
+            with self._lock:
+                self._last_id = rows[-1]["id"]
+                for row in rows:
+                    for sub in self._subscribers.get(row["doctor_id"], ()):
+                        sub.push(dict(row))
+
+
+def format_event(change):
+    return f"id: {change['id']}\nevent: slot\ndata: {json.dumps(change)}\n\n"
+
+
+def stream(broker, sub, missed):
+    """Generator of SSE frames for one subscriber; unsubscribes when the client goes away."""
+    try:
+        yield "retry: 3000\n\n"
+        if missed is None:
+            yield "event: reset\ndata: {}\n\n"
+        else:
+            for change in missed:
+                yield format_event(change)
+
+        while True:
+            try:
+                change = sub.queue.get(timeout=HEARTBEAT_SECONDS)
+            except queue.Empty:
+                yield ": ping\n\n"
+                continue
+            if sub.overflowed:
+                yield "event: reset\ndata: {}\n\n"
+                return
+            yield format_event(change)
+    finally:
+        broker.unsubscribe(sub)
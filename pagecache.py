@@ -0,0 +1,108 @@
+"""Short-lived per-process cache of rendered doctor availability pages.
+
+Entries are keyed by (page, doctor id, first day, days shown) and hold the
+rendered body with its ETag. An entry is served until it is `ttl` seconds
+old or until its doctor is invalidated:
+
+* explicitly, by the booking and availability writes in this process, and
+* from other processes via livefeed's change log: the ChangeBroker passes
+  every slot change to `invalidate`, so a booking made in another worker
+  drops this worker's copy within one poll interval.
+
+Changes that do not go through appointments or doctor_availability
+(holidays, slot rules, doctor edits) are picked up when the TTL runs out.
+
+Only one request per key recomputes a missing or expired entry; concurrent
+requests for the same key wait for it instead of all hitting the database.
+"""
+import hashlib
+import os
+import threading
+import time
+
+
+PAGE_CACHE_TTL = float(os.getenv("PAGE_CACHE_TTL", "10"))
+PAGE_CACHE_MAX_ENTRIES = 5000
+
+
+class PageCache:
+    def __init__(self, ttl=PAGE_CACHE_TTL, max_entries=PAGE_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._entries = {}
+        self._loading = {}
+        self._generations = {}
+        self.hits = self.misses = self.invalidations = 0
+
+    def _fresh(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None or entry["expires"] <= now or entry["generation"] != self._generations.get(key[1], 0):
+            return None
+        return entry
+
+    def get(self, key, render):
+        """(body, etag) for `key`, whose second element is the doctor id.
+
+        `render()` builds the body, or returns None for a page not to cache
+        (then this returns (None, None)).
+        """
+        with self._lock:
+            entry = self._fresh(key, time.monotonic())
+            if entry is not None:
+                self.hits += 1
+                return entry["body"], entry["etag"]
+            loading = self._loading.setdefault(key, threading.Lock())
+
+        with loading:
+            with self._lock:
+                # Filled by the request we waited for.
+                entry = self._fresh(key, time.monotonic())
+                if entry is not None:
+                    self.hits += 1
+                    return entry["body"], entry["etag"]
+                self.misses += 1
+                generation = self._generations.get(key[1], 0)
+
+            body = None
+            try:
+                body = render()
+            finally:
+                if body is None:
+                    with self._lock:
+                        self._loading.pop(key, None)
+            if body is None:
+                return None, None
+            etag = hashlib.sha1(body.encode()).hexdigest()[:20]
+
+            with self._lock:
+                self._loading.pop(key, None)
+                if len(self._entries) >= self.max_entries:
+                    self._evict()
+                # An invalidation while rendering leaves this entry already stale.
+                self._entries[key] = {"body": body, "etag": etag, "generation": generation,
+                                      "expires": time.monotonic() + self.ttl}
+            return body, etag
+
+    def _evict(self):
+        now = time.monotonic()
+        for key in [k for k, e in self._entries.items() if e["expires"] <= now]:
+            del self._entries[key]
+        if len(self._entries) >= self.max_entries:
+            self._entries.clear()
+
+    def invalidate(self, doctor_id):
+        with self._lock:
+            self.invalidations += 1
+            self._generations[doctor_id] = self._generations.get(doctor_id, 0) + 1
+
+    def on_change(self, change):
+        """livefeed listener: one row of slot_changes."""
+        self.invalidate(change["doctor_id"])
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "invalidations": self.invalidations,
+                "entries": len(self._entries)}
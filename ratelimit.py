@@ -0,0 +1,117 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+RATELIMIT_DB = os.getenv("RATELIMIT_DB", "ratelimit.db")
+# Buckets idle this long are full again, so dropping them changes nothing.
+PURGE_IDLE_SECONDS = 3600
+PURGE_INTERVAL_SECONDS = 600
+# Longest client-supplied value (a username) that goes into a bucket key.
+MAX_KEY_PART = 64
+
+
+class TokenBucketLimiter:
+    """Token buckets shared by every worker process through one SQLite file.
+
+    Each rule is a (key, rate, burst) triple: the bucket refills at `rate`
+    tokens per second up to `burst`. All rules of one call are checked and
+    charged in a single IMMEDIATE transaction, so either every bucket pays
+    a token or none does.
+    """
+
+    def __init__(self, path=RATELIMIT_DB):
+        self.path = path
+        self._local = threading.local()
+        self._schema_ready = False
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # Bucket state is disposable; losing the last few refills on a crash is harmless.
+        conn.execute("PRAGMA synchronous=OFF")
+        if not self._schema_ready:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                ) WITHOUT ROWID
+            """)
+            self._schema_ready = True
+
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def reset(self):
+        # Called after fork: never share a SQLite handle with the parent.
+        self._local = threading.local()
+
+    def hit(self, rules, now=None):
+        """Charge one token from every bucket in `rules`.
+
+        Returns (allowed, retry_after_seconds). Fails open if the store is
+        unavailable, so the limiter can never lock users out by itself.
+        """
+        if not rules:
+            return True, 0.0
+
+        now = time.time() if now is None else now
+        keys = [r[0] for r in rules]
+
+        try:
+            conn = self._conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                placeholders = ",".join("?" for _ in keys)
+                state = {
+                    row[0]: (row[1], row[2])
+                    for row in conn.execute(
+                        f"SELECT key, tokens, updated_at FROM buckets WHERE key IN ({placeholders})",
+                        keys
+                    )
+                }
+
+                updates = []
+                retry_after = 0.0
+                for key, rate, burst in rules:
+                    tokens, updated_at = state.get(key, (float(burst), now))
+                    tokens = min(float(burst), tokens + max(now - updated_at, 0.0) * rate)
+                    if tokens < 1.0:
+                        retry_after = max(retry_after, (1.0 - tokens) / rate)
+                    updates.append((key, tokens - 1.0, now))
+
+                if retry_after > 0:
+                    conn.execute("ROLLBACK")
+                    return False, retry_after
+
+                conn.executemany("""
+                    INSERT INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)
+                    ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at
+                """, updates)
+                conn.execute("COMMIT")
+                return True, 0.0
+
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+        except sqlite3.Error as e:
+            print("RATE LIMITER ERROR:", repr(e))
+            return True, 0.0
+
+    def purge(self, idle_seconds=PURGE_IDLE_SECONDS, now=None):
+        """Drop idle buckets; returns how many went."""
+        now = time.time() if now is None else now
+        return self._conn().execute("DELETE FROM buckets WHERE updated_at < ?", (now - idle_seconds,)).rowcount
+
+
+def key_part(value):
+    """A client-supplied value as it goes into a bucket key: trimmed, case-folded and length-capped."""
+    return str(value).strip().casefold()[:MAX_KEY_PART]
@@ -0,0 +1,142 @@
+"""Per-process cache of reference data: departments, the doctor roster, patient names.
+
+Triggers on the tracked tables bump a counter in `table_versions` on every
+insert, update or delete, whichever worker made it. Before serving a cached
+value the cache asks whether anything changed:
+
+* SQLite: `PRAGMA data_version` on a dedicated connection. It only changes
+  when another connection commits, reads no table pages and costs a few
+  microseconds. Only when it moved is `table_versions` read, and only the
+  datasets of tables whose version changed are reloaded.
+* Postgres: there is no data_version, so `table_versions` itself is polled,
+  at most once every `check_interval` seconds.
+
+Cached values are shared between requests; callers must not mutate them.
+"""
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import quote
+
+
+TRACKED_TABLES = ("departments", "doctors", "patients")
+
+
+def init_schema(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS table_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    for table in TRACKED_TABLES:
+        conn.execute("INSERT OR IGNORE INTO table_versions (name) VALUES (?)", (table,))
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()}
+                AFTER {event} ON {table}
+                BEGIN
+                    UPDATE table_versions SET version = version + 1 WHERE name = '{table}';
+                END
+            """)
+
+
+POSTGRES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS table_versions (
+    name TEXT PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0
+);
+INSERT INTO table_versions (name) VALUES ('departments'), ('doctors'), ('patients')
+    ON CONFLICT DO NOTHING;
+CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger AS $$
+BEGIN
+    UPDATE table_versions SET version = version + 1 WHERE name = TG_TABLE_NAME;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+CREATE OR REPLACE TRIGGER departments_version AFTER INSERT OR UPDATE OR DELETE ON departments
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
+CREATE OR REPLACE TRIGGER doctors_version AFTER INSERT OR UPDATE OR DELETE ON doctors
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
+CREATE OR REPLACE TRIGGER patients_version AFTER INSERT OR UPDATE OR DELETE ON patients
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
+"""
+
+
+class ReferenceCache:
+    """`loaders` maps a dataset name to (table, fn); fn() returns the fresh value."""
+
+    def __init__(self, backend, loaders, check_interval=1.0):
+        self.backend = backend
+        self.loaders = loaders
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._pid = os.getpid()
+        self._conn = None
+        self._data_version = None
+        self._checked_at = 0
+        self._versions = {}
+        self._data = {}
+        self.hits = self.misses = self.checks = 0
+
+    def _version_conn(self):
+        if self._conn is None:
+            path = os.path.abspath(self.backend.path)
+            self._conn = sqlite3.connect(f"file:{quote(path)}?mode=ro", uri=True, check_same_thread=False)
+        return self._conn
+
+    def _table_versions(self):
+        if self.backend.name == "sqlite":
+            rows = self._version_conn().execute("SELECT name, version FROM table_versions").fetchall()
+            return dict(rows)
+        return {r["name"]: r["version"] for r in self.backend.all("SELECT name, version FROM table_versions")}
+
+    def _refresh(self):
+        if self.backend.name == "sqlite":
+            data_version = self._version_conn().execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self._data_version:
+                return
+            self._data_version = data_version
+        else:
+            now = time.monotonic()
+            if now - self._checked_at < self.check_interval:
+                return
+            self._checked_at = now
+
+        self.checks += 1
+        versions = self._table_versions()
+        changed = {t for t, v in versions.items() if self._versions.get(t) != v}
+        self._versions = versions
+        for key, (table, _) in self.loaders.items():
+            if table in changed:
+                self._data.pop(key, None)
+
+    def get(self, key):
+        with self._lock:
+            if self._pid != os.getpid():
+                self.reset()
+            try:
+                self._refresh()
+            except Exception as e:
+                # No table_versions yet (unmigrated database) or the check failed: don't trust the cache.
+                print("Reference cache check failed:", e)
+                self._data.clear()
+                self._data_version = None
+                self.misses += 1
+                return self.loaders[key][1]()
+
+            if key in self._data:
+                self.hits += 1
+                return self._data[key]
+
+            self.misses += 1
+            value = self._data[key] = self.loaders[key][1]()
+            return value
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "checks": self.checks,
+                "cached": sorted(self._data), "versions": self._versions}
@@ -0,0 +1,1206 @@
+"""Data access for the hospital app, independent of the database engine.
+
+Routes talk to `Repositories` (doctors, patients, departments, appointments,
+availability, visits, users, AI conversations, exports) and never see a
+driver. Two backends implement the same small interface:
+
+* SqliteBackend   - hospital.db; reads on per-thread mode=ro connections,
+                    writes through the process's SerializedWriter.
+* PostgresBackend - psycopg 3 with a psycopg_pool.ConnectionPool.
+
+SQL is written once with `?` placeholders; the Postgres backend rewrites
+them to `%s` (outside string literals and comments) and doubles every
+literal `%`. Rows come back as plain dicts on both. Writes are functions
+`fn(tx, ...)` passed to `Repositories.write`, which runs them in a single
+transaction; repository methods accept that `tx` to read or write inside it.
+"""
+import functools
+import json
+import os
+import re
+import sqlite3
+import threading
+from datetime import date
+from urllib.parse import quote
+
+import archive
+import clinical
+import conversations
+import doctorload
+import refcache
+import schedule
+
+
+# Rows per fetchmany() when streaming; one batch is all that is held in memory at a time.
+STREAM_BATCH = 2000
+
+
+class DatabaseError(Exception):
+    pass
+
+
+class IntegrityError(DatabaseError):
+    pass
+
+
+# ===================== BACKENDS =====================
+class SqliteTx:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, params=()):
+        return self.conn.execute(sql, params)
+
+    def executemany(self, sql, rows):
+        self.conn.executemany(sql, rows)
+
+    def all(self, sql, params=()):
+        return [dict(r) for r in self.conn.execute(sql, params)]
+
+    # fetchall() so INSERT ... RETURNING statements run to completion before the savepoint is released.
+    def one(self, sql, params=()):
+        rows = self.conn.execute(sql, params).fetchall()
+        return dict(rows[0]) if rows else None
+
+    def scalar(self, sql, params=()):
+        rows = self.conn.execute(sql, params).fetchall()
+        return rows[0][0] if rows else None
+
+
+class SqliteBackend:
+    name = "sqlite"
+    like = "LIKE"
+
+    def __init__(self, path, writer):
+        self.path = path
+        self.writer = writer
+        self.reset()
+
+    def _conn(self, history=False):
+        if self._pid != os.getpid():
+            self.reset()
+
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{quote(os.path.abspath(self.path))}?mode=ro", uri=True,
+                                   timeout=10, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+            self._local.archived = None
+
+        # The archive file may appear after this connection was opened, so keep checking until it does.
+        if history and not self._local.archived:
+            if self._local.archived is None or os.path.exists(archive.archive_file(conn)):
+                self._local.archived = archive.attach_archive(conn, readonly=True)
+        return conn
+
+    def reset(self):
+        self._pid = os.getpid()
+        self._local = threading.local()
+
+    def all(self, sql, params=(), history=False):
+        return [dict(r) for r in self._conn(history).execute(sql, params)]
+
+    def one(self, sql, params=(), history=False):
+        row = self._conn(history).execute(sql, params).fetchone()
+        return dict(row) if row else None
+
+    def scalar(self, sql, params=()):
+        row = self._conn().execute(sql, params).fetchone()
+        return row[0] if row else None
+
+    def rows(self, sql, params=()):
+        """Plain tuples, for bulk reads where building a dict per row dominates."""
+        cur = self._conn().cursor()
+        cur.row_factory = None
+        return cur.execute(sql, params).fetchall()
+
+    def stream(self, sql, params=(), history=False, batch=STREAM_BATCH):
+        """Yield lists of up to `batch` plain tuples straight from the cursor.
+
+        Runs on its own read-only connection, closed when the generator is
+        finished or closed, so a long export neither shares a cursor with
+        the thread's other reads nor outlives its client.
+        """
+        conn = sqlite3.connect(f"file:{quote(os.path.abspath(self.path))}?mode=ro", uri=True,
+                               timeout=10, check_same_thread=False)
+        try:
+            if history:
+                archive.attach_archive(conn, readonly=True)
+            cur = conn.execute(sql, params)
+            while rows := cur.fetchmany(batch):
+                yield rows
+        finally:
+            conn.close()
+
+    def write(self, fn, *args):
+        try:
+            return self.writer.run(lambda conn: fn(SqliteTx(conn), *args))
+        except sqlite3.IntegrityError as e:
+            raise IntegrityError(str(e)) from e
+        except sqlite3.Error as e:
+            raise DatabaseError(str(e)) from e
+
+
+# String literals, quoted names and comments, where a `?` is text rather than a placeholder.
+_PG_TOKENS = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*"|--[^\n]*|/\*.*?\*/)|(\?)|(%)""", re.S)
+
+
+@functools.lru_cache(maxsize=1024)
+def _pg(sql):
+    """`?` placeholders as psycopg's `%s`, leaving literals and comments alone; every `%` doubled,
+    since psycopg reads `%` as a placeholder marker anywhere in the statement."""
+    return _PG_TOKENS.sub(lambda m: m.group(1).replace("%", "%%") if m.group(1) else
+                          "%s" if m.group(2) else "%%", sql)
+
+
+class PostgresTx:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, params=()):
+        return self.conn.execute(_pg(sql), params)
+
+    def executemany(self, sql, rows):
+        with self.conn.cursor() as cur:
+            cur.executemany(_pg(sql), rows)
+
+    def all(self, sql, params=()):
+        return self.conn.execute(_pg(sql), params).fetchall()
+
+    def one(self, sql, params=()):
+        return self.conn.execute(_pg(sql), params).fetchone()
+
+    def scalar(self, sql, params=()):
+        row = self.conn.execute(_pg(sql), params).fetchone()
+        return next(iter(row.values())) if row else None
+
+
+class PostgresBackend:
+    name = "postgres"
+    like = "ILIKE"
+
+    def __init__(self, dsn, min_size=2, max_size=20):
+        # Imported lazily: SQLite deployments never need the driver installed.
+        from psycopg.rows import dict_row
+        from psycopg_pool import ConnectionPool
+
+        self.dsn = dsn
+        self._pool_args = dict(conninfo=dsn, min_size=min_size, max_size=max_size,
+                               kwargs={"row_factory": dict_row, "autocommit": True}, open=False)
+        self._pool_cls = ConnectionPool
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        if self._pool is None or self._pid != os.getpid():
+            with self._lock:
+                if self._pool is None or self._pid != os.getpid():
+                    # Sockets must not be shared across fork; each worker gets its own pool.
+                    self._pool = self._pool_cls(**self._pool_args)
+                    self._pool.open(wait=True)
+                    self._pid = os.getpid()
+        return self._pool
+
+    def reset(self):
+        self._pool = None
+
+    def all(self, sql, params=(), history=False):
+        with self.pool.connection() as conn:
+            return conn.execute(_pg(sql), params).fetchall()
+
+    def one(self, sql, params=(), history=False):
+        with self.pool.connection() as conn:
+            return conn.execute(_pg(sql), params).fetchone()
+
+    def scalar(self, sql, params=()):
+        row = self.one(sql, params)
+        return next(iter(row.values())) if row else None
+
+    def rows(self, sql, params=()):
+        from psycopg.rows import tuple_row
+
+        with self.pool.connection() as conn:
+            return conn.cursor(row_factory=tuple_row).execute(_pg(sql), params).fetchall()
+
+    def stream(self, sql, params=(), history=False, batch=STREAM_BATCH):
+        """Yield lists of up to `batch` tuples from a server-side cursor, which needs a transaction."""
+        from psycopg.rows import tuple_row
+
+        with self.pool.connection() as conn, conn.transaction():
+            with conn.cursor(name="stream", row_factory=tuple_row) as cur:
+                cur.itersize = batch
+                cur.execute(_pg(sql), params)
+                while rows := cur.fetchmany(batch):
+                    yield rows
+
+    def write(self, fn, *args):
+        import psycopg
+
+        try:
+            with self.pool.connection() as conn:
+                with conn.transaction():
+                    return fn(PostgresTx(conn), *args)
+        except psycopg.IntegrityError as e:
+            raise IntegrityError(str(e)) from e
+        except psycopg.Error as e:
+            raise DatabaseError(str(e)) from e
+
+    def init_schema(self):
+        with self.pool.connection() as conn:
+            conn.execute(POSTGRES_SCHEMA)
+            conn.execute(refcache.POSTGRES_SCHEMA)
+            conn.execute(schedule.POSTGRES_SCHEMA)
+            conn.execute(conversations.POSTGRES_SCHEMA)
+
+
+POSTGRES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id SERIAL PRIMARY KEY,
+    username TEXT UNIQUE NOT NULL,
+    password_hash TEXT NOT NULL,
+    role TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS doctors (
+    id SERIAL PRIMARY KEY,
+    username TEXT UNIQUE NOT NULL,
+    name TEXT NOT NULL,
+    user_id INTEGER UNIQUE,
+    department TEXT,
+    department_id INTEGER NOT NULL,
+    experience INTEGER,
+    blacklisted INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS patients (
+    id SERIAL PRIMARY KEY,
+    username TEXT UNIQUE NOT NULL,
+    name TEXT NOT NULL,
+    user_id INTEGER UNIQUE,
+    blacklisted INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS departments (
+    department_id SERIAL PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    description TEXT,
+    doctors_registered INTEGER DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS appointments (
+    id SERIAL PRIMARY KEY,
+    patient_name TEXT,
+    patient_id INTEGER,
+    doctor_name TEXT,
+    doctor_id INTEGER,
+    date TEXT,
+    slot TEXT,
+    status TEXT DEFAULT 'confirmed',
+    department TEXT,
+    sr_no INTEGER,
+    created_at TEXT
+);
+CREATE TABLE IF NOT EXISTS visits (
+    id SERIAL PRIMARY KEY,
+    patient_name TEXT,
+    visit_no INTEGER,
+    visit_type TEXT,
+    tests_done TEXT,
+    diagnosis TEXT,
+    prescription TEXT,
+    medicines TEXT,
+    appointment_id INTEGER,
+    doctor_id INTEGER,
+    visit_date TEXT,
+    created_at TEXT
+);
+ALTER TABLE visits ADD COLUMN IF NOT EXISTS appointment_id INTEGER;
+ALTER TABLE visits ADD COLUMN IF NOT EXISTS doctor_id INTEGER;
+ALTER TABLE visits ADD COLUMN IF NOT EXISTS visit_date TEXT;
+ALTER TABLE visits ADD COLUMN IF NOT EXISTS created_at TEXT;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_visits_appointment ON visits(appointment_id);
+CREATE TABLE IF NOT EXISTS visit_counters (
+    patient_name TEXT PRIMARY KEY,
+    last_visit_no INTEGER NOT NULL
+);
+INSERT INTO visit_counters (patient_name, last_visit_no)
+    SELECT patient_name, MAX(visit_no) FROM visits
+    WHERE patient_name IS NOT NULL AND visit_no IS NOT NULL GROUP BY patient_name
+    ON CONFLICT (patient_name) DO UPDATE
+        SET last_visit_no = GREATEST(visit_counters.last_visit_no, excluded.last_visit_no);
+CREATE TABLE IF NOT EXISTS doctor_availability (
+    id SERIAL PRIMARY KEY,
+    doctor_id INTEGER,
+    date TEXT,
+    slot TEXT,
+    status INTEGER DEFAULT 1,
+    UNIQUE(doctor_id, date, slot)
+);
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    owner TEXT NOT NULL,
+    key TEXT NOT NULL,
+    request_hash TEXT NOT NULL,
+    status_code INTEGER NOT NULL,
+    response TEXT NOT NULL,
+    created_at DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY (owner, key)
+);
+CREATE INDEX IF NOT EXISTS idx_idempotency_created ON idempotency_keys(created_at);
+CREATE INDEX IF NOT EXISTS idx_appt_doctor_date ON appointments(doctor_id, date, slot);
+CREATE INDEX IF NOT EXISTS idx_appt_patient ON appointments(patient_name);
+CREATE INDEX IF NOT EXISTS idx_visits_patient ON visits(patient_name, visit_no);
+CREATE OR REPLACE VIEW appointments_all AS SELECT * FROM appointments;
+CREATE OR REPLACE VIEW doctor_availability_all AS SELECT * FROM doctor_availability;
+"""
+
+
+def create_backend(writer=None, sqlite_path=None):
+    """Pick the backend from DB_BACKEND (sqlite, the default, or postgres)."""
+    kind = os.getenv("DB_BACKEND", "sqlite").lower()
+    if kind == "postgres":
+        return PostgresBackend(
+            os.environ["DATABASE_URL"],
+            min_size=int(os.getenv("DB_POOL_MIN", "2")),
+            max_size=int(os.getenv("DB_POOL_MAX", "20")),
+        )
+    if kind == "sqlite":
+        return SqliteBackend(sqlite_path, writer)
+    raise ValueError(f"Unknown DB_BACKEND {kind!r}")
+
+
+# ===================== REPOSITORIES =====================
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+class Repository:
+    def __init__(self, db):
+        self.db = db
+
+    def src(self, tx):
+        return tx if tx is not None else self.db
+
+    def selection(self, table, ids=None, name=None, **filters):
+        """(subquery, params) selecting the ids of `table` rows that are in `ids` (when given), have
+        `name` in their name (when given) and equal every filter. The id list is bound as one JSON
+        parameter, so its length is not limited by the driver's placeholder count."""
+        where, params = [], []
+        if ids is not None:
+            ids_sql = ("SELECT CAST(value AS INTEGER) FROM json_array_elements_text(CAST(? AS json))"
+                       if self.db.name == "postgres" else "SELECT value FROM json_each(?)")
+            where.append(f"id IN ({ids_sql})")
+            params.append(json.dumps([int(i) for i in ids]))
+        if name:
+            where.append(f"name {self.db.like} ?")
+            params.append(f"%{name}%")
+        for column, value in filters.items():
+            where.append(f"{column} = ?")
+            params.append(value)
+        if not where:
+            raise ValueError("A selection needs ids or at least one filter")
+        return f"SELECT id FROM {table} WHERE {' AND '.join(where)}", tuple(params)
+
+    def name_rows(self, table, id_column, detail, ids=None):
+        sql = f"SELECT {id_column}, name, {detail} FROM {table}"
+        if ids is None:
+            return self.db.rows(sql)
+        rows = []
+        for i in range(0, len(ids), 500):
+            chunk = tuple(ids[i:i + 500])
+            rows += self.db.rows(f"{sql} WHERE {id_column} IN ({','.join('?' for _ in chunk)})", chunk)
+        return rows
+
+
+class UserRepository(Repository):
+    def by_username(self, username):
+        return self.db.one("SELECT * FROM users WHERE username = ?", (username,))
+
+    def list_summary(self):
+        return self.db.all("SELECT id, username, role FROM users")
+
+    def count(self, tx=None):
+        return self.src(tx).scalar("SELECT COUNT(*) FROM users")
+
+    def create(self, tx, username, password_hash, role):
+        return tx.scalar(
+            "INSERT INTO users (username, password_hash, role) VALUES (?, ?, ?) RETURNING id",
+            (username, password_hash, role)
+        )
+
+    def set_username(self, tx, user_id, username):
+        tx.execute("UPDATE users SET username = ? WHERE id = ?", (username, user_id))
+
+
+class DoctorRepository(Repository):
+    def get(self, doctor_id, tx=None):
+        return self.src(tx).one("SELECT * FROM doctors WHERE id = ?", (doctor_id,))
+
+    def many(self, doctor_ids, tx=None):
+        """{id: row} for the given ids, in one query."""
+        if not doctor_ids:
+            return {}
+        placeholders = ",".join("?" for _ in doctor_ids)
+        rows = self.src(tx).all(f"SELECT * FROM doctors WHERE id IN ({placeholders})", tuple(doctor_ids))
+        return {r["id"]: r for r in rows}
+
+    def by_user_id(self, user_id):
+        return self.db.one("SELECT * FROM doctors WHERE user_id = ?", (user_id,))
+
+    def by_name(self, name):
+        return self.db.one("SELECT * FROM doctors WHERE name = ?", (name,))
+
+    def list_summary(self):
+        return self.db.all("SELECT id, name, user_id, department, experience, blacklisted FROM doctors")
+
+    def in_department(self, department_id):
+        return self.db.all(
+            "SELECT id, name, experience, blacklisted, department_id FROM doctors WHERE department_id = ?",
+            (department_id,)
+        )
+
+    def recommended(self, department_id, limit=None):
+        """Open doctors of a department best first, from the doctor_load index (doctorload.py)."""
+        return self.db.all(f"""
+            SELECT d.id, d.name, d.experience, l.as_of_day, l.next_free_day, l.booked_ahead,
+                   (l.next_free_day - l.as_of_day) * {doctorload.WAIT_WEIGHT}
+                   + l.booked_ahead * {doctorload.LOAD_WEIGHT}
+                   - MIN(COALESCE(d.experience, 0), {doctorload.EXPERIENCE_CAP}) * {doctorload.EXPERIENCE_WEIGHT}
+                   AS score
+            FROM doctor_load l
+            JOIN doctors d ON d.id = l.doctor_id
+            WHERE l.department_id = ? AND d.blacklisted != 0
+            ORDER BY l.next_free_day IS NULL, score, d.id
+            LIMIT ?
+        """, (department_id, -1 if limit is None else limit))
+
+    def load_as_of(self, department_id):
+        return self.db.scalar("SELECT MIN(as_of_day) AS day FROM doctor_load WHERE department_id = ?",
+                              (department_id,))
+
+    def in_department_named(self, department_name):
+        return self.db.all(
+            "SELECT id, name, experience, blacklisted FROM doctors WHERE department = ?",
+            (department_name,)
+        )
+
+    def search(self, q):
+        like = self.db.like
+        return self.db.all(
+            f"SELECT name, department, experience FROM doctors WHERE name {like} ? OR department {like} ?",
+            (f"%{q}%", f"%{q}%")
+        )
+
+    def names(self, ids=None):
+        """(id, name, department) tuples for the fuzzy name index, all of them or just `ids`."""
+        return self.name_rows("doctors", "id", "department", ids)
+
+    def create(self, tx, username, name, user_id, department, experience, department_id):
+        return tx.scalar("""
+            INSERT INTO doctors (username, name, user_id, department, experience, department_id)
+            VALUES (?, ?, ?, ?, ?, ?) RETURNING id
+        """, (username, name, user_id, department, experience, department_id))
+
+    def update(self, tx, doctor_id, name, department, experience):
+        tx.execute("""
+            UPDATE doctors
+            SET name = ?, department = ?, experience = ?
+            WHERE id = ?
+        """, (name, department, experience, doctor_id))
+
+    def set_blacklisted(self, tx, doctor_id, value):
+        tx.execute("UPDATE doctors SET blacklisted = ? WHERE id = ?", (value, doctor_id))
+
+    def select(self, ids=None, name=None, department_id=None, blacklisted=None):
+        filters = {k: v for k, v in (("department_id", department_id), ("blacklisted", blacklisted)) if v is not None}
+        return self.selection("doctors", ids, name, **filters)
+
+    def set_blacklisted_many(self, tx, selection, value):
+        """Set `blacklisted` on every selected doctor; returns the ids that changed."""
+        sql, params = selection
+        return [r["id"] for r in tx.execute(
+            f"UPDATE doctors SET blacklisted = ? WHERE id IN ({sql}) AND blacklisted <> ? RETURNING id",
+            (value, *params, value)).fetchall()]
+
+    def delete_many(self, tx, selection, today):
+        """Delete the selected doctors with their logins and future availability, cancel their
+        future confirmed appointments and take them off their departments' counts. One
+        statement per table; past appointments and availability stay as history.
+        Returns the deleted doctor ids and the number of rows touched per table."""
+        sql, params = selection
+        greatest = "GREATEST" if self.db.name == "postgres" else "MAX"
+        counts = {}
+        counts["appointments_cancelled"] = tx.execute(f"""
+            UPDATE appointments SET status = 'cancelled'
+            WHERE doctor_id IN ({sql}) AND date >= ? AND status = 'confirmed'
+        """, (*params, today)).rowcount
+        counts["availability"] = tx.execute(
+            f"DELETE FROM doctor_availability WHERE doctor_id IN ({sql}) AND date >= ?", (*params, today)).rowcount
+        tx.execute(f"""
+            UPDATE departments SET doctors_registered = {greatest}(0, doctors_registered - (
+                SELECT COUNT(*) FROM doctors d
+                WHERE d.department_id = departments.department_id AND d.id IN ({sql})
+            ))
+            WHERE department_id IN (SELECT department_id FROM doctors WHERE id IN ({sql}))
+        """, (*params, *params))
+        counts["users"] = tx.execute(
+            f"DELETE FROM users WHERE id IN (SELECT user_id FROM doctors WHERE id IN ({sql}))", params).rowcount
+        deleted = [r["id"] for r in tx.execute(f"DELETE FROM doctors WHERE id IN ({sql}) RETURNING id", params).fetchall()]
+        counts["doctors"] = len(deleted)
+        return deleted, counts
+
+
+class PatientRepository(Repository):
+    def get(self, patient_id, tx=None):
+        return self.src(tx).one("SELECT * FROM patients WHERE id = ?", (patient_id,))
+
+    def by_username(self, username):
+        return self.db.one("SELECT * FROM patients WHERE username = ?", (username,))
+
+    def by_usernames(self, usernames, tx=None):
+        """{username: row} for the given usernames, in one query."""
+        if not usernames:
+            return {}
+        placeholders = ",".join("?" for _ in usernames)
+        rows = self.src(tx).all(f"SELECT * FROM patients WHERE username IN ({placeholders})", tuple(usernames))
+        return {r["username"]: r for r in rows}
+
+    def summaries(self, usernames):
+        """Name, visit count and latest diagnosis of just these patients, keyed by username."""
+        if not usernames:
+            return {}
+        placeholders = ",".join("?" for _ in usernames)
+        rows = self.db.all(f"""
+            SELECT p.username, p.name, p.blacklisted,
+                   (SELECT COUNT(*) FROM visits v WHERE v.patient_name = p.username) AS visits,
+                   (SELECT diagnosis FROM visits v WHERE v.patient_name = p.username
+                    ORDER BY visit_no DESC LIMIT 1) AS last_diagnosis
+            FROM patients p
+            WHERE p.username IN ({placeholders})
+        """, tuple(usernames))
+        return {r["username"]: r for r in rows}
+
+    def list_summary(self):
+        return self.db.all("SELECT id, name, user_id, blacklisted FROM patients")
+
+    def search(self, q):
+        return self.db.all(f"SELECT name FROM patients WHERE name {self.db.like} ?", (f"%{q}%",))
+
+    def names(self, ids=None):
+        """(id, name, username) tuples for the fuzzy name index, all of them or just `ids`."""
+        return self.name_rows("patients", "id", "username", ids)
+
+    def create(self, tx, username, name, user_id):
+        return tx.scalar(
+            "INSERT INTO patients (username, name, user_id) VALUES (?, ?, ?) RETURNING id",
+            (username, name, user_id)
+        )
+
+    def update(self, tx, patient_id, name, username):
+        tx.execute("UPDATE patients SET name = ?, username = ? WHERE id = ?", (name, username, patient_id))
+
+    def set_blacklisted(self, tx, patient_id, value):
+        tx.execute("UPDATE patients SET blacklisted = ? WHERE id = ?", (value, patient_id))
+
+    def select(self, ids=None, name=None, blacklisted=None):
+        return self.selection("patients", ids, name, **({} if blacklisted is None else {"blacklisted": blacklisted}))
+
+    def set_blacklisted_many(self, tx, selection, value):
+        """Set `blacklisted` on every selected patient; returns the ids that changed."""
+        sql, params = selection
+        return [r["id"] for r in tx.execute(
+            f"UPDATE patients SET blacklisted = ? WHERE id IN ({sql}) AND blacklisted <> ? RETURNING id",
+            (value, *params, value)).fetchall()]
+
+    def delete_many(self, tx, selection, today):
+        """Delete the selected patients with their logins and cancel their future confirmed
+        appointments (booked under the patient's user id). Past appointments stay as history.
+        Returns the deleted patient ids and the number of rows touched per table."""
+        sql, params = selection
+        counts = {}
+        counts["appointments_cancelled"] = tx.execute(f"""
+            UPDATE appointments SET status = 'cancelled'
+            WHERE patient_id IN (SELECT user_id FROM patients WHERE id IN ({sql}))
+              AND date >= ? AND status = 'confirmed'
+        """, (*params, today)).rowcount
+        counts["users"] = tx.execute(
+            f"DELETE FROM users WHERE id IN (SELECT user_id FROM patients WHERE id IN ({sql}))", params).rowcount
+        deleted = [r["id"] for r in tx.execute(f"DELETE FROM patients WHERE id IN ({sql}) RETURNING id", params).fetchall()]
+        counts["patients"] = len(deleted)
+        return deleted, counts
+
+
+class DepartmentRepository(Repository):
+    def get(self, department_id):
+        return self.db.one(
+            "SELECT department_id, name, description, doctors_registered FROM departments WHERE department_id = ?",
+            (department_id,)
+        )
+
+    def id_by_name(self, name, tx=None):
+        return self.src(tx).scalar("SELECT department_id FROM departments WHERE name = ?", (name,))
+
+    def list_summary(self):
+        return self.db.all("SELECT department_id, name, doctors_registered FROM departments")
+
+    def list_names(self):
+        return self.db.all("SELECT department_id, name FROM departments")
+
+    def search(self, q):
+        return self.db.all(
+            f"SELECT name, description FROM departments WHERE name {self.db.like} ?", (f"%{q}%",)
+        )
+
+    def names(self, ids=None):
+        """(department_id, name, description) tuples for the fuzzy name index, all of them or just `ids`."""
+        return self.name_rows("departments", "department_id", "description", ids)
+
+    def create(self, tx, name, description):
+        return tx.scalar(
+            "INSERT INTO departments(name, description) VALUES (?, ?) RETURNING department_id",
+            (name, description)
+        )
+
+    def add_doctor(self, tx, department_id):
+        tx.execute(
+            "UPDATE departments SET doctors_registered = doctors_registered + 1 WHERE department_id = ?",
+            (department_id,)
+        )
+
+
+def _slot_open_sql(patient, appointment="NULL"):
+    """Conditions for doctor_slots `s` (doctor `d`) taking `patient` on the date bound
+    four times as ?: the doctor is not blocked, the slot has capacity left, the
+    patient does not already hold it, the session is open that day and it is not
+    a holiday. `appointment` is excluded from the counts (a move)."""
+    return f"""
+        d.blacklisted != 0
+        AND (SELECT COUNT(*) FROM appointments x
+             WHERE x.doctor_id = s.doctor_id AND x.date = ? AND x.slot = s.slot AND x.status = 'confirmed'
+               AND x.id IS DISTINCT FROM {appointment}) < s.capacity
+        AND NOT EXISTS (SELECT 1 FROM appointments x
+                        WHERE x.doctor_id = s.doctor_id AND x.date = ? AND x.slot = s.slot
+                          AND x.patient_id = {patient} AND x.status = 'confirmed'
+                          AND x.id IS DISTINCT FROM {appointment})
+        AND EXISTS (SELECT 1 FROM doctor_availability v
+                    WHERE v.doctor_id = s.doctor_id AND v.date = ? AND v.slot = s.session AND v.status = 1)
+        AND NOT EXISTS (SELECT 1 FROM holidays h
+                        WHERE h.date = ?
+                          AND (h.doctor_id = s.doctor_id OR h.department_id = d.department_id
+                               OR (h.doctor_id IS NULL AND h.department_id IS NULL)))
+    """
+
+
+class AppointmentRepository(Repository):
+    def list_summary(self):
+        return self.db.all("SELECT sr_no, patient_name, doctor_name, status, department FROM appointments")
+
+    def upcoming_for_doctor(self, doctor_id, start, limit, after=None):
+        """A doctor's appointments from `start` on, in (date, slot, id) order.
+
+        `after` is the (date, slot, id) key of the last row already shown;
+        the read is a range scan of idx_appt_doctor_date however long the
+        doctor's history is.
+        """
+        key = after or (start, "", 0)
+        return self.db.all("""
+            SELECT id, sr_no, patient_name, date, slot, status, department
+            FROM appointments
+            WHERE doctor_id = ? AND date >= ? AND (date, slot, id) > (?, ?, ?)
+            ORDER BY date, slot, id
+            LIMIT ?
+        """, (doctor_id, start, *key, limit))
+
+    def past_for_doctor(self, doctor_id, before, limit):
+        """Appointments strictly before the (date, slot, id) key `before`, newest first.
+        Includes rows moved to the archive."""
+        return self.db.all("""
+            SELECT id, sr_no, patient_name, date, slot, status, department
+            FROM appointments_all
+            WHERE doctor_id = ? AND (date, slot, id) < (?, ?, ?)
+            ORDER BY date DESC, slot DESC, id DESC
+            LIMIT ?
+        """, (doctor_id, *before, limit), history=True)
+
+    def count_upcoming_for_doctor(self, doctor_id, start):
+        return self.db.scalar("""
+            SELECT COUNT(*) AS total FROM appointments
+            WHERE doctor_id = ? AND date >= ? AND status = 'confirmed'
+        """, (doctor_id, start))
+
+    def history_for_patient(self, patient_name):
+        # Includes rows moved to the archive (see archive.py).
+        return self.db.all(
+            "SELECT sr_no, patient_name, doctor_name, department FROM appointments_all WHERE patient_name = ?",
+            (patient_name,), history=True
+        )
+
+    def count_for_doctor_name(self, doctor_name):
+        return self.db.scalar("SELECT COUNT(*) AS total FROM appointments WHERE doctor_name = ?", (doctor_name,))
+
+    def booked_counts(self, doctor_id, dates):
+        placeholders = ",".join("?" for _ in dates)
+        return self.db.all(f"""
+            SELECT date, slot, COUNT(*) AS cnt
+            FROM appointments
+            WHERE doctor_id = ?
+              AND date IN ({placeholders})
+              AND status = 'confirmed'
+            GROUP BY date, slot
+        """, (doctor_id, *dates))
+
+    def _lock_slot(self, tx, doctor_id, slot):
+        if self.db.name == "postgres":
+            # Serialize bookings of one slot; SQLite already has a single writer.
+            tx.execute("SELECT 1 FROM doctor_slots WHERE doctor_id = ? AND slot = ? FOR UPDATE", (doctor_id, slot))
+
+    def book(self, tx, patient_name, patient_id, doctor_name, doctor_id, slot_date, slot, department,
+             created_at):
+        """Insert a confirmed appointment only while the slot is open to the patient
+        (see _slot_open_sql). Returns the new id, or None."""
+        self._lock_slot(tx, doctor_id, slot)
+        return tx.scalar(f"""
+            INSERT INTO appointments
+                (patient_name, patient_id, doctor_name, doctor_id, date, slot, department, created_at, status)
+            SELECT ?, ?, ?, s.doctor_id, ?, s.slot, ?, ?, 'confirmed'
+            FROM doctor_slots s
+            JOIN doctors d ON d.id = s.doctor_id
+            WHERE s.doctor_id = ? AND s.slot = ?
+              AND {_slot_open_sql("?")}
+            RETURNING id
+        """, (patient_name, patient_id, doctor_name, slot_date, department, created_at,
+              doctor_id, slot, slot_date, slot_date, patient_id, slot_date, slot_date))
+
+    def move(self, tx, appointment_id, doctor_id, slot_date, slot):
+        """Move a confirmed appointment to another slot, date or doctor under the same
+        rules as booking. Returns the id, or None."""
+        self._lock_slot(tx, doctor_id, slot)
+        # SQLite's RETURNING only sees the target table, unqualified; Postgres needs the alias (doctors has an id too).
+        returning = "a.id" if self.db.name == "postgres" else "id"
+        return tx.scalar(f"""
+            UPDATE appointments AS a
+            SET doctor_id = s.doctor_id, doctor_name = d.name, department = d.department,
+                date = ?, slot = s.slot
+            FROM doctor_slots s
+            JOIN doctors d ON d.id = s.doctor_id
+            WHERE a.id = ? AND a.status = 'confirmed' AND s.doctor_id = ? AND s.slot = ?
+              AND {_slot_open_sql("a.patient_id", "a.id")}
+            RETURNING {returning}
+        """, (slot_date, appointment_id, doctor_id, slot, slot_date, slot_date, slot_date, slot_date))
+
+    def cancel(self, tx, appointment_id):
+        return tx.scalar(
+            "UPDATE appointments SET status = 'cancelled' WHERE id = ? AND status = 'confirmed' RETURNING id",
+            (appointment_id,)
+        )
+
+    def many(self, appointment_ids, tx=None):
+        """{id: row} for the given ids, in one query."""
+        if not appointment_ids:
+            return {}
+        placeholders = ",".join("?" for _ in appointment_ids)
+        rows = self.src(tx).all(f"""
+            SELECT id, patient_name, patient_id, doctor_id, date, slot, status
+            FROM appointments WHERE id IN ({placeholders})
+        """, tuple(appointment_ids))
+        return {r["id"]: r for r in rows}
+
+    def count_confirmed(self, tx, doctor_id, slot_date, slot):
+        return tx.scalar("""
+            SELECT COUNT(*) AS cnt FROM appointments
+            WHERE doctor_id = ? AND date = ? AND slot = ? AND status = 'confirmed'
+        """, (doctor_id, slot_date, slot))
+
+    def create(self, tx, patient_name, patient_id, doctor_name, doctor_id, slot_date, slot, department,
+               created_at, status='confirmed', sr_no=None):
+        return tx.scalar("""
+            INSERT INTO appointments
+                (patient_name, patient_id, doctor_name, doctor_id, date, slot, department, sr_no, created_at, status)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            RETURNING id
+        """, (patient_name, patient_id, doctor_name, doctor_id, slot_date, slot, department, sr_no,
+              created_at, status))
+
+
+class AvailabilityRepository(Repository):
+    def for_range(self, doctor_id, start, end):
+        return self.db.all(
+            "SELECT date, slot, status FROM doctor_availability WHERE doctor_id = ? AND date BETWEEN ? AND ?",
+            (doctor_id, start, end)
+        )
+
+    def day_bitmaps(self, doctor_ids, start, end):
+        """(doctor_id, day offset from start, offered mask, full mask) tuples, one per doctor-day.
+
+        Bit i of a mask is the doctor's slot with doctor_slots.bit i; full means booked to capacity.
+        """
+        placeholders = ",".join("?" for _ in doctor_ids)
+        if self.db.name == "sqlite":
+            # Maintained by triggers (slotmaps.py); day is days since 1970-01-01.
+            start_day, end_day = (date.fromisoformat(d).toordinal() - EPOCH_ORDINAL for d in (start, end))
+            return self.db.rows(f"""
+                SELECT doctor_id, day - ?, available_mask, full_mask FROM day_bitmaps
+                WHERE doctor_id IN ({placeholders}) AND day BETWEEN ? AND ?
+            """, (start_day, *doctor_ids, start_day, end_day))
+
+        return self.db.rows(f"""
+            WITH offered AS (
+                SELECT a.doctor_id, a.date, SUM(CAST(1 AS BIGINT) << s.bit) AS mask
+                FROM doctor_availability a
+                JOIN doctor_slots s ON s.doctor_id = a.doctor_id AND s.session = a.slot
+                WHERE a.doctor_id IN ({placeholders}) AND a.date BETWEEN ? AND ? AND a.status = 1
+                GROUP BY a.doctor_id, a.date
+            ),
+            full_slots AS (
+                SELECT a.doctor_id, a.date, s.bit
+                FROM appointments a
+                JOIN doctor_slots s ON s.doctor_id = a.doctor_id AND s.slot = a.slot
+                WHERE a.doctor_id IN ({placeholders}) AND a.date BETWEEN ? AND ? AND a.status = 'confirmed'
+                GROUP BY a.doctor_id, a.date, s.bit, s.capacity
+                HAVING COUNT(*) >= s.capacity
+            ),
+            booked AS (
+                SELECT doctor_id, date, SUM(CAST(1 AS BIGINT) << bit) AS mask
+                FROM full_slots GROUP BY doctor_id, date
+            )
+            SELECT COALESCE(o.doctor_id, k.doctor_id),
+                   CAST(COALESCE(o.date, k.date) AS DATE) - CAST(? AS DATE),
+                   CAST(COALESCE(o.mask, 0) AS BIGINT), CAST(COALESCE(k.mask, 0) AS BIGINT)
+            FROM offered o
+            FULL OUTER JOIN booked k ON k.doctor_id = o.doctor_id AND k.date = o.date
+        """, (*doctor_ids, start, end, *doctor_ids, start, end, start))
+
+    def status(self, doctor_id, slot_date, slot):
+        return self.db.scalar("""
+            SELECT status FROM doctor_availability
+            WHERE doctor_id = ? AND date = ? AND slot = ?
+        """, (doctor_id, slot_date, slot))
+
+    def upsert_many(self, tx, rows):
+        tx.executemany("""
+            INSERT INTO doctor_availability (doctor_id, date, slot, status)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(doctor_id, date, slot)
+            DO UPDATE SET status = excluded.status
+        """, rows)
+
+
+class ScheduleRepository(Repository):
+    def doctor_slots(self, doctor_id):
+        return self.db.all("""
+            SELECT slot, session, start_minute, end_minute, capacity FROM doctor_slots
+            WHERE doctor_id = ? ORDER BY start_minute
+        """, (doctor_id,))
+
+    def slot(self, doctor_id, slot):
+        return self.db.one("SELECT * FROM doctor_slots WHERE doctor_id = ? AND slot = ?", (doctor_id, slot))
+
+    def slot_bits_for(self, doctor_ids):
+        """(slot keys used by any of the doctors in time-of-day order, {doctor_id: {slot key: bit}})."""
+        placeholders = ",".join("?" for _ in doctor_ids)
+        rows = self.db.all(f"""
+            SELECT doctor_id, slot, bit FROM doctor_slots
+            WHERE doctor_id IN ({placeholders})
+            ORDER BY start_minute, slot
+        """, tuple(doctor_ids))
+        bits = {}
+        for r in rows:
+            bits.setdefault(r["doctor_id"], {})[r["slot"]] = r["bit"]
+        return list(dict.fromkeys(r["slot"] for r in rows)), bits
+
+    def holidays_between(self, start, end):
+        return self.db.all("""
+            SELECT id, department_id, doctor_id, date, label FROM holidays
+            WHERE date BETWEEN ? AND ? ORDER BY date
+        """, (start, end))
+
+    def is_holiday(self, doctor, slot_date):
+        return self.db.scalar("""
+            SELECT COUNT(*) FROM holidays
+            WHERE date = ? AND (doctor_id = ? OR department_id = ? OR (doctor_id IS NULL AND department_id IS NULL))
+        """, (slot_date, doctor["id"], doctor["department_id"])) > 0
+
+    def rules(self):
+        return self.db.all("SELECT * FROM slot_rules ORDER BY session, id")
+
+    def breaks(self):
+        return self.db.all("SELECT * FROM slot_breaks ORDER BY start_time, id")
+
+    def holidays(self):
+        return self.db.all("SELECT * FROM holidays ORDER BY date, id")
+
+    def save_rule(self, tx, department_id, doctor_id, session, start_time, end_time, slot_minutes, capacity):
+        """One rule per (scope, session): replaces an existing one."""
+        tx.execute("""
+            DELETE FROM slot_rules
+            WHERE session = ? AND department_id IS NOT DISTINCT FROM ? AND doctor_id IS NOT DISTINCT FROM ?
+        """, (session, department_id, doctor_id))
+        return tx.scalar("""
+            INSERT INTO slot_rules (department_id, doctor_id, session, start_time, end_time, slot_minutes, capacity)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            RETURNING id
+        """, (department_id, doctor_id, session, start_time, end_time, slot_minutes, capacity))
+
+    def add_break(self, tx, department_id, doctor_id, start_time, end_time, label):
+        return tx.scalar("""
+            INSERT INTO slot_breaks (department_id, doctor_id, start_time, end_time, label)
+            VALUES (?, ?, ?, ?, ?)
+            RETURNING id
+        """, (department_id, doctor_id, start_time, end_time, label))
+
+    def add_holiday(self, tx, department_id, doctor_id, holiday_date, label):
+        return tx.scalar("""
+            INSERT INTO holidays (department_id, doctor_id, date, label)
+            VALUES (?, ?, ?, ?)
+            RETURNING id
+        """, (department_id, doctor_id, holiday_date, label))
+
+    def delete(self, tx, kind, row_id):
+        table = {"rules": "slot_rules", "breaks": "slot_breaks", "holidays": "holidays"}[kind]
+        return tx.one(f"DELETE FROM {table} WHERE id = ? RETURNING *", (row_id,))
+
+
+class ReportRepository(Repository):
+    """Reads the utilisation rollups (rollups.py); never the appointments table."""
+
+    def department_days(self, start, end, department_id=None):
+        where, params = "", [start, end]
+        if department_id is not None:
+            where, params = " AND st.department_id = ?", params + [department_id]
+        return self.db.all(f"""
+            SELECT st.date, st.department_id, dp.name AS department, st.offered, st.booked, st.confirmed,
+                   st.cancelled, st.no_show, st.lead_days_sum, st.lead_count
+            FROM department_day_stats st
+            LEFT JOIN departments dp ON dp.department_id = st.department_id
+            WHERE st.date BETWEEN ? AND ?{where}
+            ORDER BY st.date, st.department_id
+        """, tuple(params))
+
+    def doctor_days(self, start, end, department_id=None, doctor_id=None):
+        where, params = "", [start, end]
+        if department_id is not None:
+            where, params = where + " AND st.department_id = ?", params + [department_id]
+        if doctor_id is not None:
+            where, params = where + " AND st.doctor_id = ?", params + [doctor_id]
+        return self.db.all(f"""
+            SELECT st.date, st.doctor_id, d.name AS doctor, st.department_id, st.offered, st.booked,
+                   st.confirmed, st.cancelled, st.no_show, st.lead_days_sum, st.lead_count
+            FROM doctor_day_stats st
+            LEFT JOIN doctors d ON d.id = st.doctor_id
+            WHERE st.date BETWEEN ? AND ?{where}
+            ORDER BY st.date, st.doctor_id
+        """, tuple(params))
+
+    def pending_days(self):
+        return self.db.scalar("SELECT COUNT(*) AS n FROM rollup_dirty")
+
+
+VISIT_COLUMNS = ("patient_name", "visit_no", "visit_type", "tests_done", "diagnosis", "prescription", "medicines",
+                 "appointment_id", "doctor_id", "visit_date", "created_at")
+
+
+class VisitRepository(Repository):
+    def for_patient(self, patient_name):
+        rows = self.db.all("""
+            SELECT visit_no, visit_type, tests_done, diagnosis, prescription, medicines, visit_date
+            FROM visits WHERE patient_name = ?
+            ORDER BY visit_no DESC
+        """, (patient_name,))
+        return [clinical.decode(r) for r in rows]
+
+    def last_for_patient(self, patient_name):
+        row = self.db.one("""
+            SELECT visit_type, diagnosis, prescription
+            FROM visits
+            WHERE patient_name = ?
+            ORDER BY visit_no DESC LIMIT 1
+        """, (patient_name,))
+        return clinical.decode(row) if row else None
+
+    def search(self, kind, name, start, end, prefix=False, doctor_id=None, limit=200):
+        """Visits with a medicine or test (`kind`) named `name`, case-insensitively, newest first.
+
+        A range scan of idx_visit_items_name; `prefix` matches names starting with `name`.
+        """
+        params = [kind, name]
+        match = "i.name_key = lower(trim(?))"
+        if prefix:
+            match = "i.name_key >= lower(trim(?)) AND i.name_key < lower(trim(?)) || char(1114111)"
+            params.append(name)
+        params += [start, end]
+        where = ""
+        if doctor_id is not None:
+            where = " AND i.doctor_id = ?"
+            params.append(doctor_id)
+
+        return self.db.all(f"""
+            SELECT i.visit_id, i.visit_date, i.patient_name, i.doctor_id, i.name, i.detail,
+                   v.visit_no, v.visit_type, v.diagnosis
+            FROM visit_items i
+            JOIN visits v ON v.id = i.visit_id
+            WHERE i.kind = ? AND {match} AND i.visit_date BETWEEN ? AND ?{where}
+            ORDER BY i.visit_date DESC, i.visit_id DESC
+            LIMIT ?
+        """, (*params, limit))
+
+    def allocate_numbers(self, tx, patient_name, count=1):
+        """Reserve `count` consecutive visit numbers for a patient; returns the first.
+
+        One upsert on the patient's visit_counters row, so concurrent writers
+        never hand out the same number and nothing scans visits for MAX(visit_no).
+        """
+        last = tx.scalar("""
+            INSERT INTO visit_counters (patient_name, last_visit_no) VALUES (?, ?)
+            ON CONFLICT (patient_name) DO UPDATE
+                SET last_visit_no = visit_counters.last_visit_no + excluded.last_visit_no
+            RETURNING last_visit_no
+        """, (patient_name, count))
+        return last - count + 1
+
+    def create_many(self, tx, visits):
+        """Insert visits (dicts of VISIT_COLUMNS minus visit_no), numbering each
+        patient's in list order. Returns their visit numbers."""
+        counts = {}
+        for v in visits:
+            counts[v["patient_name"]] = counts.get(v["patient_name"], 0) + 1
+        next_no = {name: self.allocate_numbers(tx, name, n) for name, n in counts.items()}
+
+        numbers, rows = [], []
+        for v in visits:
+            visit_no = next_no[v["patient_name"]]
+            next_no[v["patient_name"]] += 1
+            numbers.append(visit_no)
+            rows.append(tuple(visit_no if c == "visit_no" else v.get(c) for c in VISIT_COLUMNS))
+
+        tx.executemany(f"""
+            INSERT INTO visits ({", ".join(VISIT_COLUMNS)})
+            VALUES ({", ".join("?" for _ in VISIT_COLUMNS)})
+        """, rows)
+        return numbers
+
+
+class ConversationRepository(Repository):
+    """AI conversations and their messages (see conversations.py)."""
+
+    def get(self, conversation_id, tx=None):
+        return self.src(tx).one("SELECT * FROM ai_conversations WHERE id = ?", (conversation_id,))
+
+    def for_user(self, user_id, limit=50):
+        return self.db.all("""
+            SELECT id, title, created_at, updated_at FROM ai_conversations
+            WHERE user_id = ? ORDER BY updated_at DESC, id DESC LIMIT ?
+        """, (user_id, limit))
+
+    def recent(self, conversation_id, after, limit=conversations.WINDOW_LIMIT, tx=None):
+        """Messages newer than `after` (the summary's last message), newest first."""
+        return self.src(tx).all("""
+            SELECT id, role, content, tokens, created_at FROM ai_messages
+            WHERE conversation_id = ? AND id > ?
+            ORDER BY id DESC LIMIT ?
+        """, (conversation_id, after, limit))
+
+    def messages(self, conversation_id, before=None, limit=50):
+        return self.db.all(f"""
+            SELECT id, role, content, created_at FROM ai_messages
+            WHERE conversation_id = ?{" AND id < ?" if before else ""}
+            ORDER BY id DESC LIMIT ?
+        """, (conversation_id, *([before] if before else []), limit))
+
+    def create(self, tx, user_id, title, now):
+        return tx.scalar("""
+            INSERT INTO ai_conversations (user_id, title, created_at, updated_at) VALUES (?, ?, ?, ?)
+            RETURNING id
+        """, (user_id, title, now, now))
+
+    def between(self, conversation_id, after, before, limit=conversations.WINDOW_LIMIT):
+        """Messages with after < id < before, oldest first."""
+        return self.db.all("""
+            SELECT id, role, content, tokens FROM ai_messages
+            WHERE conversation_id = ? AND id > ? AND id < ?
+            ORDER BY id LIMIT ?
+        """, (conversation_id, after, before, limit))
+
+    def add_messages(self, tx, conversation_id, messages, now):
+        """Append (role, content) pairs."""
+        tx.executemany("""
+            INSERT INTO ai_messages (conversation_id, role, content, tokens, created_at) VALUES (?, ?, ?, ?, ?)
+        """, [(conversation_id, role, content, conversations.estimate_tokens(content), now)
+              for role, content in messages])
+        tx.execute("UPDATE ai_conversations SET updated_at = ? WHERE id = ?", (now, conversation_id))
+
+    def request_summary(self, tx, conversation_id, requested_at):
+        tx.execute("UPDATE ai_conversations SET summary_requested_at = ? WHERE id = ?",
+                   (requested_at, conversation_id))
+
+    def save_summary(self, tx, conversation_id, summary, through, expected_through, requested_at=0):
+        """Store a summary covering messages up to `through`, unless another run already moved
+        past `expected_through`. Returns whether it was stored."""
+        cur = tx.execute("""
+            UPDATE ai_conversations SET summary = ?, summarized_through = ?, summary_requested_at = ?
+            WHERE id = ? AND summarized_through = ?
+        """, (summary, through, requested_at, conversation_id, expected_through))
+        return cur.rowcount == 1
+
+
+class IdempotencyRepository(Repository):
+    """Stored responses of requests sent with an Idempotency-Key, per owner."""
+
+    def get(self, tx, owner, key):
+        return tx.one("SELECT request_hash, status_code, response FROM idempotency_keys WHERE owner = ? AND key = ?",
+                      (owner, key))
+
+    def save(self, tx, owner, key, request_hash, status_code, response, created_at):
+        tx.execute("""
+            INSERT INTO idempotency_keys (owner, key, request_hash, status_code, response, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (owner, key, request_hash, status_code, response, created_at))
+
+    def purge(self, tx, before):
+        tx.execute("DELETE FROM idempotency_keys WHERE created_at < ?", (before,))
+
+
+class ExportRepository(Repository):
+    """Whole tables for the admin exports, streamed in batches of tuples."""
+
+    # name: (table, its *_all view with archived rows or None, columns). Never users.password_hash.
+    TABLES = {
+        "users": ("users", None, ("id", "username", "role")),
+        "doctors": ("doctors", None, ("id", "username", "name", "user_id", "department", "department_id",
+                                      "experience", "blacklisted")),
+        "patients": ("patients", None, ("id", "username", "name", "user_id", "blacklisted")),
+        "appointments": ("appointments", "appointments_all", ("id", "patient_name", "patient_id", "doctor_name",
+                                                              "doctor_id", "date", "slot", "status", "department",
+                                                              "sr_no", "created_at")),
+        "availability": ("doctor_availability", "doctor_availability_all", ("id", "doctor_id", "date", "slot",
+                                                                            "status")),
+    }
+
+    def stream(self, name, history=False):
+        """(columns, generator of row batches). `history` adds archived rows, unordered."""
+        table, history_view, columns = self.TABLES[name]
+        history = history and history_view is not None
+        sql = f"SELECT {', '.join(columns)} FROM {history_view if history else table}"
+        # The hot tables come out in primary key order for free; sorting the union would delay the first row.
+        if not history:
+            sql += " ORDER BY id"
+        return columns, self.db.stream(sql, history=history)
+
+
+class Repositories:
+    def __init__(self, backend):
+        self.backend = backend
+        self.users = UserRepository(backend)
+        self.doctors = DoctorRepository(backend)
+        self.patients = PatientRepository(backend)
+        self.departments = DepartmentRepository(backend)
+        self.appointments = AppointmentRepository(backend)
+        self.availability = AvailabilityRepository(backend)
+        self.visits = VisitRepository(backend)
+        self.schedule = ScheduleRepository(backend)
+        self.reports = ReportRepository(backend)
+        self.idempotency = IdempotencyRepository(backend)
+        self.conversations = ConversationRepository(backend)
+        self.exports = ExportRepository(backend)
+
+    def write(self, fn, *args):
+        return self.backend.write(fn, *args)
+
+    def reset(self):
+        self.backend.reset()
@@ -0,0 +1,301 @@
+"""Per-doctor and per-department daily utilisation rollups for reports.
+
+Triggers on appointments and doctor_availability only record which
+(doctor, day) pairs changed, in `rollup_dirty`; that is one small insert per
+booking. A recurring background job (`refresh_rollups`) then recomputes
+just those days from the base tables, archive included, into:
+
+* doctor_day_stats     - per doctor and day: offered capacity (open sessions
+                         x slot capacity from doctor_slots), bookings by
+                         status and the summed booking lead time in days.
+                         doctor_slots only describes today's grid, so a past
+                         day keeps the offered capacity it was last rolled up
+                         with; a slot rule change never rewrites history.
+* department_day_stats - the same summed per department and day.
+
+Recomputing a day from scratch instead of adding deltas keeps the rollups
+exact under cancellations, moves and archival, and the dirty table drains
+in batches so no transaction holds the write lock for long. Reports read
+only the rollup tables (see ReportRepository), so they never scan
+appointments.
+
+    python rollups.py             # drain the dirty days now
+    python rollups.py --rebuild   # mark every known day dirty, then drain
+    python rollups.py --schedule  # enqueue the recurring job
+"""
+import argparse
+import os
+from datetime import date
+
+import archive
+
+
+ROLLUP_INTERVAL_SECONDS = int(os.getenv("ROLLUP_INTERVAL_SECONDS", "300"))
+ROLLUP_BATCH_SIZE = 500
+
+STAT_COLUMNS = ("offered", "booked", "confirmed", "cancelled", "no_show", "lead_days_sum", "lead_count")
+
+
+def _mark_sql(ref):
+    # An upsert clause, not OR IGNORE: the outer statement's conflict policy would override that.
+    return f"""
+        INSERT INTO rollup_dirty (doctor_id, date) VALUES ({ref}.doctor_id, {ref}.date)
+        ON CONFLICT DO NOTHING;
+    """
+
+
+TRIGGERS = {
+    "appointments_rollup_insert": ("AFTER INSERT ON appointments", "NEW"),
+    "appointments_rollup_update_old": ("AFTER UPDATE OF doctor_id, date, status, created_at ON appointments",
+                                       "OLD"),
+    "appointments_rollup_update_new": ("AFTER UPDATE OF doctor_id, date, status, created_at ON appointments",
+                                       "NEW"),
+    "appointments_rollup_delete": ("AFTER DELETE ON appointments", "OLD"),
+    "availability_rollup_insert": ("AFTER INSERT ON doctor_availability", "NEW"),
+    "availability_rollup_update_old": ("AFTER UPDATE ON doctor_availability", "OLD"),
+    "availability_rollup_update_new": ("AFTER UPDATE ON doctor_availability", "NEW"),
+    "availability_rollup_delete": ("AFTER DELETE ON doctor_availability", "OLD"),
+}
+
+
+def init_schema(conn):
+    created = not conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'rollup_dirty'"
+    ).fetchone()
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS rollup_dirty (
+            doctor_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            PRIMARY KEY (doctor_id, date)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS doctor_day_stats (
+            doctor_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            department_id INTEGER,
+            offered INTEGER NOT NULL DEFAULT 0,
+            booked INTEGER NOT NULL DEFAULT 0,
+            confirmed INTEGER NOT NULL DEFAULT 0,
+            cancelled INTEGER NOT NULL DEFAULT 0,
+            no_show INTEGER NOT NULL DEFAULT 0,
+            lead_days_sum REAL NOT NULL DEFAULT 0,
+            lead_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (doctor_id, date)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_doctor_day_stats_dept ON doctor_day_stats(department_id, date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_doctor_day_stats_date ON doctor_day_stats(date)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS department_day_stats (
+            department_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            offered INTEGER NOT NULL DEFAULT 0,
+            booked INTEGER NOT NULL DEFAULT 0,
+            confirmed INTEGER NOT NULL DEFAULT 0,
+            cancelled INTEGER NOT NULL DEFAULT 0,
+            no_show INTEGER NOT NULL DEFAULT 0,
+            lead_days_sum REAL NOT NULL DEFAULT 0,
+            lead_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (department_id, date)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_department_day_stats_date ON department_day_stats(date)")
+
+    # Recreated every migration so trigger bodies follow the code.
+    for name, (event, ref) in TRIGGERS.items():
+        conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+        conn.execute(f"""
+            CREATE TRIGGER {name} {event}
+            WHEN {ref}.doctor_id IS NOT NULL AND {ref}.date IS NOT NULL{archive.skip_archival(event)}
+            BEGIN {_mark_sql(ref)} END
+        """)
+
+    if created:
+        mark_all(conn, ["main.appointments", "main.doctor_availability"])
+
+
+def _sources(conn, table, attached):
+    return [f"main.{table}"] + ([f"archive.{table}"] if attached else [])
+
+
+def mark_all(conn, tables):
+    for table in tables:
+        conn.execute(f"""
+            INSERT OR IGNORE INTO rollup_dirty (doctor_id, date)
+            SELECT DISTINCT doctor_id, date FROM {table}
+            WHERE doctor_id IS NOT NULL AND date IS NOT NULL
+        """)
+
+
+def mark_offered_from(conn, since, doctor_ids=None):
+    """Mark the doctors' (all when None) open days from `since` on dirty, after their slots changed."""
+    doctor_filter = ""
+    if doctor_ids is not None:
+        doctor_filter = " AND doctor_id IN ({})".format(",".join("?" for _ in doctor_ids))
+    conn.execute(f"""
+        INSERT OR IGNORE INTO rollup_dirty (doctor_id, date)
+        SELECT DISTINCT doctor_id, date FROM doctor_availability
+        WHERE doctor_id IS NOT NULL AND date >= ?{doctor_filter}
+    """, (since, *(doctor_ids or ())))
+
+
+def _offered_sql(table):
+    return f"""
+        SELECT a.doctor_id, a.date, SUM(s.capacity) AS offered
+        FROM {table} a
+        JOIN rollup_batch k ON k.doctor_id = a.doctor_id AND k.date = a.date
+        JOIN doctor_slots s ON s.doctor_id = a.doctor_id AND s.session = a.slot
+        WHERE a.status = 1
+        GROUP BY a.doctor_id, a.date
+    """
+
+
+def _bookings_sql(table):
+    return f"""
+        SELECT a.doctor_id, a.date,
+               COUNT(*) AS booked,
+               SUM(a.status = 'confirmed') AS confirmed,
+               SUM(a.status = 'cancelled') AS cancelled,
+               SUM(a.status = 'no_show') AS no_show,
+               SUM(julianday(a.date) - julianday(a.created_at)) AS lead_days_sum,
+               COUNT(julianday(a.created_at)) AS lead_count
+        FROM {table} a
+        JOIN rollup_batch k ON k.doctor_id = a.doctor_id AND k.date = a.date
+        GROUP BY a.doctor_id, a.date
+    """
+
+
+def refresh_batch(conn, attached, batch_size=ROLLUP_BATCH_SIZE, today=None):
+    """Recompute up to `batch_size` dirty days in one transaction; returns how many.
+
+    Days before `today` that were rolled up before keep their offered capacity.
+    """
+    today = today or date.today().isoformat()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM rollup_batch")
+        n = conn.execute("""
+            INSERT INTO rollup_batch (doctor_id, date, offered)
+            SELECT r.doctor_id, r.date, CASE WHEN r.date < ? THEN st.offered END
+            FROM (SELECT doctor_id, date FROM rollup_dirty LIMIT ?) r
+            LEFT JOIN doctor_day_stats st ON st.doctor_id = r.doctor_id AND st.date = r.date
+        """, (today, batch_size)).rowcount
+        if n == 0:
+            conn.execute("COMMIT")
+            return 0
+
+        # Department days to re-sum: where the doctor's days were counted before and where they count now.
+        touched = """
+            INSERT OR IGNORE INTO rollup_departments (department_id, date)
+            SELECT st.department_id, st.date FROM doctor_day_stats st
+            JOIN rollup_batch k ON k.doctor_id = st.doctor_id AND k.date = st.date
+            WHERE st.department_id IS NOT NULL
+        """
+        conn.execute("DELETE FROM rollup_departments")
+        conn.execute(touched)
+
+        offered = " UNION ALL ".join(_offered_sql(t) for t in _sources(conn, "doctor_availability", attached))
+        bookings = " UNION ALL ".join(_bookings_sql(t) for t in _sources(conn, "appointments", attached))
+        conn.execute("""
+            DELETE FROM doctor_day_stats
+            WHERE (doctor_id, date) IN (SELECT doctor_id, date FROM rollup_batch)
+        """)
+        conn.execute(f"""
+            INSERT INTO doctor_day_stats
+                (doctor_id, date, department_id, offered, booked, confirmed, cancelled, no_show,
+                 lead_days_sum, lead_count)
+            SELECT k.doctor_id, k.date, d.department_id,
+                   COALESCE(k.offered, o.offered, 0), COALESCE(b.booked, 0), COALESCE(b.confirmed, 0),
+                   COALESCE(b.cancelled, 0), COALESCE(b.no_show, 0),
+                   COALESCE(b.lead_days_sum, 0), COALESCE(b.lead_count, 0)
+            FROM rollup_batch k
+            LEFT JOIN doctors d ON d.id = k.doctor_id
+            LEFT JOIN (
+                SELECT doctor_id, date, SUM(offered) AS offered FROM ({offered}) GROUP BY doctor_id, date
+            ) o ON o.doctor_id = k.doctor_id AND o.date = k.date
+            LEFT JOIN (
+                SELECT doctor_id, date, SUM(booked) AS booked, SUM(confirmed) AS confirmed,
+                       SUM(cancelled) AS cancelled, SUM(no_show) AS no_show,
+                       SUM(lead_days_sum) AS lead_days_sum, SUM(lead_count) AS lead_count
+                FROM ({bookings}) GROUP BY doctor_id, date
+            ) b ON b.doctor_id = k.doctor_id AND b.date = k.date
+            WHERE k.offered IS NOT NULL OR o.offered IS NOT NULL OR b.booked IS NOT NULL
+        """)
+        conn.execute(touched)
+
+        sums = ", ".join(f"SUM({c})" for c in STAT_COLUMNS)
+        conn.execute("""
+            DELETE FROM department_day_stats
+            WHERE (department_id, date) IN (SELECT department_id, date FROM rollup_departments)
+        """)
+        conn.execute(f"""
+            INSERT INTO department_day_stats (department_id, date, {", ".join(STAT_COLUMNS)})
+            SELECT st.department_id, st.date, {sums}
+            FROM doctor_day_stats st
+            JOIN rollup_departments t ON t.department_id = st.department_id AND t.date = st.date
+            GROUP BY st.department_id, st.date
+        """)
+
+        conn.execute("""
+            DELETE FROM rollup_dirty
+            WHERE (doctor_id, date) IN (SELECT doctor_id, date FROM rollup_batch)
+        """)
+        conn.execute("COMMIT")
+        return n
+
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def refresh(conn, batch_size=ROLLUP_BATCH_SIZE, rebuild=False):
+    """Drain rollup_dirty. `conn` must be in autocommit mode (isolation_level=None)."""
+    attached = archive.attach_archive(conn)
+    conn.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS rollup_batch
+            (doctor_id INTEGER, date TEXT, offered INTEGER, PRIMARY KEY (doctor_id, date))
+    """)
+    conn.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS rollup_departments
+            (department_id INTEGER, date TEXT, PRIMARY KEY (department_id, date))
+    """)
+
+    if rebuild:
+        conn.execute("BEGIN IMMEDIATE")
+        mark_all(conn, _sources(conn, "appointments", attached) + _sources(conn, "doctor_availability", attached))
+        conn.execute("COMMIT")
+
+    days = 0
+    while True:
+        n = refresh_batch(conn, attached, batch_size)
+        days += n
+        if n < batch_size:
+            return {"days": days}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Refresh the utilisation rollups")
+    parser.add_argument("--batch-size", type=int, default=ROLLUP_BATCH_SIZE)
+    parser.add_argument("--rebuild", action="store_true", help="recompute every day, archive included")
+    parser.add_argument("--schedule", action="store_true", help="enqueue the recurring rollup job and exit")
+    args = parser.parse_args()
+
+    import app
+
+    app.create_app()
+    if args.schedule:
+        print("Scheduled rollup job:", app.schedule_rollups(delay=0))
+        return
+
+    conn = app.get_db_connection()
+    conn.isolation_level = None
+    try:
+        print(refresh(conn, args.batch_size, rebuild=args.rebuild))
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
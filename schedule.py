@@ -0,0 +1,312 @@
+"""Slot definitions: sessions, slot length, per-slot capacity, breaks and holidays.
+
+Doctors mark availability per session (morning, afternoon, ...) in
+doctor_availability, as before. These tables decide how each session is cut
+into bookable slots:
+
+* slot_rules  - a session's start/end time, slot length and capacity. A rule
+                for a doctor beats one for their department, which beats the
+                hospital-wide default (department_id and doctor_id both NULL).
+                Capacity 0 switches the session off.
+* slot_breaks - daily intervals (lunch, rounds) that no slot may overlap.
+* holidays    - whole days off: hospital-wide, per department or per doctor.
+
+compile_slots() resolves rules and breaks into doctor_slots, one row per
+bookable slot of a doctor's day, whenever a rule, break or doctor changes.
+A change that would drop the slot of an upcoming confirmed appointment is
+refused, so bookings never point at a slot that no longer exists.
+Booking, the day grid and the packed bitmaps (slotmaps.py) read that table,
+so nothing is resolved per request. A session that is a single slot keeps
+the session key as its slot key ("morning"), so existing appointments stay
+valid; finer slots are keyed by their start time ("09:15").
+"""
+import slotmaps
+
+
+DEFAULT_SESSIONS = [("morning", "08:00", "12:00"), ("afternoon", "12:00", "16:00")]
+
+
+def to_minutes(hhmm):
+    hours, minutes = hhmm.split(":")
+    value = int(hours) * 60 + int(minutes)
+    if not 0 <= value <= 24 * 60:
+        raise ValueError(f"Invalid time {hhmm!r}")
+    return value
+
+
+def to_hhmm(minutes):
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def init_schema(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS slot_rules (
+            id INTEGER PRIMARY KEY,
+            department_id INTEGER,
+            doctor_id INTEGER,
+            session TEXT NOT NULL,
+            start_time TEXT NOT NULL,
+            end_time TEXT NOT NULL,
+            slot_minutes INTEGER NOT NULL,
+            capacity INTEGER NOT NULL DEFAULT 1
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS slot_breaks (
+            id INTEGER PRIMARY KEY,
+            department_id INTEGER,
+            doctor_id INTEGER,
+            start_time TEXT NOT NULL,
+            end_time TEXT NOT NULL,
+            label TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS holidays (
+            id INTEGER PRIMARY KEY,
+            department_id INTEGER,
+            doctor_id INTEGER,
+            date TEXT NOT NULL,
+            label TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_holidays_date ON holidays(date)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS doctor_slots (
+            doctor_id INTEGER NOT NULL,
+            slot TEXT NOT NULL,
+            session TEXT NOT NULL,
+            start_minute INTEGER NOT NULL,
+            end_minute INTEGER NOT NULL,
+            capacity INTEGER NOT NULL,
+            bit INTEGER NOT NULL DEFAULT 0,  -- this slot's bit in the doctor's day bitmaps (slotmaps.py)
+            PRIMARY KEY (doctor_id, slot)
+        ) WITHOUT ROWID
+    """)
+    if "bit" not in {r[1] for r in conn.execute("PRAGMA table_info(doctor_slots)")}:
+        conn.execute("ALTER TABLE doctor_slots ADD COLUMN bit INTEGER NOT NULL DEFAULT 0")
+    seed_defaults(conn)
+
+
+def seed_defaults(conn):
+    if conn.execute("SELECT COUNT(*) AS n FROM slot_rules").fetchone()["n"]:
+        return
+    # One slot per session, capacity one: exactly the behaviour before slot rules existed.
+    conn.executemany("""
+        INSERT INTO slot_rules (session, start_time, end_time, slot_minutes, capacity)
+        VALUES (?, ?, ?, ?, 1)
+    """, [(key, start, end, to_minutes(end) - to_minutes(start)) for key, start, end in DEFAULT_SESSIONS])
+
+
+POSTGRES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS slot_rules (
+    id SERIAL PRIMARY KEY,
+    department_id INTEGER,
+    doctor_id INTEGER,
+    session TEXT NOT NULL,
+    start_time TEXT NOT NULL,
+    end_time TEXT NOT NULL,
+    slot_minutes INTEGER NOT NULL,
+    capacity INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS slot_breaks (
+    id SERIAL PRIMARY KEY,
+    department_id INTEGER,
+    doctor_id INTEGER,
+    start_time TEXT NOT NULL,
+    end_time TEXT NOT NULL,
+    label TEXT
+);
+CREATE TABLE IF NOT EXISTS holidays (
+    id SERIAL PRIMARY KEY,
+    department_id INTEGER,
+    doctor_id INTEGER,
+    date TEXT NOT NULL,
+    label TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_holidays_date ON holidays(date);
+CREATE TABLE IF NOT EXISTS doctor_slots (
+    doctor_id INTEGER NOT NULL,
+    slot TEXT NOT NULL,
+    session TEXT NOT NULL,
+    start_minute INTEGER NOT NULL,
+    end_minute INTEGER NOT NULL,
+    capacity INTEGER NOT NULL,
+    bit INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (doctor_id, slot)
+);
+ALTER TABLE doctor_slots ADD COLUMN IF NOT EXISTS bit INTEGER NOT NULL DEFAULT 0;
+"""
+
+
+def applies_to(row, doctor):
+    """0 for a hospital-wide row, 1 for the doctor's department, 2 for the doctor, None otherwise."""
+    # Older databases hold doctors.department_id as TEXT, so compare as strings.
+    if row["doctor_id"] is not None:
+        return 2 if str(row["doctor_id"]) == str(doctor["id"]) else None
+    if row["department_id"] is not None:
+        return 1 if str(row["department_id"]) == str(doctor["department_id"]) else None
+    return 0
+
+
+def cut_session(session, start_time, end_time, slot_minutes, capacity, breaks):
+    """Bookable slots of one session, skipping any that overlap a break."""
+    start, end = to_minutes(start_time), to_minutes(end_time)
+    if capacity <= 0 or slot_minutes <= 0 or end <= start:
+        return []
+    if slot_minutes >= end - start:
+        return [{"slot": session, "session": session, "start_minute": start, "end_minute": end,
+                 "capacity": capacity}]
+
+    spans = [(to_minutes(b["start_time"]), to_minutes(b["end_time"])) for b in breaks]
+    slots = []
+    for slot_start in range(start, end - slot_minutes + 1, slot_minutes):
+        slot_end = slot_start + slot_minutes
+        if any(b_start < slot_end and slot_start < b_end for b_start, b_end in spans):
+            continue
+        slots.append({"slot": to_hhmm(slot_start), "session": session, "start_minute": slot_start,
+                      "end_minute": slot_end, "capacity": capacity})
+    return slots
+
+
+def doctor_day(doctor, rules, breaks):
+    """Resolve the rules and breaks that apply to one doctor into their slots."""
+    chosen = {}
+    for rule in rules:
+        level = applies_to(rule, doctor)
+        if level is not None and level >= chosen.get(rule["session"], (-1, None))[0]:
+            chosen[rule["session"]] = (level, rule)
+
+    own_breaks = [b for b in breaks if applies_to(b, doctor) is not None]
+    slots = []
+    for _, rule in chosen.values():
+        slots += cut_session(rule["session"], rule["start_time"], rule["end_time"],
+                             rule["slot_minutes"], rule["capacity"], own_breaks)
+
+    if len({s["slot"] for s in slots}) != len(slots):
+        raise ValueError(f"Overlapping sessions for doctor {doctor['id']}")
+    return sorted(slots, key=lambda s: s["start_minute"])
+
+
+def compile_slots(tx, doctor_ids=None, bitmaps=True, since=None):
+    """Rebuild doctor_slots for the given doctors (all when None).
+
+    `tx` is a write transaction (repositories' SqliteTx/PostgresTx or the
+    init_db connection). `bitmaps` refreshes SQLite's day_bitmaps for days
+    from `since` on (all days when None). With `since`, a change that would
+    drop the slot of a confirmed appointment on or after that day raises
+    ValueError instead, leaving the transaction to roll back. So does a
+    doctor's day with more slots than fit a day bitmap.
+    """
+    rules = tx.execute("SELECT * FROM slot_rules ORDER BY id").fetchall()
+    breaks = tx.execute("SELECT * FROM slot_breaks").fetchall()
+
+    if doctor_ids is None:
+        doctors = tx.execute("SELECT id, department_id FROM doctors").fetchall()
+        of_doctors, params = "", ()
+    else:
+        placeholders = ",".join("?" for _ in doctor_ids)
+        doctors = tx.execute(f"SELECT id, department_id FROM doctors WHERE id IN ({placeholders})",
+                             tuple(doctor_ids)).fetchall()
+        of_doctors, params = f" WHERE doctor_id IN ({placeholders})", tuple(doctor_ids)
+
+    previous = {}
+    for r in tx.execute(f"SELECT doctor_id, slot, bit FROM doctor_slots{of_doctors}", params).fetchall():
+        previous.setdefault(r["doctor_id"], {})[r["slot"]] = r["bit"]
+
+    rows, changed = [], {}
+    for doctor in doctors:
+        day = doctor_day(doctor, rules, breaks)
+        bits, changed[doctor["id"]] = slotmaps.assign_bits(doctor["id"], previous.get(doctor["id"], {}),
+                                                           [s["slot"] for s in day])
+        for s in day:
+            rows.append((doctor["id"], s["slot"], s["session"], s["start_minute"], s["end_minute"], s["capacity"],
+                         bits[s["slot"]]))
+
+    if since is not None:
+        check_bookings_kept(tx, [d["id"] for d in doctors], {(r[0], r[1]) for r in rows}, since)
+
+    tx.execute(f"DELETE FROM doctor_slots{of_doctors}", params)
+
+    if rows:
+        tx.executemany("""
+            INSERT INTO doctor_slots (doctor_id, slot, session, start_minute, end_minute, capacity, bit)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+
+    if bitmaps:
+        if since is not None:
+            slotmaps.clear_bits(tx, changed, since)
+        slotmaps.refresh(tx, None if doctor_ids is None else [d["id"] for d in doctors], since)
+    return len(rows)
+
+
+def check_bookings_kept(tx, doctor_ids, new_slots, since):
+    """Raise ValueError if confirmed appointments from `since` on hold a current slot
+    of these doctors that is not in `new_slots` ((doctor_id, slot) pairs).
+
+    Appointments whose slot was already gone before this change are left alone.
+    """
+    if not doctor_ids:
+        return
+    placeholders = ",".join("?" for _ in doctor_ids)
+    rows = tx.execute(f"""
+        SELECT a.doctor_id, a.slot, MIN(a.date) AS first_date, COUNT(*) AS n
+        FROM appointments a
+        JOIN doctor_slots s ON s.doctor_id = a.doctor_id AND s.slot = a.slot
+        WHERE a.doctor_id IN ({placeholders}) AND a.date >= ? AND a.status = 'confirmed'
+        GROUP BY a.doctor_id, a.slot
+    """, (*doctor_ids, since)).fetchall()
+    lost = [r for r in rows if (r["doctor_id"], r["slot"]) not in new_slots]
+    if lost:
+        total = sum(r["n"] for r in lost)
+        sample = ", ".join(f"doctor {r['doctor_id']} slot {r['slot']} from {r['first_date']}" for r in lost[:5])
+        raise ValueError(f"This change removes slots that {total} confirmed appointment(s) are booked in "
+                         f"({sample}); move or cancel them first")
+
+
+def sessions(slots):
+    """[(session, "HH:MM - HH:MM")] in day order, for the per-session availability forms."""
+    spans = {}
+    for s in slots:
+        start, end = spans.get(s["session"], (s["start_minute"], s["end_minute"]))
+        spans[s["session"]] = (min(start, s["start_minute"]), max(end, s["end_minute"]))
+    return [(key, f"{to_hhmm(start)} - {to_hhmm(end)}")
+            for key, (start, end) in sorted(spans.items(), key=lambda item: item[1])]
+
+
+def day_grid(slots, session_status, booked, holiday=False):
+    """Every slot of one day with its remaining capacity.
+
+    `session_status` maps session -> 1/0 from doctor_availability and
+    `booked` maps slot -> confirmed appointments.
+    """
+    grid = []
+    for s in slots:
+        taken = booked.get(s["slot"], 0)
+        open_ = not holiday and int(session_status.get(s["session"], 0) or 0) == 1
+        grid.append({
+            "key": s["slot"],
+            "session": s["session"],
+            "label": f"{to_hhmm(s['start_minute'])} - {to_hhmm(s['end_minute'])}",
+            "start_minute": s["start_minute"],
+            "end_minute": s["end_minute"],
+            "capacity": s["capacity"],
+            "booked": taken >= s["capacity"],
+            "remaining": max(s["capacity"] - taken, 0) if open_ else 0,
+            "status": 1 if open_ else 0,
+        })
+    return grid
+
+
+def free_intervals(grid):
+    """Merge back-to-back slots that still have room into [start, end) intervals."""
+    intervals = []
+    for s in grid:
+        if s["remaining"] <= 0:
+            continue
+        if intervals and intervals[-1][1] == s["start_minute"]:
+            intervals[-1][1] = s["end_minute"]
+        else:
+            intervals.append([s["start_minute"], s["end_minute"]])
+    return [{"start": to_hhmm(start), "end": to_hhmm(end)} for start, end in intervals]
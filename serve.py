@@ -0,0 +1,111 @@
+"""Production entry point: gunicorn with one of the presets in gunicorn.conf.py.
+
+    python serve.py [--preset sync|gthread|async] [--workers N] [--threads N]
+                    [--bind 0.0.0.0:8000] [--no-preload] [--pidfile gunicorn.pid]
+    python serve.py --print-config          # the settings a preset resolves to
+    python serve.py --reload                # HUP: replace workers gracefully
+    python serve.py --upgrade               # USR2 + TERM: switch to new code
+
+`app.run(debug=True)` in app.py stays the development server.
+
+--reload lets in-flight requests finish (up to graceful_timeout) while new
+workers take over; with preload_app those workers fork from the master and
+run the code it already imported, so use it for config changes. --upgrade
+starts a new master on the new code next to the old one, waits until it is
+serving, then stops the old master gracefully; no request is refused.
+"""
+import argparse
+import os
+import runpy
+import signal
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+CONFIG = os.path.join(ROOT, "gunicorn.conf.py")
+
+
+def read_pid(pidfile):
+    try:
+        with open(pidfile) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def reload_workers(pidfile):
+    pid = read_pid(pidfile)
+    if pid is None:
+        sys.exit(f"No running server found in {pidfile}")
+    os.kill(pid, signal.SIGHUP)
+    print(f"Sent HUP to {pid}; workers are being replaced")
+
+
+def upgrade(pidfile, timeout=60):
+    old_pid = read_pid(pidfile)
+    if old_pid is None:
+        sys.exit(f"No running server found in {pidfile}")
+    os.kill(old_pid, signal.SIGUSR2)
+
+    # gunicorn renames the old master's pidfile to <pidfile>.oldbin and the new master writes <pidfile>.
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        new_pid = read_pid(pidfile)
+        if new_pid and new_pid != old_pid:
+            break
+        time.sleep(0.2)
+    else:
+        sys.exit(f"New master did not start within {timeout}s; {old_pid} keeps serving")
+
+    time.sleep(2)  # let the new master fork its workers before the old one stops accepting
+    os.kill(old_pid, signal.SIGTERM)
+    print(f"New master {new_pid} serving; old master {old_pid} is shutting down gracefully")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--preset", choices=("sync", "gthread", "async"),
+                        default=os.getenv("GUNICORN_PRESET", "gthread"))
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--threads", type=int)
+    parser.add_argument("--bind")
+    parser.add_argument("--no-preload", action="store_true")
+    parser.add_argument("--pidfile", default=os.getenv("GUNICORN_PIDFILE", os.path.join(ROOT, "gunicorn.pid")))
+    parser.add_argument("--print-config", action="store_true")
+    parser.add_argument("--reload", action="store_true")
+    parser.add_argument("--upgrade", action="store_true")
+    args = parser.parse_args()
+
+    if args.reload:
+        return reload_workers(args.pidfile)
+    if args.upgrade:
+        return upgrade(args.pidfile)
+
+    os.environ["GUNICORN_PRESET"] = args.preset
+    os.environ["GUNICORN_PIDFILE"] = args.pidfile
+    if args.workers:
+        os.environ["WEB_CONCURRENCY"] = str(args.workers)
+    if args.threads:
+        os.environ["GUNICORN_THREADS"] = str(args.threads)
+    if args.bind:
+        os.environ["BIND"] = args.bind
+    if args.no_preload:
+        os.environ["GUNICORN_PRELOAD"] = "0"
+
+    if args.print_config:
+        # Under the async preset this monkey-patches this process, which only prints and exits.
+        try:
+            settings = runpy.run_path(CONFIG)
+        except ImportError as e:
+            sys.exit(f"preset {args.preset}: {e}")
+        for name in ("bind", "worker_class", "workers", "threads", "worker_connections", "timeout",
+                     "graceful_timeout", "preload_app", "pidfile"):
+            print(f"{name:<20} {settings[name]}")
+        return
+
+    os.chdir(ROOT)
+    os.execv(sys.executable, [sys.executable, "-m", "gunicorn", "-c", CONFIG, "wsgi:app"])
+
+
+if __name__ == "__main__":
+    main()
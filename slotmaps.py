@@ -0,0 +1,287 @@
+"""Packed per-doctor, per-day slot bitmaps for date-range availability queries.
+
+A day is one 64-bit mask: bit i stands for the doctor's slot whose
+`doctor_slots.bit` is i. Bits belong to one doctor's day, so departments
+with different slot lengths do not share 63 bits between them. A slot keeps
+its bit for as long as it stays in the doctor's day, so past days' rows keep
+their meaning after slot rules change; a bit given to a new slot is first
+cleared from the doctor's past rows. On SQLite, triggers on
+doctor_availability and appointments keep one `day_bitmaps` row per
+(doctor, day) with the offered slots and the slots booked to capacity
+(capacity from schedule.py's doctor_slots), so a range read is one
+primary-key range scan instead of aggregating every slot and booking row.
+A department's quarter becomes two (doctors x days) uint64 arrays and every
+free/booked computation is one vectorised operation over all of them.
+
+On the wire the masks are first compacted to the slot keys the requested
+doctors actually use, then each doctor's range is a hex string with
+`hex_width(n_slots)` digits per day, so two coarse sessions cost one
+character per day. numpy is imported inside the functions that use it, so
+init_db (init_schema) and app import do not load it.
+"""
+from datetime import date
+
+import archive
+
+
+MAX_SLOTS = 63  # per doctor and day; SQLite integers are signed 64-bit
+
+
+def _offered_sql(ref):
+    return f"""
+        INSERT INTO day_bitmaps (doctor_id, day, available_mask, full_mask)
+        VALUES ({ref}.doctor_id, unixepoch({ref}.date) / 86400, (
+            SELECT COALESCE(SUM(1 << s.bit), 0)
+            FROM doctor_availability a
+            JOIN doctor_slots s ON s.doctor_id = a.doctor_id AND s.session = a.slot
+            WHERE a.doctor_id = {ref}.doctor_id AND a.date = {ref}.date AND a.status = 1
+        ), 0)
+        ON CONFLICT(doctor_id, day) DO UPDATE SET available_mask = excluded.available_mask;
+    """
+
+
+def _full_sql(ref):
+    return f"""
+        INSERT INTO day_bitmaps (doctor_id, day, available_mask, full_mask)
+        VALUES ({ref}.doctor_id, unixepoch({ref}.date) / 86400, 0, (
+            SELECT COALESCE(SUM(1 << bit), 0) FROM (
+                SELECT s.bit
+                FROM appointments a
+                JOIN doctor_slots s ON s.doctor_id = a.doctor_id AND s.slot = a.slot
+                WHERE a.doctor_id = {ref}.doctor_id AND a.date = {ref}.date AND a.status = 'confirmed'
+                GROUP BY s.bit, s.capacity
+                HAVING COUNT(*) >= s.capacity
+            )
+        ))
+        ON CONFLICT(doctor_id, day) DO UPDATE SET full_mask = excluded.full_mask;
+    """
+
+
+TRIGGERS = {
+    "availability_bitmap_insert": ("AFTER INSERT ON doctor_availability", "NEW", _offered_sql),
+    "availability_bitmap_update_old": ("AFTER UPDATE ON doctor_availability", "OLD", _offered_sql),
+    "availability_bitmap_update_new": ("AFTER UPDATE ON doctor_availability", "NEW", _offered_sql),
+    "availability_bitmap_delete": ("AFTER DELETE ON doctor_availability", "OLD", _offered_sql),
+    "appointments_bitmap_insert": ("AFTER INSERT ON appointments", "NEW", _full_sql),
+    "appointments_bitmap_update_old": ("AFTER UPDATE OF doctor_id, date, slot, status ON appointments",
+                                       "OLD", _full_sql),
+    "appointments_bitmap_update_new": ("AFTER UPDATE OF doctor_id, date, slot, status ON appointments",
+                                       "NEW", _full_sql),
+    "appointments_bitmap_delete": ("AFTER DELETE ON appointments", "OLD", _full_sql),
+}
+
+
+def init_schema(conn):
+    """day_bitmaps and the triggers that keep it current.
+
+    Needs schedule's doctor_slots; schedule.compile_slots() assigns the bits
+    and fills the bitmaps.
+    """
+    # Bits were global per slot key before they moved to doctor_slots.
+    conn.execute("DROP TABLE IF EXISTS slot_bits")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS day_bitmaps (
+            doctor_id INTEGER NOT NULL,
+            day INTEGER NOT NULL,  -- days since 1970-01-01
+            available_mask INTEGER NOT NULL DEFAULT 0,
+            full_mask INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (doctor_id, day)
+        ) WITHOUT ROWID
+    """)
+
+    # Recreated every migration so trigger bodies follow the code.
+    for name, (event, ref, body) in TRIGGERS.items():
+        conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+        conn.execute(f"""
+            CREATE TRIGGER {name} {event}
+            WHEN {ref}.doctor_id IS NOT NULL AND unixepoch({ref}.date) IS NOT NULL{archive.skip_archival(event)}
+            BEGIN {body(ref)} END
+        """)
+
+
+def assign_bits(doctor_id, previous, slots):
+    """Bits for one doctor's `slots` (keys in day order): ({key: bit}, mask of bits that change meaning).
+
+    `previous` maps the doctor's current keys to their bits. A key that
+    stays keeps its bit; new keys take the lowest bits no staying key holds.
+    """
+    if len(slots) > MAX_SLOTS:
+        raise ValueError(f"Doctor {doctor_id} would have {len(slots)} slots a day; at most {MAX_SLOTS} fit "
+                         f"a day bitmap, so use longer slots or a shorter session")
+    bits = {}
+    for key in slots:
+        if key in previous and previous[key] not in bits.values():
+            bits[key] = previous[key]
+    free = iter(sorted(set(range(MAX_SLOTS)) - set(bits.values())))
+    for key in slots:
+        if key not in bits:
+            bits[key] = next(free)
+    changed = sum(1 << bit for key, bit in bits.items() if previous.get(key) != bit)
+    return bits, changed
+
+
+def clear_bits(tx, changed, before):
+    """Clear bits that now stand for another slot ({doctor_id: mask}) from days before `before`.
+
+    Days from `before` on are rebuilt by refresh().
+    """
+    tx.executemany("""
+        UPDATE day_bitmaps SET available_mask = available_mask & ~?, full_mask = full_mask & ~?
+        WHERE doctor_id = ? AND day < unixepoch(?) / 86400 AND (available_mask | full_mask) & ? != 0
+    """, [(mask, mask, doctor_id, before, mask) for doctor_id, mask in changed.items() if mask])
+
+
+def refresh(tx, doctor_ids=None, since=None):
+    """Recompute day_bitmaps for the doctors (all when None) from `since` (all days when None)."""
+    if doctor_ids is not None and not doctor_ids:
+        return
+
+    doctor_filter, doctor_params = "", []
+    if doctor_ids is not None:
+        doctor_filter = " AND doctor_id IN ({})".format(",".join("?" for _ in doctor_ids))
+        doctor_params = list(doctor_ids)
+    since_filter, since_params = "", []
+    if since is not None:
+        since_filter, since_params = " AND date >= ?", [since]
+    params = doctor_params + since_params
+
+    tx.execute(f"""
+        DELETE FROM day_bitmaps WHERE day >= COALESCE(unixepoch(?) / 86400, 0) {doctor_filter}
+    """, (since, *doctor_params))
+    tx.execute(f"""
+        INSERT INTO day_bitmaps (doctor_id, day, available_mask)
+        SELECT doctor_id, unixepoch(date) / 86400, SUM(1 << bit) FROM (
+            SELECT a.doctor_id, a.date, s.bit
+            FROM doctor_availability a
+            JOIN doctor_slots s ON s.doctor_id = a.doctor_id AND s.session = a.slot
+            WHERE a.status = 1
+        ) WHERE unixepoch(date) IS NOT NULL {doctor_filter} {since_filter}
+        GROUP BY doctor_id, date
+        ON CONFLICT(doctor_id, day) DO UPDATE SET available_mask = excluded.available_mask
+    """, params)
+    tx.execute(f"""
+        INSERT INTO day_bitmaps (doctor_id, day, full_mask)
+        SELECT doctor_id, unixepoch(date) / 86400, SUM(1 << bit) FROM (
+            SELECT a.doctor_id, a.date, s.bit
+            FROM appointments a
+            JOIN doctor_slots s ON s.doctor_id = a.doctor_id AND s.slot = a.slot
+            WHERE a.status = 'confirmed'
+            GROUP BY a.doctor_id, a.date, s.bit, s.capacity
+            HAVING COUNT(*) >= s.capacity
+        ) WHERE unixepoch(date) IS NOT NULL {doctor_filter} {since_filter}
+        GROUP BY doctor_id, date
+        ON CONFLICT(doctor_id, day) DO UPDATE SET full_mask = excluded.full_mask
+    """, params)
+
+
+def hex_width(n_slots):
+    return max(1, (n_slots + 3) // 4)
+
+
+def popcount(masks):
+    import numpy as np
+
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(masks)
+    table = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+    return table[masks.view(np.uint8)].reshape(*masks.shape, 8).sum(axis=-1, dtype=np.uint8)
+
+
+def to_grids(rows, doctor_ids, days):
+    """(doctor_id, day offset, offered, full) tuples -> two len(doctor_ids) x days uint64 arrays."""
+    import numpy as np
+
+    available = np.zeros((len(doctor_ids), days), dtype=np.uint64)
+    full = np.zeros((len(doctor_ids), days), dtype=np.uint64)
+    if not rows:
+        return available, full
+
+    cols = np.array(rows, dtype=np.int64)
+    order = np.argsort(doctor_ids)
+    doc_idx = order[np.searchsorted(np.asarray(doctor_ids)[order], cols[:, 0])]
+    day_idx = cols[:, 1]
+
+    keep = (day_idx >= 0) & (day_idx < days)
+    available[doc_idx[keep], day_idx[keep]] = cols[keep, 2].astype(np.uint64)
+    full[doc_idx[keep], day_idx[keep]] = cols[keep, 3].astype(np.uint64)
+    return available, full
+
+
+def compact(grid, moves, n_slots):
+    """rows x days masks -> rows x days x words holding only the bits in `moves`.
+
+    `moves` maps (bit, column) to the rows whose `bit` is the response's slot
+    `column`; it lands at bit column % 64 of word column // 64.
+    """
+    import numpy as np
+
+    out = np.zeros((*grid.shape, max(1, (n_slots + 63) // 64)), dtype=np.uint64)
+    for (bit, column), rows in moves.items():
+        rows = np.asarray(rows)
+        out[rows, :, column // 64] |= ((grid[rows] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(column % 64)
+    return out
+
+
+def to_hex(grid, n_slots):
+    """One string per row of a rows x days x words grid, `hex_width(n_slots)` lowercase hex digits per day."""
+    import numpy as np
+
+    digits = np.frombuffer(b"0123456789abcdef", dtype=np.uint8)
+    width = hex_width(n_slots)
+    shifts = np.arange(15, -1, -1, dtype=np.uint64) * np.uint64(4)
+    # Highest word first, so each day reads as one number.
+    nibbles = (grid[..., ::-1, None] >> shifts) & np.uint64(0xF)
+    nibbles = nibbles.reshape(*grid.shape[:2], -1)[..., -width:]
+    chars = digits[nibbles.astype(np.intp)].reshape(grid.shape[0], -1)
+    return [row.tobytes().decode("ascii") for row in chars]
+
+
+def summarize(doctor_ids, start, days, slots, doctor_bits, rows, closed=(), detail=False):
+    """Free bitmap, free total and first free day per doctor.
+
+    `slots` lists the slot keys in the order the response does and
+    `doctor_bits` maps doctor id -> {slot key: bit}; `closed` holds (doctor
+    index, day offset) pairs for holidays. `detail` adds the offered and
+    full bitmaps and per-day free counts.
+    """
+    import numpy as np
+
+    available, full = to_grids(rows, doctor_ids, days)
+    moves = {}
+    for i, doctor_id in enumerate(doctor_ids):
+        bits = doctor_bits.get(doctor_id, {})
+        for column, key in enumerate(slots):
+            if key in bits:
+                moves.setdefault((bits[key], column), []).append(i)
+    available, full = compact(available, moves, len(slots)), compact(full, moves, len(slots))
+    for i, day in closed:
+        if 0 <= day < days:
+            available[i, day] = 0
+
+    free = available & ~full
+    free_counts = popcount(free).sum(axis=-1)
+
+    has_free = free_counts > 0
+    first_free = np.where(has_free.any(axis=1), has_free.argmax(axis=1), -1)
+    start_day = date.fromisoformat(start).toordinal()
+
+    free_hex = to_hex(free, len(slots))
+    if detail:
+        available_hex = to_hex(available, len(slots))
+        full_hex = to_hex(full & available, len(slots))
+
+    results = []
+    for i, doctor_id in enumerate(doctor_ids):
+        result = {
+            "doctor_id": int(doctor_id),
+            "free": free_hex[i],
+            "total_free": int(free_counts[i].sum()),
+            "first_free_date": (date.fromordinal(start_day + int(first_free[i])).isoformat()
+                                if first_free[i] >= 0 else None),
+        }
+        if detail:
+            result["available"] = available_hex[i]
+            result["full"] = full_hex[i]
+            result["free_per_day"] = free_counts[i].tolist()
+        results.append(result)
+    return results
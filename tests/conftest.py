@@ -0,0 +1,103 @@
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("OPENROUTER_API_KEY", "test")
+
+PASSWORD = "test-pw"
+
+
+@pytest.fixture
+def hms(tmp_path, monkeypatch):
+    """The app module on a fresh database in tmp_path.
+
+    The side files (rate limits, archive, audit log, admission metrics) are
+    opened relative to the working directory or next to the database, so
+    they all land in tmp_path too.
+    """
+    monkeypatch.chdir(tmp_path)
+    import app
+    from ratelimit import TokenBucketLimiter
+
+    monkeypatch.setattr(app, "limiter", TokenBucketLimiter(str(tmp_path / "ratelimit.db")))
+    monkeypatch.setattr(app.admission_control, "metrics_path", str(tmp_path / "metrics.db"))
+    app.create_app({"DATABASE_NAME": str(tmp_path / "hospital.db"), "TESTING": True})
+    app.reset_after_fork()
+    app.init_db()
+    yield app
+    app.audit_log.close()
+    app.admission_control.reset()
+
+
+def seed(hms):
+    """Department 1 with doctors 1-3 (users doc1-doc3) and patients pat1-pat3, all with PASSWORD."""
+    repo = hms.repo
+
+    def load(tx):
+        dept_id = repo.departments.create(tx, "Cardiology", "Heart")
+        doctors, patients = [], []
+        for i in range(1, 4):
+            uid = repo.users.create(tx, f"doc{i}", hms.hash_password(PASSWORD), "doctor")
+            doctors.append(repo.doctors.create(tx, f"doc{i}", f"Dr {i}", uid, "Cardiology", 3 * i, dept_id))
+        for i in range(1, 4):
+            uid = repo.users.create(tx, f"pat{i}", hms.hash_password(PASSWORD), "patient")
+            patients.append(repo.patients.create(tx, f"pat{i}", f"Patient {i}", uid))
+        hms.compile_doctor_slots(tx, doctors)
+        return dept_id, doctors, patients
+
+    hms.seed = dict(zip(("department", "doctors", "patients"), repo.write(load)))
+    return hms
+
+
+@pytest.fixture
+def seeded(hms):
+    return seed(hms)
+
+
+@pytest.fixture(params=["sqlite", "postgres"])
+def store(request, tmp_path, monkeypatch):
+    """`hms` on each backend. Postgres needs DATABASE_URL; each test gets a schema of its own there."""
+    if request.param == "postgres":
+        url = os.getenv("DATABASE_URL")
+        if not url:
+            pytest.skip("DATABASE_URL is not set")
+        psycopg = pytest.importorskip("psycopg")
+        pytest.importorskip("psycopg_pool")
+        schema = f"test_{uuid.uuid4().hex[:12]}"
+        with psycopg.connect(url, autocommit=True) as conn:
+            conn.execute(f"CREATE SCHEMA {schema}")
+
+        def drop():
+            import app
+
+            if getattr(app.repo.backend, "_pool", None) is not None:
+                app.repo.backend._pool.close()
+            with psycopg.connect(url, autocommit=True) as conn:
+                conn.execute(f"DROP SCHEMA {schema} CASCADE")
+
+        request.addfinalizer(drop)
+        monkeypatch.setenv("DB_BACKEND", "postgres")
+        monkeypatch.setenv("DATABASE_URL", psycopg.conninfo.make_conninfo(url, options=f"-c search_path={schema}"))
+    else:
+        monkeypatch.setenv("DB_BACKEND", "sqlite")
+    return request.getfixturevalue("hms")
+
+
+@pytest.fixture
+def seeded_store(store):
+    return seed(store)
+
+
+def login(client, role, **values):
+    with client.session_transaction() as s:
+        s["user_role"] = role
+        s.update(values)
+    return client
+
+
+@pytest.fixture
+def admin(hms):
+    return login(hms.app.test_client(), "admin", user_id=1)
@@ -0,0 +1,102 @@
+import threading
+
+import pytest
+from werkzeug.routing import Map, Rule
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+import admission
+from admission import AdmissionControl
+
+
+def hello(environ, start_response):
+    return Response("ok")(environ, start_response)
+
+
+@pytest.fixture
+def make(tmp_path):
+    controls = []
+
+    def make(capacity=4):
+        url_map = Map([Rule("/book", endpoint="book"), Rule("/chat", endpoint="chat"), Rule("/page", endpoint="page")])
+        control = AdmissionControl(hello, url_map, {"book": "critical", "chat": "best_effort"}, capacity=capacity,
+                                   metrics_path=str(tmp_path / "metrics.db"), enabled=True)
+        controls.append(control)
+        return control
+
+    yield make
+    for control in controls:
+        control.reset()
+
+
+def value(control, name, labels):
+    for line in control.metrics().splitlines():
+        if line.startswith(f"{name}{{{labels}}} "):
+            return float(line.rsplit(" ", 1)[1])
+    return None
+
+
+def test_best_effort_is_shed_before_critical(make):
+    control = make(capacity=4)
+    # Best effort may hold half the slots; both are taken.
+    control._admit("best_effort", 0)
+    control._admit("best_effort", 0)
+    client = Client(control)
+    assert client.get("/chat").status_code == 503
+    assert client.get("/book").status_code == 200
+    assert client.get("/page").status_code == 200
+    assert control.stats()["tiers"]["best_effort"]["shed"]["concurrency"] == 1
+
+
+def test_requests_never_flush_metrics_themselves(make, monkeypatch):
+    control = make()
+    threads = []
+    monkeypatch.setattr(control, "flush", lambda: threads.append(threading.current_thread().name))
+    monkeypatch.setattr(admission, "FLUSH_INTERVAL", 0.05)
+    client = Client(control)
+    for _ in range(5):
+        client.get("/page")
+    control._stop.wait(0.3)
+    assert threads and set(threads) == {"admission-metrics"}
+
+
+def test_a_reused_pid_does_not_overwrite_the_old_worker(make):
+    old, new = make(), make()
+    Client(old).get("/page")
+    Client(old).get("/page")
+    old.flush()
+    # Same pid, later start: a new worker that was handed the dead one's pid.
+    Client(new).get("/page")
+    assert value(new, "admission_requests_total", 'tier="normal"') == 3
+
+
+def test_retired_workers_keep_their_counters_but_not_their_gauges(make):
+    control = make()
+    Client(control).get("/page")
+    control._admit("normal", 0)
+    control.flush()
+    assert value(control, "admission_inflight", 'tier="normal"') == 1
+
+    control.retire([control._pid])
+    conn = control._metrics_conn()
+    assert {r[0] for r in conn.execute("SELECT DISTINCT pid FROM admission_metrics")} == {0}
+    control.retire([control._pid])
+    assert conn.execute("SELECT value FROM admission_metrics WHERE pid = 0 AND name = 'admission_requests_total' "
+                        "AND labels = 'tier=\"normal\"'").fetchone()[0] == 2
+    assert conn.execute("SELECT COUNT(*) FROM admission_metrics WHERE name = 'admission_inflight'").fetchone()[0] == 0
+
+    control.clear()
+    assert conn.execute("SELECT COUNT(*) FROM admission_metrics").fetchone()[0] == 0
+
+
+def test_old_metrics_table_is_replaced(make, tmp_path):
+    import sqlite3
+
+    conn = sqlite3.connect(tmp_path / "metrics.db")
+    conn.execute("CREATE TABLE admission_metrics (pid INTEGER, name TEXT, labels TEXT, value REAL, updated_at REAL, "
+                 "PRIMARY KEY (pid, name, labels))")
+    conn.commit()
+    conn.close()
+    control = make()
+    Client(control).get("/page")
+    assert value(control, "admission_requests_total", 'tier="normal"') == 1
@@ -0,0 +1,49 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def test_import_does_not_load_the_ai_sdk(tmp_path):
+    code = "import sys, app; print('openai' in sys.modules, app._ai_client)"
+    env = {**os.environ, "DATABASE_NAME": str(tmp_path / "hospital.db")}
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    assert out.stdout.split() == ["False", "None"]
+    # Importing opened nothing.
+    assert not (tmp_path / "hospital.db").exists()
+
+
+def test_ai_client_is_built_once_and_dropped_after_fork(hms):
+    client = hms.get_ai_client()
+    assert hms.get_ai_client() is client
+    assert str(client.base_url).startswith(hms.app.config["OPENROUTER_BASE_URL"])
+    hms.reset_after_fork()
+    assert hms._ai_client is None
+    assert hms.get_ai_client() is not client
+
+
+def test_init_db_is_a_no_op_once_current(hms):
+    conn = hms.get_db_connection()
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == hms.SCHEMA_VERSION
+    conn.execute("CREATE TABLE marker (x)")
+    conn.execute("DROP TABLE departments")
+    conn.commit()
+    hms.init_db()
+    # Nothing was re-run: the dropped table stays dropped.
+    assert conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'departments'").fetchone()[0] == 0
+
+    conn.execute("PRAGMA user_version = 0")
+    hms.init_db()
+    assert conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'departments'").fetchone()[0] == 1
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == hms.SCHEMA_VERSION
+    assert hms.repo.users.count() == 1
+
+
+def test_create_app_moves_storage_to_the_configured_database(hms, tmp_path):
+    other = str(tmp_path / "other.db")
+    hms.create_app({"DATABASE_NAME": other})
+    assert hms.DATABASE_NAME == other
+    hms.init_db()
+    assert os.path.exists(other)
+    assert hms.repo.users.count() == 1
@@ -0,0 +1,124 @@
+import sqlite3
+from datetime import date, timedelta
+
+import pytest
+
+import archive
+import jobs
+
+
+def days_ago(n):
+    return (date.today() - timedelta(days=n)).isoformat()
+
+
+def connect(hms):
+    conn = hms.get_db_connection()
+    conn.isolation_level = None
+    return conn
+
+
+def add_appointment(conn, day, doctor_id=1, slot="morning"):
+    return conn.execute("""
+        INSERT INTO appointments (patient_name, patient_id, doctor_name, doctor_id, date, slot, status)
+        VALUES ('pat1', 1, 'Dr 1', ?, ?, ?, 'confirmed')
+    """, (doctor_id, day, slot)).lastrowid
+
+
+def test_moves_old_rows_and_keeps_them_in_history(seeded):
+    conn = connect(seeded)
+    old = add_appointment(conn, days_ago(400))
+    recent = add_appointment(conn, days_ago(1))
+    conn.execute("INSERT INTO doctor_availability (doctor_id, date, slot, status) VALUES (1, ?, 'morning', 1)",
+                 (days_ago(30),))
+
+    stats = archive.run_archival(conn)
+    assert stats["appointments"] == 1 and stats["doctor_availability"] == 1
+    assert [r[0] for r in conn.execute("SELECT id FROM main.appointments")] == [recent]
+    assert [r[0] for r in conn.execute("SELECT id FROM archive.appointments")] == [old]
+    assert sorted(r[0] for r in conn.execute("SELECT id FROM appointments_all")) == [old, recent]
+
+
+def test_archival_skips_the_change_triggers_and_marks_rollup_days(seeded):
+    conn = connect(seeded)
+    for n in range(50):
+        add_appointment(conn, days_ago(200 + n))
+    conn.execute("DELETE FROM rollup_dirty")
+    changes = conn.execute("SELECT COUNT(*) FROM slot_changes").fetchone()[0]
+
+    assert archive.run_archival(conn)["appointments"] == 50
+    assert conn.execute("SELECT COUNT(*) FROM slot_changes").fetchone()[0] == changes
+    assert conn.execute("SELECT COUNT(*) FROM rollup_dirty").fetchone()[0] == 50
+    assert conn.execute("SELECT COUNT(*) FROM archival_running").fetchone()[0] == 0
+
+    # Ordinary deletes still reach the triggers.
+    add_appointment(conn, days_ago(1))
+    conn.execute("DELETE FROM appointments")
+    assert conn.execute("SELECT COUNT(*) FROM slot_changes").fetchone()[0] == changes + 2
+
+
+def test_archive_lives_beside_the_database(seeded, tmp_path, monkeypatch):
+    conn = connect(seeded)
+    old = add_appointment(conn, days_ago(400))
+    elsewhere = tmp_path / "elsewhere"
+    elsewhere.mkdir()
+    monkeypatch.chdir(elsewhere)
+
+    archive.run_archival(conn)
+    assert (tmp_path / archive.ARCHIVE_DATABASE_NAME).exists()
+    assert list(elsewhere.iterdir()) == []
+    assert [r["id"] for r in seeded.repo.backend.all("SELECT id FROM appointments_all", history=True)] == [old]
+
+
+def test_archived_ids_are_not_reused(seeded):
+    conn = connect(seeded)
+    add_appointment(conn, days_ago(1))
+    top = add_appointment(conn, days_ago(400))
+    archive.run_archival(conn)
+    assert add_appointment(conn, days_ago(1)) > top
+
+
+def test_id_clash_fails_instead_of_overwriting(seeded):
+    conn = connect(seeded)
+    first = add_appointment(conn, days_ago(400))
+    archive.run_archival(conn)
+    # A row that somehow got an archived id (e.g. from before the AUTOINCREMENT migration).
+    conn.execute("INSERT INTO appointments (id, patient_name, doctor_id, date) VALUES (?, 'other', 1, ?)",
+                 (first, days_ago(300)))
+
+    with pytest.raises(sqlite3.IntegrityError):
+        archive.run_archival(conn)
+    assert conn.execute("SELECT patient_name FROM archive.appointments WHERE id = ?", (first,)).fetchone()[0] == "pat1"
+    assert conn.execute("SELECT COUNT(*) FROM main.appointments").fetchone()[0] == 1
+    assert conn.execute("SELECT COUNT(*) FROM archival_running").fetchone()[0] == 0
+
+
+def test_migration_rebuilds_appointments_with_autoincrement(tmp_path):
+    conn = sqlite3.connect(tmp_path / "old.db", isolation_level=None)
+    conn.execute("CREATE TABLE appointments (id INTEGER PRIMARY KEY, date TEXT)")
+    conn.execute("CREATE INDEX idx_date ON appointments(date)")
+    conn.execute("INSERT INTO appointments VALUES (3, '2020-01-01')")
+    cold = sqlite3.connect(tmp_path / "cold.db")
+    cold.execute("CREATE TABLE appointments (id INTEGER PRIMARY KEY, date TEXT)")
+    cold.execute("INSERT INTO appointments VALUES (9, '2019-01-01')")
+    cold.commit()
+    cold.close()
+
+    assert archive.ensure_autoincrement(conn, "appointments", str(tmp_path / "cold.db"))
+    assert not archive.ensure_autoincrement(conn, "appointments", str(tmp_path / "cold.db"))
+    assert conn.execute("SELECT id FROM appointments").fetchall() == [(3,)]
+    assert conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'").fetchall() == [("idx_date",)]
+    assert conn.execute("INSERT INTO appointments (date) VALUES ('2026-01-01')").lastrowid == 10
+
+
+def test_archival_job_reschedules_even_when_it_fails(hms, monkeypatch):
+    def broken(conn):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    monkeypatch.setattr(archive, "run_archival", broken)
+    hms.schedule_archival(delay=0)
+    job = hms.job_queue.claim("w", 60)
+    jobs.run_job(hms.job_queue, job, "w")
+    assert hms.job_queue.get(job["id"])["status"] == "failed"
+    statuses = [r[0] for r in hms.job_queue._conn().execute(
+        "SELECT status FROM jobs WHERE kind = 'archive_old_rows' AND id != ?", (job["id"],))]
+    assert statuses == ["queued"]
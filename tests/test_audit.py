@@ -0,0 +1,74 @@
+import sqlite3
+import time
+
+import pytest
+
+import audit
+from audit import AuditLog
+
+
+@pytest.fixture
+def log(tmp_path):
+    # A long interval and a big batch keep the background thread out of the way.
+    log = AuditLog(str(tmp_path / "audit.db"), flush_interval=60, flush_batch=10_000, max_buffered=5)
+    yield log
+    log.close(timeout=1)
+
+
+def test_record_then_query_newest_first(log):
+    log.record("doctor.create", "doctor", 3, actor_id=1, actor_role="admin", details={"name": "Dr 3"})
+    log.record("doctor.delete", "doctor", 3, actor_id=1, actor_role="admin")
+    events = log.query(entity_type="doctor", entity_id=3)
+    assert [e["action"] for e in events] == ["doctor.delete", "doctor.create"]
+    assert events[1]["details"] == {"name": "Dr 3"}
+
+    conn = sqlite3.connect(log.path)
+    with pytest.raises(sqlite3.DatabaseError, match="append-only"):
+        conn.execute("DELETE FROM audit_events")
+
+
+def test_backlog_past_the_limit_is_flushed_by_the_recorder(log):
+    for i in range(6):
+        log.record("x", "t", i)
+    assert log.stats()["buffered"] == 0 and log.stats()["flushed"] == 6
+
+
+def test_failing_audit_db_does_not_stall_requests(tmp_path, monkeypatch):
+    log = AuditLog(str(tmp_path / "missing" / "audit.db"), flush_interval=60, flush_batch=10_000, max_buffered=5)
+    calls = []
+    flush = log._flush
+    monkeypatch.setattr(log, "_flush", lambda **kw: calls.append(1) or flush(**kw))
+    for i in range(50):
+        log.record("x", "t", i)
+    # One synchronous attempt, then the recorders back off; nothing is dropped.
+    assert len(calls) == 1
+    assert log.stats()["buffered"] == 50 and log.stats()["errors"] == 1
+
+    log.path = str(tmp_path / "audit.db")
+    assert log.flush() == 50
+    log.close(timeout=1)
+
+
+def test_locked_audit_db_waits_only_briefly(log):
+    log.record("first", "t")
+    log.flush()
+    blocker = sqlite3.connect(log.path, isolation_level=None)
+    blocker.execute("BEGIN IMMEDIATE")
+
+    started = time.monotonic()
+    for i in range(10):
+        log.record("x", "t", i)
+    assert time.monotonic() - started < audit.BACKPRESSURE_TIMEOUT + 1
+    assert log.stats()["buffered"] == 10
+
+    blocker.execute("ROLLBACK")
+    assert log.flush() == 10
+
+
+def test_recorders_do_not_queue_behind_a_running_flush(log):
+    with log._flush_lock:
+        started = time.monotonic()
+        for i in range(10):
+            log.record("x", "t", i)
+        assert time.monotonic() - started < 0.5
+    assert log.flush() == 10
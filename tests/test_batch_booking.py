@@ -0,0 +1,91 @@
+from datetime import date, timedelta
+
+import pytest
+
+from conftest import login
+
+
+def day(offset):
+    return (date.today() + timedelta(days=offset)).isoformat()
+
+
+@pytest.fixture
+def staff(seeded_store):
+    hms = seeded_store
+    hms.repo.write(lambda tx: tx.executemany(
+        "INSERT INTO doctor_availability (doctor_id, date, slot, status) VALUES (?, ?, ?, 1)",
+        [(d, day(o), s) for d in (1, 2) for o in (1, 2) for s in ("morning", "afternoon")]))
+    return login(hms.app.test_client(), "admin", user_id=1)
+
+
+def book(patient, doctor_id=1, offset=1, slot="morning"):
+    return {"op": "book", "patient": patient, "doctor_id": doctor_id, "date": day(offset), "slot": slot}
+
+
+def statuses(hms):
+    return sorted(r["status"] for r in hms.repo.backend.all("SELECT status FROM appointments"))
+
+
+def test_items_get_results_in_order(staff, seeded_store):
+    response = staff.post("/appointments/batch", json={"items": [
+        book("pat1"),
+        book("pat2"),                      # slot already taken by pat1
+        book("nobody", slot="afternoon"),
+        book("pat2", doctor_id=99),
+        {"op": "cancel", "appointment_id": 12345},
+    ]})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert [r.get("error") for r in body["results"]] == [None, "slot_unavailable", "patient_not_found",
+                                                       "doctor_not_found", "not_found_or_not_confirmed"]
+    assert [r["index"] for r in body["results"]] == [0, 1, 2, 3, 4]
+    assert (body["applied"], body["failed"], body["success"]) == (1, 4, False)
+
+    booked = body["results"][0]["appointment_id"]
+    body = staff.post("/appointments/batch", json={"items": [
+        {"op": "move", "appointment_id": booked, "doctor_id": 2, "date": day(2), "slot": "afternoon"},
+        book("pat2"),                      # the slot the move freed
+    ]}).get_json()
+    assert body["success"]
+    appointment = seeded_store.repo.backend.one(
+        "SELECT doctor_id, date, slot FROM appointments WHERE id = ?", (booked,))
+    assert (appointment["doctor_id"], appointment["date"], appointment["slot"]) == (2, day(2), "afternoon")
+
+    assert staff.post("/appointments/batch", json={"items": [{"op": "cancel", "appointment_id": booked}]}) \
+        .get_json()["success"]
+    assert statuses(seeded_store) == ["cancelled", "confirmed"]
+
+
+def test_atomic_batch_rolls_back_on_any_failure(staff, seeded_store):
+    response = staff.post("/appointments/batch", json={"atomic": True, "items": [book("pat1"), book("pat2")]})
+    assert response.status_code == 409
+    assert response.get_json()["applied"] == 0
+    assert statuses(seeded_store) == []
+
+
+def test_idempotency_key_replays_the_stored_response(staff, seeded_store):
+    headers = {"Idempotency-Key": "abc"}
+    body = {"items": [book("pat1")]}
+    first = staff.post("/appointments/batch", json=body, headers=headers)
+    second = staff.post("/appointments/batch", json=body, headers=headers)
+    assert second.headers.get("Idempotent-Replayed") == "true"
+    assert second.get_json() == first.get_json()
+    assert statuses(seeded_store) == ["confirmed"]
+
+    other = staff.post("/appointments/batch", json={"items": [book("pat2", slot="afternoon")]}, headers=headers)
+    assert other.status_code == 422
+    # Keys are per user.
+    again = login(seeded_store.app.test_client(), "admin", user_id=99)
+    assert again.post("/appointments/batch", json=body, headers=headers).get_json()["results"][0]["error"] == \
+        "slot_unavailable"
+
+
+def test_bad_requests(staff, seeded_store):
+    assert staff.post("/appointments/batch", json={"items": []}).status_code == 400
+    assert staff.post("/appointments/batch", json={"items": [{"op": "cancel"}]}).status_code == 400
+    assert staff.post("/appointments/batch", json={"items": [book("pat1", offset=1) | {"date": "soon"}]}) \
+        .status_code == 400
+    for bad in ({"patient": ["pat1"]}, {"patient": ""}, {"slot": 5}, {"op": "rebook"}):
+        assert staff.post("/appointments/batch", json={"items": [book("pat1", offset=1) | bad]}).status_code == 400
+    patient = login(seeded_store.app.test_client(), "patient", user_id=5)
+    assert patient.post("/appointments/batch", json={"items": [book("pat1")]}).status_code == 403
@@ -0,0 +1,91 @@
+from datetime import date, timedelta
+
+import pytest
+
+from conftest import login
+
+
+def day(offset):
+    return (date.today() + timedelta(days=offset)).isoformat()
+
+
+@pytest.fixture
+def admin(seeded_store):
+    return login(seeded_store.app.test_client(), "admin", user_id=1)
+
+
+def bulk(admin, kind, **body):
+    return admin.post(f"/admin/{kind}s/bulk", json=body)
+
+
+def blacklisted(hms, table):
+    return {r["id"]: r["blacklisted"] for r in hms.repo.backend.all(f"SELECT id, blacklisted FROM {table}")}
+
+
+def test_blacklist_by_ids_and_filters(seeded_store, admin):
+    body = bulk(admin, "doctor", action="blacklist", ids=[1, 2]).get_json()
+    assert (sorted(body["ids"]), body["counts"]) == ([1, 2], {"doctors": 2})
+    # Already blocked: nothing changes.
+    assert bulk(admin, "doctor", action="blacklist", ids=[1, 2]).get_json()["ids"] == []
+    assert blacklisted(seeded_store, "doctors") == {1: 0, 2: 0, 3: 1}
+
+    body = bulk(admin, "doctor", action="unblacklist", filter={"department_id": seeded_store.seed["department"],
+                                                                "blacklisted": 0}).get_json()
+    assert sorted(body["ids"]) == [1, 2]
+    assert bulk(admin, "patient", action="blacklist", ids=[1, 2, 3], filter={"name": "Patient 2"}) \
+        .get_json()["ids"] == [2]
+    assert blacklisted(seeded_store, "patients") == {1: 1, 2: 0, 3: 1}
+
+
+def test_deleting_doctors_cascades(seeded_store, admin):
+    def setup(tx):
+        tx.executemany("INSERT INTO doctor_availability (doctor_id, date, slot, status) VALUES (?, ?, 'morning', 1)",
+                       [(1, day(-2)), (1, day(2)), (2, day(2))])
+        tx.executemany("INSERT INTO appointments (patient_name, patient_id, doctor_id, date, slot, status) "
+                       "VALUES ('pat1', 5, ?, ?, 'morning', 'confirmed')", [(1, day(-2)), (1, day(2)), (2, day(2))])
+
+    seeded_store.repo.write(setup)
+    body = bulk(admin, "doctor", action="delete", ids=[1]).get_json()
+    assert body["ids"] == [1] and body["counts"]["users"] == 1
+
+    backend = seeded_store.repo.backend
+    assert [r["id"] for r in backend.all("SELECT id FROM doctors ORDER BY id")] == [2, 3]
+    assert backend.scalar("SELECT COUNT(*) FROM users WHERE username = 'doc1'") == 0
+    assert sorted((r["doctor_id"], r["date"]) for r in backend.all("SELECT doctor_id, date FROM doctor_availability")) \
+        == [(1, day(-2)), (2, day(2))]
+    statuses = {(r["doctor_id"], r["date"]): r["status"] for r in backend.all(
+        "SELECT doctor_id, date, status FROM appointments")}
+    assert statuses == {(1, day(-2)): "confirmed", (1, day(2)): "cancelled", (2, day(2)): "confirmed"}
+
+
+def test_deleting_patients_cancels_their_future_appointments(seeded_store, admin):
+    seeded_store.repo.write(lambda tx: tx.executemany(
+        "INSERT INTO appointments (patient_name, patient_id, doctor_id, date, slot, status) "
+        "VALUES (?, ?, 1, ?, 'morning', 'confirmed')", [("pat1", 5, day(1)), ("pat2", 6, day(1))]))
+    body = bulk(admin, "patient", action="delete", filter={"name": "Patient 1"}).get_json()
+    assert body["ids"] == [1]
+    backend = seeded_store.repo.backend
+    assert backend.scalar("SELECT COUNT(*) FROM patients") == 2
+    assert backend.scalar("SELECT COUNT(*) FROM users WHERE username = 'pat1'") == 0
+    assert {r["patient_name"]: r["status"] for r in backend.all("SELECT patient_name, status FROM appointments")} \
+        == {"pat1": "cancelled", "pat2": "confirmed"}
+
+
+def test_deleted_names_leave_the_typeahead(seeded_store, admin):
+    def names():
+        return {s["name"] for s in admin.get("/search/suggest?kind=doctor&q=Dr").get_json()["suggestions"]}
+
+    assert names() == {"Dr 1", "Dr 2", "Dr 3"}
+    bulk(admin, "doctor", action="delete", ids=[2])
+    assert names() == {"Dr 1", "Dr 3"}
+
+
+def test_bad_bulk_requests(seeded_store, admin):
+    assert bulk(admin, "doctor", action="archive", ids=[1]).status_code == 400
+    assert bulk(admin, "doctor", action="delete").status_code == 400
+    assert bulk(admin, "doctor", action="delete", filter={"experience": 3}).status_code == 400
+    assert bulk(admin, "patient", action="delete", filter={"blacklisted": 2}).status_code == 400
+    assert bulk(admin, "patient", action="delete", ids="1,2").status_code == 400
+    patient = login(seeded_store.app.test_client(), "patient", user_id=5)
+    assert bulk(patient, "patient", action="delete", ids=[1]).status_code == 403
+    assert seeded_store.repo.backend.scalar("SELECT COUNT(*) FROM patients") == 3
@@ -0,0 +1,93 @@
+import json
+from datetime import date
+
+import pytest
+
+from conftest import login
+
+import clinical
+
+
+TODAY = date.today().isoformat()
+
+
+def test_free_text_is_parsed():
+    assert clinical.parse_medicines("Paracetamol 500mg, Cetirizine 10 mg;Rest") == [
+        {"name": "Paracetamol", "dose": "500mg"}, {"name": "Cetirizine", "dose": "10 mg"}, {"name": "Rest"}]
+    assert clinical.parse_tests("CBC: normal, Lipid panel") == [{"name": "CBC", "result": "normal"},
+                                                                {"name": "Lipid panel"}]
+
+
+def test_normalise_validates_structured_fields():
+    item = clinical.normalise({"medicines": [{"name": " Ibuprofen ", "dose": "200mg", "days": 3}, "Rest"],
+                               "prescription": {"advice": "Fluids", "follow_up": "2026-02-01"}})
+    assert json.loads(item["medicines"]) == [{"name": "Ibuprofen", "dose": "200mg", "days": 3}, {"name": "Rest"}]
+    assert json.loads(item["prescription"]) == {"advice": "Fluids", "follow_up": "2026-02-01"}
+
+    for bad in ({"medicines": [{"dose": "1mg"}]}, {"medicines": [{"name": "x", "days": -1}]},
+                {"tests_done": [{"name": "x", "colour": "red"}]}, {"tests_done": 3},
+                {"prescription": {"follow_up": "soon"}}):
+        with pytest.raises(ValueError):
+            clinical.normalise(bad)
+
+
+@pytest.fixture
+def visits(seeded):
+    conn = seeded.get_db_connection()
+    ids = [conn.execute("INSERT INTO appointments (patient_name, patient_id, doctor_id, date, slot, status) "
+                        "VALUES (?, ?, ?, ?, 'morning', 'confirmed')", (p, pid, d, TODAY)).lastrowid
+           for p, pid, d in (("pat1", 5, 1), ("pat2", 6, 1), ("pat3", 7, 2))]
+    conn.commit()
+    admin = login(seeded.app.test_client(), "admin", user_id=1)
+    response = admin.post("/doctor/visits/batch", json={"visits": [
+        {"appointment_id": ids[0], "medicines": "Paracetamol 500mg, Cetirizine 10mg", "tests_done": "CBC: normal"},
+        {"appointment_id": ids[1], "medicines": [{"name": "paracetamol", "dose": "650mg"}]},
+        {"appointment_id": ids[2], "medicines": ["Paracetamol"], "tests_done": [{"name": "ECG"}]},
+    ]})
+    assert response.status_code == 201
+    return admin
+
+
+def test_triggers_index_items_and_search_uses_them(seeded, visits):
+    conn = seeded.get_db_connection()
+    assert conn.execute("SELECT COUNT(*) FROM visit_items").fetchone()[0] == 6
+
+    body = visits.get("/visits/search", query_string={"medicine": "PARACETAMOL"}).get_json()
+    assert body["patients"] == ["pat1", "pat2", "pat3"]
+    assert visits.get("/visits/search", query_string={"medicine": "para", "match": "prefix"}) \
+        .get_json()["patients"] == ["pat1", "pat2", "pat3"]
+    assert visits.get("/visits/search", query_string={"medicine": "para"}).get_json()["visits"] == []
+    assert visits.get("/visits/search", query_string={"test": "ecg"}).get_json()["patients"] == ["pat3"]
+
+    # Doctors only see their own visits.
+    doctor = login(seeded.app.test_client(), "doctor", user_id=2, doctor_name="Dr 1", doctor_id=1)
+    assert doctor.get("/visits/search", query_string={"medicine": "paracetamol"}).get_json()["patients"] == \
+        ["pat1", "pat2"]
+
+    conn.execute("UPDATE visits SET medicines = '[]' WHERE patient_name = 'pat1'")
+    conn.commit()
+    assert visits.get("/visits/search", query_string={"medicine": "cetirizine"}).get_json()["visits"] == []
+
+
+def test_search_arguments(visits):
+    assert visits.get("/visits/search").status_code == 400
+    assert visits.get("/visits/search", query_string={"medicine": "x", "start": "nope"}).status_code == 400
+    assert visits.get("/visits/search", query_string={"medicine": "x", "limit": 0}).status_code == 400
+
+
+def test_migration_converts_free_text_visits(seeded):
+    conn = seeded.get_db_connection()
+    # A database from before visit_items.
+    for name in clinical.TRIGGERS:
+        conn.execute(f"DROP TRIGGER {name}")
+    conn.execute("DROP TABLE visit_items")
+    conn.execute("INSERT INTO visits (patient_name, visit_no, visit_date, medicines, tests_done, prescription) "
+                 "VALUES ('pat1', 1, ?, 'Amoxicillin 250mg', 'CRP: 4', 'Rest')", (TODAY,))
+    conn.execute("PRAGMA user_version = 1")
+    conn.commit()
+    seeded.init_db()
+
+    row = clinical.decode(dict(conn.execute("SELECT medicines, tests_done, prescription FROM visits").fetchone()))
+    assert row == {"medicines": [{"name": "Amoxicillin", "dose": "250mg"}],
+                   "tests_done": [{"name": "CRP", "result": "4"}], "prescription": {"advice": "Rest"}}
+    assert [r[0] for r in conn.execute("SELECT name_key FROM visit_items ORDER BY kind")] == ["amoxicillin", "crp"]
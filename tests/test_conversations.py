@@ -0,0 +1,93 @@
+import pytest
+
+from conftest import login
+
+import conversations
+import jobs
+
+
+def turn(i, role="user", tokens=10):
+    return {"id": i, "role": role, "content": f"m{i}", "tokens": tokens}
+
+
+def test_prompt_stays_within_budget_newest_turns_first():
+    recent = [turn(i) for i in (5, 4, 3, 2, 1)]
+    system, message = "s" * 40, "q" * 40
+    budget = conversations.estimate_tokens(system) + conversations.estimate_tokens(message) + 30
+    prompt, window = conversations.build_prompt(system, None, recent, message, budget=budget)
+    assert [m["id"] for m in window] == [5, 4, 3]
+    assert [m["content"] for m in prompt] == [system, "m3", "m4", "m5", message]
+
+    prompt, window = conversations.build_prompt(system, "earlier", recent, message, budget=budget)
+    assert prompt[1]["content"].endswith("earlier") and len(window) < 3
+
+
+def test_summary_boundaries():
+    recent = [turn(i, tokens=100) for i in (6, 5, 4, 3)]
+    assert conversations.needs_summary(recent, keep=350)
+    assert not conversations.needs_summary(recent, keep=400)
+    assert conversations.keep_boundary(recent, keep=250) == 5
+    # A single message over the limit is summarised as well.
+    assert conversations.keep_boundary(recent, keep=50) == 7
+
+    older = [turn(i, tokens=100) for i in (1, 2, 3)]
+    assert [m["id"] for m in conversations.take_chunk(older, limit=250)] == [1, 2]
+    assert [m["id"] for m in conversations.take_chunk([turn(1, tokens=900)], limit=250)] == [1]
+
+    clipped = conversations.clip_summary("word " * 1000, max_tokens=20)
+    assert clipped.endswith(" ...") and len(clipped) <= 4 * 16 + 4
+
+
+@pytest.fixture
+def chat(store, monkeypatch):
+    monkeypatch.setattr(store, "RATE_LIMIT_SCALE", 100)
+    prompts = []
+
+    def complete(messages, max_tokens=300, temperature=0.6):
+        prompts.append(messages)
+        return "summary of turns" if messages[0]["content"] == conversations.SUMMARY_PROMPT else "r" * 1600
+
+    monkeypatch.setattr(store, "complete", complete)
+    client = login(store.app.test_client(), "patient", user_id=5)
+    conversation_id = client.post("/ai/conversations", json={"title": "Cough"}).get_json()["conversation"]["id"]
+    return store, client, conversation_id, prompts
+
+
+def send(client, conversation_id, message):
+    return client.post("/ai/chat", json={"conversation_id": conversation_id, "message": message})
+
+
+def test_turns_are_stored_and_old_ones_summarised(chat):
+    hms, client, conversation_id, prompts = chat
+    for i in range(3):
+        response = send(client, conversation_id, f"question {i} " + "x" * 1500)
+        assert response.get_json()["source"] == "llm"
+        assert sum(conversations.estimate_tokens(m["content"]) for m in prompts[-1]) <= conversations.PROMPT_BUDGET
+
+    messages = client.get(f"/ai/conversations/{conversation_id}").get_json()["messages"]
+    assert [m["role"] for m in messages] == ["user", "assistant"] * 3
+
+    # Only one summary job is queued however many turns overflow the window.
+    queued = hms.job_queue._conn().execute(
+        "SELECT COUNT(*) FROM jobs WHERE kind = 'summarize_conversation' AND status = 'queued'").fetchone()[0]
+    assert queued == 1
+    while True:
+        job = hms.job_queue.claim("w", 60)
+        if job is None:
+            break
+        jobs.run_job(hms.job_queue, job, "w")
+
+    conversation = hms.repo.conversations.get(conversation_id)
+    assert conversation["summary"] == "summary of turns"
+    assert conversation["summarized_through"] > 0
+    send(client, conversation_id, "and now?")
+    assert prompts[-1][1]["content"].endswith("summary of turns")
+
+
+def test_conversations_are_private(chat):
+    hms, client, conversation_id, _ = chat
+    other = login(hms.app.test_client(), "patient", user_id=6)
+    assert other.get(f"/ai/conversations/{conversation_id}").status_code == 404
+    assert send(other, conversation_id, "hello").status_code == 404
+    assert other.get("/ai/conversations").get_json()["conversations"] == []
+    assert send(client, conversation_id, "x" * 4 * conversations.MESSAGE_MAX_TOKENS).status_code == 400
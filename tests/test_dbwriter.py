@@ -0,0 +1,91 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from conftest import login
+from dbwriter import SerializedWriter, WriteTimeout
+
+
+@pytest.fixture
+def writer(tmp_path):
+    path = str(tmp_path / "w.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE t (x INTEGER UNIQUE)")
+    conn.close()
+    return SerializedWriter(path)
+
+
+def insert(conn, x):
+    conn.execute("INSERT INTO t VALUES (?)", (x,))
+    return x
+
+
+def values(writer):
+    return [r[0] for r in sqlite3.connect(writer.path).execute("SELECT x FROM t ORDER BY x")]
+
+
+def test_failing_write_rolls_back_alone(writer):
+    futures = [writer.submit(insert, x) for x in (1, 2, 1, 3)]
+    assert [f.exception() is None for f in futures] == [True, True, False, True]
+    assert isinstance(futures[2].exception(), sqlite3.IntegrityError)
+    assert values(writer) == [1, 2, 3]
+
+
+def test_concurrent_writers_all_commit(writer):
+    threads = [threading.Thread(target=writer.run, args=(insert, x)) for x in range(50)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert values(writer) == list(range(50))
+
+
+def test_connect_failure_fails_the_group_and_recovers(writer, monkeypatch):
+    connect = writer._connect
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise sqlite3.OperationalError("unable to open database file")
+        return connect()
+
+    monkeypatch.setattr(writer, "_connect", flaky)
+    with pytest.raises(sqlite3.OperationalError):
+        writer.run(insert, 1, timeout=5)
+    assert writer.run(insert, 2, timeout=5) == 2
+    assert values(writer) == [2]
+
+
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_dead_thread_is_restarted(writer):
+    class Fatal(BaseException):
+        pass
+
+    def die(conn):
+        raise Fatal()
+
+    writer.run(insert, 1)
+    assert isinstance(writer.submit(die).exception(5), Fatal)
+    writer._thread.join(5)
+    assert not writer._thread.is_alive()
+    assert writer.run(insert, 2, timeout=5) == 2
+
+
+def test_timeout_raises_write_timeout(writer):
+    with pytest.raises(WriteTimeout):
+        writer.run(lambda conn: time.sleep(0.5), timeout=0.05)
+
+
+def test_write_timeout_is_a_503(seeded, monkeypatch):
+    def stuck(fn, *args, **kwargs):
+        raise WriteTimeout("write not committed within 30s")
+
+    monkeypatch.setattr(seeded.db_writer, "run", stuck)
+    client = login(seeded.app.test_client(), "admin", user_id=1)
+    response = client.post("/doctor/toggle/1")
+    assert (response.status_code, response.headers["Retry-After"]) == (503, "2")
+    response = client.post("/doctor/toggle/1", headers={"Accept": "application/json"})
+    assert response.status_code == 503 and response.get_json()["success"] is False
@@ -0,0 +1,94 @@
+from datetime import date, timedelta
+
+from conftest import login
+
+import doctorload
+
+
+def day(offset):
+    return (date.today() + timedelta(days=offset)).isoformat()
+
+
+def connect(hms):
+    conn = hms.get_db_connection()
+    conn.isolation_level = None
+    return conn
+
+
+def open_day(conn, doctor_id, slot_date):
+    conn.execute("INSERT INTO doctor_availability (doctor_id, date, slot, status) VALUES (?, ?, 'morning', 1)",
+                 (doctor_id, slot_date))
+
+
+def load(conn, doctor_id):
+    return dict(conn.execute("SELECT * FROM doctor_load WHERE doctor_id = ?", (doctor_id,)).fetchone())
+
+
+def recommended(hms, **args):
+    client = login(hms.app.test_client(), "patient", user_id=5)
+    return client.get(f"/department/{hms.seed['department']}/recommended", query_string=args)
+
+
+def test_triggers_track_free_days_and_bookings(seeded):
+    conn = connect(seeded)
+    assert load(conn, 1)["next_free_day"] is None
+    open_day(conn, 1, day(3))
+    open_day(conn, 1, day(1))
+    assert doctorload.day_to_date(load(conn, 1)["next_free_day"]) == day(1)
+
+    booking = conn.execute("INSERT INTO appointments (patient_name, patient_id, doctor_id, date, slot, status) "
+                           "VALUES ('pat1', 5, 1, ?, 'morning', 'confirmed')", (day(1),)).lastrowid
+    # Day 1's only slot is now full; day 3 is next.
+    assert doctorload.day_to_date(load(conn, 1)["next_free_day"]) == day(3)
+    assert load(conn, 1)["booked_ahead"] == 1
+
+    conn.execute("UPDATE appointments SET status = 'cancelled' WHERE id = ?", (booking,))
+    assert load(conn, 1)["booked_ahead"] == 0
+    assert doctorload.day_to_date(load(conn, 1)["next_free_day"]) == day(1)
+
+    # Bookings beyond the window don't count.
+    conn.execute("INSERT INTO appointments (patient_name, patient_id, doctor_id, date, slot, status) "
+                 "VALUES ('pat2', 6, 1, ?, 'morning', 'confirmed')", (day(doctorload.LOAD_WINDOW_DAYS),))
+    assert load(conn, 1)["booked_ahead"] == 0
+
+
+def test_holidays_are_skipped(seeded, admin):
+    conn = connect(seeded)
+    open_day(conn, 1, day(1))
+    open_day(conn, 1, day(2))
+    assert admin.post("/admin/schedule/holidays", json={"date": day(1), "doctor_id": 1}).status_code == 201
+    assert doctorload.day_to_date(load(conn, 1)["next_free_day"]) == day(2)
+
+
+def test_recommendation_ranks_by_wait_then_load(seeded):
+    conn = connect(seeded)
+    open_day(conn, 1, day(5))
+    open_day(conn, 2, day(1))
+    open_day(conn, 3, day(1))
+    for _ in range(3):
+        conn.execute("INSERT INTO appointments (patient_name, patient_id, doctor_id, date, slot, status) "
+                     "VALUES ('pat1', 5, 2, ?, 'afternoon', 'confirmed')", (day(2),))
+    # Doctor 3: same wait as 2, lighter load; doctor 1 waits longest.
+    response = recommended(seeded)
+    assert response.status_code == 200
+    doctors = response.get_json()["doctors"]
+    assert [d["doctor_id"] for d in doctors] == [3, 2, 1]
+    assert doctors[0]["next_free_date"] == day(1) and doctors[1]["booked_next_days"] == 3
+    assert [d["doctor_id"] for d in recommended(seeded, limit=1).get_json()["doctors"]] == [3]
+    assert recommended(seeded, limit=0).status_code == 400
+
+
+def test_stale_rows_roll_over_on_first_read(seeded):
+    conn = connect(seeded)
+    open_day(conn, 1, day(1))
+    conn.execute("UPDATE doctor_load SET as_of_day = as_of_day - 3, booked_ahead = 9")
+    recommended(seeded)
+    assert load(conn, 1)["as_of_day"] == doctorload.today_day()
+    assert load(conn, 1)["booked_ahead"] == 0
+
+
+def test_login_and_sqlite_are_required(store):
+    client = store.app.test_client()
+    assert client.get("/department/1/recommended").status_code == 401
+    status = login(client, "patient", user_id=5).get("/department/1/recommended").status_code
+    assert status == (200 if store.repo.backend.name == "sqlite" else 501)
@@ -0,0 +1,74 @@
+import csv
+import io
+import json
+from datetime import date, timedelta
+
+from conftest import login
+
+import archive
+import exports
+
+
+def batches(*chunks):
+    yield from chunks
+
+
+def test_one_chunk_per_batch():
+    chunks = list(exports.jsonl_chunks(("id", "name"), batches([(1, "Zoë")], [(2, None), (3, "x")])))
+    assert chunks == ['{"id":1,"name":"Zoë"}\n', '{"id":2,"name":null}\n{"id":3,"name":"x"}\n']
+
+    chunks = list(exports.csv_chunks(("id", "name"), batches([(1, 'say "hi", ok')], [(2, "b")])))
+    assert len(chunks) == 2
+    assert list(csv.reader(io.StringIO("".join(chunks)))) == [["id", "name"], ["1", 'say "hi", ok'], ["2", "b"]]
+    assert list(exports.csv_chunks(("id",), batches())) == ["id\r\n"]
+
+
+def test_closing_the_body_closes_the_cursor():
+    closed = []
+
+    def source():
+        try:
+            yield [(1,)]
+            yield [(2,)]
+        finally:
+            closed.append(True)
+
+    body = exports.encode("jsonl", ("id",), source())
+    assert next(body) == '{"id":1}\n'
+    body.close()
+    assert closed == [True]
+
+
+def test_export_route(seeded_store):
+    admin = login(seeded_store.app.test_client(), "admin", user_id=1)
+    response = admin.get("/admin/export/users")
+    assert response.mimetype == "application/x-ndjson"
+    assert "attachment; filename=users-" in response.headers["Content-Disposition"]
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [r["username"] for r in rows][:2] == ["admin@123", "doc1"]
+    assert all(set(r) == {"id", "username", "role"} for r in rows)
+
+    response = admin.get("/admin/export/patients?format=csv")
+    assert response.mimetype == "text/csv"
+    assert response.get_data(as_text=True).splitlines()[1] == f"{seeded_store.seed['patients'][0]},pat1,Patient 1,5,1"
+
+    assert admin.get("/admin/export/passwords").status_code == 404
+    assert admin.get("/admin/export/users?format=xml").status_code == 400
+    patient = login(seeded_store.app.test_client(), "patient", user_id=5)
+    assert patient.get("/admin/export/users").status_code == 403
+
+
+def test_history_adds_archived_rows(seeded, admin):
+    conn = seeded.get_db_connection()
+    conn.isolation_level = None
+    old = (date.today() - timedelta(days=400)).isoformat()
+    conn.execute("INSERT INTO appointments (patient_name, patient_id, doctor_id, date, slot, status) "
+                 "VALUES ('pat1', 5, 1, ?, 'morning', 'confirmed')", (old,))
+    archive.run_archival(conn)
+
+    def dates(query):
+        body = admin.get(f"/admin/export/appointments{query}").get_data(as_text=True)
+        return [json.loads(line)["date"] for line in body.splitlines()]
+
+    assert dates("") == []
+    assert dates("?history=1") == [old]
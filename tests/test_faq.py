@@ -0,0 +1,76 @@
+import json
+
+import pytest
+
+from conftest import login
+
+import faq
+
+
+ENTRIES = [
+    {"id": "cold", "questions": ["How do I treat a common cold?", "home remedies for a runny nose"],
+     "answer": "Rest and fluids."},
+    {"id": "hours", "questions": ["What are the visiting hours?", "when can I visit a patient"],
+     "answer": "10am to 8pm."},
+]
+
+
+@pytest.fixture
+def index(tmp_path):
+    path = tmp_path / "faq.json"
+    path.write_text(json.dumps(ENTRIES))
+    return faq.FaqIndex(str(path), threshold=0.7)
+
+
+def test_terms_drop_stopwords_stem_and_pair():
+    assert faq.terms("What are the visiting hours?") == ["visit", "hour", "visit hour"]
+    assert faq.terms("allergies") == ["allergy"]
+
+
+def test_match_scores_phrasings(index):
+    entry, score = index.match("how do i treat a common cold")
+    assert entry["id"] == "cold" and score == pytest.approx(1.0, abs=1e-5)
+    assert index.match("visiting hours")[0]["id"] == "hours"
+    assert index.match("quantum chromodynamics") == (None, 0.0)
+    # Words the index has never seen make a partial match score lower.
+    assert index.match("visiting hours for the cardiology ward")[1] < index.match("visiting hours")[1]
+
+
+def test_answer_counts_hits_and_saved_upstream_time(index):
+    assert index.answer("What are the visiting hours?") == "10am to 8pm."
+    assert index.answer("Can I take ibuprofen with my blood thinner?") is None
+    index.record_upstream(2.0)
+    stats = index.stats()
+    assert (stats["entries"], stats["lookups"], stats["hits"], stats["hit_rate"]) == (2, 2, 1, 0.5)
+    assert stats["upstream_seconds_saved"] == 2.0
+
+    built = index._index
+    index.reset()
+    assert index.stats()["lookups"] == 0 and index._index is built
+
+
+def test_every_shipped_phrasing_finds_its_own_entry():
+    index = faq.FaqIndex()
+    with open(faq.FAQ_PATH, encoding="utf-8") as f:
+        entries = json.load(f)
+    for entry in entries:
+        for question in entry["questions"]:
+            assert index.answer(question) == entry["answer"], question
+
+
+def test_chat_answers_standalone_questions_locally(hms, monkeypatch):
+    calls = []
+    monkeypatch.setattr(hms, "complete", lambda messages, **kw: calls.append(messages) or "from the llm")
+    client = login(hms.app.test_client(), "patient", user_id=5)
+    question = "How do I treat a common cold?"
+
+    response = client.post("/ai/chat", json={"message": question}).get_json()
+    assert response["source"] == "faq" and calls == []
+
+    # A follow-up in a conversation may depend on earlier turns and goes to the LLM.
+    conversation_id = client.post("/ai/conversations", json={}).get_json()["conversation"]["id"]
+    assert client.post("/ai/chat", json={"conversation_id": conversation_id, "message": question}) \
+        .get_json()["source"] == "faq"
+    assert client.post("/ai/chat", json={"conversation_id": conversation_id, "message": question}) \
+        .get_json()["source"] == "llm"
+    assert len(calls) == 1
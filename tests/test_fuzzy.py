@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+import fuzzy
+from conftest import login
+
+
+@pytest.fixture
+def index():
+    index = fuzzy.NameIndex()
+    index.load([(1, "Alice Smith", "pat1"), (2, "Bob Jones", "pat2"), (3, "Alicia Keys", "pat3"),
+                (4, "Alan Alba", "pat4"), (5, "Cardiology", None)])
+    return index
+
+
+def keys(results):
+    return [key for _, key, _, _ in results]
+
+
+def test_short_word_typos_are_found(index):
+    assert keys(index.search("alce")) == [1]
+    [(score, key, _, _)] = index.search("smiht")
+    assert key == 1 and score >= 0.8
+    assert keys(index.search("alice smiht"))[0] == 1
+
+
+def test_trigram_matches_prefixes_and_longer_typos(index):
+    assert keys(index.search("cardiolgy")) == [5]
+    assert keys(index.search("ali"))[:2] == [1, 3]
+    assert index.search("xyz") == []
+
+
+def test_edits_allowed_grow_with_word_length(index):
+    assert [fuzzy.max_edits(w) for w in ("bop", "alce", "smiht", "cardiolgy")] == [0, 1, 1, 2]
+    # Two edits are too many for a five-letter word.
+    assert index.search("smhti") == []
+
+
+def test_edit_distances_count_a_swap_as_one_edit():
+    distances = fuzzy.edit_distances(np, "smiht", ["smith", "smiht", "smyth", "miht", "jones"])
+    assert distances.tolist() == [1, 0, 2, 1, 5]
+
+
+def test_updates_are_searchable(index):
+    index.put(2, "Robert Jones", "pat2")
+    index.remove(1)
+    assert keys(index.search("robret")) == [2]
+    assert 1 not in keys(index.search("alce"))
+
+
+def test_search_route_tolerates_typos(seeded):
+    client = login(seeded.app.test_client(), "admin", user_id=1)
+    response = client.get("/search/suggest?kind=patient&q=Patinet")
+    assert response.status_code == 200
+    assert {s["name"] for s in response.get_json()["suggestions"]} == {"Patient 1", "Patient 2", "Patient 3"}
@@ -0,0 +1,87 @@
+import threading
+import time
+
+import jobs
+
+
+def test_claim_complete_and_result(hms):
+    queue = hms.job_queue
+    job_id = queue.enqueue("noop", {"x": 1})
+    job = queue.claim("w1", 60)
+    assert (job["id"], job["payload"], job["attempts"]) == (job_id, {"x": 1}, 1)
+    assert queue.claim("w2", 60) is None
+    queue.complete(job_id, "w1", {"ok": True})
+    assert queue.get(job_id)["status"] == "done"
+    assert queue.get(job_id)["result"] == {"ok": True}
+
+
+def test_failures_back_off_then_give_up(hms):
+    queue = hms.job_queue
+    job_id = queue.enqueue("noop", max_attempts=2)
+    queue.fail(queue.claim("w", 60)["id"], "w", "boom")
+    job = queue.get(job_id)
+    assert job["status"] == "queued" and job["run_at"] > time.time()
+
+    queue._conn().execute("UPDATE jobs SET run_at = 0 WHERE id = ?", (job_id,))
+    queue.fail(queue.claim("w", 60)["id"], "w", "boom again")
+    assert queue.get(job_id)["status"] == "failed"
+
+
+def test_expired_claim_is_reclaimed(hms):
+    queue = hms.job_queue
+    job_id = queue.enqueue("noop")
+    queue.claim("dead-worker", 60)
+    queue._conn().execute("UPDATE jobs SET locked_until = 0 WHERE id = ?", (job_id,))
+    job = queue.claim("w", 60)
+    assert job["id"] == job_id and job["attempts"] == 2
+    # The old owner can no longer complete it.
+    queue.complete(job_id, "dead-worker")
+    assert queue.get(job_id)["status"] == "running"
+
+
+def test_unique_keeps_one_waiting_copy(hms):
+    first = hms.job_queue.enqueue("recurring", unique=True)
+    assert hms.job_queue.enqueue("recurring", unique=True) == first
+
+
+def test_heartbeat_keeps_a_long_job_claimed(hms, monkeypatch):
+    queue = hms.job_queue
+    runs = []
+
+    def slow(payload):
+        runs.append(1)
+        time.sleep(0.8)
+        return "done"
+
+    monkeypatch.setitem(jobs.handlers, "slow", slow)
+    job_id = queue.enqueue("slow")
+    job = queue.claim("w1", 0.3)
+    stolen = []
+    thief = threading.Thread(target=lambda: [stolen.append(queue.claim("w2", 0.3)) or time.sleep(0.1)
+                                             for _ in range(6)])
+    thief.start()
+    jobs.run_job(queue, job, "w1", visibility_timeout=0.3)
+    thief.join()
+    assert stolen == [None] * 6
+    assert runs == [1]
+    assert queue.get(job_id)["status"] == "done"
+
+
+def test_enqueue_goes_through_the_writer(hms, monkeypatch):
+    calls = []
+    run = hms.db_writer.run
+    monkeypatch.setattr(hms.db_writer, "run", lambda fn, *args, **kw: calls.append(fn) or run(fn, *args, **kw))
+    job_id = hms.job_queue.enqueue("noop")
+    assert calls == [jobs.insert_job]
+    assert hms.job_queue.get(job_id)["kind"] == "noop"
+
+
+def test_enqueue_creates_the_table_on_a_fresh_database(tmp_path):
+    from dbwriter import SerializedWriter
+
+    path = str(tmp_path / "jobs.db")
+    writer = SerializedWriter(path)
+    queue = jobs.JobQueue(path, writer)
+    job_id = queue.enqueue("noop")
+    assert queue.get(job_id)["kind"] == "noop"
+    writer.reset()
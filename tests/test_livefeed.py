@@ -0,0 +1,104 @@
+import queue
+from datetime import date, timedelta
+
+import pytest
+
+from conftest import login
+
+import livefeed
+
+
+DAY = (date.today() + timedelta(days=1)).isoformat()
+
+
+@pytest.fixture
+def broker(seeded):
+    broker = livefeed.ChangeBroker(seeded.DATABASE_NAME, poll_interval=0.02)
+    yield broker
+    broker.reset()
+
+
+def connect(hms):
+    conn = hms.get_db_connection()
+    conn.isolation_level = None
+    return conn
+
+
+def book(conn, doctor_id=1, slot="morning"):
+    return conn.execute("INSERT INTO appointments (patient_name, patient_id, doctor_id, date, slot, status) "
+                        "VALUES ('pat1', 5, ?, ?, ?, 'confirmed')", (doctor_id, DAY, slot)).lastrowid
+
+
+def changes(conn):
+    return [(r["doctor_id"], r["slot"], r["kind"]) for r in conn.execute("SELECT * FROM slot_changes ORDER BY id")]
+
+
+def test_triggers_log_both_ends_of_a_move(seeded):
+    conn = connect(seeded)
+    conn.execute("INSERT INTO doctor_availability (doctor_id, date, slot, status) VALUES (2, ?, 'morning', 1)", (DAY,))
+    booking = book(conn)
+    conn.execute("UPDATE appointments SET doctor_id = 2, slot = 'afternoon' WHERE id = ?", (booking,))
+    logged = changes(conn)
+    assert logged[:2] == [(2, "morning", "availability"), (1, "morning", "booking")]
+    assert sorted(logged[2:]) == [(1, "morning", "booking"), (2, "afternoon", "booking")]
+
+
+def test_subscribers_get_only_their_doctors_changes(seeded, broker):
+    conn = connect(seeded)
+    sub, missed = broker.subscribe(1)
+    assert missed == []
+    book(conn, doctor_id=2)
+    book(conn, doctor_id=1)
+    change = sub.queue.get(timeout=5)
+    assert (change["doctor_id"], change["date"], change["kind"]) == (1, DAY, "booking")
+    with pytest.raises(queue.Empty):
+        sub.queue.get(timeout=0.1)
+    broker.unsubscribe(sub)
+    assert broker.subscriber_count() == 0
+
+
+def test_reconnect_replays_missed_changes_or_resets(seeded, broker):
+    conn = connect(seeded)
+    book(conn)
+    book(conn, slot="afternoon")
+    broker.start()
+    first = conn.execute("SELECT MIN(id) FROM slot_changes").fetchone()[0]
+    _, missed = broker.subscribe(1, last_event_id=first)
+    assert [c["slot"] for c in missed] == ["afternoon"]
+
+    # Trimmed from the log: the client has to reload.
+    conn.execute("DELETE FROM slot_changes WHERE id = ?", (first,))
+    _, missed = broker.subscribe(1, last_event_id=first - 1)
+    assert missed is None
+
+
+def test_stream_resets_a_client_that_fell_behind(broker):
+    sub, _ = broker.subscribe(1)
+    frames = livefeed.stream(broker, sub, None)
+    assert next(frames).startswith("retry:")
+    assert next(frames).startswith("event: reset")
+
+    sub.overflowed = True
+    sub.queue.put({"id": 1})
+    assert next(frames).startswith("event: reset")
+    with pytest.raises(StopIteration):
+        next(frames)
+    assert broker.subscriber_count() == 0
+
+
+def test_events_endpoint(seeded):
+    client = seeded.app.test_client()
+    assert client.get("/doctor/1/events").status_code == 401
+    login(client, "patient", user_id=5)
+    assert client.get("/doctor/99/events").status_code == 404
+
+    book(connect(seeded))
+    response = client.get("/doctor/1/events", headers={"Last-Event-ID": "0"}, buffered=False)
+    assert response.mimetype == "text/event-stream"
+    frames = iter(response.response)
+    next(frames)
+    frame = next(frames)
+    frame = frame.decode() if isinstance(frame, bytes) else frame
+    assert frame.startswith("id: 1\nevent: slot\n")
+    response.close()
+    assert seeded.slot_feed.subscriber_count() == 0
@@ -0,0 +1,87 @@
+import threading
+import time
+from datetime import date, timedelta
+
+from conftest import login
+
+from pagecache import PageCache
+
+
+DAY = (date.today() + timedelta(days=1)).isoformat()
+
+
+def test_entries_live_until_ttl_or_invalidation():
+    cache = PageCache(ttl=60)
+    calls = []
+
+    def render():
+        calls.append(1)
+        return f"page {len(calls)}"
+
+    body, etag = cache.get(("view", 1, DAY, 7), render)
+    assert cache.get(("view", 1, DAY, 7), render) == (body, etag)
+    assert len(calls) == 1
+
+    cache.on_change({"doctor_id": 2})
+    assert cache.get(("view", 1, DAY, 7), render) == (body, etag)
+    cache.on_change({"doctor_id": 1})
+    assert cache.get(("view", 1, DAY, 7), render)[0] == "page 2"
+
+    cache.ttl = 0
+    cache.invalidate(1)
+    assert cache.get(("view", 1, DAY, 7), render)[0] == "page 3"
+    assert cache.get(("view", 1, DAY, 7), render)[0] == "page 4"
+
+
+def test_missing_pages_are_not_cached():
+    cache = PageCache()
+    assert cache.get(("view", 1, DAY, 7), lambda: None) == (None, None)
+    assert cache.stats()["entries"] == 0
+
+
+def test_concurrent_misses_render_once():
+    cache = PageCache()
+    calls = []
+
+    def render():
+        calls.append(1)
+        time.sleep(0.1)
+        return "page"
+
+    threads = [threading.Thread(target=cache.get, args=(("view", 1, DAY, 7), render)) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1 and cache.stats()["hits"] == 4
+
+
+def test_invalidation_while_rendering_leaves_the_entry_stale():
+    cache = PageCache()
+    cache.get(("view", 1, DAY, 7), lambda: cache.invalidate(1) or "old")
+    assert cache.get(("view", 1, DAY, 7), lambda: "new")[0] == "new"
+
+
+def test_doctor_page_etag_and_invalidation(seeded):
+    client = login(seeded.app.test_client(), "patient", user_id=5, username="pat1")
+    first = client.get("/doctorview/1")
+    assert first.status_code == 200 and first.headers["ETag"]
+    assert client.get("/doctorview/1", headers={"If-None-Match": first.headers["ETag"]}).status_code == 304
+
+    # A write from another process reaches this one through the change log.
+    conn = seeded.get_db_connection()
+    conn.execute("INSERT INTO doctor_availability (doctor_id, date, slot, status) VALUES (1, ?, 'morning', 1)", (DAY,))
+    conn.commit()
+    deadline = time.monotonic() + 5
+    while seeded.page_cache.stats()["invalidations"] == 0 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert seeded.page_cache.stats()["invalidations"] == 1
+    # Re-rendered; the ETag follows the body, so an unchanged page is still a 304.
+    assert client.get("/doctorview/1", headers={"If-None-Match": first.headers["ETag"]}).status_code == 304
+    assert seeded.page_cache.stats()["misses"] == 2
+    assert client.get("/doctorview/99").status_code == 302
+
+    invalidations = seeded.page_cache.stats()["invalidations"]
+    response = client.post("/patient/book", json={"doctor_id": 1, "date": DAY, "slot": "morning"})
+    assert response.get_json()["ok"]
+    assert seeded.page_cache.stats()["invalidations"] > invalidations
@@ -0,0 +1,80 @@
+import jobs
+from ratelimit import MAX_KEY_PART, TokenBucketLimiter
+
+
+def test_burst_then_denied_with_retry_after(tmp_path):
+    limiter = TokenBucketLimiter(str(tmp_path / "rl.db"))
+    rules = [("k", 1.0, 3)]
+    assert [limiter.hit(rules, now=100)[0] for _ in range(3)] == [True, True, True]
+    allowed, retry_after = limiter.hit(rules, now=100)
+    assert not allowed and retry_after == 1.0
+    # Refilled a second later.
+    assert limiter.hit(rules, now=101)[0]
+
+
+def test_all_rules_pay_or_none_do(tmp_path):
+    limiter = TokenBucketLimiter(str(tmp_path / "rl.db"))
+    assert limiter.hit([("a", 1.0, 1)], now=0)[0]
+    assert not limiter.hit([("a", 1.0, 1), ("b", 1.0, 1)], now=0)[0]
+    # "b" was not charged by the refused call.
+    assert limiter.hit([("b", 1.0, 1)], now=0)[0]
+
+
+def test_purge_drops_only_idle_buckets(tmp_path):
+    limiter = TokenBucketLimiter(str(tmp_path / "rl.db"))
+    limiter.hit([("old", 1.0, 1)], now=0)
+    limiter.hit([("new", 1.0, 1)], now=5000)
+    assert limiter.purge(idle_seconds=3600, now=5000) == 1
+    keys = [r[0] for r in limiter._conn().execute("SELECT key FROM buckets")]
+    assert keys == ["new"]
+
+
+def test_login_bucket_key_is_normalised_and_capped(hms):
+    client = hms.app.test_client()
+    client.post("/login.html", data={"username": "  Mallory" + "x" * 500, "password": "nope"})
+    client.post("/login.html", data={"username": "mallory" + "x" * 500, "password": "nope"})
+    keys = [r[0] for r in hms.limiter._conn().execute("SELECT key FROM buckets WHERE key LIKE 'login:user:%'")]
+    assert keys == ["login:user:" + ("mallory" + "x" * 500)[:MAX_KEY_PART]]
+
+
+def test_purge_job_reschedules_itself(hms):
+    hms.schedule_limiter_purge(delay=0)
+    job = hms.job_queue.claim("w", 60)
+    assert job["kind"] == "purge_rate_limits"
+    jobs.run_job(hms.job_queue, job, "w")
+    assert hms.job_queue.get(job["id"])["status"] == "done"
+    waiting = hms.job_queue._conn().execute(
+        "SELECT COUNT(*) FROM jobs WHERE kind = 'purge_rate_limits' AND status = 'queued'").fetchone()[0]
+    assert waiting == 1
+
+
+def test_failed_purge_keeps_a_single_chain(hms, monkeypatch):
+    def broken(*args, **kwargs):
+        raise RuntimeError("locked")
+
+    monkeypatch.setattr(hms.limiter, "purge", broken)
+    hms.schedule_limiter_purge(delay=0)
+    job = hms.job_queue.claim("w", 60)
+    jobs.run_job(hms.job_queue, job, "w")
+    assert hms.job_queue.get(job["id"])["status"] == "failed"
+    statuses = [r[0] for r in hms.job_queue._conn().execute(
+        "SELECT status FROM jobs WHERE kind = 'purge_rate_limits' AND id != ?", (job["id"],))]
+    assert statuses == ["queued"]
+
+
+def test_login_and_ai_chat_answer_429_past_the_burst(seeded, monkeypatch):
+    client = seeded.app.test_client()
+    burst = seeded.LOGIN_LIMIT_PER_USER[1]
+    statuses = [client.post("/login.html", data={"username": "pat1", "password": "wrong"}).status_code
+                for _ in range(burst + 1)]
+    assert statuses[-1] == 429 and 429 not in statuses[:-1]
+    # The per-user bucket is spent even for the right password.
+    response = client.post("/login.html", data={"username": "pat1", "password": "test-pw"})
+    assert response.status_code == 429 and int(response.headers["Retry-After"]) >= 1
+
+    monkeypatch.setattr(seeded, "complete", lambda messages, **kw: "ok")
+    with client.session_transaction() as s:
+        s.update(user_role="patient", user_id=5)
+    burst = seeded.AI_LIMIT_PER_USER[1]
+    statuses = [client.post("/ai/chat", json={"message": f"question {i}"}).status_code for i in range(burst + 1)]
+    assert statuses == [200] * burst + [429]
@@ -0,0 +1,52 @@
+import sqlite3
+
+import refcache
+
+
+def add_department(hms, name):
+    return hms.repo.write(lambda tx: hms.repo.departments.create(tx, name, ""))
+
+
+def test_cached_until_its_table_changes(seeded_store):
+    hms = seeded_store
+    reference = hms.reference
+    reference.check_interval = 0
+    doctors = reference.get("doctors")
+    departments = reference.get("departments")
+    assert reference.get("doctors") is doctors
+    assert reference.stats()["hits"] == 1
+
+    add_department(hms, "Neurology")
+    # Only datasets built from the changed table are reloaded.
+    assert reference.get("doctors") is doctors
+    assert [d["name"] for d in reference.get("departments")] == ["Cardiology", "Neurology"]
+    assert reference.get("departments") is not departments
+
+
+def test_writes_from_another_connection_are_seen(seeded):
+    reference = seeded.reference
+    assert len(reference.get("patients")) == 3
+    conn = sqlite3.connect(seeded.DATABASE_NAME)
+    conn.execute("DELETE FROM patients WHERE id = 3")
+    conn.commit()
+    assert len(reference.get("patients")) == 2
+
+
+def test_unchanged_database_skips_the_version_table(seeded):
+    reference = seeded.reference
+    reference.get("doctors")
+    checks = reference.stats()["checks"]
+    for _ in range(5):
+        reference.get("doctors")
+    assert reference.stats()["checks"] == checks
+
+
+def test_unmigrated_database_is_not_cached(tmp_path):
+    path = str(tmp_path / "empty.db")
+    sqlite3.connect(path).close()
+    calls = []
+    backend = type("Backend", (), {"name": "sqlite", "path": path})()
+    reference = refcache.ReferenceCache(backend, {"x": ("departments", lambda: calls.append(1) or len(calls))})
+    assert reference.get("x") == 1
+    assert reference.get("x") == 2
+    assert reference.stats()["cached"] == []
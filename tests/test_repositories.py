@@ -0,0 +1,112 @@
+import threading
+from datetime import date, timedelta
+
+import pytest
+
+import repositories
+from repositories import _pg
+
+
+def test_pg_rewrites_placeholders_only():
+    assert _pg("SELECT * FROM t WHERE a = ? AND b = ?") == "SELECT * FROM t WHERE a = %s AND b = %s"
+    assert _pg("SELECT '?', \"a?\" FROM t WHERE x = ?") == "SELECT '?', \"a?\" FROM t WHERE x = %s"
+    assert _pg("SELECT 'it''s ?' WHERE x = ?") == "SELECT 'it''s ?' WHERE x = %s"
+    assert _pg("SELECT 1 -- why?\nWHERE x = ?") == "SELECT 1 -- why?\nWHERE x = %s"
+    assert _pg("SELECT /* a ? b */ ?") == "SELECT /* a ? b */ %s"
+
+
+def test_pg_escapes_percent():
+    assert _pg("SELECT 10 % 3, ?") == "SELECT 10 %% 3, %s"
+    assert _pg("SELECT * FROM t WHERE name LIKE '%x%' AND y = ?") == \
+        "SELECT * FROM t WHERE name LIKE '%%x%%' AND y = %s"
+    assert _pg("SELECT 1 -- 100%\n") == "SELECT 1 -- 100%%\n"
+
+
+def test_backend_is_picked_from_the_environment(store):
+    assert store.repo.backend.name in ("sqlite", "postgres")
+
+
+def test_literals_with_question_marks_and_percents_round_trip(store):
+    assert store.repo.backend.scalar("SELECT 'why?' AS a") == "why?"
+    assert store.repo.backend.scalar("SELECT '50%' || ? AS a", ("!",)) == "50%!"
+    assert store.repo.backend.scalar("SELECT 7 % ? AS a", (4,)) == 3
+
+
+def test_users_and_duplicate_usernames(store):
+    repo = store.repo
+    user_id = repo.write(lambda tx: repo.users.create(tx, "someone", "hash", "patient"))
+    assert repo.users.by_username("someone")["id"] == user_id
+    with pytest.raises(repositories.IntegrityError):
+        repo.write(lambda tx: repo.users.create(tx, "someone", "hash", "patient"))
+    # The failed transaction left nothing behind.
+    assert repo.users.count() == 2
+
+
+def test_seeded_people_and_search(seeded_store):
+    repo = seeded_store.repo
+    assert [d["name"] for d in repo.doctors.list_summary()] == ["Dr 1", "Dr 2", "Dr 3"]
+    assert repo.departments.id_by_name("Cardiology") == seeded_store.seed["department"]
+    assert sorted(r["name"] for r in repo.patients.search("patient 2")) == ["Patient 2"]
+    assert [r[1] for r in repo.doctors.names([2, 3])] == ["Dr 2", "Dr 3"]
+
+
+def test_selection_blacklist_and_delete(seeded_store):
+    repo = seeded_store.repo
+    today = date.today().isoformat()
+    changed = repo.write(lambda tx: repo.doctors.set_blacklisted_many(tx, repo.doctors.select(ids=[1, 2]), 0))
+    assert sorted(changed) == [1, 2]
+    assert repo.write(lambda tx: repo.doctors.set_blacklisted_many(tx, repo.doctors.select(ids=[1, 2]), 0)) == []
+
+    deleted, counts = repo.write(lambda tx: repo.doctors.delete_many(tx, repo.doctors.select(blacklisted=0), today))
+    assert sorted(deleted) == [1, 2] and counts["users"] == 2
+    assert repo.departments.get(seeded_store.seed["department"])["doctors_registered"] == 0
+
+
+def test_book_move_and_cancel(seeded_store):
+    repo = seeded_store.repo
+    day = (date.today() + timedelta(days=3)).isoformat()
+    slot = repo.schedule.doctor_slots(1)[0]
+    repo.write(lambda tx: repo.availability.upsert_many(tx, [(1, day, slot["session"], 1)]))
+
+    def book(tx):
+        return repo.appointments.book(tx, "pat1", 5, "Dr 1", 1, day, slot["slot"], "Cardiology", "now")
+
+    appointment_id = repo.write(book)
+    assert appointment_id is not None
+    # Same patient, same slot: refused.
+    assert repo.write(book) is None
+    assert repo.write(lambda tx: repo.appointments.cancel(tx, appointment_id)) == appointment_id
+    assert repo.appointments.many([appointment_id])[appointment_id]["status"] == "cancelled"
+
+
+def test_each_thread_reuses_its_read_connection(hms, monkeypatch):
+    connect = repositories.sqlite3.connect
+    opened = []
+    monkeypatch.setattr(repositories.sqlite3, "connect", lambda *a, **kw: opened.append(a) or connect(*a, **kw))
+    backend = hms.repo.backend
+    backend.reset()
+
+    def read():
+        for _ in range(200):
+            assert backend.scalar("SELECT COUNT(*) FROM users") == 1
+
+    threads = [threading.Thread(target=read) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(opened) == 4
+
+
+# doctor_load is SQLite only (doctorload.py).
+def test_recommended_doctors(seeded):
+    rows = seeded.repo.doctors.recommended(seeded.seed["department"])
+    assert {r["id"] for r in rows} <= {1, 2, 3}
+
+
+def test_export_streams_in_id_order(seeded_store):
+    columns, batches = seeded_store.repo.exports.stream("patients")
+    rows = [row for batch in batches for row in batch]
+    assert columns[0] == "id"
+    assert [r[0] for r in rows] == sorted(r[0] for r in rows)
+    assert [r[2] for r in rows] == ["Patient 1", "Patient 2", "Patient 3"]
@@ -0,0 +1,134 @@
+import sqlite3
+from datetime import date, timedelta
+
+import archive
+import jobs
+import rollups
+
+
+def day(offset):
+    return (date.today() + timedelta(days=offset)).isoformat()
+
+
+def connect(hms):
+    conn = hms.get_db_connection()
+    conn.isolation_level = None
+    return conn
+
+
+def open_session(conn, slot_date, doctor_id=1, session="morning"):
+    conn.execute("INSERT INTO doctor_availability (doctor_id, date, slot, status) VALUES (?, ?, ?, 1)",
+                 (doctor_id, slot_date, session))
+
+
+def book(conn, slot_date, doctor_id=1, status="confirmed", created_at=None):
+    return conn.execute("""
+        INSERT INTO appointments (patient_name, patient_id, doctor_id, date, slot, status, created_at)
+        VALUES ('pat1', 5, ?, ?, 'morning', ?, ?)
+    """, (doctor_id, slot_date, status, created_at)).lastrowid
+
+
+def stats(conn, slot_date, doctor_id=1):
+    row = conn.execute("SELECT * FROM doctor_day_stats WHERE doctor_id = ? AND date = ?",
+                       (doctor_id, slot_date)).fetchone()
+    return dict(row) if row else None
+
+
+def test_refresh_rolls_up_doctor_and_department_days(seeded):
+    conn = connect(seeded)
+    target = day(4)
+    open_session(conn, target)
+    open_session(conn, target, doctor_id=2)
+    book(conn, target, created_at=day(0))
+    book(conn, target, status="cancelled", created_at=day(2))
+    book(conn, target, doctor_id=2, created_at=day(1))
+
+    assert rollups.refresh(conn)["days"] == 2
+    doctor = stats(conn, target)
+    assert (doctor["offered"], doctor["booked"], doctor["confirmed"], doctor["cancelled"]) == (1, 2, 1, 1)
+    assert doctor["lead_days_sum"] == 6 and doctor["lead_count"] == 2
+    department = dict(conn.execute("SELECT * FROM department_day_stats WHERE date = ?", (target,)).fetchone())
+    assert (department["offered"], department["booked"], department["confirmed"]) == (2, 3, 2)
+    assert conn.execute("SELECT COUNT(*) FROM rollup_dirty").fetchone()[0] == 0
+
+
+def test_rule_change_updates_upcoming_days_but_not_history(seeded, admin):
+    conn = connect(seeded)
+    past, upcoming = day(-2), day(2)
+    for slot_date in (past, upcoming):
+        open_session(conn, slot_date)
+        book(conn, slot_date, status="cancelled")
+    rollups.refresh(conn)
+    assert stats(conn, past)["offered"] == stats(conn, upcoming)["offered"] == 1
+
+    response = admin.post("/admin/schedule/rules", json={"session": "morning", "start": "08:00", "end": "12:00",
+                                                         "slot_minutes": 60, "capacity": 2})
+    assert response.status_code == 201
+    # A late status change on the past day makes it dirty again.
+    conn.execute("UPDATE appointments SET status = 'no_show' WHERE date = ?", (past,))
+    rollups.refresh(conn)
+    assert stats(conn, upcoming)["offered"] == 8
+    assert stats(conn, past)["offered"] == 1
+    assert stats(conn, past)["no_show"] == 1
+
+
+def test_archived_days_keep_their_capacity(seeded, admin):
+    conn = connect(seeded)
+    old = day(-400)
+    open_session(conn, old)
+    book(conn, old)
+    rollups.refresh(conn)
+    admin.post("/admin/schedule/rules", json={"session": "morning", "start": "08:00", "end": "12:00",
+                                              "slot_minutes": 60, "capacity": 2})
+
+    archive.run_archival(conn)
+    rollups.refresh(conn)
+    assert stats(conn, old)["offered"] == 1 and stats(conn, old)["booked"] == 1
+
+
+def test_rollup_job_is_recurring_and_survives_failures(hms, monkeypatch):
+    hms.schedule_recurring_jobs()
+    kinds = {r[0] for r in hms.job_queue._conn().execute("SELECT kind FROM jobs WHERE status = 'queued'")}
+    assert kinds == {"purge_rate_limits", "archive_old_rows", "refresh_rollups"}
+
+    def broken(conn):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(rollups, "refresh", broken)
+    job_id = hms.job_queue._conn().execute("SELECT id FROM jobs WHERE kind = 'refresh_rollups'").fetchone()[0]
+    hms.job_queue._conn().execute("UPDATE jobs SET priority = 100 WHERE id = ?", (job_id,))
+    job = hms.job_queue.claim("w", 60)
+    assert job["id"] == job_id
+    jobs.run_job(hms.job_queue, job, "w")
+    assert hms.job_queue.get(job_id)["status"] == "failed"
+    statuses = [r[0] for r in hms.job_queue._conn().execute(
+        "SELECT status FROM jobs WHERE kind = 'refresh_rollups' AND id != ?", (job_id,))]
+    assert statuses == ["queued"]
+
+
+def test_utilisation_report(seeded, admin):
+    conn = connect(seeded)
+    target = day(-1)
+    open_session(conn, target)
+    open_session(conn, target, doctor_id=2)
+    book(conn, target, created_at=day(-3))
+    book(conn, target, status="cancelled", created_at=day(-2))
+    assert admin.get("/admin/reports/utilisation").get_json()["pending_days"] == 2
+    rollups.refresh(conn)
+
+    body = admin.get("/admin/reports/utilisation").get_json()
+    assert body["pending_days"] == 0
+    [row] = body["rows"]
+    assert (row["date"], row["department"], row["offered"], row["confirmed"]) == (target, "Cardiology", 2, 1)
+    assert (row["utilisation"], row["cancel_rate"], row["avg_lead_days"]) == (0.5, 0.5, 1.5)
+
+    rows = admin.get("/admin/reports/utilisation", query_string={"group": "doctor", "doctor_id": 2}).get_json()["rows"]
+    assert [(r["doctor_id"], r["offered"], r["booked"], r["utilisation"]) for r in rows] == [(2, 1, 0, 0.0)]
+    assert rows[0]["cancel_rate"] is None
+
+    csv_body = admin.get("/admin/reports/utilisation", query_string={"format": "csv"}).get_data(as_text=True)
+    assert csv_body.splitlines()[0].startswith("date,department_id,department,offered")
+
+    for args in ({"group": "ward"}, {"start": "soon"}, {"start": day(1), "end": day(0)},
+                 {"start": day(-800), "end": day(0)}):
+        assert admin.get("/admin/reports/utilisation", query_string=args).status_code == 400
@@ -0,0 +1,97 @@
+from datetime import date, timedelta
+
+from conftest import login
+
+import schedule
+
+
+def day(offset):
+    return (date.today() + timedelta(days=offset)).isoformat()
+
+
+def book(hms, slot_date, slot="morning", doctor_id=1, status="confirmed"):
+    conn = hms.get_db_connection()
+    conn.execute("INSERT INTO appointments (patient_name, patient_id, doctor_id, date, slot, status) "
+                 "VALUES ('pat1', 5, ?, ?, ?, ?)", (doctor_id, slot_date, slot, status))
+    conn.commit()
+
+
+def slot_keys(hms, doctor_id=1):
+    return [s["slot"] for s in hms.repo.schedule.doctor_slots(doctor_id)]
+
+
+HOURLY_MORNING = {"session": "morning", "start": "08:00", "end": "12:00", "slot_minutes": 60}
+
+
+def test_cut_session_skips_breaks():
+    breaks = [{"start_time": "10:00", "end_time": "10:30"}]
+    slots = schedule.cut_session("morning", "09:00", "12:00", 30, 2, breaks)
+    assert [s["slot"] for s in slots] == ["09:00", "09:30", "10:30", "11:00", "11:30"]
+    assert schedule.cut_session("morning", "09:00", "12:00", 180, 1, breaks)[0]["slot"] == "morning"
+    assert schedule.cut_session("morning", "09:00", "12:00", 30, 0, breaks) == []
+
+
+def test_doctor_rule_beats_department_and_default():
+    rules = [
+        {"session": "morning", "start_time": "08:00", "end_time": "12:00", "slot_minutes": 240, "capacity": 1,
+         "department_id": None, "doctor_id": None},
+        {"session": "morning", "start_time": "09:00", "end_time": "11:00", "slot_minutes": 60, "capacity": 3,
+         "department_id": 4, "doctor_id": None},
+        {"session": "morning", "start_time": "09:00", "end_time": "10:00", "slot_minutes": 30, "capacity": 1,
+         "department_id": None, "doctor_id": 7},
+    ]
+    assert [s["slot"] for s in schedule.doctor_day({"id": 7, "department_id": 4}, rules, [])] == ["09:00", "09:30"]
+    assert [s["capacity"] for s in schedule.doctor_day({"id": 8, "department_id": 4}, rules, [])] == [3, 3]
+    assert [s["slot"] for s in schedule.doctor_day({"id": 9, "department_id": 5}, rules, [])] == ["morning"]
+
+
+def test_rule_change_that_orphans_bookings_is_refused(seeded, admin):
+    book(seeded, day(3))
+    rules = len(seeded.repo.schedule.rules())
+
+    response = admin.post("/admin/schedule/rules", json={**HOURLY_MORNING, "doctor_id": 1})
+    assert response.status_code == 400
+    assert "1 confirmed appointment(s)" in response.get_json()["error"]
+    # Rolled back: neither the rule nor the new slots were kept.
+    assert len(seeded.repo.schedule.rules()) == rules
+    assert slot_keys(seeded) == ["morning", "afternoon"]
+
+    # Other doctors are unaffected by doctor 1's booking.
+    assert admin.post("/admin/schedule/rules", json={**HOURLY_MORNING, "doctor_id": 2}).status_code == 201
+    assert slot_keys(seeded, 2) == ["08:00", "09:00", "10:00", "11:00", "afternoon"]
+
+
+def test_past_and_cancelled_bookings_do_not_block(seeded, admin):
+    book(seeded, day(-3))
+    book(seeded, day(3), status="cancelled")
+    assert admin.post("/admin/schedule/rules", json=HOURLY_MORNING).status_code == 201
+    assert slot_keys(seeded) == ["08:00", "09:00", "10:00", "11:00", "afternoon"]
+
+
+def test_deleting_a_rule_is_checked_too(seeded, admin):
+    book(seeded, day(1), slot="afternoon", doctor_id=2)
+    afternoon = next(r["id"] for r in seeded.repo.schedule.rules() if r["session"] == "afternoon")
+    response = admin.delete(f"/admin/schedule/rules/{afternoon}")
+    assert response.status_code == 400
+    assert "doctor 2 slot afternoon" in response.get_json()["error"]
+    assert "afternoon" in slot_keys(seeded, 2)
+
+
+def test_departments_with_different_slot_lengths(seeded_store):
+    hms = seeded_store
+    admin = login(hms.app.test_client(), "admin", user_id=1)
+
+    def add_doctor(tx, minutes):
+        department = hms.repo.departments.create(tx, f"{minutes}-minute clinic", "")
+        user = hms.repo.users.create(tx, f"doc{minutes}", "hash", "doctor")
+        return department, hms.repo.doctors.create(tx, f"doc{minutes}", f"Dr {minutes}", user, "", 1, department)
+
+    for minutes in (10, 15, 20):
+        department, doctor_id = hms.repo.write(add_doctor, minutes)
+        for session, start, end in (("morning", "08:00", "12:00"), ("afternoon", "12:00", "16:00")):
+            response = admin.post("/admin/schedule/rules", json={"department_id": department, "session": session,
+                                                                 "start": start, "end": end, "slot_minutes": minutes})
+            assert response.status_code == 201
+        assert len(slot_keys(hms, doctor_id)) == 8 * 60 // minutes
+    # The seeded department keeps its two sessions.
+    assert slot_keys(hms) == ["morning", "afternoon"]
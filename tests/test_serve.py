@@ -0,0 +1,71 @@
+import importlib.util
+import os
+import runpy
+import signal
+import subprocess
+import sys
+
+import pytest
+
+import serve
+
+
+def print_config(*args, **env):
+    out = subprocess.run([sys.executable, serve.__file__, "--print-config", *args], capture_output=True, text=True,
+                         env={**os.environ, **env})
+    return out.returncode, dict(line.split(None, 1) for line in out.stdout.splitlines()), out.stderr
+
+
+def test_presets_resolve_to_gunicorn_settings():
+    code, settings, _ = print_config("--preset", "sync", "--workers", "3", "--bind", "127.0.0.1:9000", "--no-preload")
+    assert code == 0
+    assert (settings["worker_class"], settings["workers"], settings["threads"]) == ("sync", "3", "1")
+    assert (settings["bind"], settings["preload_app"]) == ("127.0.0.1:9000", "False")
+
+    code, settings, _ = print_config("--preset", "gthread", GUNICORN_WORKER_CLASS="sync")
+    assert (settings["worker_class"], settings["threads"], settings["preload_app"]) == ("sync", "8", "True")
+
+
+@pytest.mark.skipif(importlib.util.find_spec("gevent") is not None, reason="gevent is installed")
+def test_async_preset_without_gevent_is_a_clear_error():
+    code, _, err = print_config("--preset", "async")
+    assert code != 0 and "preset async" in err
+
+
+def test_reload_and_upgrade_signal_the_master(tmp_path, monkeypatch):
+    pidfile = tmp_path / "gunicorn.pid"
+    pidfile.write_text("100\n")
+    sent = []
+
+    def kill(pid, sig):
+        sent.append((pid, sig))
+        if sig == signal.SIGUSR2:
+            pidfile.write_text("200\n")
+
+    monkeypatch.setattr(serve.os, "kill", kill)
+    monkeypatch.setattr(serve.time, "sleep", lambda s: None)
+    serve.reload_workers(str(pidfile))
+    serve.upgrade(str(pidfile))
+    assert sent == [(100, signal.SIGHUP), (100, signal.SIGUSR2), (100, signal.SIGTERM)]
+
+    with pytest.raises(SystemExit, match="No running server"):
+        serve.reload_workers(str(tmp_path / "missing.pid"))
+
+
+def test_failed_upgrade_leaves_the_old_master_running(tmp_path, monkeypatch):
+    pidfile = tmp_path / "gunicorn.pid"
+    pidfile.write_text("100\n")
+    sent = []
+    monkeypatch.setattr(serve.os, "kill", lambda pid, sig: sent.append(sig))
+    with pytest.raises(SystemExit, match="keeps serving"):
+        serve.upgrade(str(pidfile), timeout=0)
+    assert sent == [signal.SIGUSR2]
+
+
+def test_post_fork_sizes_admission_to_the_worker(hms, monkeypatch):
+    monkeypatch.delenv("ADMISSION_CAPACITY", raising=False)
+    monkeypatch.setenv("GUNICORN_THREADS", "5")
+    monkeypatch.setattr(hms.admission_control, "capacity", 1)
+    config = runpy.run_path(serve.CONFIG)
+    config["post_fork"](None, None)
+    assert hms.admission_control.capacity == 5
@@ -0,0 +1,160 @@
+from datetime import date, timedelta
+
+import numpy as np
+
+import slotmaps
+
+
+def bits(hms, doctor_id=1):
+    return {r["slot"]: r["bit"] for r in hms.repo.backend.all("SELECT slot, bit FROM doctor_slots WHERE doctor_id = ?",
+                                                              (doctor_id,))}
+
+
+def bitmap(hms, doctor_id, day):
+    offset = date.fromisoformat(day).toordinal() - date(1970, 1, 1).toordinal()
+    return hms.repo.backend.one("SELECT available_mask, full_mask FROM day_bitmaps WHERE doctor_id = ? AND day = ?",
+                                (doctor_id, offset))
+
+
+def add_rule(admin, **rule):
+    return admin.post("/admin/schedule/rules", json=rule)
+
+
+def test_availability_and_bookings_set_bits(seeded):
+    day = (date.today() + timedelta(days=2)).isoformat()
+    conn = seeded.get_db_connection()
+    conn.execute("INSERT INTO doctor_availability (doctor_id, date, slot, status) VALUES (1, ?, 'morning', 1)", (day,))
+    conn.execute("INSERT INTO appointments (patient_name, patient_id, doctor_id, date, slot, status) "
+                 "VALUES ('pat1', 5, 1, ?, 'morning', 'confirmed')", (day,))
+    conn.commit()
+    morning = 1 << bits(seeded, 1)["morning"]
+    assert bitmap(seeded, 1, day) == {"available_mask": morning, "full_mask": morning}
+
+
+def test_rule_change_keeps_bits_and_clears_reused_ones_from_past_days(seeded, admin):
+    past = (date.today() - timedelta(days=5)).isoformat()
+    conn = seeded.get_db_connection()
+    conn.executemany("INSERT INTO doctor_availability (doctor_id, date, slot, status) VALUES (1, ?, ?, 1)",
+                     [(past, "morning"), (past, "afternoon")])
+    conn.commit()
+    before = bits(seeded)
+
+    # "morning" becomes four hour-long slots; one of them takes over its bit.
+    assert add_rule(admin, session="morning", start="08:00", end="12:00", slot_minutes=60).status_code == 201
+    after = bits(seeded)
+    assert after["afternoon"] == before["afternoon"]
+    assert sorted(after.values()) == list(range(5))
+    # The past day still shows its afternoon, and no hourly slot inherits the old morning.
+    assert bitmap(seeded, 1, past) == {"available_mask": 1 << after["afternoon"], "full_mask": 0}
+
+
+def test_slot_lengths_per_department(seeded, admin):
+    def add_doctor(tx, minutes):
+        department = seeded.repo.departments.create(tx, f"{minutes}-minute clinic", "")
+        user = seeded.repo.users.create(tx, f"doc{minutes}", "hash", "doctor")
+        return seeded.repo.doctors.create(tx, f"doc{minutes}", f"Dr {minutes}", user, "", 1, department)
+
+    def set_slots(doctor_id, minutes, sessions=(("morning", "08:00", "12:00"),)):
+        department = seeded.repo.doctors.get(doctor_id)["department_id"]
+        for session, start, end in sessions:
+            assert add_rule(admin, department_id=department, session=session, start=start, end=end,
+                            slot_minutes=minutes).status_code == 201
+
+    doctors = {minutes: seeded.repo.write(add_doctor, minutes) for minutes in (5, 10, 15, 20)}
+    set_slots(doctors[5], 5)
+    for minutes in (10, 15, 20):
+        set_slots(doctors[minutes], minutes, (("morning", "08:00", "12:00"), ("afternoon", "12:00", "16:00")))
+    assert [len(bits(seeded, doctors[m])) for m in (5, 10, 15, 20)] == [49, 48, 32, 24]
+
+    # Five-minute slots become ten-minute ones: the start times they share keep their bits.
+    five = bits(seeded, doctors[5])
+    set_slots(doctors[5], 10)
+    assert all(five[key] == bit for key, bit in bits(seeded, doctors[5]).items())
+
+    # One response covers every slot key of the four doctors, more than fit one 64-bit word.
+    day = (date.today() + timedelta(days=1)).isoformat()
+    conn = seeded.get_db_connection()
+    conn.executemany("INSERT INTO doctor_availability (doctor_id, date, slot, status) VALUES (?, ?, ?, 1)",
+                     [(doctors[5], day, "morning")] +
+                     [(doctors[m], day, session) for m in (10, 15, 20) for session in ("morning", "afternoon")])
+    conn.commit()
+    body = admin.get("/availability/range", query_string={"doctor_id": ",".join(map(str, doctors.values())),
+                                                          "start": day, "days": 1}).get_json()
+    assert len(body["slots"]) == 48 + 16 + 1  # ten-minute starts, the other quarter hours, "afternoon"
+    assert body["hex_digits_per_day"] == 17
+    for minutes, end in ((5, 12), (10, 16), (15, 16), (20, 16)):
+        result = next(d for d in body["doctors"] if d["doctor_id"] == doctors[minutes])
+        free = int(result["free"], 16)
+        step = max(minutes, 10)
+        assert {key for j, key in enumerate(body["slots"]) if free >> j & 1} == \
+            {f"{m // 60:02d}:{m % 60:02d}" for m in range(8 * 60, end * 60, step)}
+
+
+def test_too_many_slots_for_one_day_is_a_clear_error(seeded, admin):
+    response = add_rule(admin, session="day", start="00:00", end="24:00", slot_minutes=15)
+    assert response.status_code == 400
+    assert "at most 63 fit a day bitmap" in response.get_json()["error"]
+    # Nothing was rebuilt.
+    assert set(bits(seeded)) == {"morning", "afternoon"}
+
+
+def test_assign_bits():
+    assert slotmaps.assign_bits(1, {}, ["a", "b"]) == ({"a": 0, "b": 1}, 0b11)
+    # "b" keeps bit 1; "c" takes the lowest bit left, which "a" used to mean.
+    assert slotmaps.assign_bits(1, {"a": 0, "b": 1}, ["b", "c"]) == ({"b": 1, "c": 0}, 0b1)
+    # Rows migrated without bits all hold 0.
+    assert slotmaps.assign_bits(1, {"a": 0, "b": 0}, ["a", "b"]) == ({"a": 0, "b": 1}, 0b10)
+    keys = [f"k{i:02d}" for i in range(slotmaps.MAX_SLOTS)]
+    assert sorted(slotmaps.assign_bits(1, {}, keys)[0].values()) == list(range(slotmaps.MAX_SLOTS))
+
+
+def test_summarize_compacts_to_the_requested_slots():
+    start = "2026-01-05"
+    rows = [(7, 0, 0b101, 0b001), (7, 2, 0b100, 0), (8, 1, 0b1, 0)]
+    results = slotmaps.summarize([7, 8], start, 3, ["a", "c"], {7: {"a": 0, "c": 2}, 8: {"c": 0}}, rows, detail=True)
+    assert [r["free"] for r in results] == ["202", "020"]
+    assert results[0]["available"] == "302"
+    assert results[0]["total_free"] == 2
+    assert results[0]["first_free_date"] == start
+    assert results[0]["free_per_day"] == [1, 0, 1]
+    assert slotmaps.popcount(np.array([0b1011], dtype=np.uint64)).tolist() == [3]
+
+
+def test_summarize_past_64_slots():
+    keys = [f"k{i}" for i in range(70)]
+    rows = [(1, 0, 1 << 62, 0), (2, 0, 1, 0)]
+    doctor_bits = {1: {k: i for i, k in enumerate(keys[:63])}, 2: {"k69": 0}}
+    first, second = slotmaps.summarize([1, 2], "2026-01-05", 1, keys, doctor_bits, rows)
+    assert first["free"] == f"{1 << 62:018x}"
+    assert second["free"] == f"{1 << 69:018x}"
+    assert (first["total_free"], second["total_free"]) == (1, 1)
+
+
+def test_range_endpoint(seeded, admin):
+    today = date.today()
+    day = [(today + timedelta(days=i)).isoformat() for i in range(3)]
+    conn = seeded.get_db_connection()
+    conn.executemany("INSERT INTO doctor_availability (doctor_id, date, slot, status) VALUES (?, ?, ?, 1)",
+                     [(1, day[1], "morning"), (1, day[2], "afternoon"), (2, day[1], "morning")])
+    conn.execute("INSERT INTO appointments (patient_name, patient_id, doctor_id, date, slot, status) "
+                 "VALUES ('pat1', 5, 2, ?, 'morning', 'confirmed')", (day[1],))
+    conn.execute("INSERT INTO holidays (doctor_id, date) VALUES (1, ?)", (day[2],))
+    conn.commit()
+
+    body = admin.get("/availability/range", query_string={"doctor_id": "1,2", "days": 3, "detail": "1"}).get_json()
+    assert (body["start"], body["end"], body["hex_digits_per_day"]) == (day[0], day[2], 1)
+    morning = 1 << body["slots"].index("morning")
+    doctor1, doctor2 = body["doctors"]
+    assert doctor1["free"] == f"0{morning:x}0" and doctor1["first_free_date"] == day[1]
+    assert doctor2["free"] == "000" and doctor2["total_free"] == 0
+    assert doctor2["available"] == f"0{morning:x}0"
+
+    by_department = admin.get("/availability/range", query_string={"department_id": seeded.seed["department"],
+                                                                   "end": day[2]}).get_json()
+    assert [d["name"] for d in by_department["doctors"]] == ["Dr 1", "Dr 2", "Dr 3"]
+    assert by_department["days"] == 3
+
+    for args in ({"doctor_id": "x"}, {"doctor_id": 1, "days": 0}, {"doctor_id": 1, "start": "soon"}):
+        assert admin.get("/availability/range", query_string=args).status_code == 400
+    assert admin.get("/availability/range", query_string={"doctor_id": 99}).status_code == 404
+    assert seeded.app.test_client().get("/availability/range").status_code == 401
@@ -0,0 +1,86 @@
+from datetime import date
+
+import pytest
+
+from conftest import login
+
+
+@pytest.fixture
+def appointments(seeded_store):
+    """Doctor 1: pat1 twice and pat2 once; doctor 2: pat1; one cancelled with doctor 1."""
+    rows = [("pat1", 5, 1, "confirmed"), ("pat1", 5, 1, "confirmed"), ("pat2", 6, 1, "confirmed"),
+            ("pat1", 5, 2, "confirmed"), ("pat3", 7, 1, "cancelled")]
+
+    def insert(tx):
+        return [tx.scalar("INSERT INTO appointments (patient_name, patient_id, doctor_id, date, slot, status) "
+                          "VALUES (?, ?, ?, ?, 'morning', ?) RETURNING id", (p, pid, d, date.today().isoformat(), s))
+                for p, pid, d, s in rows]
+
+    return seeded_store.repo.write(insert)
+
+
+@pytest.fixture
+def doctor(seeded_store):
+    return login(seeded_store.app.test_client(), "doctor", user_id=2, doctor_name="Dr 1", doctor_id=1)
+
+
+def numbers(hms):
+    return sorted((r["patient_name"], r["visit_no"]) for r in hms.repo.backend.all(
+        "SELECT patient_name, visit_no FROM visits"))
+
+
+def test_one_visit_per_appointment_numbered_per_patient(seeded_store, appointments, doctor):
+    response = doctor.post("/doctor/visits", json={"appointment_id": appointments[0], "diagnosis": "Flu"})
+    assert response.status_code == 201
+    assert response.get_json()["visit_no"] == 1
+    assert doctor.post("/doctor/visits", json={"appointment_id": appointments[1]}).get_json()["visit_no"] == 2
+    assert doctor.post("/doctor/visits", json={"appointment_id": appointments[2]}).get_json()["visit_no"] == 1
+
+    assert doctor.post("/doctor/visits", json={"appointment_id": appointments[0]}).status_code == 409
+    assert numbers(seeded_store) == [("pat1", 1), ("pat1", 2), ("pat2", 1)]
+
+
+def test_batch_reserves_numbers_in_request_order(seeded_store, appointments, doctor):
+    response = doctor.post("/doctor/visits/batch", json={"visits": [
+        {"appointment_id": appointments[2]}, {"appointment_id": appointments[1]}, {"appointment_id": appointments[0]}]})
+    assert response.status_code == 201
+    assert [(v["patient"], v["visit_no"]) for v in response.get_json()["visits"]] == \
+        [("pat2", 1), ("pat1", 1), ("pat1", 2)]
+
+
+def test_one_bad_visit_rejects_the_batch(seeded_store, appointments, doctor):
+    response = doctor.post("/doctor/visits/batch", json={"visits": [
+        {"appointment_id": appointments[0]}, {"appointment_id": appointments[4]}]})
+    assert response.status_code == 409
+    assert response.get_json()["index"] == 1
+    assert numbers(seeded_store) == []
+    # The rolled-back batch did not use up pat1's number.
+    assert doctor.post("/doctor/visits", json={"appointment_id": appointments[0]}).get_json()["visit_no"] == 1
+
+
+def test_who_may_record(seeded_store, appointments, doctor, admin):
+    response = doctor.post("/doctor/visits", json={"appointment_id": appointments[3]})
+    assert (response.status_code, response.get_json()["error"]) == (403, "not_your_appointment")
+    assert doctor.post("/doctor/visits", json={"appointment_id": 12345}).status_code == 404
+    patient = login(seeded_store.app.test_client(), "patient", user_id=5)
+    assert patient.post("/doctor/visits", json={"appointment_id": appointments[3]}).status_code == 403
+
+    assert admin.post("/doctor/visits", json={"appointment_id": appointments[3]}).status_code == 201
+
+
+def test_bad_batches(appointments, doctor):
+    assert doctor.post("/doctor/visits/batch", json={"visits": []}).status_code == 400
+    assert doctor.post("/doctor/visits/batch", json={"visits": [
+        {"appointment_id": appointments[0]}, {"appointment_id": appointments[0]}]}).status_code == 400
+    assert doctor.post("/doctor/visits", json={"appointment_id": appointments[0], "diagnosis": 3}).status_code == 400
+
+
+def test_migration_tops_counters_up_from_existing_visits(seeded_store, appointments, doctor):
+    if seeded_store.repo.backend.name != "sqlite":
+        pytest.skip("SQLite migration")
+    conn = seeded_store.get_db_connection()
+    conn.execute("INSERT INTO visits (patient_name, visit_no) VALUES ('pat1', 7)")
+    conn.execute("PRAGMA user_version = 1")
+    conn.commit()
+    seeded_store.init_db()
+    assert doctor.post("/doctor/visits", json={"appointment_id": appointments[0]}).get_json()["visit_no"] == 8
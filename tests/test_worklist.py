@@ -0,0 +1,72 @@
+from datetime import date, timedelta
+
+from conftest import login
+
+
+def day(offset):
+    return (date.today() + timedelta(days=offset)).isoformat()
+
+
+def add_appointments(hms, rows):
+    hms.repo.write(lambda tx: tx.executemany(
+        "INSERT INTO appointments (patient_name, patient_id, doctor_name, doctor_id, date, slot, status) "
+        "VALUES (?, 5, ?, ?, ?, ?, 'confirmed')", rows))
+
+
+def keys(data):
+    return [(r["date"], r["slot"]) for r in data["appointments"]]
+
+
+def test_upcoming_pages_follow_the_cursor(seeded_store, monkeypatch):
+    hms = seeded_store
+    monkeypatch.setattr(hms, "WORKLIST_PAGE_SIZE", 2)
+    add_appointments(hms, [
+        ("pat1", "Dr 1", 1, day(-1), "morning"),
+        ("pat1", "Dr 1", 1, day(0), "afternoon"),
+        ("pat2", "Dr 1", 1, day(0), "morning"),
+        ("pat3", "Dr 1", 1, day(2), "morning"),
+        ("pat1", "Dr 2", 2, day(1), "morning"),
+    ])
+    first = hms.fetch_doctor_dashboard_data(1, "Dr 1")
+    assert keys(first) == [(day(0), "afternoon"), (day(0), "morning")]
+    assert first["total_upcoming"] == 3
+    assert set(first["patients"]) == {"pat1", "pat2"}
+    assert first["patients"]["pat2"]["visits"] == 0
+
+    second = hms.fetch_doctor_dashboard_data(1, "Dr 1", after=hms.parse_worklist_cursor(first["next_cursor"]))
+    assert keys(second) == [(day(2), "morning")]
+    assert second["next_cursor"] is None
+
+
+def test_paging_back_is_newest_first(seeded_store, monkeypatch):
+    hms = seeded_store
+    monkeypatch.setattr(hms, "WORKLIST_PAGE_SIZE", 2)
+    add_appointments(hms, [("pat1", "Dr 1", 1, day(-d), "morning") for d in (0, 1, 2, 3)])
+    before = hms.parse_worklist_cursor(hms.fetch_doctor_dashboard_data(1, "Dr 1")["earlier_cursor"])
+    page = hms.fetch_doctor_dashboard_data(1, "Dr 1", before=before)
+    assert page["view"] == "past"
+    assert keys(page) == [(day(-1), "morning"), (day(-2), "morning")]
+    page = hms.fetch_doctor_dashboard_data(1, "Dr 1", before=hms.parse_worklist_cursor(page["next_cursor"]))
+    assert keys(page) == [(day(-3), "morning")]
+
+
+def test_bad_cursors_are_ignored():
+    import app
+
+    assert app.parse_worklist_cursor("2026-01-05,morning,7") == ("2026-01-05", "morning", 7)
+    assert app.parse_worklist_cursor("2026-13-05,morning,7") is None
+    assert app.parse_worklist_cursor("x") is None
+    assert app.parse_worklist_cursor(None) is None
+
+
+def test_doctor_pages_render_the_worklist(seeded):
+    add_appointments(seeded, [("pat2", "Dr 1", 1, day(1), "morning")])
+    # An old session without doctor_id still works.
+    client = login(seeded.app.test_client(), "doctor", user_id=2, doctor_name="Dr 1")
+    for path in ("/doctorhome.html", "/doctorassigned.html", "/doctorhome.html?after=junk",
+                 f"/doctorhome.html?before={day(0)},,0"):
+        response = client.get(path)
+        assert response.status_code == 200, path
+    assert b"Patient 2" in client.get("/doctorhome.html").data
+    with client.session_transaction() as s:
+        assert s["doctor_id"] == 1